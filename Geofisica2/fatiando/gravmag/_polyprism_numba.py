@@ -0,0 +1,448 @@
+"""
+A numba implementation of the gravity and magnetic fields of polygonal prisms.
+
+These functions are used by fatiando.gravmag.polyprism as a backend and are
+not meant to be used directly. The model is packed into flat arrays: the x
+and y coordinates of the vertices of all prisms (one after the other), the
+offsets of the first vertex of each prism (with one extra element at the
+end), the top and bottom of each prism, and their physical property.
+
+The formulas are the same as the original numpy code (including the *dummy*
+values used to avoid divisions by zero and log(0)). Each function below
+calculates the contribution of a single edge (from vertex (X1, Y1) to
+(X2, Y2), relative to the computation point) of the prism between Z1 and
+Z2. The magnetic fields need all six second derivatives of the kernel, so
+they use ``tensor_edge`` to calculate them together while sharing the
+geometry of the edge. The loop over the computation points doesn't allocate
+any temporary arrays and releases the GIL so that fatiando.gravmag.polyprism
+can run it on parts of the points in parallel threads. The compiled functions
+are cached on disk so that they are only compiled the first time they are
+used.
+
+A few doctests for the numba code::
+
+>>> import numpy as np
+>>> xp, yp, zp = np.zeros(1), np.zeros(1), np.zeros(1)
+>>> x = np.array([-10., 10., 10., -10.])
+>>> y = np.array([-10., -10., 10., 10.])
+>>> offsets = np.array([0, 4])
+>>> z1, z2, props = np.array([10.]), np.array([20.]), np.ones(1)
+>>> res = np.zeros(1)
+>>> engine(GZZ, xp, yp, zp, x, y, offsets, z1, z2, props, res)
+>>> # The two halves of the prism add up to the whole
+>>> halves = np.zeros(1)
+>>> engine(GZZ, xp, yp, zp, np.tile(x, 2), np.tile(y, 2),
+...        np.array([0, 4, 8]), np.array([10., 15.]), np.array([15., 20.]),
+...        np.ones(2), halves)
+>>> bool(np.allclose(res, halves))
+True
+>>> # The fused tensor is the same as the individual kernels
+>>> X1, Y1, X2, Y2, Z1, Z2 = -3., 2., 5., 4., 1., 7.
+>>> R = [np.sqrt(X**2 + Y**2 + Z**2) for X, Y in [(X1, Y1), (X2, Y2)]
+...      for Z in [Z1, Z2]]
+>>> tensor = tensor_edge(X1, Y1, X2, Y2, Z1, Z2, *R)
+>>> kernels = [k(X1, Y1, X2, Y2, Z1, Z2) for k in [kernelxx, kernelxy,
+...            kernelxz, kernelyy, kernelyz, kernelzz]]
+>>> bool(np.allclose(tensor, kernels, rtol=1e-14, atol=0))
+True
+
+"""
+from __future__ import division, absolute_import
+import numba
+import numpy as np
+
+# Codes used to select which field the generic loops below will calculate
+GZ = 0
+GXX = 1
+GXY = 2
+GXZ = 3
+GYY = 4
+GYZ = 5
+GZZ = 6
+
+# Map the field names to the codes used in the compiled loops
+FIELD_CODES = {'gz': GZ, 'gxx': GXX, 'gxy': GXY, 'gxz': GXZ, 'gyy': GYY,
+               'gyz': GYZ, 'gzz': GZZ}
+
+# Used to avoid divisions by zero and log(0)
+DUMMY = 1e-10
+
+
+@numba.jit(nopython=True, cache=True, error_model='numpy')
+def kernelz(X1, Y1, X2, Y2, Z1, Z2):
+    "The z derivative of the kernel (for gz)"
+    dummy = DUMMY
+    Z1_sqr = Z1**2
+    Z2_sqr = Z2**2
+    p = X1*Y2 - X2*Y1
+    p_sqr = p**2
+    Qk1 = (Y2 - Y1)*Y1 + (X2 - X1)*X1
+    Qk2 = (Y2 - Y1)*Y2 + (X2 - X1)*X2
+    Ak1 = X1**2 + Y1**2
+    Ak2 = X2**2 + Y2**2
+    R1k1 = np.sqrt(Ak1 + Z1_sqr)
+    R1k2 = np.sqrt(Ak2 + Z1_sqr)
+    R2k1 = np.sqrt(Ak1 + Z2_sqr)
+    R2k2 = np.sqrt(Ak2 + Z2_sqr)
+    Ak1 = np.sqrt(Ak1)
+    Ak2 = np.sqrt(Ak2)
+    Bk1 = np.sqrt(Qk1**2 + p_sqr)
+    Bk2 = np.sqrt(Qk2**2 + p_sqr)
+    E1k1 = R1k1*Bk1
+    E1k2 = R1k2*Bk2
+    E2k1 = R2k1*Bk1
+    E2k2 = R2k2*Bk2
+    # Simplifying these arctans with, e.g., (Z2 - Z1)*arctan2(Qk2*p -
+    # Qk1*p, p*p + Qk2*Qk1) doesn't work because of the restrictions
+    # regarding the angles for that identity. The regression tests
+    # fail for some points by a large amount.
+    kernel = (Z2 - Z1)*(np.arctan2(Qk2, p) - np.arctan2(Qk1, p))
+    kernel += Z2*(np.arctan2(Z2*Qk1, R2k1*p) - np.arctan2(Z2*Qk2, R2k2*p))
+    kernel += Z1*(np.arctan2(Z1*Qk2, R1k2*p) - np.arctan2(Z1*Qk1, R1k1*p))
+    Ck1 = Qk1*Ak1
+    Ck2 = Qk2*Ak2
+    # dummy helps prevent zero division and log(0) errors (that's why I
+    # need to add it twice)
+    # Simplifying these two logs with a single one is not worth it
+    # because it would introduce two pow operations.
+    kernel += 0.5*p*Ak1/(Bk1 + dummy)*np.log(
+        (E1k1 - Ck1)*(E2k1 + Ck1)/((E1k1 + Ck1)*(E2k1 - Ck1) + dummy) +
+        dummy)
+    kernel += 0.5*p*(Ak2/(Bk2 + dummy))*np.log(
+        (E2k2 - Ck2)*(E1k2 + Ck2)/((E2k2 + Ck2)*(E1k2 - Ck2) + dummy) +
+        dummy)
+    return kernel
+
+
+@numba.jit(nopython=True, cache=True, error_model='numpy')
+def kernelxx(X1, Y1, X2, Y2, Z1, Z2):
+    "The xx second derivative of the kernel"
+    dummy = DUMMY
+    deltax = X2 - X1 + dummy
+    deltay = Y2 - Y1 + dummy
+    n = deltax/deltay
+    g = X1 - Y1*n
+    dist = np.sqrt(deltax*deltax + deltay*deltay)
+    cross = X1*Y2 - X2*Y1
+    p = cross/dist + dummy
+    d1 = (deltax*X1 + deltay*Y1)/dist + dummy
+    d2 = (deltax*X2 + deltay*Y2)/dist + dummy
+    vert1_sqr = X1*X1 + Y1*Y1
+    vert2_sqr = X2*X2 + Y2*Y2
+    R11 = np.sqrt(vert1_sqr + Z1*Z1)
+    R12 = np.sqrt(vert1_sqr + Z2*Z2)
+    R21 = np.sqrt(vert2_sqr + Z1*Z1)
+    R22 = np.sqrt(vert2_sqr + Z2*Z2)
+    atan_diff_d2 = np.arctan2(Z2*d2, p*R22) - np.arctan2(Z1*d2, p*R21)
+    atan_diff_d1 = np.arctan2(Z2*d1, p*R12) - np.arctan2(Z1*d1, p*R11)
+    tmp = g*Y2*atan_diff_d2/(p*d2) + n*p*atan_diff_d2/(d2)
+    tmp -= g*Y1*atan_diff_d1/(p*d1) + n*p*atan_diff_d1/(d1)
+    tmp += n*np.log(
+        (Z2 + R12)*(Z1 + R21)/((Z1 + R11)*(Z2 + R22) + dummy) + dummy)
+    tmp *= -1/(1 + n*n)
+    return tmp
+
+
+@numba.jit(nopython=True, cache=True, error_model='numpy')
+def kernelxy(X1, Y1, X2, Y2, Z1, Z2):
+    "The xy second derivative of the kernel"
+    dummy = DUMMY
+    deltax = X2 - X1 + dummy
+    deltay = Y2 - Y1 + dummy
+    n = deltax/deltay
+    g = X1 - Y1*n
+    g_sqr = g*g
+    dist = np.sqrt(deltax*deltax + deltay*deltay)
+    cross = X1*Y2 - X2*Y1
+    p = cross/dist + dummy
+    d1 = (deltax*X1 + deltay*Y1)/dist + dummy
+    d2 = (deltax*X2 + deltay*Y2)/dist + dummy
+    vert1_sqr = X1*X1 + Y1*Y1
+    vert2_sqr = X2*X2 + Y2*Y2
+    R11 = np.sqrt(vert1_sqr + Z1*Z1)
+    R12 = np.sqrt(vert1_sqr + Z2*Z2)
+    R21 = np.sqrt(vert2_sqr + Z1*Z1)
+    R22 = np.sqrt(vert2_sqr + Z2*Z2)
+    atan_diff_d2 = np.arctan2(Z2*d2, p*R22) - np.arctan2(Z1*d2, p*R21)
+    atan_diff_d1 = np.arctan2(Z2*d1, p*R12) - np.arctan2(Z1*d1, p*R11)
+    tmp = (g_sqr + g*n*Y2)*atan_diff_d2/(p*d2) - p*atan_diff_d2/d2
+    tmp -= (g_sqr + g*n*Y1)*atan_diff_d1/(p*d1) - p*atan_diff_d1/d1
+    tmp += np.log(
+        (Z2 + R22)*(Z1 + R11)/((Z1 + R21)*(Z2 + R12) + dummy) + dummy)
+    tmp *= 1/(1 + n*n)
+    return tmp
+
+
+@numba.jit(nopython=True, cache=True, error_model='numpy')
+def kernelxz(X1, Y1, X2, Y2, Z1, Z2):
+    "The xz second derivative of the kernel"
+    dummy = DUMMY
+    deltax = X2 - X1 + dummy
+    deltay = Y2 - Y1 + dummy
+    n = deltax/deltay
+    n_sqr_p1 = n*n + 1
+    g = X1 - Y1*n
+    ng = n*g
+    dist = np.sqrt(deltax*deltax + deltay*deltay)
+    d1 = (deltax*X1 + deltay*Y1)/dist + dummy
+    d2 = (deltax*X2 + deltay*Y2)/dist + dummy
+    vert1_sqr = X1*X1 + Y1*Y1
+    vert2_sqr = X2*X2 + Y2*Y2
+    R11 = np.sqrt(vert1_sqr + Z1*Z1)
+    R12 = np.sqrt(vert1_sqr + Z2*Z2)
+    R21 = np.sqrt(vert2_sqr + Z1*Z1)
+    R22 = np.sqrt(vert2_sqr + Z2*Z2)
+    # Collapsing these logs decreases the precision too much leading to a
+    # larger difference with the prism code.
+    log_r22 = np.log((R22 - d2)/(R22 + d2) + dummy)
+    log_r21 = np.log((R21 - d2)/(R21 + d2) + dummy)
+    log_r12 = np.log((R12 - d1)/(R12 + d1) + dummy)
+    log_r11 = np.log((R11 - d1)/(R11 + d1) + dummy)
+    log_diff_d1 = (0.5/d1)*(log_r12 - log_r11)
+    log_diff_d2 = (0.5/d2)*(log_r22 - log_r21)
+    tmp = (Y2*n_sqr_p1 + ng)*log_diff_d2
+    tmp -= (Y1*n_sqr_p1 + ng)*log_diff_d1
+    tmp *= -1/n_sqr_p1
+    return tmp
+
+
+@numba.jit(nopython=True, cache=True, error_model='numpy')
+def kernelyy(X1, Y1, X2, Y2, Z1, Z2):
+    "The yy second derivative of the kernel"
+    dummy = DUMMY
+    deltax = X2 - X1 + dummy
+    deltay = Y2 - Y1 + dummy
+    m = deltay/deltax
+    c = Y1 - X1*m
+    dist = np.sqrt(deltax*deltax + deltay*deltay)
+    cross = X1*Y2 - X2*Y1
+    p = cross/dist + dummy
+    d1 = (deltax*X1 + deltay*Y1)/dist + dummy
+    d2 = (deltax*X2 + deltay*Y2)/dist + dummy
+    vert1_sqr = X1*X1 + Y1*Y1
+    vert2_sqr = X2*X2 + Y2*Y2
+    R11 = np.sqrt(vert1_sqr + Z1*Z1)
+    R12 = np.sqrt(vert1_sqr + Z2*Z2)
+    R21 = np.sqrt(vert2_sqr + Z1*Z1)
+    R22 = np.sqrt(vert2_sqr + Z2*Z2)
+    atan_diff_d2 = np.arctan2(Z2*d2, p*R22) - np.arctan2(Z1*d2, p*R21)
+    atan_diff_d1 = np.arctan2(Z2*d1, p*R12) - np.arctan2(Z1*d1, p*R11)
+    tmp = c*X2*atan_diff_d2/(p*d2) + m*p*atan_diff_d2/d2
+    tmp -= c*X1*atan_diff_d1/(p*d1) + m*p*atan_diff_d1/d1
+    tmp += m*np.log(
+        (Z2 + R12)*(Z1 + R21)/((Z2 + R22)*(Z1 + R11)) + dummy)
+    tmp *= 1/(1 + m*m)
+    return tmp
+
+
+@numba.jit(nopython=True, cache=True, error_model='numpy')
+def kernelyz(X1, Y1, X2, Y2, Z1, Z2):
+    "The yz second derivative of the kernel"
+    dummy = DUMMY
+    deltax = X2 - X1 + dummy
+    deltay = Y2 - Y1 + dummy
+    m = deltay/deltax
+    m_sqr_p1 = m*m + 1
+    c = Y1 - X1*m
+    cm = c*m
+    dist = np.sqrt(deltax*deltax + deltay*deltay)
+    d1 = (deltax*X1 + deltay*Y1)/dist + dummy
+    d2 = (deltax*X2 + deltay*Y2)/dist + dummy
+    vert1_sqr = X1*X1 + Y1*Y1
+    vert2_sqr = X2*X2 + Y2*Y2
+    R11 = np.sqrt(vert1_sqr + Z1*Z1)
+    R12 = np.sqrt(vert1_sqr + Z2*Z2)
+    R21 = np.sqrt(vert2_sqr + Z1*Z1)
+    R22 = np.sqrt(vert2_sqr + Z2*Z2)
+    # Same remark about collapsing logs as kernelxz
+    log_r11 = np.log((R11 - d1)/(R11 + d1) + dummy)
+    log_r12 = np.log((R12 - d1)/(R12 + d1) + dummy)
+    log_r21 = np.log((R21 - d2)/(R21 + d2) + dummy)
+    log_r22 = np.log((R22 - d2)/(R22 + d2) + dummy)
+    tmp = (X2*m_sqr_p1 + cm)*(0.5/d2)*(log_r22 - log_r21)
+    tmp -= (X1*m_sqr_p1 + cm)*(0.5/d1)*(log_r12 - log_r11)
+    tmp *= 1/m_sqr_p1
+    return tmp
+
+
+@numba.jit(nopython=True, cache=True, error_model='numpy')
+def kernelzz(X1, Y1, X2, Y2, Z1, Z2):
+    "The zz second derivative of the kernel"
+    deltax = X2 - X1
+    deltay = Y2 - Y1
+    # dist is only used in divisions. Add dummy to avoid zero division
+    # errors if the two vertices coincide.
+    dist = np.sqrt(deltax*deltax + deltay*deltay) + DUMMY
+    cross = X1*Y2 - X2*Y1
+    p = cross/dist
+    d1 = (deltax*X1 + deltay*Y1)/dist
+    d2 = (deltax*X2 + deltay*Y2)/dist
+    vert1_sqr = X1*X1 + Y1*Y1
+    vert2_sqr = X2*X2 + Y2*Y2
+    R11 = np.sqrt(vert1_sqr + Z1*Z1)
+    R12 = np.sqrt(vert1_sqr + Z2*Z2)
+    R21 = np.sqrt(vert2_sqr + Z1*Z1)
+    R22 = np.sqrt(vert2_sqr + Z2*Z2)
+    return (np.arctan2(Z2*d2, p*R22) - np.arctan2(Z1*d2, p*R21) -
+            np.arctan2(Z2*d1, p*R12) + np.arctan2(Z1*d1, p*R11))
+
+
+@numba.jit(nopython=True, cache=True, error_model='numpy')
+def tensor_edge(X1, Y1, X2, Y2, Z1, Z2, R11, R12, R21, R22):
+    """
+    All six second derivatives of the kernel (xx, xy, xz, yy, yz, zz) for a
+    single edge.
+
+    Gives the same as kernelxx, kernelxy, etc but the geometry of the edge is
+    calculated only once. R11 and R12 are the distances to the first vertex
+    at Z1 and Z2, R21 and R22 to the second vertex. The caller can reuse
+    them for the next edge (its first vertex is the second one of this edge).
+    """
+    dummy = DUMMY
+    deltax = X2 - X1 + dummy
+    deltay = Y2 - Y1 + dummy
+    dist = np.sqrt(deltax*deltax + deltay*deltay)
+    cross = X1*Y2 - X2*Y1
+    p = cross/dist + dummy
+    d1 = (deltax*X1 + deltay*Y1)/dist + dummy
+    d2 = (deltax*X2 + deltay*Y2)/dist + dummy
+    atan_diff_d2 = np.arctan2(Z2*d2, p*R22) - np.arctan2(Z1*d2, p*R21)
+    atan_diff_d1 = np.arctan2(Z2*d1, p*R12) - np.arctan2(Z1*d1, p*R11)
+    # The arguments of the logs in xx, xy and yy are ratios of these two
+    prod1 = (Z2 + R12)*(Z1 + R21)
+    prod2 = (Z1 + R11)*(Z2 + R22)
+    log_r22 = np.log((R22 - d2)/(R22 + d2) + dummy)
+    log_r21 = np.log((R21 - d2)/(R21 + d2) + dummy)
+    log_r12 = np.log((R12 - d1)/(R12 + d1) + dummy)
+    log_r11 = np.log((R11 - d1)/(R11 + d1) + dummy)
+    # The x derivatives
+    n = deltax/deltay
+    n_sqr_p1 = n*n + 1
+    g = X1 - Y1*n
+    g_sqr = g*g
+    ng = n*g
+    xx = g*Y2*atan_diff_d2/(p*d2) + n*p*atan_diff_d2/(d2)
+    xx -= g*Y1*atan_diff_d1/(p*d1) + n*p*atan_diff_d1/(d1)
+    xx += n*np.log(prod1/(prod2 + dummy) + dummy)
+    xx *= -1/n_sqr_p1
+    xy = (g_sqr + ng*Y2)*atan_diff_d2/(p*d2) - p*atan_diff_d2/d2
+    xy -= (g_sqr + ng*Y1)*atan_diff_d1/(p*d1) - p*atan_diff_d1/d1
+    xy += np.log(prod2/(prod1 + dummy) + dummy)
+    xy *= 1/n_sqr_p1
+    xz = (Y2*n_sqr_p1 + ng)*(0.5/d2)*(log_r22 - log_r21)
+    xz -= (Y1*n_sqr_p1 + ng)*(0.5/d1)*(log_r12 - log_r11)
+    xz *= -1/n_sqr_p1
+    # The y derivatives
+    m = deltay/deltax
+    m_sqr_p1 = m*m + 1
+    c = Y1 - X1*m
+    cm = c*m
+    yy = c*X2*atan_diff_d2/(p*d2) + m*p*atan_diff_d2/d2
+    yy -= c*X1*atan_diff_d1/(p*d1) + m*p*atan_diff_d1/d1
+    yy += m*np.log(prod1/prod2 + dummy)
+    yy *= 1/m_sqr_p1
+    yz = (X2*m_sqr_p1 + cm)*(0.5/d2)*(log_r22 - log_r21)
+    yz -= (X1*m_sqr_p1 + cm)*(0.5/d1)*(log_r12 - log_r11)
+    yz *= 1/m_sqr_p1
+    # zz doesn't add dummy to the edge vector (see kernelzz)
+    deltax = X2 - X1
+    deltay = Y2 - Y1
+    dist = np.sqrt(deltax*deltax + deltay*deltay) + dummy
+    p = cross/dist
+    d1 = (deltax*X1 + deltay*Y1)/dist
+    d2 = (deltax*X2 + deltay*Y2)/dist
+    zz = (np.arctan2(Z2*d2, p*R22) - np.arctan2(Z1*d2, p*R21) -
+          np.arctan2(Z2*d1, p*R12) + np.arctan2(Z1*d1, p*R11))
+    return xx, xy, xz, yy, yz, zz
+
+
+@numba.jit(nopython=True, cache=True)
+def edge_kernel(code, X1, Y1, X2, Y2, Z1, Z2):
+    "Evaluate the kernel of the field *code* on a single edge"
+    if code == GZ:
+        return kernelz(X1, Y1, X2, Y2, Z1, Z2)
+    elif code == GXX:
+        return kernelxx(X1, Y1, X2, Y2, Z1, Z2)
+    elif code == GXY:
+        return kernelxy(X1, Y1, X2, Y2, Z1, Z2)
+    elif code == GXZ:
+        return kernelxz(X1, Y1, X2, Y2, Z1, Z2)
+    elif code == GYY:
+        return kernelyy(X1, Y1, X2, Y2, Z1, Z2)
+    elif code == GYZ:
+        return kernelyz(X1, Y1, X2, Y2, Z1, Z2)
+    else:
+        return kernelzz(X1, Y1, X2, Y2, Z1, Z2)
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def engine(code, xp, yp, zp, x, y, offsets, z1, z2, props, result):
+    """
+    Calculate the field *code* of the prisms (times their property *props*)
+    on the computation points and put it in *result*.
+    """
+    for i in range(xp.size):
+        res = 0.
+        for j in range(props.size):
+            Z1 = z1[j] - zp[i]
+            Z2 = z2[j] - zp[i]
+            first, last = offsets[j], offsets[j + 1]
+            kernel = 0.
+            for k in range(first, last):
+                following = k + 1 if k + 1 < last else first
+                kernel += edge_kernel(code, x[k] - xp[i], y[k] - yp[i],
+                                      x[following] - xp[i],
+                                      y[following] - yp[i], Z1, Z2)
+            res += kernel*props[j]
+        result[i] = res
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def magnetic_engine(xp, yp, zp, x, y, offsets, z1, z2, mag, direction,
+                    result):
+    """
+    Calculate the magnetic induction of the prisms with magnetization *mag*
+    (one vector per row) projected on *direction* and put it in *result*.
+    """
+    for i in range(xp.size):
+        bx, by, bz = 0., 0., 0.
+        for j in range(z1.size):
+            Z1 = z1[j] - zp[i]
+            Z2 = z2[j] - zp[i]
+            first, last = offsets[j], offsets[j + 1]
+            X1 = x[first] - xp[i]
+            Y1 = y[first] - yp[i]
+            vert_sqr = X1*X1 + Y1*Y1
+            R11 = np.sqrt(vert_sqr + Z1*Z1)
+            R12 = np.sqrt(vert_sqr + Z2*Z2)
+            v1, v2, v3, v4, v5, v6 = 0., 0., 0., 0., 0., 0.
+            for k in range(first, last):
+                following = k + 1 if k + 1 < last else first
+                X2 = x[following] - xp[i]
+                Y2 = y[following] - yp[i]
+                vert_sqr = X2*X2 + Y2*Y2
+                R21 = np.sqrt(vert_sqr + Z1*Z1)
+                R22 = np.sqrt(vert_sqr + Z2*Z2)
+                xx, xy, xz, yy, yz, zz = tensor_edge(X1, Y1, X2, Y2, Z1, Z2,
+                                                     R11, R12, R21, R22)
+                v1 += xx
+                v2 += xy
+                v3 += xz
+                v4 += yy
+                v5 += yz
+                v6 += zz
+                # The second vertex is the first of the next edge
+                X1, Y1, R11, R12 = X2, Y2, R21, R22
+            mx, my, mz = mag[j, 0], mag[j, 1], mag[j, 2]
+            bx += v1*mx + v2*my + v3*mz
+            by += v2*mx + v4*my + v5*mz
+            bz += v3*mx + v5*my + v6*mz
+        # Skip the components that aren't needed (they might be nan)
+        res = 0.
+        if direction[0] != 0:
+            res += direction[0]*bx
+        if direction[1] != 0:
+            res += direction[1]*by
+        if direction[2] != 0:
+            res += direction[2]*bz
+        result[i] = res
@@ -2,6 +2,12 @@
 """
 Cython implementation of the gravity and magnetic fields of right rectangular
 prisms.
+
+All functions take the model as a structure of arrays: the bounds of each
+prism (x1, x2, y1, y2, z1, z2) and the physical property of each prism are
+1d-arrays with one element per prism. A single call loops over all
+computation points and all prisms and adds the result to *res*. The loops
+run without holding the GIL.
 """
 import numpy
 
@@ -13,6 +19,23 @@ cimport cython
 DTYPE = numpy.float
 ctypedef numpy.float_t DTYPE_T
 
+# Codes used to select which field the generic loops below will calculate
+cdef enum:
+    POTENTIAL
+    GX
+    GY
+    GZ
+    GXX
+    GXY
+    GXZ
+    GYY
+    GYZ
+    GZZ
+    TF
+    BX
+    BY
+    BZ
+
 cdef inline double safe_atan2(double y, double x) nogil:
     cdef double res
     if y == 0:
@@ -67,30 +90,124 @@ cdef inline double kernelyz(double x, double y, double z, double r) nogil:
 cdef inline double kernelzz(double x, double y, double z, double r) nogil:
     return -safe_atan2(x*y, z*r)
 
+cdef inline double node_kernel(
+        int field, double dx, double dy, double dz, double sx, double sy,
+        double sz) nogil:
+    """
+    Evaluate the kernel of *field* on a single corner (dx, dy, dz) relative to
+    the computation point. (sx, sy, sz) are the dimensions of the prism.
+    """
+    cdef double r, tmp1, tmp2
+    r = sqrt(dx**2 + dy**2 + dz**2)
+    # The gxy, gxz, and gyz kernels have singularities when the
+    # point is aligned with some of the corners. Move the point
+    # slightly to avoid them.
+    if field == POTENTIAL:
+        return kernelpot(dx, dy, dz, r)
+    elif field == GX:
+        return kernelx(dx, dy, dz, r)
+    elif field == GY:
+        return kernely(dx, dy, dz, r)
+    elif field == GZ:
+        return kernelz(dx, dy, dz, r)
+    elif field == GXX:
+        return kernelxx(dx, dy, dz, r)
+    elif field == GXY:
+        if dx == 0 and dy == 0 and dz < 0:
+            tmp1 = 0.00001*sx
+            tmp2 = 0.00001*sy
+            r = sqrt(tmp1**2 + tmp2**2 + dz**2)
+        return kernelxy(dx, dy, dz, r)
+    elif field == GXZ:
+        if dx == 0 and dz == 0 and dy < 0:
+            tmp1 = 0.00001*sx
+            tmp2 = 0.00001*sz
+            r = sqrt(tmp1**2 + tmp2**2 + dy**2)
+        return kernelxz(dx, dy, dz, r)
+    elif field == GYY:
+        return kernelyy(dx, dy, dz, r)
+    elif field == GYZ:
+        if dy == 0 and dz == 0 and dx < 0:
+            tmp1 = 0.00001*sy
+            tmp2 = 0.00001*sz
+            r = sqrt(tmp1**2 + tmp2**2 + dx**2)
+        return kernelyz(dx, dy, dz, r)
+    else:
+        return kernelzz(dx, dy, dz, r)
+
 @cython.wraparound(False)
 @cython.boundscheck(False)
-def tf(numpy.ndarray[DTYPE_T, ndim=1] xp not None,
-       numpy.ndarray[DTYPE_T, ndim=1] yp not None,
-       numpy.ndarray[DTYPE_T, ndim=1] zp not None,
-       double x1, double x2, double y1, double y2, double z1, double z2,
-       double mx, double my, double mz, double fx, double fy, double fz,
-       numpy.ndarray[DTYPE_T, ndim=1] res not None):
-    cdef unsigned int l, size, i, j, k
-    cdef numpy.ndarray[DTYPE_T, ndim=1] x, y, z
-    cdef DTYPE_T kernel, r, v1, v2, v3, v4, v5, v6, bx, by, bz, dx, dy, dz
-    size = len(xp)
-    x = numpy.array([x2, x1], dtype=DTYPE)
-    y = numpy.array([y2, y1], dtype=DTYPE)
-    z = numpy.array([z2, z1], dtype=DTYPE)
-    for l in range(size):
-        # Evaluate the integration limits
-        for k in range(2):
-            dz = z[k] - zp[l]
-            for j in range(2):
-                dy = y[j] - yp[l]
-                for i in range(2):
-                    dx = x[i] - xp[l]
-                    r = sqrt(dx**2 + dy**2 + dz**2)
+cdef inline double gravity_kernel(
+        int field, double xp, double yp, double zp, double x1, double x2,
+        double y1, double y2, double z1, double z2) nogil:
+    """
+    Evaluate the kernel of *field* on the 8 corners of a single prism.
+    """
+    cdef unsigned int i, j, k
+    cdef double x[2]
+    cdef double y[2]
+    cdef double z[2]
+    cdef double kernel
+    cdef double res = 0
+    x[0], x[1] = x2, x1
+    y[0], y[1] = y2, y1
+    z[0], z[1] = z2, z1
+    # Evaluate the integration limits
+    for k in range(2):
+        for j in range(2):
+            for i in range(2):
+                kernel = node_kernel(field, x[i] - xp, y[j] - yp, z[k] - zp,
+                                     x2 - x1, y2 - y1, z2 - z1)
+                if (i + j + k) % 2 == 0:
+                    res += kernel
+                else:
+                    res -= kernel
+    return res
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef inline double magnetic_kernel(
+        int field, double xp, double yp, double zp, double x1, double x2,
+        double y1, double y2, double z1, double z2, double mx, double my,
+        double mz, double fx, double fy, double fz) nogil:
+    """
+    Evaluate the magnetic *field* of a single prism with magnetization
+    (mx, my, mz). (fx, fy, fz) is the direction of the regional field (only
+    used for the total-field anomaly).
+    """
+    cdef unsigned int i, j, k
+    cdef double x[2]
+    cdef double y[2]
+    cdef double z[2]
+    cdef double kernel, r, dx, dy, dz, v1, v2, v3, v4, v5, v6, bx, by, bz
+    cdef double res = 0
+    x[0], x[1] = x2, x1
+    y[0], y[1] = y2, y1
+    z[0], z[1] = z2, z1
+    # Evaluate the integration limits
+    for k in range(2):
+        dz = z[k] - zp
+        for j in range(2):
+            dy = y[j] - yp
+            for i in range(2):
+                dx = x[i] - xp
+                r = sqrt(dx**2 + dy**2 + dz**2)
+                if field == BX:
+                    v1 = kernelxx(dx, dy, dz, r)
+                    v2 = kernelxy(dx, dy, dz, r)
+                    v3 = kernelxz(dx, dy, dz, r)
+                    kernel = (v1*mx + v2*my + v3*mz)
+                elif field == BY:
+                    v2 = kernelxy(dx, dy, dz, r)
+                    v4 = kernelyy(dx, dy, dz, r)
+                    v5 = kernelyz(dx, dy, dz, r)
+                    kernel = (v2*mx + v4*my + v5*mz)
+                elif field == BZ:
+                    v3 = kernelxz(dx, dy, dz, r)
+                    v5 = kernelyz(dx, dy, dz, r)
+                    v6 = kernelzz(dx, dy, dz, r)
+                    kernel = (v3*mx + v5*my + v6*mz)
+                else:
                     v1 = kernelxx(dx, dy, dz, r)
                     v2 = kernelxy(dx, dy, dz, r)
                     v3 = kernelxz(dx, dy, dz, r)
@@ -101,379 +218,632 @@ def tf(numpy.ndarray[DTYPE_T, ndim=1] xp not None,
                     by = (v2*mx + v4*my + v5*mz)
                     bz = (v3*mx + v5*my + v6*mz)
                     kernel = fx*bx + fy*by + fz*bz
-                    res[l] += ((-1.)**(i + j + k))*kernel
+                if (i + j + k) % 2 == 0:
+                    res += kernel
+                else:
+                    res -= kernel
+    return res
 
-@cython.wraparound(False)
-@cython.boundscheck(False)
-def bx(numpy.ndarray[DTYPE_T, ndim=1] xp not None,
-       numpy.ndarray[DTYPE_T, ndim=1] yp not None,
-       numpy.ndarray[DTYPE_T, ndim=1] zp not None,
-       double x1, double x2, double y1, double y2, double z1, double z2,
-       double mx, double my, double mz,
-       numpy.ndarray[DTYPE_T, ndim=1] res not None):
-    cdef unsigned int l, size, i, j, k
-    cdef numpy.ndarray[DTYPE_T, ndim=1] x, y, z
-    cdef DTYPE_T kernel, r, v1, v2, v3, dx, dy, dz
-    size = len(xp)
-    x = numpy.array([x2, x1], dtype=DTYPE)
-    y = numpy.array([y2, y1], dtype=DTYPE)
-    z = numpy.array([z2, z1], dtype=DTYPE)
-    for l in range(size):
-        # Evaluate the integration limits
-        for k in range(2):
-            dz = z[k] - zp[l]
-            for j in range(2):
-                dy = y[j] - yp[l]
-                for i in range(2):
-                    dx = x[i] - xp[l]
-                    r = sqrt(dx**2 + dy**2 + dz**2)
-                    v1 = kernelxx(dx, dy, dz, r)
-                    v2 = kernelxy(dx, dy, dz, r)
-                    v3 = kernelxz(dx, dy, dz, r)
-                    kernel = (v1*mx + v2*my + v3*mz)
-                    res[l] += ((-1.)**(i + j + k))*kernel
+cdef inline double point_kernel(
+        int field, double dx, double dy, double dz) nogil:
+    """
+    The equivalent of the prism kernels for a point of unit mass at
+    (dx, dy, dz) relative to the computation point. Used for prisms that are
+    far away from the computation point. The magnetic fields use the second
+    derivatives (the fields of a dipole).
+    """
+    cdef double r2, r, r5
+    r2 = dx**2 + dy**2 + dz**2
+    r = sqrt(r2)
+    if field == POTENTIAL:
+        return 1/r
+    elif field == GX:
+        return dx/(r*r2)
+    elif field == GY:
+        return dy/(r*r2)
+    elif field == GZ:
+        return dz/(r*r2)
+    r5 = r*r2*r2
+    if field == GXX:
+        return (3*dx**2 - r2)/r5
+    elif field == GXY:
+        return 3*dx*dy/r5
+    elif field == GXZ:
+        return 3*dx*dz/r5
+    elif field == GYY:
+        return (3*dy**2 - r2)/r5
+    elif field == GYZ:
+        return 3*dy*dz/r5
+    else:
+        return (3*dz**2 - r2)/r5
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
-def by(numpy.ndarray[DTYPE_T, ndim=1] xp not None,
-       numpy.ndarray[DTYPE_T, ndim=1] yp not None,
-       numpy.ndarray[DTYPE_T, ndim=1] zp not None,
-       double x1, double x2, double y1, double y2, double z1, double z2,
-       double mx, double my, double mz,
-       numpy.ndarray[DTYPE_T, ndim=1] res not None):
-    cdef unsigned int l, size, i, j, k
-    cdef numpy.ndarray[DTYPE_T, ndim=1] x, y, z
-    cdef DTYPE_T kernel, r, v2, v4, v5, dx, dy, dz
-    size = len(xp)
-    x = numpy.array([x2, x1], dtype=DTYPE)
-    y = numpy.array([y2, y1], dtype=DTYPE)
-    z = numpy.array([z2, z1], dtype=DTYPE)
-    for l in range(size):
-        # Evaluate the integration limits
-        for k in range(2):
-            dz = z[k] - zp[l]
-            for j in range(2):
-                dy = y[j] - yp[l]
-                for i in range(2):
-                    dx = x[i] - xp[l]
-                    r = sqrt(dx**2 + dy**2 + dz**2)
-                    v2 = kernelxy(dx, dy, dz, r)
-                    v4 = kernelyy(dx, dy, dz, r)
-                    v5 = kernelyz(dx, dy, dz, r)
-                    kernel = (v2*mx + v4*my + v5*mz)
-                    res[l] += ((-1.)**(i + j + k))*kernel
+cdef inline double dipole_kernel(
+        int field, double dx, double dy, double dz, double mx, double my,
+        double mz, double fx, double fy, double fz) nogil:
+    """
+    The equivalent of the magnetic_kernel for a dipole with unit volume and
+    magnetization (mx, my, mz) at (dx, dy, dz) relative to the computation
+    point.
+    """
+    cdef double v1, v2, v3, v4, v5, v6, bx, by, bz
+    v1 = point_kernel(GXX, dx, dy, dz)
+    v2 = point_kernel(GXY, dx, dy, dz)
+    v3 = point_kernel(GXZ, dx, dy, dz)
+    v4 = point_kernel(GYY, dx, dy, dz)
+    v5 = point_kernel(GYZ, dx, dy, dz)
+    v6 = point_kernel(GZZ, dx, dy, dz)
+    bx = (v1*mx + v2*my + v3*mz)
+    by = (v2*mx + v4*my + v5*mz)
+    bz = (v3*mx + v5*my + v6*mz)
+    if field == BX:
+        return bx
+    elif field == BY:
+        return by
+    elif field == BZ:
+        return bz
+    return fx*bx + fy*by + fz*bz
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
-def bz(numpy.ndarray[DTYPE_T, ndim=1] xp not None,
-       numpy.ndarray[DTYPE_T, ndim=1] yp not None,
-       numpy.ndarray[DTYPE_T, ndim=1] zp not None,
-       double x1, double x2, double y1, double y2, double z1, double z2,
-       double mx, double my, double mz,
-       numpy.ndarray[DTYPE_T, ndim=1] res not None):
-    cdef unsigned int l, size, i, j, k
-    cdef numpy.ndarray[DTYPE_T, ndim=1] x, y, z
-    cdef DTYPE_T kernel, r, v3, v5, v6, dx, dy, dz
-    size = len(xp)
-    x = numpy.array([x2, x1], dtype=DTYPE)
-    y = numpy.array([y2, y1], dtype=DTYPE)
-    z = numpy.array([z2, z1], dtype=DTYPE)
+cdef void gravity(int field, double[:] xp, double[:] yp, double[:] zp,
+                  double[:] x1, double[:] x2, double[:] y1, double[:] y2,
+                  double[:] z1, double[:] z2, double[:] density,
+                  double[:] res) nogil:
+    """
+    Add the gravitational *field* of all prisms to *res*.
+    """
+    cdef unsigned int l, p, size, nprisms
+    cdef double tmp
+    size = xp.shape[0]
+    nprisms = x1.shape[0]
     for l in range(size):
-        # Evaluate the integration limits
-        for k in range(2):
-            dz = z[k] - zp[l]
-            for j in range(2):
-                dy = y[j] - yp[l]
-                for i in range(2):
-                    dx = x[i] - xp[l]
-                    r = sqrt(dx**2 + dy**2 + dz**2)
-                    v3 = kernelxz(dx, dy, dz, r)
-                    v5 = kernelyz(dx, dy, dz, r)
-                    v6 = kernelzz(dx, dy, dz, r)
-                    kernel = (v3*mx + v5*my + v6*mz)
-                    res[l] += ((-1.)**(i + j + k))*kernel
+        tmp = 0
+        for p in range(nprisms):
+            tmp += density[p]*gravity_kernel(
+                field, xp[l], yp[l], zp[l], x1[p], x2[p], y1[p], y2[p], z1[p],
+                z2[p])
+        res[l] += tmp
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
-def gx(numpy.ndarray[DTYPE_T, ndim=1] xp not None,
-       numpy.ndarray[DTYPE_T, ndim=1] yp not None,
-       numpy.ndarray[DTYPE_T, ndim=1] zp not None,
-       double x1, double x2, double y1, double y2, double z1, double z2,
-       double density,
-       numpy.ndarray[DTYPE_T, ndim=1] res not None):
-    cdef unsigned int l, size, i, j, k
-    cdef numpy.ndarray[DTYPE_T, ndim=1] x, y, z
-    cdef DTYPE_T kernel, r, dx, dy, dz
-    size = len(xp)
-    x = numpy.array([x2, x1], dtype=DTYPE)
-    y = numpy.array([y2, y1], dtype=DTYPE)
-    z = numpy.array([z2, z1], dtype=DTYPE)
+cdef void magnetic(int field, double[:] xp, double[:] yp, double[:] zp,
+                   double[:] x1, double[:] x2, double[:] y1, double[:] y2,
+                   double[:] z1, double[:] z2, double[:] mx, double[:] my,
+                   double[:] mz, double fx, double fy, double fz,
+                   double[:] res) nogil:
+    """
+    Add the magnetic *field* of all prisms to *res*.
+    """
+    cdef unsigned int l, p, size, nprisms
+    cdef double tmp
+    size = xp.shape[0]
+    nprisms = x1.shape[0]
     for l in range(size):
-        # Evaluate the integration limits
-        for k in range(2):
-            dz = z[k] - zp[l]
-            for j in range(2):
-                dy = y[j] - yp[l]
-                for i in range(2):
-                    dx = x[i] - xp[l]
-                    r = sqrt(dx**2 + dy**2 + dz**2)
-                    kernel = kernelx(dx, dy, dz, r)
-                    res[l] += ((-1.)**(i + j + k))*kernel*density
+        tmp = 0
+        for p in range(nprisms):
+            tmp += magnetic_kernel(
+                field, xp[l], yp[l], zp[l], x1[p], x2[p], y1[p], y2[p], z1[p],
+                z2[p], mx[p], my[p], mz[p], fx, fy, fz)
+        res[l] += tmp
+
+# Map the field names to the codes used in the compiled loops
+FIELD_CODES = {'potential': POTENTIAL, 'gx': GX, 'gy': GY, 'gz': GZ,
+               'gxx': GXX, 'gxy': GXY, 'gxz': GXZ, 'gyy': GYY, 'gyz': GYZ,
+               'gzz': GZZ}
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
-def gy(numpy.ndarray[DTYPE_T, ndim=1] xp not None,
-       numpy.ndarray[DTYPE_T, ndim=1] yp not None,
-       numpy.ndarray[DTYPE_T, ndim=1] zp not None,
-       double x1, double x2, double y1, double y2, double z1, double z2,
-       double density,
-       numpy.ndarray[DTYPE_T, ndim=1] res not None):
-    cdef unsigned int l, size, i, j, k
-    cdef numpy.ndarray[DTYPE_T, ndim=1] x, y, z
-    cdef DTYPE_T kernel, r, dx, dy, dz
-    size = len(xp)
-    x = numpy.array([x2, x1], dtype=DTYPE)
-    y = numpy.array([y2, y1], dtype=DTYPE)
-    z = numpy.array([z2, z1], dtype=DTYPE)
+cdef void fused(int *codes, int nfields, double[:] xp, double[:] yp,
+                double[:] zp, double[:] x1, double[:] x2, double[:] y1,
+                double[:] y2, double[:] z1, double[:] z2, double[:] density,
+                double[:, :] res) nogil:
+    """
+    Add several gravitational fields of all prisms to *res* (one column per
+    field).
+
+    All fields are evaluated in a single pass over the corners of the prisms.
+    The distance to the corner and the log and atan2 terms of the kernels are
+    computed only once per corner and shared by all fields.
+    """
+    cdef unsigned int l, p, f, i, j, k, size, nprisms
+    cdef double x[2]
+    cdef double y[2]
+    cdef double z[2]
+    cdef double tmp[10]
+    cdef double dx, dy, dz, r, rs, t1, t2, weight, kernel
+    cdef double logx = 0, logy = 0, logz = 0
+    cdef double atanx = 0, atany = 0, atanz = 0
+    cdef bint need_logx = 0, need_logy = 0, need_logz = 0
+    cdef bint need_atanx = 0, need_atany = 0, need_atanz = 0
+    size = xp.shape[0]
+    nprisms = x1.shape[0]
+    # Find out which of the log and atan2 terms are needed
+    for f in range(nfields):
+        if codes[f] == POTENTIAL:
+            need_logx = need_logy = need_logz = 1
+            need_atanx = need_atany = need_atanz = 1
+        elif codes[f] == GX:
+            need_logy = need_logz = need_atanx = 1
+        elif codes[f] == GY:
+            need_logx = need_logz = need_atany = 1
+        elif codes[f] == GZ:
+            need_logx = need_logy = need_atanz = 1
+        elif codes[f] == GXX:
+            need_atanx = 1
+        elif codes[f] == GXY:
+            need_logz = 1
+        elif codes[f] == GXZ:
+            need_logy = 1
+        elif codes[f] == GYY:
+            need_atany = 1
+        elif codes[f] == GYZ:
+            need_logx = 1
+        else:
+            need_atanz = 1
     for l in range(size):
-        # Evaluate the integration limits
-        for k in range(2):
-            dz = z[k] - zp[l]
-            for j in range(2):
-                dy = y[j] - yp[l]
-                for i in range(2):
-                    dx = x[i] - xp[l]
-                    r = sqrt(dx**2 + dy**2 + dz**2)
-                    kernel = kernely(dx, dy, dz, r)
-                    res[l] += ((-1.)**(i + j + k))*kernel*density
+        for f in range(nfields):
+            tmp[f] = 0
+        for p in range(nprisms):
+            x[0], x[1] = x2[p], x1[p]
+            y[0], y[1] = y2[p], y1[p]
+            z[0], z[1] = z2[p], z1[p]
+            # Evaluate the integration limits
+            for k in range(2):
+                dz = z[k] - zp[l]
+                for j in range(2):
+                    dy = y[j] - yp[l]
+                    for i in range(2):
+                        dx = x[i] - xp[l]
+                        r = sqrt(dx**2 + dy**2 + dz**2)
+                        if need_logx:
+                            logx = safe_log(dx + r)
+                        if need_logy:
+                            logy = safe_log(dy + r)
+                        if need_logz:
+                            logz = safe_log(dz + r)
+                        if need_atanx:
+                            atanx = safe_atan2(dz*dy, dx*r)
+                        if need_atany:
+                            atany = safe_atan2(dz*dx, dy*r)
+                        if need_atanz:
+                            atanz = safe_atan2(dx*dy, dz*r)
+                        if (i + j + k) % 2 == 0:
+                            weight = density[p]
+                        else:
+                            weight = -density[p]
+                        for f in range(nfields):
+                            if codes[f] == POTENTIAL:
+                                kernel = (dx*dy*logz + dy*dz*logx
+                                          + dx*dz*logy - 0.5*dx**2*atanx
+                                          - 0.5*dy**2*atany
+                                          - 0.5*dz**2*atanz)
+                            elif codes[f] == GX:
+                                kernel = -(dy*logz + dz*logy - dx*atanx)
+                            elif codes[f] == GY:
+                                kernel = -(dz*logx + dx*logz - dy*atany)
+                            elif codes[f] == GZ:
+                                kernel = -(dx*logy + dy*logx - dz*atanz)
+                            elif codes[f] == GXX:
+                                kernel = -atanx
+                            elif codes[f] == GXY:
+                                kernel = logz
+                                # Same singularity treatment as in
+                                # gravity_kernel
+                                if dx == 0 and dy == 0 and dz < 0:
+                                    t1 = 0.00001*(x2[p] - x1[p])
+                                    t2 = 0.00001*(y2[p] - y1[p])
+                                    rs = sqrt(t1**2 + t2**2 + dz**2)
+                                    kernel = safe_log(dz + rs)
+                            elif codes[f] == GXZ:
+                                kernel = logy
+                                if dx == 0 and dz == 0 and dy < 0:
+                                    t1 = 0.00001*(x2[p] - x1[p])
+                                    t2 = 0.00001*(z2[p] - z1[p])
+                                    rs = sqrt(t1**2 + t2**2 + dy**2)
+                                    kernel = safe_log(dy + rs)
+                            elif codes[f] == GYY:
+                                kernel = -atany
+                            elif codes[f] == GYZ:
+                                kernel = logx
+                                if dy == 0 and dz == 0 and dx < 0:
+                                    t1 = 0.00001*(y2[p] - y1[p])
+                                    t2 = 0.00001*(z2[p] - z1[p])
+                                    rs = sqrt(t1**2 + t2**2 + dx**2)
+                                    kernel = safe_log(dx + rs)
+                            else:
+                                kernel = -atanz
+                            tmp[f] += weight*kernel
+        for f in range(nfields):
+            res[l, f] += tmp[f]
+
+def fields(double[:] xp not None, double[:] yp not None,
+           double[:] zp not None, double[:] x1 not None,
+           double[:] x2 not None, double[:] y1 not None,
+           double[:] y2 not None, double[:] z1 not None,
+           double[:] z2 not None, double[:] density not None, names,
+           double[:, :] res not None):
+    """
+    Calculate the gravitational fields given in the sequence *names* at once.
+    Column i of *res* (shape = (npoints, len(names))) gets the field
+    names[i].
+    """
+    cdef int codes[10]
+    cdef int f, nfields = len(names)
+    if nfields > 10 or nfields != res.shape[1]:
+        raise ValueError("Invalid number of fields {}".format(nfields))
+    for f in range(nfields):
+        codes[f] = FIELD_CODES[names[f]]
+    with nogil:
+        fused(codes, nfields, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
-def gz(numpy.ndarray[DTYPE_T, ndim=1] xp not None,
-       numpy.ndarray[DTYPE_T, ndim=1] yp not None,
-       numpy.ndarray[DTYPE_T, ndim=1] zp not None,
-       double x1, double x2, double y1, double y2, double z1, double z2,
-       double density,
-       numpy.ndarray[DTYPE_T, ndim=1] res not None):
-    cdef unsigned int l, size, i, j, k
-    cdef numpy.ndarray[DTYPE_T, ndim=1] x, y, z
-    cdef DTYPE_T kernel, r, dx, dy, dz
-    size = len(xp)
-    x = numpy.array([x2, x1], dtype=DTYPE)
-    y = numpy.array([y2, y1], dtype=DTYPE)
-    z = numpy.array([z2, z1], dtype=DTYPE)
-    for l in range(size):
-        # Evaluate the integration limits
-        for k in range(2):
-            dz = z[k] - zp[l]
-            for j in range(2):
-                dy = y[j] - yp[l]
-                for i in range(2):
-                    dx = x[i] - xp[l]
-                    r = sqrt(dx**2 + dy**2 + dz**2)
-                    kernel = kernelz(dx, dy, dz, r)
-                    res[l] += ((-1.)**(i + j + k))*kernel*density
+def magnetic_fields(
+        double[:] xp not None, double[:] yp not None, double[:] zp not None,
+        double[:] x1 not None, double[:] x2 not None, double[:] y1 not None,
+        double[:] y2 not None, double[:] z1 not None, double[:] z2 not None,
+        double[:] mx not None, double[:] my not None, double[:] mz not None,
+        double fx, double fy, double fz, double[:, :] res not None):
+    """
+    Calculate tf, bx, by, and bz at once. The columns of *res*
+    (shape = (npoints, 4)) get each field, in this order. The second
+    derivative kernels are evaluated only once for each corner.
+    """
+    cdef unsigned int l, p, i, j, k, size, nprisms
+    cdef double x[2]
+    cdef double y[2]
+    cdef double z[2]
+    cdef double dx, dy, dz, r, sign, v1, v2, v3, v4, v5, v6, bx, by, bz
+    size = xp.shape[0]
+    nprisms = x1.shape[0]
+    with nogil:
+        for l in range(size):
+            bx, by, bz = 0, 0, 0
+            for p in range(nprisms):
+                x[0], x[1] = x2[p], x1[p]
+                y[0], y[1] = y2[p], y1[p]
+                z[0], z[1] = z2[p], z1[p]
+                for k in range(2):
+                    dz = z[k] - zp[l]
+                    for j in range(2):
+                        dy = y[j] - yp[l]
+                        for i in range(2):
+                            dx = x[i] - xp[l]
+                            r = sqrt(dx**2 + dy**2 + dz**2)
+                            if (i + j + k) % 2 == 0:
+                                sign = 1
+                            else:
+                                sign = -1
+                            v1 = sign*kernelxx(dx, dy, dz, r)
+                            v2 = sign*kernelxy(dx, dy, dz, r)
+                            v3 = sign*kernelxz(dx, dy, dz, r)
+                            v4 = sign*kernelyy(dx, dy, dz, r)
+                            v5 = sign*kernelyz(dx, dy, dz, r)
+                            v6 = sign*kernelzz(dx, dy, dz, r)
+                            bx += v1*mx[p] + v2*my[p] + v3*mz[p]
+                            by += v2*mx[p] + v4*my[p] + v5*mz[p]
+                            bz += v3*mx[p] + v5*my[p] + v6*mz[p]
+            res[l, 0] += fx*bx + fy*by + fz*bz
+            res[l, 1] += bx
+            res[l, 2] += by
+            res[l, 3] += bz
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
-def gxx(numpy.ndarray[DTYPE_T, ndim=1] xp not None,
-        numpy.ndarray[DTYPE_T, ndim=1] yp not None,
-        numpy.ndarray[DTYPE_T, ndim=1] zp not None,
-        double x1, double x2, double y1, double y2, double z1, double z2,
-        double density,
-        numpy.ndarray[DTYPE_T, ndim=1] res not None):
-    cdef unsigned int l, size, i, j, k
-    cdef numpy.ndarray[DTYPE_T, ndim=1] x, y, z
-    cdef DTYPE_T kernel, r, dx, dy, dz
-    size = len(xp)
-    x = numpy.array([x2, x1], dtype=DTYPE)
-    y = numpy.array([y2, y1], dtype=DTYPE)
-    z = numpy.array([z2, z1], dtype=DTYPE)
-    for l in range(size):
-        # Evaluate the integration limits
-        for k in range(2):
-            dz = z[k] - zp[l]
-            for j in range(2):
-                dy = y[j] - yp[l]
-                for i in range(2):
-                    dx = x[i] - xp[l]
-                    r = sqrt(dx**2 + dy**2 + dz**2)
-                    kernel = kernelxx(dx, dy, dz, r)
-                    res[l] += ((-1.)**(i + j + k))*kernel*density
+def gravity_sensitivity(
+        field, double[:] xp not None, double[:] yp not None,
+        double[:] zp not None, double[:] x1 not None, double[:] x2 not None,
+        double[:] y1 not None, double[:] y2 not None, double[:] z1 not None,
+        double[:] z2 not None, double[:] density not None, double scale,
+        cython.floating[:, :] res not None):
+    """
+    Fill *res* (shape = (npoints, nprisms)) with the gravitational *field* of
+    each prism times *scale*. *res* can be float32 or float64.
+    """
+    cdef unsigned int l, p, size, nprisms
+    cdef int code = FIELD_CODES[field]
+    size = xp.shape[0]
+    nprisms = x1.shape[0]
+    with nogil:
+        for l in range(size):
+            for p in range(nprisms):
+                res[l, p] = scale*density[p]*gravity_kernel(
+                    code, xp[l], yp[l], zp[l], x1[p], x2[p], y1[p], y2[p],
+                    z1[p], z2[p])
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
-def gxy(numpy.ndarray[DTYPE_T, ndim=1] xp not None,
-        numpy.ndarray[DTYPE_T, ndim=1] yp not None,
-        numpy.ndarray[DTYPE_T, ndim=1] zp not None,
-        double x1, double x2, double y1, double y2, double z1, double z2,
-        double density,
-        numpy.ndarray[DTYPE_T, ndim=1] res not None):
-    cdef unsigned int l, size, i, j, k
-    cdef numpy.ndarray[DTYPE_T, ndim=1] x, y, z
-    cdef DTYPE_T kernel, r, dx, dy, dz, tmp1, tmp2
-    size = len(xp)
-    x = numpy.array([x2, x1], dtype=DTYPE)
-    y = numpy.array([y2, y1], dtype=DTYPE)
-    z = numpy.array([z2, z1], dtype=DTYPE)
-    for l in range(size):
-        # Evaluate the integration limits
-        for k in range(2):
-            dz = z[k] - zp[l]
-            for j in range(2):
-                dy = y[j] - yp[l]
-                for i in range(2):
-                    dx = x[i] - xp[l]
-                    if dx == 0 and dy == 0 and dz < 0:
-                        tmp1 = 0.00001*(x2 - x1)
-                        tmp2 = 0.00001*(y2 - y1)
-                        r = sqrt(tmp1**2 + tmp2**2 + dz**2)
-                    else:
-                        r = sqrt(dx**2 + dy**2 + dz**2)
-                    kernel = kernelxy(dx, dy, dz, r)
-                    res[l] += ((-1.)**(i + j + k))*kernel*density
+def magnetic_sensitivity(
+        field, double[:] xp not None, double[:] yp not None,
+        double[:] zp not None, double[:] x1 not None, double[:] x2 not None,
+        double[:] y1 not None, double[:] y2 not None, double[:] z1 not None,
+        double[:] z2 not None, double[:] mx not None, double[:] my not None,
+        double[:] mz not None, double fx, double fy, double fz, double scale,
+        cython.floating[:, :] res not None):
+    """
+    Fill *res* (shape = (npoints, nprisms)) with the magnetic *field* of each
+    prism times *scale*. *res* can be float32 or float64.
+    """
+    cdef unsigned int l, p, size, nprisms
+    cdef int code = {'tf': TF, 'bx': BX, 'by': BY, 'bz': BZ}[field]
+    size = xp.shape[0]
+    nprisms = x1.shape[0]
+    with nogil:
+        for l in range(size):
+            for p in range(nprisms):
+                res[l, p] = scale*magnetic_kernel(
+                    code, xp[l], yp[l], zp[l], x1[p], x2[p], y1[p], y2[p],
+                    z1[p], z2[p], mx[p], my[p], mz[p], fx, fy, fz)
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
-def gxz(numpy.ndarray[DTYPE_T, ndim=1] xp not None,
-        numpy.ndarray[DTYPE_T, ndim=1] yp not None,
-        numpy.ndarray[DTYPE_T, ndim=1] zp not None,
-        double x1, double x2, double y1, double y2, double z1, double z2,
-        double density,
-        numpy.ndarray[DTYPE_T, ndim=1] res not None):
-    cdef unsigned int l, size, i, j, k
-    cdef numpy.ndarray[DTYPE_T, ndim=1] x, y, z
-    cdef DTYPE_T kernel, r, dx, dy, dz, tmp1, tmp2
-    size = len(xp)
-    x = numpy.array([x2, x1], dtype=DTYPE)
-    y = numpy.array([y2, y1], dtype=DTYPE)
-    z = numpy.array([z2, z1], dtype=DTYPE)
-    for l in range(size):
-        # Evaluate the integration limits
-        for k in range(2):
-            dz = z[k] - zp[l]
-            for j in range(2):
-                dy = y[j] - yp[l]
-                for i in range(2):
-                    dx = x[i] - xp[l]
-                    if dx == 0 and dz == 0 and dy < 0:
-                        tmp1 = 0.00001*(x2 - x1)
-                        tmp2 = 0.00001*(z2 - z1)
-                        r = sqrt(tmp1**2 + tmp2**2 + dy**2)
-                    else:
-                        r = sqrt(dx**2 + dy**2 + dz**2)
-                    kernel = kernelxz(dx, dy, dz, r)
-                    res[l] += ((-1.)**(i + j + k))*kernel*density
+def gravity_transpose(
+        field, double[:] xp not None, double[:] yp not None,
+        double[:] zp not None, double[:] x1 not None, double[:] x2 not None,
+        double[:] y1 not None, double[:] y2 not None, double[:] z1 not None,
+        double[:] z2 not None, double[:] density not None, double scale,
+        double[:] residuals not None, double[:] res not None):
+    """
+    Multiply the transpose of the sensitivity matrix of the gravitational
+    *field* by *residuals* (one per point) without forming the matrix.
+    *res* has one element per prism.
+    """
+    cdef unsigned int l, p, size, nprisms
+    cdef int code = FIELD_CODES[field]
+    cdef double tmp
+    size = xp.shape[0]
+    nprisms = x1.shape[0]
+    with nogil:
+        for p in range(nprisms):
+            tmp = 0
+            for l in range(size):
+                tmp += residuals[l]*gravity_kernel(
+                    code, xp[l], yp[l], zp[l], x1[p], x2[p], y1[p], y2[p],
+                    z1[p], z2[p])
+            res[p] = scale*density[p]*tmp
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
-def gyy(numpy.ndarray[DTYPE_T, ndim=1] xp not None,
-        numpy.ndarray[DTYPE_T, ndim=1] yp not None,
-        numpy.ndarray[DTYPE_T, ndim=1] zp not None,
-        double x1, double x2, double y1, double y2, double z1, double z2,
-        double density,
-        numpy.ndarray[DTYPE_T, ndim=1] res not None):
-    cdef unsigned int l, size, i, j, k
-    cdef numpy.ndarray[DTYPE_T, ndim=1] x, y, z
-    cdef DTYPE_T kernel, r, dx, dy, dz
-    size = len(xp)
-    x = numpy.array([x2, x1], dtype=DTYPE)
-    y = numpy.array([y2, y1], dtype=DTYPE)
-    z = numpy.array([z2, z1], dtype=DTYPE)
-    for l in range(size):
-        # Evaluate the integration limits
-        for k in range(2):
-            dz = z[k] - zp[l]
-            for j in range(2):
-                dy = y[j] - yp[l]
-                for i in range(2):
-                    dx = x[i] - xp[l]
-                    r = sqrt(dx**2 + dy**2 + dz**2)
-                    kernel = kernelyy(dx, dy, dz, r)
-                    res[l] += ((-1.)**(i + j + k))*kernel*density
+def magnetic_transpose(
+        field, double[:] xp not None, double[:] yp not None,
+        double[:] zp not None, double[:] x1 not None, double[:] x2 not None,
+        double[:] y1 not None, double[:] y2 not None, double[:] z1 not None,
+        double[:] z2 not None, double[:] mx not None, double[:] my not None,
+        double[:] mz not None, double fx, double fy, double fz, double scale,
+        double[:] residuals not None, double[:] res not None):
+    """
+    Multiply the transpose of the sensitivity matrix of the magnetic *field*
+    by *residuals* (one per point) without forming the matrix.
+    *res* has one element per prism.
+    """
+    cdef unsigned int l, p, size, nprisms
+    cdef int code = {'tf': TF, 'bx': BX, 'by': BY, 'bz': BZ}[field]
+    cdef double tmp
+    size = xp.shape[0]
+    nprisms = x1.shape[0]
+    with nogil:
+        for p in range(nprisms):
+            tmp = 0
+            for l in range(size):
+                tmp += residuals[l]*magnetic_kernel(
+                    code, xp[l], yp[l], zp[l], x1[p], x2[p], y1[p], y2[p],
+                    z1[p], z2[p], mx[p], my[p], mz[p], fx, fy, fz)
+            res[p] = scale*tmp
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
-def gyz(numpy.ndarray[DTYPE_T, ndim=1] xp not None,
-        numpy.ndarray[DTYPE_T, ndim=1] yp not None,
-        numpy.ndarray[DTYPE_T, ndim=1] zp not None,
-        double x1, double x2, double y1, double y2, double z1, double z2,
-        double density,
-        numpy.ndarray[DTYPE_T, ndim=1] res not None):
-    cdef unsigned int l, size, i, j, k
-    cdef numpy.ndarray[DTYPE_T, ndim=1] x, y, z
-    cdef DTYPE_T kernel, r, dx, dy, dz, tmp1, tmp2
-    size = len(xp)
-    x = numpy.array([x2, x1], dtype=DTYPE)
-    y = numpy.array([y2, y1], dtype=DTYPE)
-    z = numpy.array([z2, z1], dtype=DTYPE)
-    for l in range(size):
-        # Evaluate the integration limits
-        for k in range(2):
-            dz = z[k] - zp[l]
-            for j in range(2):
-                dy = y[j] - yp[l]
-                for i in range(2):
-                    dx = x[i] - xp[l]
-                    if dy == 0 and dz == 0 and dx < 0:
-                        tmp1 = 0.00001*(y2 - y1)
-                        tmp2 = 0.00001*(z2 - z1)
-                        r = sqrt(tmp1**2 + tmp2**2 + dx**2)
-                    else:
-                        r = sqrt(dx**2 + dy**2 + dz**2)
-                    kernel = kernelyz(dx, dy, dz, r)
-                    res[l] += ((-1.)**(i + j + k))*kernel*density
+def regular_mesh(
+        field, double[:] xp not None, double[:] yp not None,
+        double[:] zp not None, double[:] xs not None, double[:] ys not None,
+        double[:] zs not None, double[:, :, ::1] weights not None,
+        double sx, double sy, double sz, double[:] res not None):
+    """
+    Calculate the gravitational *field* of a regular prism mesh evaluating
+    the kernel only once on each node of the mesh.
+
+    The nodes are at (xs[i], ys[j], zs[k]). *weights[k, j, i]* is the signed
+    sum of the densities of the prisms that share that node (zero for nodes
+    inside regions of constant density, which are skipped). (sx, sy, sz) are
+    the dimensions of the prisms.
+    """
+    cdef unsigned int l, i, j, k, size, nx, ny, nz
+    cdef int code = FIELD_CODES[field]
+    cdef double tmp, dz, dy
+    size = xp.shape[0]
+    nz, ny, nx = weights.shape[0], weights.shape[1], weights.shape[2]
+    with nogil:
+        for l in range(size):
+            tmp = 0
+            for k in range(nz):
+                dz = zs[k] - zp[l]
+                for j in range(ny):
+                    dy = ys[j] - yp[l]
+                    for i in range(nx):
+                        if weights[k, j, i] != 0:
+                            tmp += weights[k, j, i]*node_kernel(
+                                code, xs[i] - xp[l], dy, dz, sx, sy, sz)
+            res[l] += tmp
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
-def gzz(numpy.ndarray[DTYPE_T, ndim=1] xp not None,
-        numpy.ndarray[DTYPE_T, ndim=1] yp not None,
-        numpy.ndarray[DTYPE_T, ndim=1] zp not None,
-        double x1, double x2, double y1, double y2, double z1, double z2,
-        double density,
-        numpy.ndarray[DTYPE_T, ndim=1] res not None):
-    cdef unsigned int l, size, i, j, k
-    cdef numpy.ndarray[DTYPE_T, ndim=1] x, y, z
-    cdef DTYPE_T kernel, r, dx, dy, dz
-    size = len(xp)
-    x = numpy.array([x2, x1], dtype=DTYPE)
-    y = numpy.array([y2, y1], dtype=DTYPE)
-    z = numpy.array([z2, z1], dtype=DTYPE)
-    for l in range(size):
-        # Evaluate the integration limits
-        for k in range(2):
-            dz = z[k] - zp[l]
-            for j in range(2):
-                dy = y[j] - yp[l]
-                for i in range(2):
-                    dx = x[i] - xp[l]
-                    r = sqrt(dx**2 + dy**2 + dz**2)
-                    kernel = kernelzz(dx, dy, dz, r)
-                    res[l] += ((-1.)**(i + j + k))*kernel*density
+def gravity_farfield(
+        field, double[:] xp not None, double[:] yp not None,
+        double[:] zp not None, double[:] x1 not None, double[:] x2 not None,
+        double[:] y1 not None, double[:] y2 not None, double[:] z1 not None,
+        double[:] z2 not None, double[:] density not None, double ratio,
+        double[:] res not None):
+    """
+    Calculate the gravitational *field* using a point mass for the prisms
+    whose distance from the computation point is larger than *ratio* times
+    their diagonal.
+    """
+    cdef unsigned int l, p, size, nprisms
+    cdef int code = FIELD_CODES[field]
+    cdef double tmp, dx, dy, dz, volume, diagonal
+    size = xp.shape[0]
+    nprisms = x1.shape[0]
+    with nogil:
+        for l in range(size):
+            tmp = 0
+            for p in range(nprisms):
+                dx = 0.5*(x1[p] + x2[p]) - xp[l]
+                dy = 0.5*(y1[p] + y2[p]) - yp[l]
+                dz = 0.5*(z1[p] + z2[p]) - zp[l]
+                diagonal = ((x2[p] - x1[p])**2 + (y2[p] - y1[p])**2 +
+                            (z2[p] - z1[p])**2)
+                if dx**2 + dy**2 + dz**2 > ratio**2*diagonal:
+                    volume = (x2[p] - x1[p])*(y2[p] - y1[p])*(z2[p] - z1[p])
+                    tmp += density[p]*volume*point_kernel(code, dx, dy, dz)
+                else:
+                    tmp += density[p]*gravity_kernel(
+                        code, xp[l], yp[l], zp[l], x1[p], x2[p], y1[p],
+                        y2[p], z1[p], z2[p])
+            res[l] += tmp
 
 @cython.wraparound(False)
 @cython.boundscheck(False)
-def potential(numpy.ndarray[DTYPE_T, ndim=1] xp not None,
-              numpy.ndarray[DTYPE_T, ndim=1] yp not None,
-              numpy.ndarray[DTYPE_T, ndim=1] zp not None,
-              double x1, double x2, double y1, double y2, double z1, double z2,
-              double density,
-              numpy.ndarray[DTYPE_T, ndim=1] res not None):
-    cdef unsigned int l, size, i, j, k
-    cdef numpy.ndarray[DTYPE_T, ndim=1] x, y, z
-    cdef DTYPE_T kernel, r, dx, dy, dz
-    size = len(xp)
-    x = numpy.array([x2, x1], dtype=DTYPE)
-    y = numpy.array([y2, y1], dtype=DTYPE)
-    z = numpy.array([z2, z1], dtype=DTYPE)
-    for l in range(size):
-        # Evaluate the integration limits
-        for k in range(2):
-            dz = z[k] - zp[l]
-            for j in range(2):
-                dy = y[j] - yp[l]
-                for i in range(2):
-                    dx = x[i] - xp[l]
-                    r = sqrt(dx**2 + dy**2 + dz**2)
-                    kernel = kernelpot(dx, dy, dz, r)
-                    res[l] += ((-1.)**(i + j + k))*kernel*density
+def magnetic_farfield(
+        field, double[:] xp not None, double[:] yp not None,
+        double[:] zp not None, double[:] x1 not None, double[:] x2 not None,
+        double[:] y1 not None, double[:] y2 not None, double[:] z1 not None,
+        double[:] z2 not None, double[:] mx not None, double[:] my not None,
+        double[:] mz not None, double fx, double fy, double fz, double ratio,
+        double[:] res not None):
+    """
+    Calculate the magnetic *field* using a dipole for the prisms whose
+    distance from the computation point is larger than *ratio* times their
+    diagonal.
+    """
+    cdef unsigned int l, p, size, nprisms
+    cdef int code = {'tf': TF, 'bx': BX, 'by': BY, 'bz': BZ}[field]
+    cdef double tmp, dx, dy, dz, volume, diagonal
+    size = xp.shape[0]
+    nprisms = x1.shape[0]
+    with nogil:
+        for l in range(size):
+            tmp = 0
+            for p in range(nprisms):
+                dx = 0.5*(x1[p] + x2[p]) - xp[l]
+                dy = 0.5*(y1[p] + y2[p]) - yp[l]
+                dz = 0.5*(z1[p] + z2[p]) - zp[l]
+                diagonal = ((x2[p] - x1[p])**2 + (y2[p] - y1[p])**2 +
+                            (z2[p] - z1[p])**2)
+                if dx**2 + dy**2 + dz**2 > ratio**2*diagonal:
+                    volume = (x2[p] - x1[p])*(y2[p] - y1[p])*(z2[p] - z1[p])
+                    tmp += volume*dipole_kernel(code, dx, dy, dz, mx[p],
+                                                my[p], mz[p], fx, fy, fz)
+                else:
+                    tmp += magnetic_kernel(
+                        code, xp[l], yp[l], zp[l], x1[p], x2[p], y1[p],
+                        y2[p], z1[p], z2[p], mx[p], my[p], mz[p], fx, fy, fz)
+            res[l] += tmp
+
+def tf(double[:] xp not None, double[:] yp not None, double[:] zp not None,
+       double[:] x1 not None, double[:] x2 not None, double[:] y1 not None,
+       double[:] y2 not None, double[:] z1 not None, double[:] z2 not None,
+       double[:] mx not None, double[:] my not None, double[:] mz not None,
+       double fx, double fy, double fz, double[:] res not None):
+    with nogil:
+        magnetic(TF, xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, fx, fy,
+                 fz, res)
+
+def bx(double[:] xp not None, double[:] yp not None, double[:] zp not None,
+       double[:] x1 not None, double[:] x2 not None, double[:] y1 not None,
+       double[:] y2 not None, double[:] z1 not None, double[:] z2 not None,
+       double[:] mx not None, double[:] my not None, double[:] mz not None,
+       double[:] res not None):
+    with nogil:
+        magnetic(BX, xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, 0, 0, 0,
+                 res)
+
+def by(double[:] xp not None, double[:] yp not None, double[:] zp not None,
+       double[:] x1 not None, double[:] x2 not None, double[:] y1 not None,
+       double[:] y2 not None, double[:] z1 not None, double[:] z2 not None,
+       double[:] mx not None, double[:] my not None, double[:] mz not None,
+       double[:] res not None):
+    with nogil:
+        magnetic(BY, xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, 0, 0, 0,
+                 res)
+
+def bz(double[:] xp not None, double[:] yp not None, double[:] zp not None,
+       double[:] x1 not None, double[:] x2 not None, double[:] y1 not None,
+       double[:] y2 not None, double[:] z1 not None, double[:] z2 not None,
+       double[:] mx not None, double[:] my not None, double[:] mz not None,
+       double[:] res not None):
+    with nogil:
+        magnetic(BZ, xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, 0, 0, 0,
+                 res)
+
+def gx(double[:] xp not None, double[:] yp not None, double[:] zp not None,
+       double[:] x1 not None, double[:] x2 not None, double[:] y1 not None,
+       double[:] y2 not None, double[:] z1 not None, double[:] z2 not None,
+       double[:] density not None, double[:] res not None):
+    with nogil:
+        gravity(GX, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+def gy(double[:] xp not None, double[:] yp not None, double[:] zp not None,
+       double[:] x1 not None, double[:] x2 not None, double[:] y1 not None,
+       double[:] y2 not None, double[:] z1 not None, double[:] z2 not None,
+       double[:] density not None, double[:] res not None):
+    with nogil:
+        gravity(GY, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+def gz(double[:] xp not None, double[:] yp not None, double[:] zp not None,
+       double[:] x1 not None, double[:] x2 not None, double[:] y1 not None,
+       double[:] y2 not None, double[:] z1 not None, double[:] z2 not None,
+       double[:] density not None, double[:] res not None):
+    with nogil:
+        gravity(GZ, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+def gxx(double[:] xp not None, double[:] yp not None, double[:] zp not None,
+        double[:] x1 not None, double[:] x2 not None, double[:] y1 not None,
+        double[:] y2 not None, double[:] z1 not None, double[:] z2 not None,
+        double[:] density not None, double[:] res not None):
+    with nogil:
+        gravity(GXX, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+def gxy(double[:] xp not None, double[:] yp not None, double[:] zp not None,
+        double[:] x1 not None, double[:] x2 not None, double[:] y1 not None,
+        double[:] y2 not None, double[:] z1 not None, double[:] z2 not None,
+        double[:] density not None, double[:] res not None):
+    with nogil:
+        gravity(GXY, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+def gxz(double[:] xp not None, double[:] yp not None, double[:] zp not None,
+        double[:] x1 not None, double[:] x2 not None, double[:] y1 not None,
+        double[:] y2 not None, double[:] z1 not None, double[:] z2 not None,
+        double[:] density not None, double[:] res not None):
+    with nogil:
+        gravity(GXZ, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+def gyy(double[:] xp not None, double[:] yp not None, double[:] zp not None,
+        double[:] x1 not None, double[:] x2 not None, double[:] y1 not None,
+        double[:] y2 not None, double[:] z1 not None, double[:] z2 not None,
+        double[:] density not None, double[:] res not None):
+    with nogil:
+        gravity(GYY, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+def gyz(double[:] xp not None, double[:] yp not None, double[:] zp not None,
+        double[:] x1 not None, double[:] x2 not None, double[:] y1 not None,
+        double[:] y2 not None, double[:] z1 not None, double[:] z2 not None,
+        double[:] density not None, double[:] res not None):
+    with nogil:
+        gravity(GYZ, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+def gzz(double[:] xp not None, double[:] yp not None, double[:] zp not None,
+        double[:] x1 not None, double[:] x2 not None, double[:] y1 not None,
+        double[:] y2 not None, double[:] z1 not None, double[:] z2 not None,
+        double[:] density not None, double[:] res not None):
+    with nogil:
+        gravity(GZZ, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+def potential(double[:] xp not None, double[:] yp not None,
+              double[:] zp not None, double[:] x1 not None,
+              double[:] x2 not None, double[:] y1 not None,
+              double[:] y2 not None, double[:] z1 not None,
+              double[:] z2 not None, double[:] density not None,
+              double[:] res not None):
+    with nogil:
+        gravity(POTENTIAL, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
@@ -0,0 +1,691 @@
+"""
+A numba implementation of the gravity and magnetic fields of right rectangular
+prisms.
+
+This is the backend used by fatiando.gravmag.prism when the compiled Cython
+module (fatiando.gravmag._prism) is not available. It has the same functions
+(with the same arguments) as the Cython module and is not meant to be used
+directly.
+
+The compiled functions release the GIL so that fatiando.gravmag.prism can run
+them in parallel threads (splitting the computation points, like it does with
+the Cython module). They don't use numba's own threads (``numba.prange``)
+because forking the process (e.g., with ``multiprocessing``) after those are
+started can make the interpreter hang on exit. The compiled functions are
+cached on disk so that they are only compiled the first time they are used.
+
+A few doctests for the numba code::
+
+>>> import numpy as np
+>>> xp, yp, zp = np.array([0.]), np.array([0.]), np.array([-10.])
+>>> model = [np.array([v]) for v in [-10., 10., -10., 10., 0., 20.]]
+>>> res = np.zeros(1)
+>>> gz(xp, yp, zp, *(model + [np.array([1.]), res]))
+>>> # The effect of the upper and lower halves of a prism add up
+>>> halves = np.zeros(1)
+>>> two = [np.repeat(m, 2) for m in model[:4]]
+>>> gz(xp, yp, zp, *(two + [np.array([0., 10.]), np.array([10., 20.]),
+...                         np.array([1., 1.]), halves]))
+>>> bool(np.allclose(res, halves))
+True
+
+"""
+from __future__ import division, absolute_import
+import math
+import numba
+import numpy as np
+
+# Codes used to select which field the generic loops below will calculate.
+# Same as in the Cython module.
+POTENTIAL = 0
+GX = 1
+GY = 2
+GZ = 3
+GXX = 4
+GXY = 5
+GXZ = 6
+GYY = 7
+GYZ = 8
+GZZ = 9
+TF = 10
+BX = 11
+BY = 12
+BZ = 13
+
+# Map the field names to the codes used in the compiled loops
+FIELD_CODES = {'potential': POTENTIAL, 'gx': GX, 'gy': GY, 'gz': GZ,
+               'gxx': GXX, 'gxy': GXY, 'gxz': GXZ, 'gyy': GYY, 'gyz': GYZ,
+               'gzz': GZZ}
+MAGNETIC_CODES = {'tf': TF, 'bx': BX, 'by': BY, 'bz': BZ}
+
+
+@numba.jit(nopython=True, cache=True)
+def safe_atan2(y, x):
+    if y == 0:
+        res = 0.
+    elif (y > 0) and (x < 0):
+        res = math.atan2(y, x) - math.pi
+    elif (y < 0) and (x < 0):
+        res = math.atan2(y, x) + math.pi
+    else:
+        res = math.atan2(y, x)
+    return res
+
+
+@numba.jit(nopython=True, cache=True)
+def safe_log(x):
+    if x == 0:
+        res = 0.
+    else:
+        res = math.log(x)
+    return res
+
+
+@numba.jit(nopython=True, cache=True)
+def node_kernel(field, dx, dy, dz, sx, sy, sz):
+    """
+    Evaluate the kernel of *field* on a single corner (dx, dy, dz) relative to
+    the computation point. (sx, sy, sz) are the dimensions of the prism.
+    """
+    r = math.sqrt(dx**2 + dy**2 + dz**2)
+    # Minus in gravity because Nagy et al (2000) give the formula for the
+    # gradient of the potential. Gravity is -grad(V).
+    if field == POTENTIAL:
+        return (dx*dy*safe_log(dz + r) + dy*dz*safe_log(dx + r) +
+                dx*dz*safe_log(dy + r) - 0.5*dx**2*safe_atan2(dz*dy, dx*r) -
+                0.5*dy**2*safe_atan2(dz*dx, dy*r) -
+                0.5*dz**2*safe_atan2(dx*dy, dz*r))
+    elif field == GX:
+        return -(dy*safe_log(dz + r) + dz*safe_log(dy + r) -
+                 dx*safe_atan2(dz*dy, dx*r))
+    elif field == GY:
+        return -(dz*safe_log(dx + r) + dx*safe_log(dz + r) -
+                 dy*safe_atan2(dx*dz, dy*r))
+    elif field == GZ:
+        return -(dx*safe_log(dy + r) + dy*safe_log(dx + r) -
+                 dz*safe_atan2(dx*dy, dz*r))
+    elif field == GXX:
+        return -safe_atan2(dz*dy, dx*r)
+    # The gxy, gxz, and gyz kernels have singularities when the point is
+    # aligned with some of the corners. Move the point slightly to avoid them.
+    elif field == GXY:
+        if dx == 0 and dy == 0 and dz < 0:
+            r = math.sqrt((0.00001*sx)**2 + (0.00001*sy)**2 + dz**2)
+        return safe_log(dz + r)
+    elif field == GXZ:
+        if dx == 0 and dz == 0 and dy < 0:
+            r = math.sqrt((0.00001*sx)**2 + (0.00001*sz)**2 + dy**2)
+        return safe_log(dy + r)
+    elif field == GYY:
+        return -safe_atan2(dz*dx, dy*r)
+    elif field == GYZ:
+        if dy == 0 and dz == 0 and dx < 0:
+            r = math.sqrt((0.00001*sy)**2 + (0.00001*sz)**2 + dx**2)
+        return safe_log(dx + r)
+    else:
+        return -safe_atan2(dx*dy, dz*r)
+
+
+@numba.jit(nopython=True, cache=True)
+def gravity_kernel(field, xp, yp, zp, x1, x2, y1, y2, z1, z2):
+    """
+    Evaluate the kernel of *field* on the 8 corners of a single prism.
+    """
+    res = 0.
+    for k in range(2):
+        dz = (z2 if k == 0 else z1) - zp
+        for j in range(2):
+            dy = (y2 if j == 0 else y1) - yp
+            for i in range(2):
+                dx = (x2 if i == 0 else x1) - xp
+                kernel = node_kernel(field, dx, dy, dz, x2 - x1, y2 - y1,
+                                     z2 - z1)
+                if (i + j + k) % 2 == 0:
+                    res += kernel
+                else:
+                    res -= kernel
+    return res
+
+
+@numba.jit(nopython=True, cache=True)
+def magnetic_components(xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz):
+    """
+    The bx, by, and bz components of a single prism with magnetization
+    (mx, my, mz).
+    """
+    bx, by, bz = 0., 0., 0.
+    for k in range(2):
+        dz = (z2 if k == 0 else z1) - zp
+        for j in range(2):
+            dy = (y2 if j == 0 else y1) - yp
+            for i in range(2):
+                dx = (x2 if i == 0 else x1) - xp
+                sign = 1. if (i + j + k) % 2 == 0 else -1.
+                # The magnetic fields don't use the singularity treatment of
+                # the gravity gradients
+                r = math.sqrt(dx**2 + dy**2 + dz**2)
+                v1 = -sign*safe_atan2(dz*dy, dx*r)
+                v2 = sign*safe_log(dz + r)
+                v3 = sign*safe_log(dy + r)
+                v4 = -sign*safe_atan2(dz*dx, dy*r)
+                v5 = sign*safe_log(dx + r)
+                v6 = -sign*safe_atan2(dx*dy, dz*r)
+                bx += v1*mx + v2*my + v3*mz
+                by += v2*mx + v4*my + v5*mz
+                bz += v3*mx + v5*my + v6*mz
+    return bx, by, bz
+
+
+@numba.jit(nopython=True, cache=True)
+def magnetic_kernel(field, xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz,
+                    fx, fy, fz):
+    """
+    Evaluate the magnetic *field* of a single prism with magnetization
+    (mx, my, mz). (fx, fy, fz) is the direction of the regional field (only
+    used for the total-field anomaly).
+    """
+    bx, by, bz = magnetic_components(xp, yp, zp, x1, x2, y1, y2, z1, z2, mx,
+                                     my, mz)
+    if field == BX:
+        return bx
+    elif field == BY:
+        return by
+    elif field == BZ:
+        return bz
+    return fx*bx + fy*by + fz*bz
+
+
+@numba.jit(nopython=True, cache=True)
+def point_kernel(field, dx, dy, dz):
+    """
+    The equivalent of the prism kernels for a point of unit mass at
+    (dx, dy, dz) relative to the computation point.
+    """
+    r2 = dx**2 + dy**2 + dz**2
+    r = math.sqrt(r2)
+    if field == POTENTIAL:
+        return 1/r
+    elif field == GX:
+        return dx/(r*r2)
+    elif field == GY:
+        return dy/(r*r2)
+    elif field == GZ:
+        return dz/(r*r2)
+    r5 = r*r2*r2
+    if field == GXX:
+        return (3*dx**2 - r2)/r5
+    elif field == GXY:
+        return 3*dx*dy/r5
+    elif field == GXZ:
+        return 3*dx*dz/r5
+    elif field == GYY:
+        return (3*dy**2 - r2)/r5
+    elif field == GYZ:
+        return 3*dy*dz/r5
+    else:
+        return (3*dz**2 - r2)/r5
+
+
+@numba.jit(nopython=True, cache=True)
+def dipole_kernel(field, dx, dy, dz, mx, my, mz, fx, fy, fz):
+    """
+    The equivalent of magnetic_kernel for a dipole with unit volume and
+    magnetization (mx, my, mz) at (dx, dy, dz) relative to the computation
+    point.
+    """
+    v1 = point_kernel(GXX, dx, dy, dz)
+    v2 = point_kernel(GXY, dx, dy, dz)
+    v3 = point_kernel(GXZ, dx, dy, dz)
+    v4 = point_kernel(GYY, dx, dy, dz)
+    v5 = point_kernel(GYZ, dx, dy, dz)
+    v6 = point_kernel(GZZ, dx, dy, dz)
+    bx = v1*mx + v2*my + v3*mz
+    by = v2*mx + v4*my + v5*mz
+    bz = v3*mx + v5*my + v6*mz
+    if field == BX:
+        return bx
+    elif field == BY:
+        return by
+    elif field == BZ:
+        return bz
+    return fx*bx + fy*by + fz*bz
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def gravity(field, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res):
+    """
+    Add the gravitational *field* of all prisms to *res*.
+    """
+    for l in range(xp.size):
+        tmp = 0.
+        for p in range(x1.size):
+            tmp += density[p]*gravity_kernel(
+                field, xp[l], yp[l], zp[l], x1[p], x2[p], y1[p], y2[p], z1[p],
+                z2[p])
+        res[l] += tmp
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def magnetic(field, xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, fx, fy,
+             fz, res):
+    """
+    Add the magnetic *field* of all prisms to *res*.
+    """
+    for l in range(xp.size):
+        tmp = 0.
+        for p in range(x1.size):
+            tmp += magnetic_kernel(
+                field, xp[l], yp[l], zp[l], x1[p], x2[p], y1[p], y2[p], z1[p],
+                z2[p], mx[p], my[p], mz[p], fx, fy, fz)
+        res[l] += tmp
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def fused(codes, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res):
+    """
+    Add the gravitational fields with the given *codes* to the columns of
+    *res*.
+
+    All fields are evaluated in a single pass over the corners of the prisms.
+    The distance to the corner and the log and atan2 terms of the kernels are
+    computed only once per corner and shared by all fields.
+    """
+    need_logx, need_logy, need_logz = False, False, False
+    need_atanx, need_atany, need_atanz = False, False, False
+    # Find out which of the log and atan2 terms are needed
+    for code in codes:
+        if code == POTENTIAL:
+            need_logx = need_logy = need_logz = True
+            need_atanx = need_atany = need_atanz = True
+        elif code == GX:
+            need_logy = need_logz = need_atanx = True
+        elif code == GY:
+            need_logx = need_logz = need_atany = True
+        elif code == GZ:
+            need_logx = need_logy = need_atanz = True
+        elif code == GXX:
+            need_atanx = True
+        elif code == GXY:
+            need_logz = True
+        elif code == GXZ:
+            need_logy = True
+        elif code == GYY:
+            need_atany = True
+        elif code == GYZ:
+            need_logx = True
+        else:
+            need_atanz = True
+    for l in range(xp.size):
+        for p in range(x1.size):
+            for k in range(2):
+                dz = (z2[p] if k == 0 else z1[p]) - zp[l]
+                for j in range(2):
+                    dy = (y2[p] if j == 0 else y1[p]) - yp[l]
+                    for i in range(2):
+                        dx = (x2[p] if i == 0 else x1[p]) - xp[l]
+                        r = math.sqrt(dx**2 + dy**2 + dz**2)
+                        logx, logy, logz = 0., 0., 0.
+                        atanx, atany, atanz = 0., 0., 0.
+                        if need_logx:
+                            logx = safe_log(dx + r)
+                        if need_logy:
+                            logy = safe_log(dy + r)
+                        if need_logz:
+                            logz = safe_log(dz + r)
+                        if need_atanx:
+                            atanx = safe_atan2(dz*dy, dx*r)
+                        if need_atany:
+                            atany = safe_atan2(dz*dx, dy*r)
+                        if need_atanz:
+                            atanz = safe_atan2(dx*dy, dz*r)
+                        if (i + j + k) % 2 == 0:
+                            weight = density[p]
+                        else:
+                            weight = -density[p]
+                        for f in range(codes.size):
+                            code = codes[f]
+                            if code == POTENTIAL:
+                                kernel = (dx*dy*logz + dy*dz*logx +
+                                          dx*dz*logy - 0.5*dx**2*atanx -
+                                          0.5*dy**2*atany -
+                                          0.5*dz**2*atanz)
+                            elif code == GX:
+                                kernel = -(dy*logz + dz*logy - dx*atanx)
+                            elif code == GY:
+                                kernel = -(dz*logx + dx*logz - dy*atany)
+                            elif code == GZ:
+                                kernel = -(dx*logy + dy*logx - dz*atanz)
+                            elif code == GXX:
+                                kernel = -atanx
+                            elif code == GXY:
+                                kernel = logz
+                                # Same singularity treatment as in
+                                # node_kernel
+                                if dx == 0 and dy == 0 and dz < 0:
+                                    t1 = 0.00001*(x2[p] - x1[p])
+                                    t2 = 0.00001*(y2[p] - y1[p])
+                                    rs = math.sqrt(t1**2 + t2**2 + dz**2)
+                                    kernel = safe_log(dz + rs)
+                            elif code == GXZ:
+                                kernel = logy
+                                if dx == 0 and dz == 0 and dy < 0:
+                                    t1 = 0.00001*(x2[p] - x1[p])
+                                    t2 = 0.00001*(z2[p] - z1[p])
+                                    rs = math.sqrt(t1**2 + t2**2 + dy**2)
+                                    kernel = safe_log(dy + rs)
+                            elif code == GYY:
+                                kernel = -atany
+                            elif code == GYZ:
+                                kernel = logx
+                                if dy == 0 and dz == 0 and dx < 0:
+                                    t1 = 0.00001*(y2[p] - y1[p])
+                                    t2 = 0.00001*(z2[p] - z1[p])
+                                    rs = math.sqrt(t1**2 + t2**2 + dx**2)
+                                    kernel = safe_log(dx + rs)
+                            else:
+                                kernel = -atanz
+                            res[l, f] += weight*kernel
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def magnetic_fused(xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, fx, fy,
+                   fz, res):
+    """
+    Add tf, bx, by, and bz to the columns of *res*.
+    """
+    for l in range(xp.size):
+        for p in range(x1.size):
+            bx, by, bz = magnetic_components(
+                xp[l], yp[l], zp[l], x1[p], x2[p], y1[p], y2[p], z1[p], z2[p],
+                mx[p], my[p], mz[p])
+            res[l, 0] += fx*bx + fy*by + fz*bz
+            res[l, 1] += bx
+            res[l, 2] += by
+            res[l, 3] += bz
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def gravity_matrix(field, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, scale,
+                   res):
+    """
+    Fill *res* (shape = (npoints, nprisms)) with the gravitational *field* of
+    each prism times *scale*.
+    """
+    for l in range(xp.size):
+        for p in range(x1.size):
+            res[l, p] = scale*density[p]*gravity_kernel(
+                field, xp[l], yp[l], zp[l], x1[p], x2[p], y1[p], y2[p], z1[p],
+                z2[p])
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def magnetic_matrix(field, xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz,
+                    fx, fy, fz, scale, res):
+    """
+    Fill *res* (shape = (npoints, nprisms)) with the magnetic *field* of each
+    prism times *scale*.
+    """
+    for l in range(xp.size):
+        for p in range(x1.size):
+            res[l, p] = scale*magnetic_kernel(
+                field, xp[l], yp[l], zp[l], x1[p], x2[p], y1[p], y2[p], z1[p],
+                z2[p], mx[p], my[p], mz[p], fx, fy, fz)
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def gravity_matrix_transpose(field, xp, yp, zp, x1, x2, y1, y2, z1, z2,
+                             density, scale, residuals, res):
+    """
+    Multiply the transpose of the sensitivity matrix of the gravitational
+    *field* by *residuals*.
+    """
+    for p in range(x1.size):
+        tmp = 0.
+        for l in range(xp.size):
+            tmp += residuals[l]*gravity_kernel(
+                field, xp[l], yp[l], zp[l], x1[p], x2[p], y1[p], y2[p], z1[p],
+                z2[p])
+        res[p] = scale*density[p]*tmp
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def magnetic_matrix_transpose(field, xp, yp, zp, x1, x2, y1, y2, z1, z2, mx,
+                              my, mz, fx, fy, fz, scale, residuals, res):
+    """
+    Multiply the transpose of the sensitivity matrix of the magnetic *field*
+    by *residuals*.
+    """
+    for p in range(x1.size):
+        tmp = 0.
+        for l in range(xp.size):
+            tmp += residuals[l]*magnetic_kernel(
+                field, xp[l], yp[l], zp[l], x1[p], x2[p], y1[p], y2[p], z1[p],
+                z2[p], mx[p], my[p], mz[p], fx, fy, fz)
+        res[p] = scale*tmp
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def nodes(field, xp, yp, zp, xs, ys, zs, weights, sx, sy, sz, res):
+    """
+    Add the gravitational *field* of a regular mesh evaluating the kernel
+    only once on each node.
+    """
+    nz, ny, nx = weights.shape
+    for l in range(xp.size):
+        tmp = 0.
+        for k in range(nz):
+            for j in range(ny):
+                for i in range(nx):
+                    if weights[k, j, i] != 0:
+                        tmp += weights[k, j, i]*node_kernel(
+                            field, xs[i] - xp[l], ys[j] - yp[l],
+                            zs[k] - zp[l], sx, sy, sz)
+        res[l] += tmp
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def gravity_far(field, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, ratio,
+                res):
+    """
+    Add the gravitational *field* using point masses for the prisms farther
+    than *ratio* times their diagonal.
+    """
+    for l in range(xp.size):
+        tmp = 0.
+        for p in range(x1.size):
+            dx = 0.5*(x1[p] + x2[p]) - xp[l]
+            dy = 0.5*(y1[p] + y2[p]) - yp[l]
+            dz = 0.5*(z1[p] + z2[p]) - zp[l]
+            diagonal = ((x2[p] - x1[p])**2 + (y2[p] - y1[p])**2 +
+                        (z2[p] - z1[p])**2)
+            if dx**2 + dy**2 + dz**2 > ratio**2*diagonal:
+                volume = (x2[p] - x1[p])*(y2[p] - y1[p])*(z2[p] - z1[p])
+                tmp += density[p]*volume*point_kernel(field, dx, dy, dz)
+            else:
+                tmp += density[p]*gravity_kernel(
+                    field, xp[l], yp[l], zp[l], x1[p], x2[p], y1[p], y2[p],
+                    z1[p], z2[p])
+        res[l] += tmp
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def magnetic_far(field, xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, fx,
+                 fy, fz, ratio, res):
+    """
+    Add the magnetic *field* using dipoles for the prisms farther than
+    *ratio* times their diagonal.
+    """
+    for l in range(xp.size):
+        tmp = 0.
+        for p in range(x1.size):
+            dx = 0.5*(x1[p] + x2[p]) - xp[l]
+            dy = 0.5*(y1[p] + y2[p]) - yp[l]
+            dz = 0.5*(z1[p] + z2[p]) - zp[l]
+            diagonal = ((x2[p] - x1[p])**2 + (y2[p] - y1[p])**2 +
+                        (z2[p] - z1[p])**2)
+            if dx**2 + dy**2 + dz**2 > ratio**2*diagonal:
+                volume = (x2[p] - x1[p])*(y2[p] - y1[p])*(z2[p] - z1[p])
+                tmp += volume*dipole_kernel(field, dx, dy, dz, mx[p], my[p],
+                                            mz[p], fx, fy, fz)
+            else:
+                tmp += magnetic_kernel(
+                    field, xp[l], yp[l], zp[l], x1[p], x2[p], y1[p], y2[p],
+                    z1[p], z2[p], mx[p], my[p], mz[p], fx, fy, fz)
+        res[l] += tmp
+
+
+# The functions below have the same names and arguments as the ones in the
+# Cython module.
+
+def potential(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res):
+    gravity(POTENTIAL, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+
+def gx(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res):
+    gravity(GX, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+
+def gy(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res):
+    gravity(GY, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+
+def gz(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res):
+    gravity(GZ, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+
+def gxx(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res):
+    gravity(GXX, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+
+def gxy(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res):
+    gravity(GXY, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+
+def gxz(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res):
+    gravity(GXZ, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+
+def gyy(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res):
+    gravity(GYY, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+
+def gyz(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res):
+    gravity(GYZ, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+
+def gzz(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res):
+    gravity(GZZ, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+
+def tf(xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, fx, fy, fz, res):
+    magnetic(TF, xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, fx, fy, fz,
+             res)
+
+
+def bx(xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, res):
+    magnetic(BX, xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, 0., 0., 0.,
+             res)
+
+
+def by(xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, res):
+    magnetic(BY, xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, 0., 0., 0.,
+             res)
+
+
+def bz(xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, res):
+    magnetic(BZ, xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, 0., 0., 0.,
+             res)
+
+
+def fields(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, names, res):
+    """
+    Calculate the gravitational fields given in the sequence *names* at once.
+    Column i of *res* (shape = (npoints, len(names))) gets the field
+    names[i].
+    """
+    if len(names) > 10 or len(names) != res.shape[1]:
+        raise ValueError("Invalid number of fields {}".format(len(names)))
+    codes = np.array([FIELD_CODES[name] for name in names], dtype=np.int64)
+    fused(codes, xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+
+
+def magnetic_fields(xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, fx, fy, fz,
+                    res):
+    """
+    Calculate tf, bx, by, and bz at once. The columns of *res*
+    (shape = (npoints, 4)) get each field, in this order.
+    """
+    magnetic_fused(xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, fx, fy, fz,
+                   res)
+
+
+def gravity_sensitivity(field, xp, yp, zp, x1, x2, y1, y2, z1, z2, density,
+                        scale, res):
+    """
+    Fill *res* (shape = (npoints, nprisms)) with the gravitational *field* of
+    each prism times *scale*. *res* can be float32 or float64.
+    """
+    gravity_matrix(FIELD_CODES[field], xp, yp, zp, x1, x2, y1, y2, z1, z2,
+                   density, scale, np.asarray(res))
+
+
+def magnetic_sensitivity(field, xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my,
+                         mz, fx, fy, fz, scale, res):
+    """
+    Fill *res* (shape = (npoints, nprisms)) with the magnetic *field* of each
+    prism times *scale*. *res* can be float32 or float64.
+    """
+    magnetic_matrix(MAGNETIC_CODES[field], xp, yp, zp, x1, x2, y1, y2, z1,
+                    z2, mx, my, mz, fx, fy, fz, scale, np.asarray(res))
+
+
+def gravity_transpose(field, xp, yp, zp, x1, x2, y1, y2, z1, z2, density,
+                      scale, residuals, res):
+    """
+    Multiply the transpose of the sensitivity matrix of the gravitational
+    *field* by *residuals* (one per point) without forming the matrix.
+    """
+    gravity_matrix_transpose(FIELD_CODES[field], xp, yp, zp, x1, x2, y1, y2,
+                             z1, z2, density, scale, residuals, res)
+
+
+def magnetic_transpose(field, xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz,
+                       fx, fy, fz, scale, residuals, res):
+    """
+    Multiply the transpose of the sensitivity matrix of the magnetic *field*
+    by *residuals* (one per point) without forming the matrix.
+    """
+    magnetic_matrix_transpose(MAGNETIC_CODES[field], xp, yp, zp, x1, x2, y1,
+                              y2, z1, z2, mx, my, mz, fx, fy, fz, scale,
+                              residuals, res)
+
+
+def regular_mesh(field, xp, yp, zp, xs, ys, zs, weights, sx, sy, sz, res):
+    """
+    Calculate the gravitational *field* of a regular prism mesh evaluating
+    the kernel only once on each node of the mesh.
+    """
+    nodes(FIELD_CODES[field], xp, yp, zp, xs, ys, zs, weights, sx, sy, sz,
+          res)
+
+
+def gravity_farfield(field, xp, yp, zp, x1, x2, y1, y2, z1, z2, density,
+                     ratio, res):
+    """
+    Calculate the gravitational *field* using a point mass for the prisms
+    whose distance from the computation point is larger than *ratio* times
+    their diagonal.
+    """
+    gravity_far(FIELD_CODES[field], xp, yp, zp, x1, x2, y1, y2, z1, z2,
+                density, ratio, res)
+
+
+def magnetic_farfield(field, xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz,
+                      fx, fy, fz, ratio, res):
+    """
+    Calculate the magnetic *field* using a dipole for the prisms whose
+    distance from the computation point is larger than *ratio* times their
+    diagonal.
+    """
+    magnetic_far(MAGNETIC_CODES[field], xp, yp, zp, x1, x2, y1, y2, z1, z2,
+                 mx, my, mz, fx, fy, fz, ratio, res)
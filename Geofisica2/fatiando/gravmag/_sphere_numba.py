@@ -0,0 +1,179 @@
+"""
+A numba implementation of the gravity and magnetic fields of spheres.
+
+These functions are used by fatiando.gravmag.sphere as a backend and are not
+meant to be used directly. The spheres are packed into a single array (one
+sphere per column) with the center, the mass (density times volume) and the
+magnetic moment (magnetization times volume) of each sphere.
+
+The computation points are split into blocks. Each block visits the spheres
+in blocks as well, so that the spheres being used stay in the CPU cache while
+all points of the block go through them. All requested fields are calculated
+in the same pass. The engine releases the GIL so that fatiando.gravmag.sphere
+can run it on parts of the points in parallel threads. The compiled functions
+are cached on disk so that they are only compiled the first time they are
+used.
+
+A few doctests for the numba code::
+
+>>> import numpy as np
+>>> xp, yp, zp = np.zeros(2), np.zeros(2), np.array([0., -100.])
+>>> sources = np.array([[0., 0., 100., 1., 0., 0., 1.]]).T
+>>> result = np.zeros((2, 2))
+>>> codes = np.array([GZ, BZ])
+>>> engine(codes, xp, yp, zp, sources, np.zeros(3), result)
+>>> bool(np.allclose(result[:, 0], [1/100**2, 1/200**2]))
+True
+>>> bool(np.allclose(result[:, 1], [2/100**3, 2/200**3]))
+True
+
+"""
+from __future__ import division, absolute_import
+import math
+import numba
+import numpy as np
+
+# Codes used to select which field the engine will calculate
+GZ = 0
+GXX = 1
+GXY = 2
+GXZ = 3
+GYY = 4
+GYZ = 5
+GZZ = 6
+BX = 7
+BY = 8
+BZ = 9
+TF = 10
+
+# Map the field names to the codes used in the compiled loops
+FIELD_CODES = {'gz': GZ, 'gxx': GXX, 'gxy': GXY, 'gxz': GXZ, 'gyy': GYY,
+               'gyz': GYZ, 'gzz': GZZ, 'bx': BX, 'by': BY, 'bz': BZ, 'tf': TF}
+
+# The number of computation points (and spheres) in each block. A block of
+# spheres takes 28 Kb, small enough to stay in the cache.
+POINT_BLOCK = 256
+SPHERE_BLOCK = 512
+
+
+@numba.jit(nopython=True, cache=True, error_model='numpy')
+def accumulate_gz(xp, yp, zp, sources, low, high, sums):
+    """
+    Add gz of the spheres in columns low:high of *sources* to *sums*.
+    """
+    # Going over the points for each sphere vectorizes better here
+    for s in range(low, high):
+        sx, sy, sz = sources[0, s], sources[1, s], sources[2, s]
+        mass = sources[3, s]
+        for i in range(xp.size):
+            x = sx - xp[i]
+            y = sy - yp[i]
+            z = sz - zp[i]
+            r_sqr = x*x + y*y + z*z
+            sums[0, i] += mass*z/(r_sqr*math.sqrt(r_sqr))
+
+
+# Let the compiler reorder the sums over the spheres so that the loops below
+# can be vectorized. The other fast math flags would break the inf and nan
+# values of points that coincide with the center of a sphere.
+FASTMATH = {'reassoc', 'nsz', 'contract'}
+
+
+@numba.jit(nopython=True, fastmath=FASTMATH, error_model='numpy',
+           cache=True)
+def accumulate_gradients(xp, yp, zp, sources, low, high, sums):
+    """
+    Add the 6 gravity gradients of the spheres in columns low:high of
+    *sources* to *sums*.
+    """
+    for i in range(xp.size):
+        vxx, vxy, vxz, vyy, vyz, vzz = 0., 0., 0., 0., 0., 0.
+        for s in range(low, high):
+            x = sources[0, s] - xp[i]
+            y = sources[1, s] - yp[i]
+            z = sources[2, s] - zp[i]
+            r_sqr = x*x + y*y + z*z
+            mass_5 = sources[3, s]/(r_sqr*r_sqr*math.sqrt(r_sqr))
+            vxx += mass_5*(3*x*x - r_sqr)
+            vxy += mass_5*3*x*y
+            vxz += mass_5*3*x*z
+            vyy += mass_5*(3*y*y - r_sqr)
+            vyz += mass_5*3*y*z
+            vzz += mass_5*(3*z*z - r_sqr)
+        sums[1, i] += vxx
+        sums[2, i] += vxy
+        sums[3, i] += vxz
+        sums[4, i] += vyy
+        sums[5, i] += vyz
+        sums[6, i] += vzz
+
+
+@numba.jit(nopython=True, fastmath=FASTMATH, error_model='numpy',
+           cache=True)
+def accumulate_induction(xp, yp, zp, sources, low, high, sums):
+    """
+    Add the magnetic induction of the spheres in columns low:high of
+    *sources* to *sums*.
+    """
+    for i in range(xp.size):
+        bx, by, bz = 0., 0., 0.
+        for s in range(low, high):
+            x = sources[0, s] - xp[i]
+            y = sources[1, s] - yp[i]
+            z = sources[2, s] - zp[i]
+            r_sqr = x*x + y*y + z*z
+            inv_r_5 = 1/(r_sqr*r_sqr*math.sqrt(r_sqr))
+            mx, my, mz = sources[4, s], sources[5, s], sources[6, s]
+            dotprod = 3*(mx*x + my*y + mz*z)
+            bx += (dotprod*x - r_sqr*mx)*inv_r_5
+            by += (dotprod*y - r_sqr*my)*inv_r_5
+            bz += (dotprod*z - r_sqr*mz)*inv_r_5
+        sums[7, i] += bx
+        sums[8, i] += by
+        sums[9, i] += bz
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def engine(codes, xp, yp, zp, sources, direction, result):
+    """
+    Calculate the fields in *codes* of all spheres in *sources* on the
+    computation points. Column j of *result* gets the field codes[j]. The
+    total-field anomaly is projected on the unit vector *direction*.
+    """
+    gz = False
+    gradients = False
+    induction = False
+    for code in codes:
+        if code == GZ:
+            gz = True
+        elif code <= GZZ:
+            gradients = True
+        else:
+            induction = True
+    npoints = xp.size
+    nsources = sources.shape[1]
+    nblocks = (npoints + POINT_BLOCK - 1)//POINT_BLOCK
+    for block in range(nblocks):
+        start = block*POINT_BLOCK
+        end = min(start + POINT_BLOCK, npoints)
+        # gz, the 6 gradients, and the 3 components of the induction
+        sums = np.zeros((10, end - start))
+        for low in range(0, nsources, SPHERE_BLOCK):
+            high = min(low + SPHERE_BLOCK, nsources)
+            if gz:
+                accumulate_gz(xp[start:end], yp[start:end], zp[start:end],
+                              sources, low, high, sums)
+            if gradients:
+                accumulate_gradients(xp[start:end], yp[start:end],
+                                     zp[start:end], sources, low, high, sums)
+            if induction:
+                accumulate_induction(xp[start:end], yp[start:end],
+                                     zp[start:end], sources, low, high, sums)
+        for i in range(start, end):
+            for j in range(codes.size):
+                if codes[j] == TF:
+                    result[i, j] = (direction[0]*sums[7, i - start] +
+                                    direction[1]*sums[8, i - start] +
+                                    direction[2]*sums[9, i - start])
+                else:
+                    result[i, j] = sums[codes[j], i - start]
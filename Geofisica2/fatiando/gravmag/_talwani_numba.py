@@ -0,0 +1,102 @@
+"""
+A numba implementation of the gravity of 2D bodies with polygonal
+cross-section (Talwani et al., 1959).
+
+These functions are used by fatiando.gravmag.talwani as a backend and are not
+meant to be used directly. The polygons are packed into flat arrays: the x and
+z coordinates of the vertices of all polygons (one after the other), the
+offsets of the first vertex of each polygon (with one extra element at the
+end), and their densities.
+
+``edge`` calculates the contribution of a single edge of a polygon (from
+vertex (xv, zv) to (xvp1, zvp1), relative to the computation point). The
+loops over the computation points don't allocate any temporary arrays and
+release the GIL so that fatiando.gravmag.talwani can run them on parts of the
+points in parallel threads. The compiled functions are cached on disk so that
+they are only compiled the first time they are used.
+
+A few doctests for the numba code::
+
+>>> import numpy as np
+>>> xp, zp = np.array([-100., 0., 300.]), np.zeros(3)
+>>> x = np.array([-50., 50., 50., -50.])
+>>> z = np.array([100., 100., 200., 200.])
+>>> res = np.zeros(3)
+>>> engine(xp, zp, x, z, np.array([0, 4]), np.ones(1), res)
+>>> # Summing the contribution of each edge gives the same result
+>>> edges = np.zeros((4, 3))
+>>> edge_engine(xp, zp, x, z, np.roll(x, -1), np.roll(z, -1), edges)
+>>> bool(np.allclose(edges.sum(axis=0), res))
+True
+
+"""
+from __future__ import division, absolute_import
+import math
+import numba
+
+
+@numba.jit(nopython=True, cache=True, error_model='numpy')
+def edge(xv, zv, xvp1, zvp1):
+    "The contribution of a single edge of a polygon (without the density)"
+    # Temporary fix. The analytical conditions for these limits don't
+    # work. So if the conditions are breached, sum 0.01 meters to the
+    # coodinates and be happy
+    if xv == 0.:
+        xv += 0.01
+    if xv == xvp1:
+        xv += 0.01
+    if xv == zv and zv == 0.:
+        zv += 0.01
+    if zv == zvp1:
+        zv += 0.01
+    if xvp1 == zvp1 and zvp1 == 0.:
+        zvp1 += 0.01
+    if xvp1 == 0.:
+        xvp1 += 0.01
+    # End of fix
+    theta_v = math.atan2(zv, xv)
+    theta_vp1 = math.atan2(zvp1, xvp1)
+    if theta_v < 0:
+        theta_v += math.pi
+    if theta_vp1 < 0:
+        theta_vp1 += math.pi
+    if theta_v == theta_vp1:
+        return 0.
+    phi_v = math.atan2(zvp1 - zv, xvp1 - xv)
+    ai = xvp1 + zvp1*(xvp1 - xv)/(zv - zvp1)
+    tan_phi_v = math.tan(phi_v)
+    return ai*math.sin(phi_v)*math.cos(phi_v)*(
+        theta_v - theta_vp1 + tan_phi_v*math.log(
+            (math.cos(theta_v)*(math.tan(theta_v) - tan_phi_v)) /
+            (math.cos(theta_vp1)*(math.tan(theta_vp1) - tan_phi_v))))
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def engine(xp, zp, x, z, offsets, density, result):
+    """
+    Calculate the sum of the edge contributions of all polygons (times their
+    density) on the computation points and put it in *result*.
+    """
+    for i in range(xp.size):
+        res = 0.
+        for j in range(density.size):
+            first, last = offsets[j], offsets[j + 1]
+            kernel = 0.
+            for k in range(first, last):
+                following = k + 1 if k + 1 < last else first
+                kernel += edge(x[k] - xp[i], z[k] - zp[i],
+                               x[following] - xp[i], z[following] - zp[i])
+            res += kernel*density[j]
+        result[i] = res
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def edge_engine(xp, zp, x1, z1, x2, z2, result):
+    """
+    Calculate the contribution of each edge (from (x1, z1) to (x2, z2)) on
+    the computation points. Row k of *result* gets the contribution of edge k.
+    """
+    for i in range(xp.size):
+        for k in range(x1.size):
+            result[k, i] = edge(x1[k] - xp[i], z1[k] - zp[i],
+                                x2[k] - xp[i], z2[k] - zp[i])
@@ -1,8 +1,13 @@
 """
 A numba implementation of the tesseroid gravity effects.
 
-These functions compute the effect of a single tesseroid. They are used by
+These functions compute the effect of a tesseroid model (given as an array
+with the bounds of each tesseroid and an array of densities). Any combination
+of fields (given by their codes) can be calculated at once, sharing the
+adaptive discretization of the tesseroids. They are used by
 fatiando.gravmag.tesseroid as a backend and are not meant to be used directly.
+The compiled functions are cached on disk so that they are only compiled the
+first time they are used (and not again in every new process).
 
 A few doctests for the numba code::
 
@@ -28,48 +33,233 @@ import numpy as np
 from ..constants import MEAN_EARTH_RADIUS
 
 
-nodes = np.array([-0.577350269189625731058868041146,
-                  0.577350269189625731058868041146])
+# The Gauss-Legendre Quadrature nodes and weights of orders 2 to MAX_ORDER.
+# Row N has the N nodes (weights) of order N padded with zeros.
+MAX_ORDER = 8
+GLQ_NODES = np.zeros((MAX_ORDER + 1, MAX_ORDER))
+GLQ_WEIGHTS = np.zeros((MAX_ORDER + 1, MAX_ORDER))
+for _order in range(2, MAX_ORDER + 1):
+    GLQ_NODES[_order, :_order], GLQ_WEIGHTS[_order, :_order] = \
+        np.polynomial.legendre.leggauss(_order)
+
+# Codes used by the engines to select the kernels of each field
+POTENTIAL = 0
+GX = 1
+GY = 2
+GZ = 3
+GXX = 4
+GXY = 5
+GXZ = 6
+GYY = 7
+GYZ = 8
+GZZ = 9
+FIELD_CODES = {'potential': POTENTIAL, 'gx': GX, 'gy': GY, 'gz': GZ,
+               'gxx': GXX, 'gxy': GXY, 'gxz': GXZ, 'gyy': GYY, 'gyz': GYZ,
+               'gzz': GZZ}
+
+
+@numba.jit(nopython=True, cache=True)
+def point_effect(codes, lon, coslat, sinlat, radius, bounds, density, ratio,
+                 order_ratios, stack, lonc, sinlatc, coslatc, rc, out, info):
+    """
+    Integrate all tesseroids on a single point.
+
+    The kernels of all fields in *codes* are evaluated for each tesseroid
+    (see tesseroid_effect) and the results are added to *out* (one element per
+    field).
+
+    Returns the stack (which can be a new array).
+    """
+    for t in range(bounds.shape[0]):
+        stack = tesseroid_effect(
+            codes, lon, coslat, sinlat, radius, bounds[t], density[t], ratio,
+            order_ratios, stack, lonc, sinlatc, coslatc, rc, out, info)
+    return stack
+
+
+@numba.jit(nopython=True, cache=True)
+def tesseroid_effect(codes, lon, coslat, sinlat, radius, bounds, density,
+                     ratio, order_ratios, stack, lonc, sinlatc, coslatc, rc,
+                     out, info):
+    """
+    Integrate a single tesseroid on a single point.
+
+    The adaptive discretization is done once and the kernels of all fields in
+    *codes* are evaluated on each resulting tesseroid. The results are added
+    to *out* (one element per field). Tesseroids that would be divided are
+    integrated with a higher GLQ order instead if that is cheaper (see
+    raise_order). *order_ratios* has the distance/size ratio needed by each
+    order (up to order ``order_ratios.size - 1``).
+
+    *info* accumulates the error code, the maximum depth of the stack, and the
+    number of kernel evaluations (one per GLQ node and field), in this order.
+    If the stack is too small for the discretization, a larger copy is made.
+
+    Returns the stack (which can be a new array).
+    """
+    # Order 2 would need too many divisions to be accurate close to the
+    # point, so the tesseroids are not divided radially below 1 km. The
+    # higher orders are accurate on much thinner ones (down to 10 m, which
+    # keeps the distances to the GLQ nodes above the rounding errors).
+    min_lr = 1e3 if order_ratios.size <= 3 else 10.
+    for i in range(6):
+        stack[0, i] = bounds[i]
+    stktop = 0
+    while stktop >= 0:
+        w, e, s, n, top, bottom = stack[stktop, :]
+        stktop -= 1
+        distance, Llon, Llat, Lr = distance_size(
+            lon, coslat, sinlat, radius, w, e, s, n, top, bottom)
+        nlon, nlat, nr, new_cells, err = divisions(
+            distance, Llon, Llat, Lr, ratio, min_lr)
+        order = 2
+        if new_cells > 1 or err != 0:
+            order = raise_order(distance, max(Llon, Llat, Lr), ratio,
+                                new_cells, err, order_ratios)
+        if order == 2:
+            info[0] += err
+        if order == 2 and new_cells > 1:
+            if new_cells + (stktop + 1) > stack.shape[0]:
+                stack = grow(stack, stktop, new_cells)
+            stktop = split(w, e, s, n, top, bottom, nlon, nlat, nr, stack,
+                           stktop)
+            info[1] = max(info[1], stktop + 1)
+        else:
+            weights = GLQ_WEIGHTS[order, :order]
+            scale = density*scale_nodes(
+                w, e, s, n, top, bottom, GLQ_NODES[order, :order], lonc,
+                sinlatc, coslatc, rc)
+            for f in range(codes.size):
+                out[f] += scale*kernel(codes[f], lon, coslat, sinlat, radius,
+                                       lonc, sinlatc, coslatc, rc, weights)
+            info[2] += codes.size*order**3
+    return stack
+
+
+def order_ratios(ratio, max_order):
+    """
+    The distance/size ratios needed by GLQ orders 2 to *max_order* for the
+    same accuracy (on each tesseroid) that order 2 has at *ratio*.
+
+    The GLQ error of order N decays with rho**(-2N), where rho is the size of
+    the largest ellipse (with foci on the ends of the integration interval)
+    that doesn't contain the singularity of the integrand (the computation
+    point). Order N matches the accuracy of order 2 when rho_N = rho_2**(2/N).
+    The distances are measured in units of half the diagonal of the tesseroid
+    to account for the points that are close to its edges and corners. The
+    points must also be farther than the size of the tesseroid (or *ratio* if
+    smaller) so that they are well outside of it.
+
+    Returns:
+
+    * ratios : 1d-array
+        Element N is the ratio for order N (elements 0 and 1 are unused).
+
+    """
+    half_diagonal = 0.5*np.sqrt(3)
+    distance = ratio/half_diagonal
+    rho = distance + np.sqrt(max(distance**2 - 1, 0))
+    ratios = np.zeros(max_order + 1)
+    ratios[2] = ratio
+    for order in range(3, max_order + 1):
+        rho_order = rho**(2/order)
+        ratios[order] = max(half_diagonal*0.5*(rho_order + 1/rho_order),
+                            min(ratio, 1))
+    return ratios
+
+
+@numba.jit(nopython=True, cache=True)
+def raise_order(distance, size, ratio, new_cells, err, order_ratios):
+    """
+    Choose between dividing a tesseroid and integrating it with a higher GLQ
+    order.
+
+    The cost of dividing is estimated as the kernel evaluations of the
+    tesseroids that result from dividing it (*new_cells* per level) until
+    they are small enough for order 2. The lowest order that is accurate at
+    this distance is used if it is cheaper. If the tesseroid is too small to
+    be divided further (*err* is not 0), that order is used regardless of the
+    cost because order 2 would not be accurate.
+
+    Returns:
+
+    * order : int
+        The GLQ order. 2 means that the tesseroid should be divided.
+
+    """
+    if distance <= 0 or order_ratios.size <= 3:
+        return 2
+    cost = np.inf
+    if err == 0:
+        levels = np.ceil(np.log2(ratio*size/distance))
+        cost = 8*new_cells**levels
+    for order in range(3, order_ratios.size):
+        if order**3 >= cost:
+            break
+        if distance > order_ratios[order]*size:
+            return order
+    return 2
+
+
+@numba.jit(nopython=True, cache=True)
+def grow(stack, stktop, new_cells):
+    """
+    Copy the stack into a larger array that fits *new_cells* more elements.
+
+    The stack doubles in size so that it only has to grow a few times. The
+    depth-first discretization keeps it small anyway (around 7 elements per
+    level of division).
+    """
+    size = max(2*stack.shape[0], stktop + 1 + new_cells)
+    larger = np.empty((size, 6))
+    larger[:stktop + 1] = stack[:stktop + 1]
+    return larger
 
 
-def engine_factory(kernel):
+@numba.jit(nopython=True, nogil=True, cache=True)
+def engine(codes, lon, sinlat, coslat, radius, bounds, density, ratio,
+           order_ratios, stack, lonc, sinlatc, coslatc, rc, result, info):
     """
-    Make the engine functions for each specific field by passing in the
-    appropriate kernel.
+    Calculate the fields in *codes* (one per column of *result*) of all
+    tesseroids in *bounds* (one per row) on all computation points.
+
+    *info* accumulates the error code, the maximum stack depth, and the number
+    of kernel evaluations.
     """
-    @numba.jit(nopython=True)
-    def engine(lon, sinlat, coslat, radius, bounds, density, ratio,
-               stack, lonc, sinlatc, coslatc, rc, result):
-        error_code = 0
-        for l in range(result.size):
-            for i in range(6):
-                stack[0, i] = bounds[i]
-            stktop = 0
-            while stktop >= 0:
-                w, e, s, n, top, bottom = stack[stktop, :]
-                stktop -= 1
-                distance, Llon, Llat, Lr = distance_size(
-                    lon[l], coslat[l], sinlat[l], radius[l], w, e, s, n, top,
-                    bottom)
-                nlon, nlat, nr, new_cells, err = divisions(
-                    distance, Llon, Llat, Lr, ratio)
-                error_code += err
-                if new_cells > 1:
-                    if new_cells + (stktop + 1) > stack.shape[0]:
-                        raise OverflowError
-                    stktop = split(w, e, s, n, top, bottom, nlon, nlat, nr,
-                                   stack, stktop)
-                else:
-                    scale = scale_nodes(w, e, s, n, top, bottom, nodes, lonc,
-                                        sinlatc, coslatc, rc)
-                    result[l] += density*scale*kernel(
-                        lon[l], coslat[l], sinlat[l], radius[l], lonc, sinlatc,
-                        coslatc, rc)
-        return error_code
-    return engine
-
-
-@numba.jit(nopython=True)
+    for l in range(result.shape[0]):
+        stack = point_effect(
+            codes, lon[l], coslat[l], sinlat[l], radius[l], bounds, density,
+            ratio, order_ratios, stack, lonc, sinlatc, coslatc, rc,
+            result[l], info)
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def sensitivity_engine(codes, lon, sinlat, coslat, radius, bounds, columns,
+                       ratio, order_ratios, scale, stack_size, result, info):
+    """
+    Fill the sensitivity matrix *result* of the field in *codes* (a single
+    code).
+
+    Element [l, columns[t]] gets the effect of the tesseroid in row t of
+    *bounds* with unit density on point l multiplied by *scale*.
+    """
+    stack = np.empty((stack_size, 6))
+    lonc = np.empty(MAX_ORDER)
+    sinlatc = np.empty(MAX_ORDER)
+    coslatc = np.empty(MAX_ORDER)
+    rc = np.empty(MAX_ORDER)
+    out = np.empty(1)
+    for l in range(result.shape[0]):
+        for t in range(bounds.shape[0]):
+            out[0] = 0
+            stack = tesseroid_effect(
+                codes, lon[l], coslat[l], sinlat[l], radius[l], bounds[t],
+                1., ratio, order_ratios, stack, lonc, sinlatc, coslatc, rc,
+                out, info)
+            result[l, columns[t]] = scale*out[0]
+
+
+@numba.jit(nopython=True, cache=True)
 def scale_nodes(w, e, s, n, top, bottom, nodes, lonc, sinlatc, coslatc, rc):
     "Put the GLQ nodes in the integration limit"
     d2r = np.pi/180
@@ -88,7 +278,7 @@ def scale_nodes(w, e, s, n, top, bottom, nodes, lonc, sinlatc, coslatc, rc):
     return scale
 
 
-@numba.jit(nopython=True)
+@numba.jit(nopython=True, cache=True)
 def distance_size(lon, coslat, sinlat, radius, w, e, s, n, top, bottom):
     "Calculate the distance to the center of the tesseroid and its dimensions"
     d2r = np.pi/180
@@ -108,7 +298,7 @@ def distance_size(lon, coslat, sinlat, radius, w, e, s, n, top, bottom):
     return distance, Llon, Llat, Lr
 
 
-@numba.jit(nopython=True)
+@numba.jit(nopython=True, cache=True)
 def split(w, e, s, n, top, bottom, nlon, nlat, nr, stack, stktop):
     """
     Divide the region into smaller parts and add them to the stack.
@@ -129,9 +319,14 @@ def split(w, e, s, n, top, bottom, nlon, nlat, nr, stack, stktop):
     return stktop
 
 
-@numba.jit(nopython=True)
-def divisions(distance, Llon, Llat, Lr, ratio):
-    "How many divisions should be made per dimension"
+@numba.jit(nopython=True, cache=True)
+def divisions(distance, Llon, Llat, Lr, ratio, min_lr):
+    """
+    How many divisions should be made per dimension.
+
+    The radial dimension is not divided if it is smaller than *min_lr* (in
+    meters). The error is -1 if a dimension is too small to be divided.
+    """
     nlon = 1
     nlat = 1
     nr = 1
@@ -147,71 +342,79 @@ def divisions(distance, Llon, Llat, Lr, ratio):
         else:
             nlat = 2
     if distance <= ratio*Lr:
-        if Lr <= 1e3:
+        if Lr <= min_lr:
             error = -1
         else:
             nr = 2
     return nlon, nlat, nr, nlon*nlat*nr, error
 
 
-@numba.jit(nopython=True)
-def kernelV(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc):
+@numba.jit(nopython=True, cache=True)
+def kernelV(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc,
+            weights):
     r_sqr = radius**2
     result = 0
-    for i in range(2):
+    for i in range(weights.size):
         coslon = np.cos(lon - lonc[i])
-        for j in range(2):
+        for j in range(weights.size):
+            wij = weights[i]*weights[j]
             cospsi = sinlat*sinlatc[j] + coslat*coslatc[j]*coslon
-            for k in range(2):
+            for k in range(weights.size):
                 l_sqr = r_sqr + rc[k]**2 - 2*radius*rc[k]*cospsi
-                kappa = (rc[k]**2)*coslatc[j]
+                kappa = wij*weights[k]*(rc[k]**2)*coslatc[j]
                 result += kappa/np.sqrt(l_sqr)
     return result
 
 
-@numba.jit(nopython=True)
-def kernelx(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc):
+@numba.jit(nopython=True, cache=True)
+def kernelx(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc,
+            weights):
     r_sqr = radius**2
     result = 0
-    for i in range(2):
+    for i in range(weights.size):
         coslon = np.cos(lon - lonc[i])
-        for j in range(2):
+        for j in range(weights.size):
+            wij = weights[i]*weights[j]
             kphi = coslat*sinlatc[j] - sinlat*coslatc[j]*coslon
             cospsi = sinlat*sinlatc[j] + coslat*coslatc[j]*coslon
-            for k in range(2):
+            for k in range(weights.size):
                 l_sqr = r_sqr + rc[k]**2 - 2*radius*rc[k]*cospsi
-                kappa = (rc[k]**2)*coslatc[j]
+                kappa = wij*weights[k]*(rc[k]**2)*coslatc[j]
                 result += kappa*rc[k]*kphi/(l_sqr**1.5)
     return result
 
 
-@numba.jit(nopython=True)
-def kernely(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc):
+@numba.jit(nopython=True, cache=True)
+def kernely(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc,
+            weights):
     r_sqr = radius**2
     result = 0
-    for i in range(2):
+    for i in range(weights.size):
         coslon = np.cos(lon - lonc[i])
         sinlon = np.sin(lonc[i] - lon)
-        for j in range(2):
+        for j in range(weights.size):
+            wij = weights[i]*weights[j]
             cospsi = sinlat*sinlatc[j] + coslat*coslatc[j]*coslon
-            for k in range(2):
+            for k in range(weights.size):
                 l_sqr = r_sqr + rc[k]**2 - 2*radius*rc[k]*cospsi
-                kappa = (rc[k]**2)*coslatc[j]
+                kappa = wij*weights[k]*(rc[k]**2)*coslatc[j]
                 result += kappa*(rc[k]*coslatc[j]*sinlon/(l_sqr**1.5))
     return result
 
 
-@numba.jit(nopython=True)
-def kernelz(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc):
+@numba.jit(nopython=True, cache=True)
+def kernelz(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc,
+            weights):
     r_sqr = radius**2
     result = 0
-    for i in range(2):
+    for i in range(weights.size):
         coslon = np.cos(lon - lonc[i])
-        for j in range(2):
+        for j in range(weights.size):
+            wij = weights[i]*weights[j]
             cospsi = sinlat*sinlatc[j] + coslat*coslatc[j]*coslon
-            for k in range(2):
+            for k in range(weights.size):
                 l_sqr = r_sqr + rc[k]**2 - 2*radius*rc[k]*cospsi
-                kappa = (rc[k]**2)*coslatc[j]
+                kappa = wij*weights[k]*(rc[k]**2)*coslatc[j]
                 result += kappa*(rc[k]*cospsi - radius)/(l_sqr**1.5)
     # Multiply by -1 so that z is pointing down for gz and the gravity anomaly
     # doesn't look inverted (ie, negative for positive density)
@@ -219,121 +422,154 @@ def kernelz(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc):
     return result
 
 
-@numba.jit(nopython=True)
-def kernelxx(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc):
+@numba.jit(nopython=True, cache=True)
+def kernelxx(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc,
+             weights):
     r_sqr = radius**2
     result = 0
-    for i in range(2):
+    for i in range(weights.size):
         coslon = np.cos(lon - lonc[i])
-        for j in range(2):
+        for j in range(weights.size):
+            wij = weights[i]*weights[j]
             kphi = coslat*sinlatc[j] - sinlat*coslatc[j]*coslon
             cospsi = sinlat*sinlatc[j] + coslat*coslatc[j]*coslon
-            for k in range(2):
+            for k in range(weights.size):
                 l_sqr = r_sqr + rc[k]**2 - 2*radius*rc[k]*cospsi
-                kappa = (rc[k]**2)*coslatc[j]
+                kappa = wij*weights[k]*(rc[k]**2)*coslatc[j]
                 result += kappa*(3*((rc[k]*kphi)**2) - l_sqr)/(l_sqr**2.5)
     return result
 
 
-@numba.jit(nopython=True)
-def kernelxy(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc):
+@numba.jit(nopython=True, cache=True)
+def kernelxy(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc,
+             weights):
     r_sqr = radius**2
     result = 0
-    for i in range(2):
+    for i in range(weights.size):
         coslon = np.cos(lonc[i] - lon)
         sinlon = np.sin(lonc[i] - lon)
-        for j in range(2):
+        for j in range(weights.size):
+            wij = weights[i]*weights[j]
             kphi = coslat*sinlatc[j] - sinlat*coslatc[j]*coslon
             cospsi = sinlat*sinlatc[j] + coslat*coslatc[j]*coslon
-            for k in range(2):
+            for k in range(weights.size):
                 rc_sqr = rc[k]**2
                 l_sqr = r_sqr + rc_sqr - 2*radius*rc[k]*cospsi
-                kappa = rc_sqr*coslatc[j]
+                kappa = wij*weights[k]*rc_sqr*coslatc[j]
                 result += kappa*3*rc_sqr*kphi*coslatc[j]*sinlon/(l_sqr**2.5)
     return result
 
 
-@numba.jit(nopython=True)
-def kernelxz(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc):
+@numba.jit(nopython=True, cache=True)
+def kernelxz(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc,
+             weights):
     r_sqr = radius**2
     result = 0
-    for i in range(2):
+    for i in range(weights.size):
         coslon = np.cos(lon - lonc[i])
-        for j in range(2):
+        for j in range(weights.size):
+            wij = weights[i]*weights[j]
             kphi = coslat*sinlatc[j] - sinlat*coslatc[j]*coslon
             cospsi = sinlat*sinlatc[j] + coslat*coslatc[j]*coslon
-            for k in range(2):
+            for k in range(weights.size):
                 rc_sqr = rc[k]**2
                 l_5 = (r_sqr + rc_sqr - 2*radius*rc[k]*cospsi)**2.5
-                kappa = rc_sqr*coslatc[j]
+                kappa = wij*weights[k]*rc_sqr*coslatc[j]
                 result += kappa*3*rc[k]*kphi*(rc[k]*cospsi - radius)/l_5
     return result
 
 
-@numba.jit(nopython=True)
-def kernelyy(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc):
+@numba.jit(nopython=True, cache=True)
+def kernelyy(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc,
+             weights):
     r_sqr = radius**2
     result = 0
-    for i in range(2):
+    for i in range(weights.size):
         coslon = np.cos(lonc[i] - lon)
         sinlon = np.sin(lonc[i] - lon)
-        for j in range(2):
+        for j in range(weights.size):
+            wij = weights[i]*weights[j]
             cospsi = sinlat*sinlatc[j] + coslat*coslatc[j]*coslon
-            for k in range(2):
+            for k in range(weights.size):
                 rc_sqr = rc[k]**2
                 l_sqr = r_sqr + rc_sqr - 2*radius*rc[k]*cospsi
-                kappa = rc_sqr*coslatc[j]
+                kappa = wij*weights[k]*rc_sqr*coslatc[j]
                 deltay = rc[k]*coslatc[j]*sinlon
                 result += kappa*(3*(deltay**2) - l_sqr)/(l_sqr**2.5)
     return result
 
 
-@numba.jit(nopython=True)
-def kernelyz(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc):
+@numba.jit(nopython=True, cache=True)
+def kernelyz(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc,
+             weights):
     r_sqr = radius**2
     result = 0
-    for i in range(2):
+    for i in range(weights.size):
         coslon = np.cos(lonc[i] - lon)
         sinlon = np.sin(lonc[i] - lon)
-        for j in range(2):
+        for j in range(weights.size):
+            wij = weights[i]*weights[j]
             cospsi = sinlat*sinlatc[j] + coslat*coslatc[j]*coslon
-            for k in range(2):
+            for k in range(weights.size):
                 rc_sqr = rc[k]**2
                 l_sqr = r_sqr + rc_sqr - 2*radius*rc[k]*cospsi
-                kappa = rc_sqr*coslatc[j]
+                kappa = wij*weights[k]*rc_sqr*coslatc[j]
                 deltay = rc[k]*coslatc[j]*sinlon
                 deltaz = rc[k]*cospsi - radius
                 result += kappa*3.*deltay*deltaz/(l_sqr**2.5)
     return result
 
 
-@numba.jit(nopython=True)
-def kernelzz(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc):
+@numba.jit(nopython=True, cache=True)
+def kernelzz(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc,
+             weights):
     r_sqr = radius**2
     result = 0
-    for i in range(2):
+    for i in range(weights.size):
         coslon = np.cos(lon - lonc[i])
-        for j in range(2):
+        for j in range(weights.size):
+            wij = weights[i]*weights[j]
             cospsi = sinlat*sinlatc[j] + coslat*coslatc[j]*coslon
-            for k in range(2):
+            for k in range(weights.size):
                 rc_sqr = rc[k]**2
                 l_sqr = r_sqr + rc_sqr - 2*radius*rc[k]*cospsi
                 l_5 = l_sqr**2.5
-                kappa = rc_sqr*coslatc[j]
+                kappa = wij*weights[k]*rc_sqr*coslatc[j]
                 deltaz = rc[k]*cospsi - radius
                 result += kappa*(3*deltaz**2 - l_sqr)/l_5
     return result
 
 
-# Use the factory to make the functions for specific fields. These are the ones
-# that will be used by fatiando.gravmag.tesseroid
-gx = engine_factory(kernelx)
-gy = engine_factory(kernely)
-gz = engine_factory(kernelz)
-gxx = engine_factory(kernelxx)
-gxy = engine_factory(kernelxy)
-gxz = engine_factory(kernelxz)
-gyy = engine_factory(kernelyy)
-gyz = engine_factory(kernelyz)
-gzz = engine_factory(kernelzz)
-potential = engine_factory(kernelV)
+@numba.jit(nopython=True, cache=True)
+def kernel(code, lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc,
+           weights):
+    "Evaluate the kernel of the field with the given code"
+    if code == POTENTIAL:
+        return kernelV(lon, coslat, sinlat, radius, lonc, sinlatc,
+                       coslatc, rc, weights)
+    elif code == GX:
+        return kernelx(lon, coslat, sinlat, radius, lonc, sinlatc,
+                       coslatc, rc, weights)
+    elif code == GY:
+        return kernely(lon, coslat, sinlat, radius, lonc, sinlatc,
+                       coslatc, rc, weights)
+    elif code == GZ:
+        return kernelz(lon, coslat, sinlat, radius, lonc, sinlatc,
+                       coslatc, rc, weights)
+    elif code == GXX:
+        return kernelxx(lon, coslat, sinlat, radius, lonc, sinlatc,
+                        coslatc, rc, weights)
+    elif code == GXY:
+        return kernelxy(lon, coslat, sinlat, radius, lonc, sinlatc,
+                        coslatc, rc, weights)
+    elif code == GXZ:
+        return kernelxz(lon, coslat, sinlat, radius, lonc, sinlatc,
+                        coslatc, rc, weights)
+    elif code == GYY:
+        return kernelyy(lon, coslat, sinlat, radius, lonc, sinlatc,
+                        coslatc, rc, weights)
+    elif code == GYZ:
+        return kernelyz(lon, coslat, sinlat, radius, lonc, sinlatc,
+                        coslatc, rc, weights)
+    return kernelzz(lon, coslat, sinlat, radius, lonc, sinlatc, coslatc, rc,
+                    weights)
@@ -0,0 +1,55 @@
+"""
+Run the compiled (numba) engines in parallel threads.
+
+The engines are compiled with ``nogil=True`` and the computation points are
+split between a pool of Python threads. They don't use numba's own threads
+(``parallel=True`` and ``numba.prange``) because forking the process after
+those are started (e.g., to make a ``multiprocessing.Pool``) can make the
+interpreter hang on exit with the TBB threading layer.
+
+>>> import numpy as np
+>>> values = np.arange(10)
+>>> run(lambda part: int(values[part].sum()), values.size, njobs=2, parts=3)
+[3, 12, 30]
+
+"""
+from __future__ import division, absolute_import
+from multiprocessing.pool import ThreadPool
+
+import numba
+import numpy as np
+
+# The default number of threads (one per core, the same as numba's)
+NJOBS = numba.config.NUMBA_NUM_THREADS
+
+
+def run(func, size, njobs=None, parts=None):
+    """
+    Call ``func(part)`` in parallel threads on the slices that split
+    ``range(size)`` into *parts* contiguous pieces.
+
+    Uses *njobs* threads (one per core if None). Each thread takes the next
+    piece when it finishes the previous one, so use more *parts* than *njobs*
+    if some pieces take longer than others. By default, *parts* is *njobs*.
+
+    Returns:
+
+    * results : list
+        The values returned by *func* for each piece (in order).
+
+    """
+    if njobs is None:
+        njobs = NJOBS
+    if parts is None:
+        parts = njobs
+    parts = max(1, min(parts, size))
+    strides = np.linspace(0, size, parts + 1).astype('int')
+    pieces = [slice(low, high) for low, high in zip(strides[:-1], strides[1:])]
+    if njobs == 1 or parts == 1:
+        return [func(part) for part in pieces]
+    pool = ThreadPool(min(njobs, parts))
+    try:
+        return pool.map(func, pieces, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
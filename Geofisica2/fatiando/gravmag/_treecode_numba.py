@@ -0,0 +1,353 @@
+r"""
+A Barnes-Hut tree code for the fields of point masses and dipoles.
+
+These functions are used by fatiando.gravmag.sphere as a backend (when an
+*accuracy* is given) and are not meant to be used directly. They use the same
+packed array of sources (one per column with the position, mass, and magnetic
+moment) as fatiando.gravmag._sphere_numba.
+
+The sources are split into a binary tree: each node is divided in half along
+its widest dimension until it has at most ``LEAF_SIZE`` sources. Each node
+stores the monopole, dipole, and quadrupole moments of its sources (masses
+and dipoles) about its center. For each computation point, the tree is
+traversed from the root and a node is used as a whole (through a Taylor
+expansion of the kernel about its center) if
+
+.. math::
+
+    a < \theta R,
+
+where :math:`a` is the radius of the node (the largest distance between its
+center and its sources) and :math:`R` is the distance between the node center
+and the computation point. Otherwise, its children are visited (or the
+sources are summed directly if the node is a leaf). The error of the
+expansion is of the order of :math:`\theta^3` times the effect of the node.
+
+The functions release the GIL so that fatiando.gravmag.sphere can run them on
+parts of the nodes or computation points in parallel threads.
+
+A few doctests for the numba code::
+
+>>> import numpy as np
+>>> from ._sphere_numba import GZ, GZZ, engine as direct
+>>> np.random.seed(0)
+>>> sources = np.zeros((7, 5000))
+>>> sources[:2] = np.random.uniform(-1000, 1000, (2, 5000))
+>>> sources[2] = 100
+>>> sources[3] = np.random.uniform(-1, 1, 5000)
+>>> order, start, end, child, center, radius, depth = build(sources, 32)
+>>> bool(np.all(np.sort(order) == np.arange(5000)))
+True
+>>> sources = np.ascontiguousarray(sources[:, order])
+>>> moments = np.empty((start.size, NMOMENTS))
+>>> node_moments(sources, start, end, center, moments)
+>>> bool(np.allclose(moments[0, 0], sources[3].sum()))
+True
+>>> xp, yp = [i.ravel() for i in np.meshgrid(np.linspace(-1000, 1000, 10),
+...                                           np.linspace(-1000, 1000, 10))]
+>>> zp = np.zeros_like(xp)
+>>> codes = np.array([GZ, GZZ])
+>>> true = np.zeros((100, 2))
+>>> direct(codes, xp, yp, zp, sources, np.zeros(3), true)
+>>> result = np.zeros((100, 2))
+>>> engine(codes, xp, yp, zp, sources, start, end, child, center, radius,
+...        moments, 0.3, depth, np.zeros(3), result)
+>>> error = np.abs(result - true).max(axis=0)/np.abs(true).max(axis=0)
+>>> bool(np.all(error < 0.3**3))
+True
+
+"""
+from __future__ import division, absolute_import
+import math
+import numba
+import numpy as np
+
+from ._sphere_numba import GZ, GZZ, TF, accumulate_gz, \
+    accumulate_gradients, accumulate_induction
+
+# The maximum number of sources in a leaf node
+LEAF_SIZE = 16
+# Nodes with this many sources (or fewer) are summed directly because it is
+# cheaper than the multipole expansion.
+DIRECT_SIZE = 8
+# The moments of each node: the mass (1), dipole (3), and quadrupole (9)
+# moments of the masses and the moment (3), dipole (9), and quadrupole (27)
+# moments of the magnetic dipoles.
+NMOMENTS = 52
+
+
+@numba.jit(nopython=True, cache=True)
+def build(sources, leaf_size):
+    """
+    Build the tree of the sources.
+
+    The nodes are created in breadth first order. The children of node i
+    are nodes child[i] and child[i] + 1 (child[i] is -1 for leaves).
+
+    Returns:
+
+    * order, start, end, child, center, radius, depth
+        The order in which the sources are stored in the tree (sources in
+        node i are order[start[i]:end[i]]), the first child of each node,
+        the center and radius of the nodes, and the depth of the tree.
+
+    """
+    nsources = sources.shape[1]
+    order = np.arange(nsources)
+    capacity = 4*(nsources//leaf_size + 1)
+    start = np.empty(capacity, dtype=np.int64)
+    end = np.empty(capacity, dtype=np.int64)
+    child = np.empty(capacity, dtype=np.int64)
+    level = np.empty(capacity, dtype=np.int64)
+    center = np.empty((capacity, 3))
+    radius = np.empty(capacity)
+    start[0], end[0], level[0] = 0, nsources, 0
+    nnodes = 1
+    node = 0
+    depth = 0
+    lower = np.empty(3)
+    upper = np.empty(3)
+    while node < nnodes:
+        low, high = start[node], end[node]
+        depth = max(depth, level[node])
+        lower[:] = np.inf
+        upper[:] = -np.inf
+        for s in range(low, high):
+            for i in range(3):
+                lower[i] = min(lower[i], sources[i, order[s]])
+                upper[i] = max(upper[i], sources[i, order[s]])
+        axis = 0
+        for i in range(3):
+            center[node, i] = 0.5*(lower[i] + upper[i])
+            if upper[i] - lower[i] > upper[axis] - lower[axis]:
+                axis = i
+        distance = 0.
+        for s in range(low, high):
+            dist_sqr = 0.
+            for i in range(3):
+                dist_sqr += (sources[i, order[s]] - center[node, i])**2
+            distance = max(distance, dist_sqr)
+        radius[node] = math.sqrt(distance)
+        child[node] = -1
+        # All sources in the same place can't be split
+        if high - low <= leaf_size or upper[axis] == lower[axis]:
+            node += 1
+            continue
+        # Put the sources below the middle of the widest dimension first.
+        # Both halves have at least one source.
+        middle = center[node, axis]
+        i, j = low, high - 1
+        while i <= j:
+            if sources[axis, order[i]] < middle:
+                i += 1
+            else:
+                order[i], order[j] = order[j], order[i]
+                j -= 1
+        if nnodes + 2 > capacity:
+            capacity *= 2
+            start = grow(start, capacity)
+            end = grow(end, capacity)
+            child = grow(child, capacity)
+            level = grow(level, capacity)
+            radius = grow(radius, capacity)
+            center = grow(center, capacity)
+        child[node] = nnodes
+        start[nnodes], end[nnodes] = low, i
+        start[nnodes + 1], end[nnodes + 1] = i, high
+        level[nnodes] = level[nnodes + 1] = level[node] + 1
+        nnodes += 2
+        node += 1
+    return (order, start[:nnodes], end[:nnodes], child[:nnodes],
+            center[:nnodes], radius[:nnodes], depth)
+
+
+@numba.jit(nopython=True, cache=True)
+def grow(array, size):
+    """
+    Copy *array* into a larger array with *size* elements (rows).
+    """
+    new = np.empty((size,) + array.shape[1:], dtype=array.dtype)
+    new[:array.shape[0]] = array
+    return new
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def node_moments(sources, start, end, center, moments):
+    """
+    Calculate the moments of the sources of each node about its center.
+
+    The *sources* must be in the order of the tree.
+    """
+    for node in range(start.size):
+        out = moments[node]
+        out[:] = 0
+        for s in range(start[node], end[node]):
+            mass = sources[3, s]
+            dx = sources[0, s] - center[node, 0]
+            dy = sources[1, s] - center[node, 1]
+            dz = sources[2, s] - center[node, 2]
+            for i in range(3):
+                di = dx if i == 0 else (dy if i == 1 else dz)
+                out[1 + i] += mass*di
+                for k in range(3):
+                    dk = dx if k == 0 else (dy if k == 1 else dz)
+                    out[4 + 3*i + k] += mass*di*dk
+                    for j in range(3):
+                        out[25 + 9*i + 3*k + j] += sources[4 + j, s]*di*dk
+                for j in range(3):
+                    out[16 + 3*i + j] += sources[4 + j, s]*di
+            out[0] += mass
+            for j in range(3):
+                out[13 + j] += sources[4 + j, s]
+
+
+@numba.jit(nopython=True, cache=True)
+def multipole(dx, dy, dz, moments, gz, gradients, induction, sums):
+    """
+    Add the effect of a node at (dx, dy, dz) from the computation point to
+    *sums* using its *moments*.
+
+    The fields are the derivatives of 1/r contracted with the moments (see
+    the module docstring). The contractions are written out in terms of the
+    few scalars and vectors below to avoid forming the derivative tensors.
+    """
+    u = (dx, dy, dz)
+    r_sqr = dx**2 + dy**2 + dz**2
+    inv_3 = 1/(r_sqr*math.sqrt(r_sqr))
+    inv_5 = inv_3/r_sqr
+    inv_7 = inv_5/r_sqr
+    inv_9 = inv_7/r_sqr
+    if gz or gradients:
+        mass = moments[0]
+        dipole = moments[1:4]
+        quad = moments[4:13]
+        dipole_u = dipole[0]*dx + dipole[1]*dy + dipole[2]*dz
+        quad_u = (quad[0]*dx + quad[1]*dy + quad[2]*dz,
+                  quad[3]*dx + quad[4]*dy + quad[5]*dz,
+                  quad[6]*dx + quad[7]*dy + quad[8]*dz)
+        u_quad_u = quad_u[0]*dx + quad_u[1]*dy + quad_u[2]*dz
+        trace = quad[0] + quad[4] + quad[8]
+        if gz:
+            sums[0] -= (-mass*dz*inv_3 + 3*dipole_u*dz*inv_5 -
+                        dipole[2]*inv_3 +
+                        0.5*(-15*u_quad_u*dz*inv_7 +
+                             3*(trace*dz + 2*quad_u[2])*inv_5))
+        if gradients:
+            index = 1
+            for a in range(3):
+                for b in range(a, 3):
+                    delta = 1. if a == b else 0.
+                    ua_ub = u[a]*u[b]
+                    sums[index] += (
+                        mass*(3*ua_ub*inv_5 - delta*inv_3) -
+                        15*dipole_u*ua_ub*inv_7 +
+                        3*(delta*dipole_u + dipole[a]*u[b] +
+                           dipole[b]*u[a])*inv_5 +
+                        0.5*(105*u_quad_u*ua_ub*inv_9 -
+                             15*(trace*ua_ub + 2*quad_u[a]*u[b] +
+                                 2*quad_u[b]*u[a] + delta*u_quad_u)*inv_7 +
+                             3*(trace*delta + 2*quad[3*a + b])*inv_5))
+                    index += 1
+    if induction:
+        moment = moments[13:16]
+        # dipole[3*i + j] is the sum of m_j*d_i
+        dipole = moments[16:25]
+        # quad[9*i + 3*k + j] is the sum of m_j*d_i*d_k
+        quad = moments[25:52]
+        moment_u = moment[0]*dx + moment[1]*dy + moment[2]*dz
+        u_dipole_u = 0.
+        trace = dipole[0] + dipole[4] + dipole[8]
+        u_quad_u_u = 0.
+        trace_u = 0.
+        side_u = 0.
+        for i in range(3):
+            for j in range(3):
+                u_dipole_u += u[i]*dipole[3*i + j]*u[j]
+                for k in range(3):
+                    u_quad_u_u += quad[9*i + 3*k + j]*u[i]*u[k]*u[j]
+            for k in range(3):
+                # Contract the index pairs (i, i) and (i, j) of quad with u
+                trace_u += quad[9*i + 3*i + k]*u[k]
+                side_u += quad[9*i + 3*k + i]*u[k]
+        for a in range(3):
+            row = dipole[3*a]*dx + dipole[3*a + 1]*dy + dipole[3*a + 2]*dz
+            column = dipole[a]*dx + dipole[3 + a]*dy + dipole[6 + a]*dz
+            first = 0.
+            last = 0.
+            trace_a = 0.
+            side_a = 0.
+            for i in range(3):
+                trace_a += quad[9*i + 3*i + a]
+                side_a += quad[9*i + 3*a + i]
+                for k in range(3):
+                    first += quad[9*a + 3*i + k]*u[i]*u[k]
+                    last += quad[9*i + 3*k + a]*u[i]*u[k]
+            sums[7 + a] += (
+                3*moment_u*u[a]*inv_5 - moment[a]*inv_3 -
+                15*u_dipole_u*u[a]*inv_7 +
+                3*(row + trace*u[a] + column)*inv_5 +
+                0.5*(105*u_quad_u_u*u[a]*inv_9 -
+                     15*(u[a]*trace_u + 2*first + 2*u[a]*side_u +
+                         last)*inv_7 +
+                     3*(trace_a + 2*side_a)*inv_5))
+
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def engine(codes, xp, yp, zp, sources, start, end, child, center, radius,
+           moments, theta, depth, direction, result):
+    """
+    Calculate the fields in *codes* of the sources (in the order of the
+    tree) on the computation points. Same as
+    fatiando.gravmag._sphere_numba.engine but nodes smaller than *theta*
+    times their distance to the point are approximated by their moments.
+    """
+    gz = False
+    gradients = False
+    induction = False
+    for code in codes:
+        if code == GZ:
+            gz = True
+        elif code <= GZZ:
+            gradients = True
+        else:
+            induction = True
+    stack = np.empty(depth + 2, dtype=np.int64)
+    sums = np.zeros((10, 1))
+    for p in range(xp.size):
+        sums[:] = 0
+        stack[0] = 0
+        top = 1
+        while top > 0:
+            top -= 1
+            node = stack[top]
+            dx = center[node, 0] - xp[p]
+            dy = center[node, 1] - yp[p]
+            dz = center[node, 2] - zp[p]
+            size = end[node] - start[node]
+            if (size > DIRECT_SIZE and
+                    radius[node]**2 < theta**2*(dx**2 + dy**2 + dz**2)):
+                multipole(dx, dy, dz, moments[node], gz, gradients,
+                          induction, sums[:, 0])
+            elif child[node] < 0 or size <= DIRECT_SIZE:
+                if gz:
+                    accumulate_gz(xp[p:p + 1], yp[p:p + 1], zp[p:p + 1],
+                                  sources, start[node], end[node], sums)
+                if gradients:
+                    accumulate_gradients(xp[p:p + 1], yp[p:p + 1],
+                                         zp[p:p + 1], sources,
+                                         start[node], end[node], sums)
+                if induction:
+                    accumulate_induction(xp[p:p + 1], yp[p:p + 1],
+                                         zp[p:p + 1], sources,
+                                         start[node], end[node], sums)
+            else:
+                stack[top] = child[node]
+                stack[top + 1] = child[node] + 1
+                top += 2
+        for j in range(codes.size):
+            if codes[j] == TF:
+                result[p, j] = (direction[0]*sums[7, 0] +
+                                direction[1]*sums[8, 0] +
+                                direction[2]*sums[9, 0])
+            else:
+                result[p, j] = sums[codes[j], 0]
@@ -45,12 +45,13 @@ class EQLBase(Misfit):
     Base class for the classic equivalent layer.
     """
 
-    def __init__(self, x, y, z, data, grid):
+    def __init__(self, x, y, z, data, grid, accuracy=None):
         super().__init__(data=data, nparams=len(grid), islinear=True)
         self.x = x
         self.y = y
         self.z = z
         self.grid = grid
+        self.accuracy = accuracy
 
     def predicted(self, p):
         """
@@ -68,7 +69,9 @@ class EQLBase(Misfit):
             The predicted data vector.
 
         """
-        return safe_dot(self.jacobian(p), p)
+        if self.accuracy is None:
+            return safe_dot(self.jacobian(p), p)
+        return self._forward(p)
 
 
 class EQLGravity(EQLBase):
@@ -90,13 +93,23 @@ class EQLGravity(EQLBase):
         Which gravitational field is the data. Options are: ``'gz'`` (gravity
         anomaly), ``'gxx'``, ``'gxy'``, ..., ``'gzz'`` (gravity gradient
         tensor). Defaults to ``'gz'``.
+    * accuracy : float or None
+        If not None, will calculate the predicted data with the tree code of
+        :mod:`fatiando.gravmag.sphere` (see the *accuracy* argument of its
+        functions) instead of the Jacobian matrix. Use it to predict the data
+        of large layers without building the Jacobian.
 
     """
 
-    def __init__(self, x, y, z, data, grid, field='gz'):
-        super().__init__(x, y, z, data, grid)
+    def __init__(self, x, y, z, data, grid, field='gz', accuracy=None):
+        super().__init__(x, y, z, data, grid, accuracy)
         self.field = field
 
+    def _forward(self, p):
+        "Calculate the predicted data with the tree code"
+        return kernel.fields(self.x, self.y, self.z, self.grid, [self.field],
+                             dens=p, accuracy=self.accuracy)[0]
+
     def jacobian(self, p):
         """
         Calculate the Jacobian matrix for a given parameter vector.
@@ -133,15 +146,28 @@ class EQLTotalField(EQLBase):
         there is remanent magnetization and the total magnetization of the
         layer if different from the induced magnetization.
         If there is only induced magnetization, use None
+    * accuracy : float or None
+        If not None, will calculate the predicted data with the tree code of
+        :mod:`fatiando.gravmag.sphere` (see the *accuracy* argument of its
+        functions) instead of the Jacobian matrix. Use it to predict the data
+        of large layers without building the Jacobian.
 
     """
 
-    def __init__(self, x, y, z, data, inc, dec, grid, sinc=None, sdec=None):
-        super().__init__(x, y, z, data, grid)
+    def __init__(self, x, y, z, data, inc, dec, grid, sinc=None, sdec=None,
+                 accuracy=None):
+        super().__init__(x, y, z, data, grid, accuracy)
         self.inc, self.dec = inc, dec
         self.sinc = sinc if sinc is not None else inc
         self.sdec = sdec if sdec is not None else dec
 
+    def _forward(self, p):
+        "Calculate the predicted data with the tree code"
+        mag = numpy.outer(p, dircos(self.sinc, self.sdec))
+        return kernel.fields(self.x, self.y, self.z, self.grid, ['tf'],
+                             pmag=mag, inc=self.inc, dec=self.dec,
+                             accuracy=self.accuracy)[0]
+
     def jacobian(self, p):
         """
         Calculate the Jacobian matrix for a given parameter vector.
@@ -36,7 +36,10 @@ class Moulder(object):
     computes their predicted data automatically. Also permits contaminating the
     data with gaussian pseudo-random error for producing synthetic data sets.
 
-    Uses :mod:`fatiando.gravmag.talwani` for computations.
+    Uses :mod:`fatiando.gravmag.talwani` for computations. The contribution
+    of each polygon edge is kept in a
+    :class:`~fatiando.gravmag.talwani.EdgeCache` so that moving a vertex only
+    recalculates the two edges that touch it.
 
     *Moulder* objects can be persisted to Python pickle files using the
     :meth:`~fatiando.gravmag.interactive.Moulder.save` method and later
@@ -121,6 +124,7 @@ class Moulder(object):
         else:
             self.dmin, self.dmax = data.min(), data.max()
         self.predicted = kwargs.get('predicted', numpy.zeros_like(x))
+        self._talwani = talwani.EdgeCache(self.x, self.z)
         self.error = kwargs.get('error', 0)
         self.cmap = kwargs.get('cmap', pyplot.cm.RdBu_r)
         self.line_args = dict(
@@ -206,7 +210,9 @@ class Moulder(object):
         """
         The polygon model drawn as :class:`fatiando.mesher.Polygon` objects.
         """
-        m = [Polygon(p.xy, {'density': d})
+        # The patches repeat the first vertex at the end to close the path.
+        # Leave it out so the polygons don't have a zero length edge.
+        m = [Polygon(p.xy[:-1], {'density': d})
              for p, d in zip(self.polygons, self.densities)]
         return m
 
@@ -400,8 +406,12 @@ class Moulder(object):
     def _update_data(self):
         """
         Recalculate the predicted data (optionally with random error)
+
+        Only the polygon edges that changed since the last call are
+        recalculated.
         """
-        self.predicted = talwani.gz(self.x, self.z, self.model)
+        keys = [id(p) for p in self.polygons]
+        self.predicted = self._talwani.gz(self.model, keys=keys)
         if self.error > 0:
             self.predicted = utils.contaminate(self.predicted, self.error)
 
@@ -1,13 +1,19 @@
 """
 The potential fields of a homogeneous 3D prism with polygonal cross-section.
+
+The fields are calculated by compiled code (using `numba
+<http://numba.pydata.org>`__) that loops over the computation points in
+parallel threads on all cores. The loops over the prisms and their vertices
+don't allocate any temporary arrays, so the memory used doesn't grow with the
+number of computation points or vertices.
 """
 from __future__ import division, absolute_import
-from future.builtins import range
 
 import numpy as np
 
 from .. import utils
 from ..constants import SI2MGAL, SI2EOTVOS, G, CM, T2NT
+from . import _polyprism_numba, _threads
 from .._our_duecredit import due, Doi
 
 
@@ -16,6 +22,102 @@ due.cite(Doi("10.1190/1.1440645"),
          path='fatiando.gravmag.polyprism')
 
 
+def _coordinates(xp, yp, zp):
+    """
+    Make contiguous 1d-arrays of floats out of the computation points.
+    """
+    return [np.ascontiguousarray(i, dtype=np.float64).ravel()
+            for i in [xp, yp, zp]]
+
+
+def _model(prisms, prop, value=None):
+    """
+    Pack the vertices, bounds and physical property of the prisms into arrays.
+
+    These are the arrays that the compiled code in
+    ``fatiando.gravmag._polyprism_numba`` uses to loop over all prisms at
+    once. Prisms that are None or that don't have the physical property
+    *prop* (when *value* is None) are left out. If *value* is not None, it is
+    used instead of the physical property of the prisms.
+
+    Returns:
+
+    * x, y, offsets, z1, z2, props : arrays
+        The x and y coordinates of the vertices of all prisms (one after the
+        other), the index of the first vertex of each prism (plus the total
+        number of vertices at the end), the top and bottom of the prisms,
+        and their physical property.
+
+    """
+    x, y, z1, z2, props = [], [], [], [], []
+    offsets = [0]
+    for prism in prisms:
+        if prism is None or (prop not in prism.props and value is None):
+            continue
+        x.append(prism.x)
+        y.append(prism.y)
+        offsets.append(offsets[-1] + prism.nverts)
+        z1.append(prism.z1)
+        z2.append(prism.z2)
+        if value is None:
+            props.append(prism.props[prop])
+        else:
+            props.append(value)
+    x = np.concatenate([np.zeros(0)] + x).astype(np.float64)
+    y = np.concatenate([np.zeros(0)] + y).astype(np.float64)
+    return (x, y, np.array(offsets, dtype=np.int64),
+            np.array(z1, dtype=np.float64), np.array(z2, dtype=np.float64),
+            np.array(props, dtype=np.float64))
+
+
+def _gravity(field, xp, yp, zp, prisms, dens=None):
+    """
+    Calculate a gravitational field of the prisms (without converting units).
+
+    If *dens* is not None, it is used as the density of all prisms.
+    """
+    x, y, offsets, z1, z2, density = _model(prisms, 'density', dens)
+    shape = np.shape(xp)
+    xp, yp, zp = _coordinates(xp, yp, zp)
+    result = np.zeros(xp.size)
+    code = _polyprism_numba.FIELD_CODES[field]
+    _threads.run(
+        lambda part: _polyprism_numba.engine(code, xp[part], yp[part],
+                                             zp[part], x, y, offsets, z1, z2,
+                                             density, result[part]),
+        xp.size)
+    return result.reshape(shape)
+
+
+def _kernel(field, xp, yp, zp, prism):
+    """
+    Calculate a kernel of a single prism (a field with unit density and
+    without converting units).
+    """
+    return _gravity(field, xp, yp, zp, [prism], dens=1)
+
+
+def _magnetic(xp, yp, zp, prisms, direction, pmag=None):
+    """
+    Calculate the magnetic induction of the prisms projected on *direction*
+    (without converting units).
+
+    If *pmag* is not None, it is used as the magnetization of all prisms.
+    """
+    x, y, offsets, z1, z2, mag = _model(prisms, 'magnetization', pmag)
+    shape = np.shape(xp)
+    xp, yp, zp = _coordinates(xp, yp, zp)
+    result = np.zeros(xp.size)
+    mag = mag.reshape((-1, 3))
+    direction = np.array(direction, dtype=np.float64)
+    _threads.run(
+        lambda part: _polyprism_numba.magnetic_engine(
+            xp[part], yp[part], zp[part], x, y, offsets, z1, z2, mag,
+            direction, result[part]),
+        xp.size)
+    return result.reshape(shape)
+
+
 def tf(xp, yp, zp, prisms, inc, dec, pmag=None):
     r"""
     The total-field magnetic anomaly of polygonal prisms.
@@ -59,26 +161,7 @@ def tf(xp, yp, zp, prisms, inc, dec, pmag=None):
     # Calculate the 3 components of the unit vector in the direction of the
     # regional field
     fx, fy, fz = utils.dircos(inc, dec)
-    res = 0
-    for prism in prisms:
-        if prism is None:
-            continue
-        if 'magnetization' not in prism.props and pmag is None:
-            continue
-        if pmag is None:
-            mx, my, mz = prism.props['magnetization']
-        else:
-            mx, my, mz = pmag
-        v1 = kernelxx(xp, yp, zp, prism)
-        v2 = kernelxy(xp, yp, zp, prism)
-        v3 = kernelxz(xp, yp, zp, prism)
-        v4 = kernelyy(xp, yp, zp, prism)
-        v5 = kernelyz(xp, yp, zp, prism)
-        v6 = kernelzz(xp, yp, zp, prism)
-        bx = v1*mx + v2*my + v3*mz
-        by = v2*mx + v4*my + v5*mz
-        bz = v3*mx + v5*my + v6*mz
-        res += fx*bx + fy*by + fz*bz
+    res = _magnetic(xp, yp, zp, prisms, [fx, fy, fz], pmag)
     res *= CM * T2NT
     return res
 
@@ -112,16 +195,7 @@ def bx(xp, yp, zp, prisms):
     """
     if xp.shape != yp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    res = 0
-    for prism in prisms:
-        if prism is None or ('magnetization' not in prism.props):
-            continue
-        # Get the magnetization vector components
-        mx, my, mz = prism.props['magnetization']
-        v1 = kernelxx(xp, yp, zp, prism)
-        v2 = kernelxy(xp, yp, zp, prism)
-        v3 = kernelxz(xp, yp, zp, prism)
-        res += v1*mx + v2*my + v3*mz
+    res = _magnetic(xp, yp, zp, prisms, [1, 0, 0])
     res *= CM * T2NT
     return res
 
@@ -155,16 +229,7 @@ def by(xp, yp, zp, prisms):
     """
     if xp.shape != yp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    res = 0
-    for prism in prisms:
-        if prism is None or ('magnetization' not in prism.props):
-            continue
-        # Get the magnetization vector components
-        mx, my, mz = prism.props['magnetization']
-        v2 = kernelxy(xp, yp, zp, prism)
-        v4 = kernelyy(xp, yp, zp, prism)
-        v5 = kernelyz(xp, yp, zp, prism)
-        res += v2*mx + v4*my + v5*mz
+    res = _magnetic(xp, yp, zp, prisms, [0, 1, 0])
     res *= CM * T2NT
     return res
 
@@ -198,16 +263,7 @@ def bz(xp, yp, zp, prisms):
     """
     if xp.shape != yp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    res = 0
-    for prism in prisms:
-        if prism is None or ('magnetization' not in prism.props):
-            continue
-        # Get the magnetization vector components
-        mx, my, mz = prism.props['magnetization']
-        v3 = kernelxz(xp, yp, zp, prism)
-        v5 = kernelyz(xp, yp, zp, prism)
-        v6 = kernelzz(xp, yp, zp, prism)
-        res += v3*mx + v5*my + v6*mz
+    res = _magnetic(xp, yp, zp, prisms, [0, 0, 1])
     res *= CM * T2NT
     return res
 
@@ -244,66 +300,7 @@ def gz(xp, yp, zp, prisms):
     """
     if xp.shape != yp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    dummy = 1e-10
-    res = 0
-    for prism in prisms:
-        if prism is None or 'density' not in prism.props:
-            continue
-        x, y = prism.x, prism.y
-        z1, z2 = prism.z1, prism.z2
-        density = prism.props['density']
-        nverts = prism.nverts
-        # Calculate the effect of the prism
-        Z1 = z1 - zp
-        Z2 = z2 - zp
-        Z1_sqr = Z1**2
-        Z2_sqr = Z2**2
-        kernel = 0
-        for k in range(nverts):
-            Xk1 = x[k] - xp
-            Yk1 = y[k] - yp
-            Xk2 = x[(k + 1) % nverts] - xp
-            Yk2 = y[(k + 1) % nverts] - yp
-            p = Xk1*Yk2 - Xk2*Yk1
-            p_sqr = p**2
-            Qk1 = (Yk2 - Yk1)*Yk1 + (Xk2 - Xk1)*Xk1
-            Qk2 = (Yk2 - Yk1)*Yk2 + (Xk2 - Xk1)*Xk2
-            Ak1 = Xk1**2 + Yk1**2
-            Ak2 = Xk2**2 + Yk2**2
-            R1k1 = np.sqrt(Ak1 + Z1_sqr)
-            R1k2 = np.sqrt(Ak2 + Z1_sqr)
-            R2k1 = np.sqrt(Ak1 + Z2_sqr)
-            R2k2 = np.sqrt(Ak2 + Z2_sqr)
-            Ak1 = np.sqrt(Ak1)
-            Ak2 = np.sqrt(Ak2)
-            Bk1 = np.sqrt(Qk1**2 + p_sqr)
-            Bk2 = np.sqrt(Qk2**2 + p_sqr)
-            E1k1 = R1k1*Bk1
-            E1k2 = R1k2*Bk2
-            E2k1 = R2k1*Bk1
-            E2k2 = R2k2*Bk2
-            # Simplifying these arctans with, e.g., (Z2 - Z1)*arctan2(Qk2*p -
-            # Qk1*p, p*p + Qk2*Qk1) doesn't work because of the restrictions
-            # regarding the angles for that identity. The regression tests
-            # fail for some points by a large amount.
-            kernel += (Z2 - Z1)*(np.arctan2(Qk2, p) - np.arctan2(Qk1, p))
-            kernel += Z2*(np.arctan2(Z2*Qk1, R2k1*p) -
-                          np.arctan2(Z2*Qk2, R2k2*p))
-            kernel += Z1*(np.arctan2(Z1*Qk2, R1k2*p) -
-                          np.arctan2(Z1*Qk1, R1k1*p))
-            Ck1 = Qk1*Ak1
-            Ck2 = Qk2*Ak2
-            # dummy helps prevent zero division and log(0) errors (that's why I
-            # need to add it twice)
-            # Simplifying these two logs with a single one is not worth it
-            # because it would introduce two pow operations.
-            kernel += 0.5*p*Ak1/(Bk1 + dummy)*np.log(
-                (E1k1 - Ck1)*(E2k1 + Ck1)/((E1k1 + Ck1)*(E2k1 - Ck1) + dummy) +
-                dummy)
-            kernel += 0.5*p*(Ak2/(Bk2 + dummy))*np.log(
-                (E2k2 - Ck2)*(E1k2 + Ck2)/((E2k2 + Ck2)*(E1k2 - Ck2) + dummy) +
-                dummy)
-        res += kernel*density
+    res = _gravity('gz', xp, yp, zp, prisms)
     res *= G*SI2MGAL
     return res
 
@@ -340,12 +337,7 @@ def gxx(xp, yp, zp, prisms):
     """
     if xp.shape != yp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    res = 0
-    for prism in prisms:
-        if prism is None or 'density' not in prism.props:
-            continue
-        density = prism.props['density']
-        res += kernelxx(xp, yp, zp, prism)*density
+    res = _gravity('gxx', xp, yp, zp, prisms)
     res *= G * SI2EOTVOS
     return res
 
@@ -382,12 +374,7 @@ def gxy(xp, yp, zp, prisms):
     """
     if xp.shape != yp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    res = 0
-    for prism in prisms:
-        if prism is None or 'density' not in prism.props:
-            continue
-        density = prism.props['density']
-        res += kernelxy(xp, yp, zp, prism)*density
+    res = _gravity('gxy', xp, yp, zp, prisms)
     res *= G * SI2EOTVOS
     return res
 
@@ -424,12 +411,7 @@ def gxz(xp, yp, zp, prisms):
     """
     if xp.shape != yp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    res = 0
-    for prism in prisms:
-        if prism is None or 'density' not in prism.props:
-            continue
-        density = prism.props['density']
-        res += kernelxz(xp, yp, zp, prism)*density
+    res = _gravity('gxz', xp, yp, zp, prisms)
     res *= G * SI2EOTVOS
     return res
 
@@ -466,12 +448,7 @@ def gyy(xp, yp, zp, prisms):
     """
     if xp.shape != yp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    res = 0
-    for prism in prisms:
-        if prism is None or 'density' not in prism.props:
-            continue
-        density = prism.props['density']
-        res += kernelyy(xp, yp, zp, prism)*density
+    res = _gravity('gyy', xp, yp, zp, prisms)
     res *= G * SI2EOTVOS
     return res
 
@@ -508,12 +485,7 @@ def gyz(xp, yp, zp, prisms):
     """
     if xp.shape != yp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    res = 0
-    for prism in prisms:
-        if prism is None or 'density' not in prism.props:
-            continue
-        density = prism.props['density']
-        res += kernelyz(xp, yp, zp, prism)*density
+    res = _gravity('gyz', xp, yp, zp, prisms)
     res *= G * SI2EOTVOS
     return res
 
@@ -550,12 +522,7 @@ def gzz(xp, yp, zp, prisms):
     """
     if xp.shape != yp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    res = 0
-    for prism in prisms:
-        if prism is None or 'density' not in prism.props:
-            continue
-        density = prism.props['density']
-        res += kernelzz(xp, yp, zp, prism)*density
+    res = _gravity('gzz', xp, yp, zp, prisms)
     res *= G * SI2EOTVOS
     return res
 
@@ -605,45 +572,7 @@ def kernelxx(xp, yp, zp, prism):
     """
     if xp.shape != yp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    dummy = 1e-10
-    x, y = prism.x, prism.y
-    z1, z2 = prism.z1, prism.z2
-    nverts = prism.nverts
-    # Calculate the effect of the prism
-    Z1 = z1 - zp
-    Z2 = z2 - zp
-    Z1_sqr = Z1*Z1
-    Z2_sqr = Z2*Z2
-    kernel = 0
-    for k in range(nverts):
-        X1 = x[k] - xp
-        Y1 = y[k] - yp
-        X2 = x[(k + 1) % nverts] - xp
-        Y2 = y[(k + 1) % nverts] - yp
-        deltax = X2 - X1 + dummy
-        deltay = Y2 - Y1 + dummy
-        n = deltax/deltay
-        g = X1 - Y1*n
-        dist = np.sqrt(deltax*deltax + deltay*deltay)
-        cross = X1*Y2 - X2*Y1
-        p = cross/dist + dummy
-        d1 = (deltax*X1 + deltay*Y1)/dist + dummy
-        d2 = (deltax*X2 + deltay*Y2)/dist + dummy
-        vert1_sqr = X1*X1 + Y1*Y1
-        vert2_sqr = X2*X2 + Y2*Y2
-        R11 = np.sqrt(vert1_sqr + Z1_sqr)
-        R12 = np.sqrt(vert1_sqr + Z2_sqr)
-        R21 = np.sqrt(vert2_sqr + Z1_sqr)
-        R22 = np.sqrt(vert2_sqr + Z2_sqr)
-        atan_diff_d2 = np.arctan2(Z2*d2, p*R22) - np.arctan2(Z1*d2, p*R21)
-        atan_diff_d1 = np.arctan2(Z2*d1, p*R12) - np.arctan2(Z1*d1, p*R11)
-        tmp = g*Y2*atan_diff_d2/(p*d2) + n*p*atan_diff_d2/(d2)
-        tmp -= g*Y1*atan_diff_d1/(p*d1) + n*p*atan_diff_d1/(d1)
-        tmp += n*np.log(
-            (Z2 + R12)*(Z1 + R21)/((Z1 + R11)*(Z2 + R22) + dummy) + dummy)
-        tmp *= -1/(1 + n*n)
-        kernel += tmp
-    return kernel
+    return _kernel('gxx', xp, yp, zp, prism)
 
 
 def kernelxy(xp, yp, zp, prism):
@@ -691,46 +620,7 @@ def kernelxy(xp, yp, zp, prism):
     """
     if xp.shape != yp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    dummy = 1e-10
-    x, y = prism.x, prism.y
-    z1, z2 = prism.z1, prism.z2
-    nverts = prism.nverts
-    # Calculate the effect of the prism
-    Z1 = z1 - zp
-    Z2 = z2 - zp
-    Z1_sqr = Z1*Z1
-    Z2_sqr = Z2*Z2
-    kernel = 0
-    for k in range(nverts):
-        X1 = x[k] - xp
-        Y1 = y[k] - yp
-        X2 = x[(k + 1) % nverts] - xp
-        Y2 = y[(k + 1) % nverts] - yp
-        deltax = X2 - X1 + dummy
-        deltay = Y2 - Y1 + dummy
-        n = deltax/deltay
-        g = X1 - Y1*n
-        g_sqr = g*g
-        dist = np.sqrt(deltax*deltax + deltay*deltay)
-        cross = X1*Y2 - X2*Y1
-        p = cross/dist + dummy
-        d1 = (deltax*X1 + deltay*Y1)/dist + dummy
-        d2 = (deltax*X2 + deltay*Y2)/dist + dummy
-        vert1_sqr = X1*X1 + Y1*Y1
-        vert2_sqr = X2*X2 + Y2*Y2
-        R11 = np.sqrt(vert1_sqr + Z1_sqr)
-        R12 = np.sqrt(vert1_sqr + Z2_sqr)
-        R21 = np.sqrt(vert2_sqr + Z1_sqr)
-        R22 = np.sqrt(vert2_sqr + Z2_sqr)
-        atan_diff_d2 = np.arctan2(Z2*d2, p*R22) - np.arctan2(Z1*d2, p*R21)
-        atan_diff_d1 = np.arctan2(Z2*d1, p*R12) - np.arctan2(Z1*d1, p*R11)
-        tmp = (g_sqr + g*n*Y2)*atan_diff_d2/(p*d2) - p*atan_diff_d2/d2
-        tmp -= (g_sqr + g*n*Y1)*atan_diff_d1/(p*d1) - p*atan_diff_d1/d1
-        tmp += np.log(
-            (Z2 + R22)*(Z1 + R11)/((Z1 + R21)*(Z2 + R12) + dummy) + dummy)
-        tmp *= 1/(1 + n*n)
-        kernel += tmp
-    return kernel
+    return _kernel('gxy', xp, yp, zp, prism)
 
 
 def kernelxz(xp, yp, zp, prism):
@@ -778,49 +668,7 @@ def kernelxz(xp, yp, zp, prism):
     """
     if xp.shape != yp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    dummy = 1e-10
-    x, y = prism.x, prism.y
-    z1, z2 = prism.z1, prism.z2
-    nverts = prism.nverts
-    # Calculate the effect of the prism
-    Z1 = z1 - zp
-    Z2 = z2 - zp
-    Z1_sqr = Z1*Z1
-    Z2_sqr = Z2*Z2
-    kernel = 0
-    for k in range(nverts):
-        X1 = x[k] - xp
-        Y1 = y[k] - yp
-        X2 = x[(k + 1) % nverts] - xp
-        Y2 = y[(k + 1) % nverts] - yp
-        deltax = X2 - X1 + dummy
-        deltay = Y2 - Y1 + dummy
-        n = deltax/deltay
-        n_sqr_p1 = n*n + 1
-        g = X1 - Y1*n
-        ng = n*g
-        dist = np.sqrt(deltax*deltax + deltay*deltay)
-        d1 = (deltax*X1 + deltay*Y1)/dist + dummy
-        d2 = (deltax*X2 + deltay*Y2)/dist + dummy
-        vert1_sqr = X1*X1 + Y1*Y1
-        vert2_sqr = X2*X2 + Y2*Y2
-        R11 = np.sqrt(vert1_sqr + Z1_sqr)
-        R12 = np.sqrt(vert1_sqr + Z2_sqr)
-        R21 = np.sqrt(vert2_sqr + Z1_sqr)
-        R22 = np.sqrt(vert2_sqr + Z2_sqr)
-        # Collapsing these logs decreases the precision too much leading to a
-        # larger difference with the prism code.
-        log_r22 = np.log((R22 - d2)/(R22 + d2) + dummy)
-        log_r21 = np.log((R21 - d2)/(R21 + d2) + dummy)
-        log_r12 = np.log((R12 - d1)/(R12 + d1) + dummy)
-        log_r11 = np.log((R11 - d1)/(R11 + d1) + dummy)
-        log_diff_d1 = (0.5/d1)*(log_r12 - log_r11)
-        log_diff_d2 = (0.5/d2)*(log_r22 - log_r21)
-        tmp = (Y2*n_sqr_p1 + ng)*log_diff_d2
-        tmp -= (Y1*n_sqr_p1 + ng)*log_diff_d1
-        tmp *= -1/n_sqr_p1
-        kernel += tmp
-    return kernel
+    return _kernel('gxz', xp, yp, zp, prism)
 
 
 def kernelyy(xp, yp, zp, prism):
@@ -868,45 +716,7 @@ def kernelyy(xp, yp, zp, prism):
     """
     if xp.shape != yp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    dummy = 1e-10
-    x, y = prism.x, prism.y
-    z1, z2 = prism.z1, prism.z2
-    nverts = prism.nverts
-    # Calculate the effect of the prism
-    Z1 = z1 - zp
-    Z2 = z2 - zp
-    Z1_sqr = Z1*Z1
-    Z2_sqr = Z2*Z2
-    kernel = 0
-    for k in range(nverts):
-        X1 = x[k] - xp
-        Y1 = y[k] - yp
-        X2 = x[(k + 1) % nverts] - xp
-        Y2 = y[(k + 1) % nverts] - yp
-        deltax = X2 - X1 + dummy
-        deltay = Y2 - Y1 + dummy
-        m = deltay/deltax
-        c = Y1 - X1*m
-        dist = np.sqrt(deltax*deltax + deltay*deltay)
-        cross = X1*Y2 - X2*Y1
-        p = cross/dist + dummy
-        d1 = (deltax*X1 + deltay*Y1)/dist + dummy
-        d2 = (deltax*X2 + deltay*Y2)/dist + dummy
-        vert1_sqr = X1*X1 + Y1*Y1
-        vert2_sqr = X2*X2 + Y2*Y2
-        R11 = np.sqrt(vert1_sqr + Z1_sqr)
-        R12 = np.sqrt(vert1_sqr + Z2_sqr)
-        R21 = np.sqrt(vert2_sqr + Z1_sqr)
-        R22 = np.sqrt(vert2_sqr + Z2_sqr)
-        atan_diff_d2 = np.arctan2(Z2*d2, p*R22) - np.arctan2(Z1*d2, p*R21)
-        atan_diff_d1 = np.arctan2(Z2*d1, p*R12) - np.arctan2(Z1*d1, p*R11)
-        tmp = c*X2*atan_diff_d2/(p*d2) + m*p*atan_diff_d2/d2
-        tmp -= c*X1*atan_diff_d1/(p*d1) + m*p*atan_diff_d1/d1
-        tmp += m*np.log(
-            (Z2 + R12)*(Z1 + R21)/((Z2 + R22)*(Z1 + R11)) + dummy)
-        tmp *= 1/(1 + m*m)
-        kernel += tmp
-    return kernel
+    return _kernel('gyy', xp, yp, zp, prism)
 
 
 def kernelyz(xp, yp, zp, prism):
@@ -954,46 +764,7 @@ def kernelyz(xp, yp, zp, prism):
     """
     if xp.shape != yp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    dummy = 1e-10
-    x, y = prism.x, prism.y
-    z1, z2 = prism.z1, prism.z2
-    nverts = prism.nverts
-    # Calculate the effect of the prism
-    Z1 = z1 - zp
-    Z2 = z2 - zp
-    Z1_sqr = Z1*Z1
-    Z2_sqr = Z2*Z2
-    kernel = 0
-    for k in range(nverts):
-        X1 = x[k] - xp
-        Y1 = y[k] - yp
-        X2 = x[(k + 1) % nverts] - xp
-        Y2 = y[(k + 1) % nverts] - yp
-        deltax = X2 - X1 + dummy
-        deltay = Y2 - Y1 + dummy
-        m = deltay/deltax
-        m_sqr_p1 = m*m + 1
-        c = Y1 - X1*m
-        cm = c*m
-        dist = np.sqrt(deltax*deltax + deltay*deltay)
-        d1 = (deltax*X1 + deltay*Y1)/dist + dummy
-        d2 = (deltax*X2 + deltay*Y2)/dist + dummy
-        vert1_sqr = X1*X1 + Y1*Y1
-        vert2_sqr = X2*X2 + Y2*Y2
-        R11 = np.sqrt(vert1_sqr + Z1_sqr)
-        R12 = np.sqrt(vert1_sqr + Z2_sqr)
-        R21 = np.sqrt(vert2_sqr + Z1_sqr)
-        R22 = np.sqrt(vert2_sqr + Z2_sqr)
-        # Same remark about collapsing logs as kernelxz
-        log_r11 = np.log((R11 - d1)/(R11 + d1) + dummy)
-        log_r12 = np.log((R12 - d1)/(R12 + d1) + dummy)
-        log_r21 = np.log((R21 - d2)/(R21 + d2) + dummy)
-        log_r22 = np.log((R22 - d2)/(R22 + d2) + dummy)
-        tmp = (X2*m_sqr_p1 + cm)*(0.5/d2)*(log_r22 - log_r21)
-        tmp -= (X1*m_sqr_p1 + cm)*(0.5/d1)*(log_r12 - log_r11)
-        tmp *= 1/m_sqr_p1
-        kernel += tmp
-    return kernel
+    return _kernel('gyz', xp, yp, zp, prism)
 
 
 def kernelzz(xp, yp, zp, prism):
@@ -1041,36 +812,4 @@ def kernelzz(xp, yp, zp, prism):
     """
     if xp.shape != yp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    dummy = 1e-10
-    x, y = prism.x, prism.y
-    z1, z2 = prism.z1, prism.z2
-    nverts = prism.nverts
-    # Calculate the effect of the prism
-    Z1 = z1 - zp
-    Z2 = z2 - zp
-    Z1_sqr = Z1*Z1
-    Z2_sqr = Z2*Z2
-    kernel = 0
-    for k in range(nverts):
-        X1 = x[k] - xp
-        Y1 = y[k] - yp
-        X2 = x[(k + 1) % nverts] - xp
-        Y2 = y[(k + 1) % nverts] - yp
-        deltax = X2 - X1
-        deltay = Y2 - Y1
-        # dist is only used in divisions. Add dummy to avoid zero division
-        # errors if the two vertices coincide.
-        dist = np.sqrt(deltax*deltax + deltay*deltay) + dummy
-        cross = X1*Y2 - X2*Y1
-        p = cross/dist
-        d1 = (deltax*X1 + deltay*Y1)/dist
-        d2 = (deltax*X2 + deltay*Y2)/dist
-        vert1_sqr = X1*X1 + Y1*Y1
-        vert2_sqr = X2*X2 + Y2*Y2
-        R11 = np.sqrt(vert1_sqr + Z1_sqr)
-        R12 = np.sqrt(vert1_sqr + Z2_sqr)
-        R21 = np.sqrt(vert2_sqr + Z1_sqr)
-        R22 = np.sqrt(vert2_sqr + Z2_sqr)
-        kernel += (np.arctan2(Z2*d2, p*R22) - np.arctan2(Z1*d2, p*R21) -
-                   np.arctan2(Z2*d1, p*R12) + np.arctan2(Z1*d1, p*R11))
-    return kernel
+    return _kernel('gzz', xp, yp, zp, prism)
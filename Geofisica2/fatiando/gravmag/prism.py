@@ -24,6 +24,15 @@ The gravitational fields are calculated using the formula of Nagy et al.
 * :func:`~fatiando.gravmag.prism.gyz`
 * :func:`~fatiando.gravmag.prism.gzz`
 
+Function :func:`~fatiando.gravmag.prism.fields` calculates any combination of
+the above in a single pass over the prisms (e.g., the full gravity gradient
+tensor). This is faster than calling each function separately.
+
+When the model is a regular :class:`~fatiando.mesher.PrismMesh`, the above
+functions evaluate the kernels only once on each node of the mesh (instead of
+once for each corner of every prism). This is several times faster for dense
+3D meshes.
+
 .. warning::
 
     The gxy, gxz, and gyz components have singularities when the computation
@@ -43,6 +52,38 @@ Bhattacharyya, 1964) and x, y, z components of the magnetic induction:
 * :func:`~fatiando.gravmag.prism.by`
 * :func:`~fatiando.gravmag.prism.bz`
 
+Function :func:`~fatiando.gravmag.prism.magnetic_fields` calculates all of the
+above in a single pass over the prisms. It also takes the magnetization as
+arrays (magnetization vectors and/or susceptibilities) instead of the
+``'magnetization'`` property of each prism.
+
+**Far-field approximation**
+
+All field functions have a *ratio* argument. If given, prisms that are
+farther from a computation point than *ratio* times their diagonal are
+calculated as point masses (dipoles for the magnetic fields), which is much
+faster. Function :func:`~fatiando.gravmag.prism.farfield_error` gives the
+maximum error of the approximation for a given *ratio*.
+
+**Sensitivity matrix**
+
+Function :func:`~fatiando.gravmag.prism.sensitivity` calculates the
+sensitivity (Jacobian) matrix of any of the above fields for a mesh of prisms.
+The matrix can be single precision and written directly to a
+``numpy.memmap``. For problems where it doesn't fit in memory,
+:func:`~fatiando.gravmag.prism.jacobian_operator` gives a matrix-free version
+(a :class:`scipy.sparse.linalg.LinearOperator`) that can be used in
+:mod:`fatiando.inversion`. If the data are on a regular grid with the same
+spacing as a :class:`~fatiando.mesher.PrismMesh`,
+:func:`~fatiando.gravmag.prism.fft_operator` is a much faster alternative that
+uses 2D FFTs.
+
+**Backends**
+
+The fields are calculated by a compiled Cython module. If it is not available
+(e.g., when installing from source without a C compiler), a version of the
+same code compiled with `numba <http://numba.pydata.org>`__ is used instead.
+
 **Auxiliary Functions**
 
 Calculates the second derivatives of the function
@@ -84,18 +125,257 @@ doi: 10.1007/s001900000116.
 ----
 """
 from __future__ import division, absolute_import
+from multiprocessing.pool import ThreadPool
+import functools
 
 import numpy
+import scipy.sparse.linalg
 
 from .. import utils
-from ..constants import G, SI2EOTVOS, CM, T2NT, SI2MGAL
+from ..mesher import Prism, PrismMesh
+from ..constants import G, SI2EOTVOS, CM, T2NT, SI2MGAL, PERM_FREE_SPACE
 try:
     from . import _prism
 except ImportError:
-    _prism = None
+    try:
+        from . import _prism_numba as _prism
+    except ImportError:
+        _prism = None
+
+# Conversion factors from the output of the _prism functions to the units of
+# each gravitational field
+_UNITS = {'potential': G,
+          'gx': G*SI2MGAL, 'gy': G*SI2MGAL, 'gz': G*SI2MGAL,
+          'gxx': G*SI2EOTVOS, 'gxy': G*SI2EOTVOS, 'gxz': G*SI2EOTVOS,
+          'gyy': G*SI2EOTVOS, 'gyz': G*SI2EOTVOS, 'gzz': G*SI2EOTVOS}
+
+
+def _density_model(prisms, dens):
+    """
+    Pack the bounds and densities of the prisms into 1d-arrays.
+
+    These are the structure of arrays that the compiled code in
+    ``fatiando.gravmag._prism`` uses to loop over all prisms at once.
+    Prisms that are None or that don't have the ``'density'`` property (when
+    *dens* is None) are left out.
+
+    Returns:
+
+    * x1, x2, y1, y2, z1, z2, density : 1d-arrays
+
+    """
+    bounds = []
+    density = []
+    for prism in prisms:
+        if prism is None or ('density' not in prism.props and dens is None):
+            continue
+        bounds.append([prism.x1, prism.x2, prism.y1, prism.y2, prism.z1,
+                       prism.z2])
+        if dens is None:
+            density.append(prism.props['density'])
+        else:
+            density.append(dens)
+    bounds = numpy.array(bounds, dtype=numpy.float).reshape((-1, 6))
+    x1, x2, y1, y2, z1, z2 = numpy.ascontiguousarray(bounds.T)
+    return x1, x2, y1, y2, z1, z2, numpy.array(density, dtype=numpy.float)
+
+
+def _gravity_model(field, prisms, dens, ratio=None):
+    """
+    Choose the compiled function and pack the model for a gravitational field.
+
+    Regular meshes (:class:`~fatiando.mesher.PrismMesh`) are packed for the
+    ``regular_mesh`` function of ``fatiando.gravmag._prism``. It evaluates
+    the kernel once on each node of the mesh instead of once for each of the
+    8 corners of every prism (most nodes are shared by 8 prisms). The effect
+    of the prisms is recovered because the kernel enters the field of a prism
+    as a signed sum over its corners, so the field of the mesh is the sum of
+    the kernel on each node times the signed sum of the densities of the
+    prisms that share that node. All other models use the function *field*.
+
+    If *ratio* is not None, uses ``gravity_farfield`` instead (the far-field
+    approximation for any kind of model).
+
+    Returns:
+
+    * func, model
+        The function and model arguments for ``_dispatcher``.
+
+    """
+    if ratio is not None:
+        model = _density_model(prisms, dens) + (_check_ratio(ratio),)
+        return functools.partial(_prism.gravity_farfield, field), model
+    regular = (isinstance(prisms, PrismMesh) and prisms.celltype is Prism)
+    if not regular:
+        return getattr(_prism, field), _density_model(prisms, dens)
+    nz, ny, nx = prisms.shape
+    if dens is not None:
+        density = dens*numpy.ones(prisms.size, dtype=numpy.float)
+    elif 'density' in prisms.props:
+        density = numpy.array(prisms.props['density'], dtype=numpy.float)
+    else:
+        density = numpy.zeros(prisms.size, dtype=numpy.float)
+    density[list(prisms.mask)] = 0
+    # The node (i, j, k) is the upper corner (positive sign) of prism
+    # (i - 1, j - 1, k - 1) and the lower corner (negative sign) of prism
+    # (i, j, k) in each dimension.
+    padded = numpy.pad(density.reshape((nz, ny, nx)), 1, mode='constant')
+    weights = -numpy.diff(numpy.diff(numpy.diff(padded, axis=0), axis=1),
+                          axis=2)
+    nodes = [numpy.ascontiguousarray(prisms.get_xs(), dtype=numpy.float),
+             numpy.ascontiguousarray(prisms.get_ys(), dtype=numpy.float),
+             numpy.ascontiguousarray(prisms.get_zs(), dtype=numpy.float)]
+    dims = [n[1] - n[0] for n in nodes]
+    model = tuple(nodes) + (numpy.ascontiguousarray(weights),) + tuple(dims)
+    return functools.partial(_prism.regular_mesh, field), model
+
+
+def _magnetic_model(field, model, ratio, direction=None):
+    """
+    Choose the compiled function for a magnetic field and complete its model.
+
+    *model* is the output of ``_magnetization_model``. *direction* is the
+    direction of the regional field (only for ``'tf'``). If *ratio* is not
+    None, uses ``magnetic_farfield`` (the far-field approximation).
+
+    Returns:
+
+    * func, model
+        The function and model arguments for ``_dispatcher``.
+
+    """
+    if ratio is None:
+        if direction is not None:
+            model = model + tuple(direction)
+        return getattr(_prism, field), model
+    if direction is None:
+        direction = (0, 0, 0)
+    model = model + tuple(direction) + (_check_ratio(ratio),)
+    return functools.partial(_prism.magnetic_farfield, field), model
+
+
+def _check_ratio(ratio):
+    """
+    Check that the distance/size ratio of the far-field approximation is
+    valid. Returns it as a float.
+    """
+    if ratio <= 0.5:
+        raise ValueError(
+            "Invalid ratio {}. Must be > 0.5 so that the computation ".format(
+                ratio) + "point is outside of the prisms.")
+    return float(ratio)
+
+
+def _magnetization_model(prisms, pmag, direction=None):
+    """
+    Pack the bounds and magnetization vectors of the prisms into 1d-arrays.
+
+    Prisms that are None or that don't have the ``'magnetization'`` property
+    (when *pmag* is None) are left out. If *direction* is given, scalar
+    magnetizations are taken as intensities along this direction (used for
+    induced magnetization in the total-field anomaly).
+
+    Returns:
+
+    * x1, x2, y1, y2, z1, z2, mx, my, mz : 1d-arrays
+
+    """
+    bounds = []
+    mag = []
+    for prism in prisms:
+        if (prism is None or
+                ('magnetization' not in prism.props and pmag is None)):
+            continue
+        bounds.append([prism.x1, prism.x2, prism.y1, prism.y2, prism.z1,
+                       prism.z2])
+        if pmag is None:
+            mag.append(prism.props['magnetization'])
+        else:
+            mag.append(pmag)
+    if direction is not None:
+        fx, fy, fz = direction
+        mag = [[m*fx, m*fy, m*fz] if isinstance(m, (float, int)) else m
+               for m in mag]
+    bounds = numpy.array(bounds, dtype=numpy.float).reshape((-1, 6))
+    mag = numpy.array(mag, dtype=numpy.float).reshape((-1, 3))
+    x1, x2, y1, y2, z1, z2 = numpy.ascontiguousarray(bounds.T)
+    mx, my, mz = numpy.ascontiguousarray(mag.T)
+    return x1, x2, y1, y2, z1, z2, mx, my, mz
+
+
+def _prism_bounds(prisms):
+    """
+    Pack the bounds of all elements of *prisms* into 1d-arrays.
+
+    Elements that are None are kept (with zero bounds) so that the arrays
+    match the elements of *prisms*. The bounds of a
+    :class:`~fatiando.mesher.PrismMesh` are calculated from the nodes of the
+    mesh without making the prisms.
+
+    Returns:
+
+    * bounds : tuple = (x1, x2, y1, y2, z1, z2)
+        1d-arrays with the bounds of the prisms
+    * valid : 1d-array
+        1 for the prisms and 0 for the elements that are None
+
+    """
+    if isinstance(prisms, PrismMesh) and prisms.celltype is Prism:
+        nz, ny, nx = prisms.shape
+        k, j, i = [n.ravel() for n in numpy.meshgrid(
+            numpy.arange(nz), numpy.arange(ny), numpy.arange(nx),
+            indexing='ij')]
+        xs, ys, zs = [numpy.asarray(n, dtype=numpy.float) for n in
+                      (prisms.get_xs(), prisms.get_ys(), prisms.get_zs())]
+        bounds = (xs[i], xs[i + 1], ys[j], ys[j + 1], zs[k], zs[k + 1])
+        valid = numpy.ones(prisms.size, dtype=numpy.float)
+        valid[list(prisms.mask)] = 0
+        return bounds, valid
+    bounds = numpy.zeros((len(prisms), 6), dtype=numpy.float)
+    valid = numpy.zeros(len(prisms), dtype=numpy.float)
+    for n, prism in enumerate(prisms):
+        if prism is not None:
+            bounds[n] = [prism.x1, prism.x2, prism.y1, prism.y2, prism.z1,
+                         prism.z2]
+            valid[n] = 1
+    bounds = tuple(numpy.ascontiguousarray(b) for b in bounds.T)
+    return bounds, valid
+
+
+def _dispatcher(func, xp, yp, zp, model, res, njobs):
+    """
+    Run *func* (one of the functions in ``fatiando.gravmag._prism``) on the
+    computation points and add the results to *res*.
+
+    The compiled functions release the GIL, so if ``njobs > 1`` the
+    computation points are split into *njobs* parts that are evaluated in
+    parallel threads. Each thread writes to a separate part of *res*.
+
+    *model* is a tuple with the remaining arguments of *func* (the arrays
+    returned by ``_density_model`` or ``_magnetization_model``, etc).
+    """
+    if njobs < 1:
+        raise ValueError("Invalid number of jobs {}. Must be > 0.".format(
+            njobs))
+    if njobs == 1:
+        func(*((xp, yp, zp) + tuple(model) + (res,)))
+        return res
+    strides = numpy.linspace(0, len(xp), njobs + 1).astype(numpy.int)
+
+    def run(part):
+        low, high = strides[part], strides[part + 1]
+        func(*((xp[low:high], yp[low:high], zp[low:high]) + tuple(model) +
+               (res[low:high],)))
+
+    pool = ThreadPool(njobs)
+    try:
+        pool.map(run, range(njobs))
+    finally:
+        pool.close()
+    return res
 
 
-def potential(xp, yp, zp, prisms, dens=None):
+def potential(xp, yp, zp, prisms, dens=None, njobs=1, ratio=None):
     """
     Calculates the gravitational potential.
 
@@ -117,6 +397,14 @@ def potential(xp, yp, zp, prisms, dens=None):
     * dens : float or None
         If not None, will use this value instead of the ``'density'`` property
         of the prisms. Use this, e.g., for sensitivity matrix building.
+    * njobs : int
+        Split the computation points into *njobs* parts and run them in
+        parallel threads. If ``njobs=1`` will run the computation in serial.
+    * ratio : None or float
+        If not None, prisms that are farther from a computation point than
+        *ratio* times their diagonal are calculated as point masses.
+        Must be > 0.5. See :func:`~fatiando.gravmag.prism.farfield_error`
+        for the maximum error this causes.
 
     Returns:
 
@@ -128,22 +416,13 @@ def potential(xp, yp, zp, prisms, dens=None):
         raise ValueError("Input arrays xp, yp, and zp must have same length!")
     size = len(xp)
     res = numpy.zeros(size, dtype=numpy.float)
-    for prism in prisms:
-        if prism is None or ('density' not in prism.props and dens is None):
-            continue
-        if dens is None:
-            density = prism.props['density']
-        else:
-            density = dens
-        x1, x2 = prism.x1, prism.x2
-        y1, y2 = prism.y1, prism.y2
-        z1, z2 = prism.z1, prism.z2
-        _prism.potential(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+    func, model = _gravity_model('potential', prisms, dens, ratio)
+    _dispatcher(func, xp, yp, zp, model, res, njobs)
     res *= G
     return res
 
 
-def gx(xp, yp, zp, prisms, dens=None):
+def gx(xp, yp, zp, prisms, dens=None, njobs=1, ratio=None):
     """
     Calculates the :math:`g_x` gravity acceleration component.
 
@@ -165,6 +444,14 @@ def gx(xp, yp, zp, prisms, dens=None):
     * dens : float or None
         If not None, will use this value instead of the ``'density'`` property
         of the prisms. Use this, e.g., for sensitivity matrix building.
+    * njobs : int
+        Split the computation points into *njobs* parts and run them in
+        parallel threads. If ``njobs=1`` will run the computation in serial.
+    * ratio : None or float
+        If not None, prisms that are farther from a computation point than
+        *ratio* times their diagonal are calculated as point masses.
+        Must be > 0.5. See :func:`~fatiando.gravmag.prism.farfield_error`
+        for the maximum error this causes.
 
     Returns:
 
@@ -176,22 +463,13 @@ def gx(xp, yp, zp, prisms, dens=None):
         raise ValueError("Input arrays xp, yp, and zp must have same length!")
     size = len(xp)
     res = numpy.zeros(size, dtype=numpy.float)
-    for prism in prisms:
-        if prism is None or ('density' not in prism.props and dens is None):
-            continue
-        if dens is None:
-            density = prism.props['density']
-        else:
-            density = dens
-        x1, x2 = prism.x1, prism.x2
-        y1, y2 = prism.y1, prism.y2
-        z1, z2 = prism.z1, prism.z2
-        _prism.gx(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+    func, model = _gravity_model('gx', prisms, dens, ratio)
+    _dispatcher(func, xp, yp, zp, model, res, njobs)
     res *= G * SI2MGAL
     return res
 
 
-def gy(xp, yp, zp, prisms, dens=None):
+def gy(xp, yp, zp, prisms, dens=None, njobs=1, ratio=None):
     """
     Calculates the :math:`g_y` gravity acceleration component.
 
@@ -213,6 +491,14 @@ def gy(xp, yp, zp, prisms, dens=None):
     * dens : float or None
         If not None, will use this value instead of the ``'density'`` property
         of the prisms. Use this, e.g., for sensitivity matrix building.
+    * njobs : int
+        Split the computation points into *njobs* parts and run them in
+        parallel threads. If ``njobs=1`` will run the computation in serial.
+    * ratio : None or float
+        If not None, prisms that are farther from a computation point than
+        *ratio* times their diagonal are calculated as point masses.
+        Must be > 0.5. See :func:`~fatiando.gravmag.prism.farfield_error`
+        for the maximum error this causes.
 
     Returns:
 
@@ -224,22 +510,13 @@ def gy(xp, yp, zp, prisms, dens=None):
         raise ValueError("Input arrays xp, yp, and zp must have same length!")
     size = len(xp)
     res = numpy.zeros(size, dtype=numpy.float)
-    for prism in prisms:
-        if prism is None or ('density' not in prism.props and dens is None):
-            continue
-        if dens is None:
-            density = prism.props['density']
-        else:
-            density = dens
-        x1, x2 = prism.x1, prism.x2
-        y1, y2 = prism.y1, prism.y2
-        z1, z2 = prism.z1, prism.z2
-        _prism.gy(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+    func, model = _gravity_model('gy', prisms, dens, ratio)
+    _dispatcher(func, xp, yp, zp, model, res, njobs)
     res *= G * SI2MGAL
     return res
 
 
-def gz(xp, yp, zp, prisms, dens=None):
+def gz(xp, yp, zp, prisms, dens=None, njobs=1, ratio=None):
     """
     Calculates the :math:`g_z` gravity acceleration component.
 
@@ -261,6 +538,14 @@ def gz(xp, yp, zp, prisms, dens=None):
     * dens : float or None
         If not None, will use this value instead of the ``'density'`` property
         of the prisms. Use this, e.g., for sensitivity matrix building.
+    * njobs : int
+        Split the computation points into *njobs* parts and run them in
+        parallel threads. If ``njobs=1`` will run the computation in serial.
+    * ratio : None or float
+        If not None, prisms that are farther from a computation point than
+        *ratio* times their diagonal are calculated as point masses.
+        Must be > 0.5. See :func:`~fatiando.gravmag.prism.farfield_error`
+        for the maximum error this causes.
 
     Returns:
 
@@ -272,22 +557,13 @@ def gz(xp, yp, zp, prisms, dens=None):
         raise ValueError("Input arrays xp, yp, and zp must have same length!")
     size = len(xp)
     res = numpy.zeros(size, dtype=numpy.float)
-    for prism in prisms:
-        if prism is None or ('density' not in prism.props and dens is None):
-            continue
-        if dens is None:
-            density = prism.props['density']
-        else:
-            density = dens
-        x1, x2 = prism.x1, prism.x2
-        y1, y2 = prism.y1, prism.y2
-        z1, z2 = prism.z1, prism.z2
-        _prism.gz(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+    func, model = _gravity_model('gz', prisms, dens, ratio)
+    _dispatcher(func, xp, yp, zp, model, res, njobs)
     res *= G * SI2MGAL
     return res
 
 
-def gxx(xp, yp, zp, prisms, dens=None):
+def gxx(xp, yp, zp, prisms, dens=None, njobs=1, ratio=None):
     """
     Calculates the :math:`g_{xx}` gravity gradient tensor component.
 
@@ -309,6 +585,14 @@ def gxx(xp, yp, zp, prisms, dens=None):
     * dens : float or None
         If not None, will use this value instead of the ``'density'`` property
         of the prisms. Use this, e.g., for sensitivity matrix building.
+    * njobs : int
+        Split the computation points into *njobs* parts and run them in
+        parallel threads. If ``njobs=1`` will run the computation in serial.
+    * ratio : None or float
+        If not None, prisms that are farther from a computation point than
+        *ratio* times their diagonal are calculated as point masses.
+        Must be > 0.5. See :func:`~fatiando.gravmag.prism.farfield_error`
+        for the maximum error this causes.
 
     Returns:
 
@@ -320,22 +604,13 @@ def gxx(xp, yp, zp, prisms, dens=None):
         raise ValueError("Input arrays xp, yp, and zp must have same length!")
     size = len(xp)
     res = numpy.zeros(size, dtype=numpy.float)
-    for prism in prisms:
-        if prism is None or ('density' not in prism.props and dens is None):
-            continue
-        if dens is None:
-            density = prism.props['density']
-        else:
-            density = dens
-        x1, x2 = prism.x1, prism.x2
-        y1, y2 = prism.y1, prism.y2
-        z1, z2 = prism.z1, prism.z2
-        _prism.gxx(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+    func, model = _gravity_model('gxx', prisms, dens, ratio)
+    _dispatcher(func, xp, yp, zp, model, res, njobs)
     res *= G * SI2EOTVOS
     return res
 
 
-def gxy(xp, yp, zp, prisms, dens=None):
+def gxy(xp, yp, zp, prisms, dens=None, njobs=1, ratio=None):
     """
     Calculates the :math:`g_{xy}` gravity gradient tensor component.
 
@@ -365,6 +640,14 @@ def gxy(xp, yp, zp, prisms, dens=None):
     * dens : float or None
         If not None, will use this value instead of the ``'density'`` property
         of the prisms. Use this, e.g., for sensitivity matrix building.
+    * njobs : int
+        Split the computation points into *njobs* parts and run them in
+        parallel threads. If ``njobs=1`` will run the computation in serial.
+    * ratio : None or float
+        If not None, prisms that are farther from a computation point than
+        *ratio* times their diagonal are calculated as point masses.
+        Must be > 0.5. See :func:`~fatiando.gravmag.prism.farfield_error`
+        for the maximum error this causes.
 
     Returns:
 
@@ -376,22 +659,13 @@ def gxy(xp, yp, zp, prisms, dens=None):
         raise ValueError("Input arrays xp, yp, and zp must have same length!")
     size = len(xp)
     res = numpy.zeros(size, dtype=numpy.float)
-    for prism in prisms:
-        if prism is None or ('density' not in prism.props and dens is None):
-            continue
-        if dens is None:
-            density = prism.props['density']
-        else:
-            density = dens
-        x1, x2 = prism.x1, prism.x2
-        y1, y2 = prism.y1, prism.y2
-        z1, z2 = prism.z1, prism.z2
-        _prism.gxy(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+    func, model = _gravity_model('gxy', prisms, dens, ratio)
+    _dispatcher(func, xp, yp, zp, model, res, njobs)
     res *= G * SI2EOTVOS
     return res
 
 
-def gxz(xp, yp, zp, prisms, dens=None):
+def gxz(xp, yp, zp, prisms, dens=None, njobs=1, ratio=None):
     """
     Calculates the :math:`g_{xz}` gravity gradient tensor component.
 
@@ -421,6 +695,14 @@ def gxz(xp, yp, zp, prisms, dens=None):
     * dens : float or None
         If not None, will use this value instead of the ``'density'`` property
         of the prisms. Use this, e.g., for sensitivity matrix building.
+    * njobs : int
+        Split the computation points into *njobs* parts and run them in
+        parallel threads. If ``njobs=1`` will run the computation in serial.
+    * ratio : None or float
+        If not None, prisms that are farther from a computation point than
+        *ratio* times their diagonal are calculated as point masses.
+        Must be > 0.5. See :func:`~fatiando.gravmag.prism.farfield_error`
+        for the maximum error this causes.
 
     Returns:
 
@@ -432,22 +714,13 @@ def gxz(xp, yp, zp, prisms, dens=None):
         raise ValueError("Input arrays xp, yp, and zp must have same length!")
     size = len(xp)
     res = numpy.zeros(size, dtype=numpy.float)
-    for prism in prisms:
-        if prism is None or ('density' not in prism.props and dens is None):
-            continue
-        if dens is None:
-            density = prism.props['density']
-        else:
-            density = dens
-        x1, x2 = prism.x1, prism.x2
-        y1, y2 = prism.y1, prism.y2
-        z1, z2 = prism.z1, prism.z2
-        _prism.gxz(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+    func, model = _gravity_model('gxz', prisms, dens, ratio)
+    _dispatcher(func, xp, yp, zp, model, res, njobs)
     res *= G * SI2EOTVOS
     return res
 
 
-def gyy(xp, yp, zp, prisms, dens=None):
+def gyy(xp, yp, zp, prisms, dens=None, njobs=1, ratio=None):
     """
     Calculates the :math:`g_{yy}` gravity gradient tensor component.
 
@@ -469,6 +742,14 @@ def gyy(xp, yp, zp, prisms, dens=None):
     * dens : float or None
         If not None, will use this value instead of the ``'density'`` property
         of the prisms. Use this, e.g., for sensitivity matrix building.
+    * njobs : int
+        Split the computation points into *njobs* parts and run them in
+        parallel threads. If ``njobs=1`` will run the computation in serial.
+    * ratio : None or float
+        If not None, prisms that are farther from a computation point than
+        *ratio* times their diagonal are calculated as point masses.
+        Must be > 0.5. See :func:`~fatiando.gravmag.prism.farfield_error`
+        for the maximum error this causes.
 
     Returns:
 
@@ -480,22 +761,13 @@ def gyy(xp, yp, zp, prisms, dens=None):
         raise ValueError("Input arrays xp, yp, and zp must have same length!")
     size = len(xp)
     res = numpy.zeros(size, dtype=numpy.float)
-    for prism in prisms:
-        if prism is None or ('density' not in prism.props and dens is None):
-            continue
-        if dens is None:
-            density = prism.props['density']
-        else:
-            density = dens
-        x1, x2 = prism.x1, prism.x2
-        y1, y2 = prism.y1, prism.y2
-        z1, z2 = prism.z1, prism.z2
-        _prism.gyy(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+    func, model = _gravity_model('gyy', prisms, dens, ratio)
+    _dispatcher(func, xp, yp, zp, model, res, njobs)
     res *= G * SI2EOTVOS
     return res
 
 
-def gyz(xp, yp, zp, prisms, dens=None):
+def gyz(xp, yp, zp, prisms, dens=None, njobs=1, ratio=None):
     """
     Calculates the :math:`g_{yz}` gravity gradient tensor component.
 
@@ -525,6 +797,14 @@ def gyz(xp, yp, zp, prisms, dens=None):
     * dens : float or None
         If not None, will use this value instead of the ``'density'`` property
         of the prisms. Use this, e.g., for sensitivity matrix building.
+    * njobs : int
+        Split the computation points into *njobs* parts and run them in
+        parallel threads. If ``njobs=1`` will run the computation in serial.
+    * ratio : None or float
+        If not None, prisms that are farther from a computation point than
+        *ratio* times their diagonal are calculated as point masses.
+        Must be > 0.5. See :func:`~fatiando.gravmag.prism.farfield_error`
+        for the maximum error this causes.
 
     Returns:
 
@@ -536,22 +816,13 @@ def gyz(xp, yp, zp, prisms, dens=None):
         raise ValueError("Input arrays xp, yp, and zp must have same length!")
     size = len(xp)
     res = numpy.zeros(size, dtype=numpy.float)
-    for prism in prisms:
-        if prism is None or ('density' not in prism.props and dens is None):
-            continue
-        if dens is None:
-            density = prism.props['density']
-        else:
-            density = dens
-        x1, x2 = prism.x1, prism.x2
-        y1, y2 = prism.y1, prism.y2
-        z1, z2 = prism.z1, prism.z2
-        _prism.gyz(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+    func, model = _gravity_model('gyz', prisms, dens, ratio)
+    _dispatcher(func, xp, yp, zp, model, res, njobs)
     res *= G * SI2EOTVOS
     return res
 
 
-def gzz(xp, yp, zp, prisms, dens=None):
+def gzz(xp, yp, zp, prisms, dens=None, njobs=1, ratio=None):
     """
     Calculates the :math:`g_{zz}` gravity gradient tensor component.
 
@@ -573,6 +844,14 @@ def gzz(xp, yp, zp, prisms, dens=None):
     * dens : float or None
         If not None, will use this value instead of the ``'density'`` property
         of the prisms. Use this, e.g., for sensitivity matrix building.
+    * njobs : int
+        Split the computation points into *njobs* parts and run them in
+        parallel threads. If ``njobs=1`` will run the computation in serial.
+    * ratio : None or float
+        If not None, prisms that are farther from a computation point than
+        *ratio* times their diagonal are calculated as point masses.
+        Must be > 0.5. See :func:`~fatiando.gravmag.prism.farfield_error`
+        for the maximum error this causes.
 
     Returns:
 
@@ -584,22 +863,78 @@ def gzz(xp, yp, zp, prisms, dens=None):
         raise ValueError("Input arrays xp, yp, and zp must have same length!")
     size = len(xp)
     res = numpy.zeros(size, dtype=numpy.float)
-    for prism in prisms:
-        if prism is None or ('density' not in prism.props and dens is None):
-            continue
-        if dens is None:
-            density = prism.props['density']
-        else:
-            density = dens
-        x1, x2 = prism.x1, prism.x2
-        y1, y2 = prism.y1, prism.y2
-        z1, z2 = prism.z1, prism.z2
-        _prism.gzz(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
+    func, model = _gravity_model('gzz', prisms, dens, ratio)
+    _dispatcher(func, xp, yp, zp, model, res, njobs)
     res *= G * SI2EOTVOS
     return res
 
 
-def tf(xp, yp, zp, prisms, inc, dec, pmag=None):
+def fields(xp, yp, zp, prisms, fields, dens=None, njobs=1):
+    """
+    Calculates several gravitational fields at once.
+
+    This is faster than calling each function separately because the corners
+    of the prisms are visited only once. The distances to the corners and the
+    log and arctan terms of the kernels are shared by all requested fields.
+    Use it, e.g., to calculate all components of the gravity gradient tensor.
+
+    .. note:: The coordinate system of the input parameters is to be
+        x -> North, y -> East and z -> **DOWN**.
+
+    .. note:: All input values in **SI** units(!). The output is in the same
+        units as the corresponding functions (SI for the potential, mGal for
+        gravity and Eotvos for the gravity gradients).
+
+    Parameters:
+
+    * xp, yp, zp : arrays
+        Arrays with the x, y, and z coordinates of the computation points.
+    * prisms : list of :class:`~fatiando.mesher.Prism`
+        The density model used to calculate the gravitational effect.
+        Prisms must have the property ``'density'``. Prisms that don't have
+        this property will be ignored in the computations. Elements of *prisms*
+        that are None will also be ignored. *prisms* can also be a
+        :class:`~fatiando.mesher.PrismMesh`.
+    * fields : list of strings
+        The fields that will be calculated. Can be any of ``'potential'``,
+        ``'gx'``, ``'gy'``, ``'gz'``, ``'gxx'``, ``'gxy'``, ``'gxz'``,
+        ``'gyy'``, ``'gyz'``, and ``'gzz'``.
+    * dens : float or None
+        If not None, will use this value instead of the ``'density'`` property
+        of the prisms. Use this, e.g., for sensitivity matrix building.
+    * njobs : int
+        Split the computation points into *njobs* parts and run them in
+        parallel threads. If ``njobs=1`` will run the computation in serial.
+
+    Returns:
+
+    * results : list of arrays
+        The fields calculated on xp, yp, zp in the same order as *fields*.
+
+    Examples:
+
+    >>> from fatiando.mesher import Prism
+    >>> model = [Prism(-100, 100, -100, 100, 100, 300, {'density': 1000})]
+    >>> xp, yp, zp = numpy.zeros((3, 1))
+    >>> results = fields(xp, yp, zp, model, ['gzz', 'gz'])
+    >>> numpy.allclose(results[0], gzz(xp, yp, zp, model))
+    True
+    >>> numpy.allclose(results[1], gz(xp, yp, zp, model))
+    True
+
+    """
+    if xp.shape != yp.shape or xp.shape != zp.shape:
+        raise ValueError("Input arrays xp, yp, and zp must have same length!")
+    for field in fields:
+        if field not in _UNITS:
+            raise ValueError("Invalid field '{}'".format(field))
+    res = numpy.zeros((len(xp), len(fields)), dtype=numpy.float)
+    model = _density_model(prisms, dens) + (tuple(fields),)
+    _dispatcher(_prism.fields, xp, yp, zp, model, res, njobs)
+    return [res[:, i]*_UNITS[field] for i, field in enumerate(fields)]
+
+
+def tf(xp, yp, zp, prisms, inc, dec, pmag=None, njobs=1, ratio=None):
     """
     Calculate the total-field magnetic anomaly of prisms.
 
@@ -624,6 +959,14 @@ def tf(xp, yp, zp, prisms, inc, dec, pmag=None):
         A magnetization vector. If not None, will use this value instead of the
         ``'magnetization'`` property of the prisms. Use this, e.g., for
         sensitivity matrix building.
+    * njobs : int
+        Split the computation points into *njobs* parts and run them in
+        parallel threads. If ``njobs=1`` will run the computation in serial.
+    * ratio : None or float
+        If not None, prisms that are farther from a computation point than
+        *ratio* times their diagonal are calculated as dipoles.
+        Must be > 0.5. See :func:`~fatiando.gravmag.prism.farfield_error`
+        for the maximum error this causes.
 
     Returns:
 
@@ -638,31 +981,14 @@ def tf(xp, yp, zp, prisms, inc, dec, pmag=None):
     # Calculate the 3 components of the unit vector in the direction of the
     # regional field
     fx, fy, fz = utils.dircos(inc, dec)
-    if pmag is not None:
-        if isinstance(pmag, float) or isinstance(pmag, int):
-            mx, my, mz = pmag * fx, pmag * fy, pmag * fz
-        else:
-            mx, my, mz = pmag
-    for prism in prisms:
-        if (prism is None or
-                ('magnetization' not in prism.props and pmag is None)):
-            continue
-        if pmag is None:
-            mag = prism.props['magnetization']
-            if isinstance(mag, float) or isinstance(mag, int):
-                mx, my, mz = mag * fx, mag * fy, mag * fz
-            else:
-                mx, my, mz = mag
-        x1, x2 = prism.x1, prism.x2
-        y1, y2 = prism.y1, prism.y2
-        z1, z2 = prism.z1, prism.z2
-        _prism.tf(xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, fx, fy, fz,
-                  res)
+    model = _magnetization_model(prisms, pmag, direction=(fx, fy, fz))
+    func, model = _magnetic_model('tf', model, ratio, direction=(fx, fy, fz))
+    _dispatcher(func, xp, yp, zp, model, res, njobs)
     res *= CM * T2NT
     return res
 
 
-def bx(xp, yp, zp, prisms, pmag=None):
+def bx(xp, yp, zp, prisms, pmag=None, njobs=1, ratio=None):
     """
     Calculates the x component of the magnetic induction produced by
     rectangular prisms.
@@ -681,6 +1007,14 @@ def bx(xp, yp, zp, prisms, pmag=None):
         A magnetization vector. If not None, will use this value instead of the
         ``'magnetization'`` property of the prisms. Use this, e.g., for
         sensitivity matrix building.
+    * njobs : int
+        Split the computation points into *njobs* parts and run them in
+        parallel threads. If ``njobs=1`` will run the computation in serial.
+    * ratio : None or float
+        If not None, prisms that are farther from a computation point than
+        *ratio* times their diagonal are calculated as dipoles.
+        Must be > 0.5. See :func:`~fatiando.gravmag.prism.farfield_error`
+        for the maximum error this causes.
 
     Returns:
 
@@ -690,25 +1024,16 @@ def bx(xp, yp, zp, prisms, pmag=None):
     """
     if xp.shape != yp.shape or xp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    if pmag is not None:
-        mx, my, mz = pmag
     size = len(xp)
     res = numpy.zeros(size, dtype=numpy.float)
-    for prism in prisms:
-        if (prism is None or
-                ('magnetization' not in prism.props and pmag is None)):
-            continue
-        if pmag is None:
-            mx, my, mz = prism.props['magnetization']
-        x1, x2 = prism.x1, prism.x2
-        y1, y2 = prism.y1, prism.y2
-        z1, z2 = prism.z1, prism.z2
-        _prism.bx(xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, res)
+    model = _magnetization_model(prisms, pmag)
+    func, model = _magnetic_model('bx', model, ratio)
+    _dispatcher(func, xp, yp, zp, model, res, njobs)
     res *= CM * T2NT
     return res
 
 
-def by(xp, yp, zp, prisms, pmag=None):
+def by(xp, yp, zp, prisms, pmag=None, njobs=1, ratio=None):
     """
     Calculates the y component of the magnetic induction produced by
     rectangular prisms.
@@ -727,6 +1052,14 @@ def by(xp, yp, zp, prisms, pmag=None):
         A magnetization vector. If not None, will use this value instead of the
         ``'magnetization'`` property of the prisms. Use this, e.g., for
         sensitivity matrix building.
+    * njobs : int
+        Split the computation points into *njobs* parts and run them in
+        parallel threads. If ``njobs=1`` will run the computation in serial.
+    * ratio : None or float
+        If not None, prisms that are farther from a computation point than
+        *ratio* times their diagonal are calculated as dipoles.
+        Must be > 0.5. See :func:`~fatiando.gravmag.prism.farfield_error`
+        for the maximum error this causes.
 
     Returns:
 
@@ -736,25 +1069,16 @@ def by(xp, yp, zp, prisms, pmag=None):
     """
     if xp.shape != yp.shape or xp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    if pmag is not None:
-        mx, my, mz = pmag
     size = len(xp)
     res = numpy.zeros(size, dtype=numpy.float)
-    for prism in prisms:
-        if (prism is None or
-                ('magnetization' not in prism.props and pmag is None)):
-            continue
-        if pmag is None:
-            mx, my, mz = prism.props['magnetization']
-        x1, x2 = prism.x1, prism.x2
-        y1, y2 = prism.y1, prism.y2
-        z1, z2 = prism.z1, prism.z2
-        _prism.by(xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, res)
+    model = _magnetization_model(prisms, pmag)
+    func, model = _magnetic_model('by', model, ratio)
+    _dispatcher(func, xp, yp, zp, model, res, njobs)
     res *= CM * T2NT
     return res
 
 
-def bz(xp, yp, zp, prisms, pmag=None):
+def bz(xp, yp, zp, prisms, pmag=None, njobs=1, ratio=None):
     """
     Calculates the z component of the magnetic induction produced by
     rectangular prisms.
@@ -773,6 +1097,14 @@ def bz(xp, yp, zp, prisms, pmag=None):
         A magnetization vector. If not None, will use this value instead of the
         ``'magnetization'`` property of the prisms. Use this, e.g., for
         sensitivity matrix building.
+    * njobs : int
+        Split the computation points into *njobs* parts and run them in
+        parallel threads. If ``njobs=1`` will run the computation in serial.
+    * ratio : None or float
+        If not None, prisms that are farther from a computation point than
+        *ratio* times their diagonal are calculated as dipoles.
+        Must be > 0.5. See :func:`~fatiando.gravmag.prism.farfield_error`
+        for the maximum error this causes.
 
     Returns:
 
@@ -782,24 +1114,577 @@ def bz(xp, yp, zp, prisms, pmag=None):
     """
     if xp.shape != yp.shape or xp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
-    if pmag is not None:
-        mx, my, mz = pmag
     size = len(xp)
     res = numpy.zeros(size, dtype=numpy.float)
-    for prism in prisms:
-        if (prism is None or
-                ('magnetization' not in prism.props and pmag is None)):
-            continue
-        if pmag is None:
-            mx, my, mz = prism.props['magnetization']
-        x1, x2 = prism.x1, prism.x2
-        y1, y2 = prism.y1, prism.y2
-        z1, z2 = prism.z1, prism.z2
-        _prism.bz(xp, yp, zp, x1, x2, y1, y2, z1, z2, mx, my, mz, res)
+    model = _magnetization_model(prisms, pmag)
+    func, model = _magnetic_model('bz', model, ratio)
+    _dispatcher(func, xp, yp, zp, model, res, njobs)
     res *= CM * T2NT
     return res
 
 
+def magnetic_fields(xp, yp, zp, prisms, inc, dec, magnetization=None,
+                    susceptibility=None, intensity=None, njobs=1):
+    """
+    Calculate the total-field anomaly and the 3 components of the magnetic
+    induction at once.
+
+    The magnetization of the prisms can be given as arrays with one element
+    per prism (the magnetization vectors and/or the susceptibilities), which
+    avoids looping over the ``'magnetization'`` property of each prism. All
+    fields are calculated in a single pass over the prisms, which is faster
+    than calling :func:`~fatiando.gravmag.prism.tf`,
+    :func:`~fatiando.gravmag.prism.bx`, :func:`~fatiando.gravmag.prism.by`,
+    and :func:`~fatiando.gravmag.prism.bz` separately.
+
+    .. note:: Input units are SI. Output is in nT
+
+    .. note:: The coordinate system of the input parameters is to be
+        x -> North, y -> East and z -> Down.
+
+    Parameters:
+
+    * xp, yp, zp : arrays
+        Arrays with the x, y, and z coordinates of the computation points.
+    * prisms : list of :class:`~fatiando.mesher.Prism` or
+      :class:`~fatiando.mesher.PrismMesh`
+        The model used to calculate the fields.
+    * inc : float
+        The inclination of the regional field (in degrees)
+    * dec : float
+        The declination of the regional field (in degrees)
+    * magnetization : None or 2d-array
+        Array with shape (len(prisms), 3) with the magnetization vector of
+        each prism (in A/m). Use it for remanent magnetization.
+    * susceptibility : None or 1d-array
+        The magnetic susceptibility of each prism (in SI). The induced
+        magnetization is parallel to the regional field and is added to
+        *magnetization*.
+    * intensity : float
+        The intensity of the regional (inducing) field in nT. Required if
+        *susceptibility* is given.
+    * njobs : int
+        Split the computation points into *njobs* parts and run them in
+        parallel threads. If ``njobs=1`` will run the computation in serial.
+
+    If both *magnetization* and *susceptibility* are None, will use the
+    ``'magnetization'`` property of the prisms (like
+    :func:`~fatiando.gravmag.prism.tf`). Elements of *prisms* that are None
+    are ignored (but must have a row in the arrays).
+
+    Returns:
+
+    * tf, bx, by, bz : 1d-arrays
+        The fields calculated on xp, yp, zp
+
+    Examples:
+
+    >>> from fatiando.mesher import Prism
+    >>> model = [Prism(-100, 100, -100, 100, 100, 300),
+    ...          Prism(200, 300, -100, 100, 100, 300)]
+    >>> xp, yp, zp = numpy.zeros((3, 10))
+    >>> mag = numpy.array([[1, 2, 3], [0, 0, 0]])
+    >>> tf_, bx_, by_, bz_ = magnetic_fields(
+    ...     xp, yp, zp, model, 30, -10, magnetization=mag,
+    ...     susceptibility=[0.01, 0.05], intensity=23000)
+    >>> # The same as the magnetization property
+    >>> induced = 23000/(T2NT*PERM_FREE_SPACE)*numpy.array([0.01, 0.05])
+    >>> for p, m, i in zip(model, mag, induced):
+    ...     p.props['magnetization'] = m + utils.ang2vec(i, 30, -10)
+    >>> numpy.allclose(tf_, tf(xp, yp, zp, model, 30, -10))
+    True
+    >>> numpy.allclose(bz_, bz(xp, yp, zp, model))
+    True
+
+    """
+    if xp.shape != yp.shape or xp.shape != zp.shape:
+        raise ValueError("Input arrays xp, yp, and zp must have same length!")
+    fx, fy, fz = utils.dircos(inc, dec)
+    if magnetization is None and susceptibility is None:
+        model = _magnetization_model(prisms, None, direction=(fx, fy, fz))
+    else:
+        bounds, valid = _prism_bounds(prisms)
+        mag = numpy.zeros((valid.size, 3), dtype=numpy.float)
+        if magnetization is not None:
+            magnetization = numpy.asarray(magnetization, dtype=numpy.float)
+            if magnetization.shape != mag.shape:
+                raise ValueError(
+                    "Invalid magnetization with shape {}. ".format(
+                        magnetization.shape) +
+                    "Must be {}.".format(mag.shape))
+            mag += magnetization
+        if susceptibility is not None:
+            susceptibility = numpy.asarray(susceptibility, dtype=numpy.float)
+            if susceptibility.shape != valid.shape:
+                raise ValueError(
+                    "Invalid susceptibility with shape {}. ".format(
+                        susceptibility.shape) +
+                    "Must be {}.".format(valid.shape))
+            if intensity is None:
+                raise ValueError(
+                    "Need the intensity of the regional field to calculate "
+                    "the induced magnetization.")
+            induced = susceptibility*intensity/(T2NT*PERM_FREE_SPACE)
+            mag += numpy.transpose([induced*fx, induced*fy, induced*fz])
+        keep = valid == 1
+        model = (tuple(numpy.ascontiguousarray(b[keep]) for b in bounds) +
+                 tuple(numpy.ascontiguousarray(m[keep]) for m in mag.T))
+    res = numpy.zeros((len(xp), 4), dtype=numpy.float)
+    _dispatcher(_prism.magnetic_fields, xp, yp, zp, model + (fx, fy, fz),
+                res, njobs)
+    res *= CM * T2NT
+    return [res[:, i].copy() for i in range(4)]
+
+
+def farfield_error(field, ratio):
+    r"""
+    Upper bound on the error of the far-field approximation of a field.
+
+    When the *ratio* argument of the field functions is used, prisms farther
+    from the computation point than *ratio* times their diagonal are
+    calculated as point masses (or dipoles for the magnetic fields) at their
+    centers. The approximation drops all terms of the multipole expansion of
+    the field of each prism after the first. Because the prisms are symmetric
+    around their centers, all odd terms are zero and the error is at most
+
+    .. math::
+
+        \epsilon \frac{k! C}{d^{k + 1}}, \quad
+        \epsilon = \frac{(1 - t)^{-(k + 1)} + (1 + t)^{-(k + 1)}}{2} - 1,
+        \quad t = \frac{1}{2\ \mathrm{ratio}}
+
+    where :math:`d` is the distance between the computation point and the
+    center of the prism and :math:`k` is the order of the derivative of
+    :math:`1/r` that gives the field (0 for the potential, 1 for gravity, and
+    2 for the gravity gradients and magnetic fields). :math:`C` is the same
+    constant that multiplies the field of a point mass: :math:`G \rho V`
+    (times the unit conversion) for the gravitational fields and
+    :math:`C_m |\vec{M}| V` for the magnetic fields, where :math:`V` is the
+    volume of the prism and :math:`\vec{M}` its magnetization. So
+    :math:`\epsilon` is the error relative to the largest value that the
+    field of the point source can have at that distance.
+
+    Parameters:
+
+    * field : str
+        The name of the field (``'potential'``, ``'gz'``, ``'tf'``, etc).
+    * ratio : float
+        The distance/size ratio used. Must be > 0.5.
+
+    Returns:
+
+    * error : float
+        The relative error bound :math:`\epsilon`.
+
+    Examples:
+
+    >>> print('{:.5f}'.format(farfield_error('gz', 5)))
+    0.03051
+    >>> print('{:.5f}'.format(farfield_error('gzz', 5)))
+    0.06153
+    >>> print('{:.5f}'.format(farfield_error('tf', 20)))
+    0.00376
+
+    """
+    if field not in _UNITS and field not in ['tf', 'bx', 'by', 'bz']:
+        raise ValueError("Invalid field '{}'".format(field))
+    if field == 'potential':
+        order = 0
+    elif field in ['gx', 'gy', 'gz']:
+        order = 1
+    else:
+        order = 2
+    t = 0.5/_check_ratio(ratio)
+    return 0.5*((1 - t)**(-order - 1) + (1 + t)**(-order - 1)) - 1
+
+
+def sensitivity(xp, yp, zp, mesh, field, dtype=numpy.float, out=None,
+                njobs=1, inc=None, dec=None, pmag=None):
+    """
+    Calculates the sensitivity (Jacobian) matrix of a field for a prism model.
+
+    Column j of the matrix is the *field* of prism j of *mesh* with unit
+    physical property (density of 1 kg/m^3 or the magnetization given by
+    *pmag*). Elements of *mesh* that are None have a column of zeros. The
+    matrix is filled in a single compiled (and optionally parallel) pass.
+
+    Use *out* to write the matrix into an existing array. This can be a
+    ``numpy.memmap`` to build matrices that don't fit in memory and store them
+    on disk to reuse in later runs (see the example below).
+
+    .. note:: The coordinate system of the input parameters is to be
+        x -> North, y -> East and z -> **DOWN**.
+
+    .. note:: All input values in **SI** units(!). The output is in the same
+        units as the corresponding field functions.
+
+    Parameters:
+
+    * xp, yp, zp : arrays
+        Arrays with the x, y, and z coordinates of the computation points.
+    * mesh : list of :class:`~fatiando.mesher.Prism` or
+      :class:`~fatiando.mesher.PrismMesh`
+        The prisms that make up the model. Their physical properties are
+        ignored.
+    * field : str
+        The field that will be calculated. Can be any of ``'potential'``,
+        ``'gx'``, ``'gy'``, ``'gz'``, ``'gxx'``, ``'gxy'``, ``'gxz'``,
+        ``'gyy'``, ``'gyz'``, ``'gzz'``, ``'tf'``, ``'bx'``, ``'by'``, or
+        ``'bz'``.
+    * dtype : float32 or float64
+        The data type of the matrix. Ignored if *out* is given.
+    * out : None or 2d-array
+        If given, the matrix will be written to this array. Must have shape
+        (len(xp), len(mesh)) and dtype float32 or float64. Can be a
+        ``numpy.memmap``.
+    * njobs : int
+        Split the computation points (rows) into *njobs* parts and run them
+        in parallel threads. If ``njobs=1`` will run the computation in
+        serial.
+    * inc, dec : floats
+        The inclination and declination of the regional field (in degrees).
+        Required for ``field='tf'``.
+    * pmag : [mx, my, mz] or None
+        The magnetization vector used for all prisms. Required for the
+        magnetic fields. If None and ``field='tf'``, will use a unit
+        magnetization in the direction of the regional field (induced
+        magnetization).
+
+    Returns:
+
+    * sensitivity : 2d-array
+        The sensitivity matrix (*out* if it was given).
+
+    Examples:
+
+    Store the matrix on disk as a ``.npy`` file:
+
+    >>> import os, tempfile
+    >>> from fatiando.mesher import Prism
+    >>> mesh = [Prism(-100, 100, -100, 100, 100, 300),
+    ...         Prism(200, 300, -100, 100, 100, 300)]
+    >>> xp, yp, zp = numpy.zeros((3, 10))
+    >>> fname = os.path.join(tempfile.mkdtemp(), 'sensitivity.npy')
+    >>> out = numpy.lib.format.open_memmap(fname, mode='w+', shape=(10, 2),
+    ...                                    dtype=numpy.float32)
+    >>> jac = sensitivity(xp, yp, zp, mesh, 'gz', out=out)
+    >>> del jac, out
+    >>> # Load it back in later runs without recomputing
+    >>> jac = numpy.load(fname, mmap_mode='r')
+    >>> jac.shape
+    (10, 2)
+    >>> numpy.allclose(jac[:, 1], gz(xp, yp, zp, [mesh[1]], dens=1))
+    True
+
+    """
+    if xp.shape != yp.shape or xp.shape != zp.shape:
+        raise ValueError("Input arrays xp, yp, and zp must have same length!")
+    magnetic, model = _unit_model(mesh, field, inc, dec, pmag)
+    shape = (len(xp), len(model[0]))
+    if out is None:
+        out = numpy.empty(shape, dtype=dtype)
+    if out.shape != shape or out.dtype not in (numpy.float32, numpy.float64):
+        raise ValueError(
+            "Invalid output array with shape {} and dtype {}. ".format(
+                out.shape, out.dtype) +
+            "Must have shape {} and dtype float32 or float64.".format(shape))
+    if magnetic:
+        func = functools.partial(_prism.magnetic_sensitivity, field)
+    else:
+        func = functools.partial(_prism.gravity_sensitivity, field)
+    _dispatcher(func, xp, yp, zp, model, out, njobs)
+    if hasattr(out, 'flush'):
+        out.flush()
+    return out
+
+
+def jacobian_operator(xp, yp, zp, mesh, field, njobs=1, inc=None, dec=None,
+                      pmag=None):
+    """
+    Make a matrix-free version of the sensitivity (Jacobian) matrix.
+
+    The result is a :class:`scipy.sparse.linalg.LinearOperator` that behaves
+    like the matrix returned by :func:`~fatiando.gravmag.prism.sensitivity`
+    but never stores it. The products with a vector (``J.dot(m)``) and of the
+    transpose with a vector (``J.T.dot(r)``) calculate the kernels on the fly.
+    Use it for problems where the matrix doesn't fit in memory.
+
+    Can be used as the Jacobian of a
+    :class:`~fatiando.inversion.misfit.Misfit` so that the inversion never
+    forms the sensitivity or the Hessian matrices.
+
+    .. note:: Each product recalculates all kernels, which takes about as long
+        as calling :func:`~fatiando.gravmag.prism.sensitivity` once.
+
+    Parameters:
+
+    * xp, yp, zp : arrays
+        Arrays with the x, y, and z coordinates of the computation points.
+    * mesh : list of :class:`~fatiando.mesher.Prism` or
+      :class:`~fatiando.mesher.PrismMesh`
+        The prisms that make up the model. Their physical properties are
+        ignored.
+    * field : str
+        The field that will be calculated. Same as in
+        :func:`~fatiando.gravmag.prism.sensitivity`.
+    * njobs : int
+        Split the computation points (or the prisms for the transpose) into
+        *njobs* parts and run them in parallel threads. If ``njobs=1`` will
+        run the computation in serial.
+    * inc, dec : floats
+        The inclination and declination of the regional field (in degrees).
+        Required for ``field='tf'``.
+    * pmag : [mx, my, mz] or None
+        The magnetization vector used for all prisms. Required for the
+        magnetic fields. If None and ``field='tf'``, will use a unit
+        magnetization in the direction of the regional field (induced
+        magnetization).
+
+    Returns:
+
+    * jacobian : :class:`scipy.sparse.linalg.LinearOperator`
+        The operator with shape (len(xp), len(mesh)).
+
+    Examples:
+
+    >>> from fatiando.mesher import Prism
+    >>> mesh = [Prism(-100, 100, -100, 100, 100, 300),
+    ...         Prism(200, 300, -100, 100, 100, 300)]
+    >>> xp, yp, zp = numpy.zeros((3, 10))
+    >>> jac = jacobian_operator(xp, yp, zp, mesh, 'gz')
+    >>> jac.shape
+    (10, 2)
+    >>> dens = numpy.array([1000., -500.])
+    >>> matrix = sensitivity(xp, yp, zp, mesh, 'gz')
+    >>> numpy.allclose(jac.dot(dens), matrix.dot(dens))
+    True
+    >>> numpy.allclose(jac.T.dot(zp + 1), matrix.T.dot(zp + 1))
+    True
+
+    """
+    if xp.shape != yp.shape or xp.shape != zp.shape:
+        raise ValueError("Input arrays xp, yp, and zp must have same length!")
+    if njobs < 1:
+        raise ValueError("Invalid number of jobs {}. Must be > 0.".format(
+            njobs))
+    magnetic, model = _unit_model(mesh, field, inc, dec, pmag)
+    shape = (len(xp), len(model[0]))
+    scale = model[-1]
+    # The arguments of the forward functions, without the scale
+    forward_model = model[:-1]
+    if magnetic:
+        transpose = functools.partial(_prism.magnetic_transpose, field)
+        if field != 'tf':
+            # bx, by, bz don't take the direction of the regional field
+            forward_model = model[:9]
+        forward = getattr(_prism, field)
+        nprops = 3
+    else:
+        transpose = functools.partial(_prism.gravity_transpose, field)
+        forward = getattr(_prism, field)
+        nprops = 1
+
+    def matvec(vector):
+        vector = numpy.ravel(vector)
+        props = tuple(numpy.ascontiguousarray(vector*prop)
+                      for prop in model[6:6 + nprops])
+        res = numpy.zeros(shape[0], dtype=numpy.float)
+        _dispatcher(forward, xp, yp, zp,
+                    model[:6] + props + forward_model[6 + nprops:], res, njobs)
+        res *= scale
+        return res
+
+    def rmatvec(vector):
+        residuals = numpy.ascontiguousarray(numpy.ravel(vector),
+                                            dtype=numpy.float)
+        res = numpy.zeros(shape[1], dtype=numpy.float)
+        strides = numpy.linspace(0, shape[1], njobs + 1).astype(numpy.int)
+
+        def run(part):
+            low, high = strides[part], strides[part + 1]
+            args = [m[low:high] for m in model[:6 + nprops]]
+            args.extend(model[6 + nprops:])
+            transpose(*([xp, yp, zp] + args + [residuals, res[low:high]]))
+
+        if njobs == 1:
+            run(0)
+        else:
+            pool = ThreadPool(njobs)
+            try:
+                pool.map(run, range(njobs))
+            finally:
+                pool.close()
+        return res
+
+    return scipy.sparse.linalg.LinearOperator(
+        shape, matvec=matvec, rmatvec=rmatvec, dtype=numpy.float)
+
+
+def fft_operator(xp, yp, zp, shape, mesh, field, inc=None, dec=None,
+                 pmag=None):
+    """
+    Make a matrix-free sensitivity (Jacobian) matrix using 2D FFTs.
+
+    Works when the computation points are on a regular grid at a constant
+    height and the *mesh* is a :class:`~fatiando.mesher.PrismMesh` with the
+    same horizontal spacing as the grid. In this case, the sensitivity matrix
+    of each layer of the mesh is block-Toeplitz with Toeplitz blocks (the
+    effect of a prism depends only on its horizontal offset from the
+    computation point). The products of the matrix (``J.dot(m)``) and of its
+    transpose (``J.T.dot(r)``) with a vector are calculated layer by layer as
+    2D convolutions using FFTs. Only the effect of one prism per layer is
+    calculated (once, when making the operator) on a grid with twice the
+    size.
+
+    The result is a :class:`scipy.sparse.linalg.LinearOperator` like the one
+    from :func:`~fatiando.gravmag.prism.jacobian_operator` and can be used in
+    the same way. The columns match the elements of the mesh.
+
+    .. note:: The coordinate system of the input parameters is to be
+        x -> North, y -> East and z -> **DOWN**.
+
+    Parameters:
+
+    * xp, yp, zp : arrays
+        Arrays with the x, y, and z coordinates of the computation points.
+        Must be a regular grid (like the ones generated by
+        :func:`fatiando.gridder.regular`).
+    * shape : tuple = (nx, ny)
+        The shape of the grid.
+    * mesh : :class:`~fatiando.mesher.PrismMesh`
+        The mesh. Its physical properties are ignored.
+    * field : str
+        The field that will be calculated. Same as in
+        :func:`~fatiando.gravmag.prism.sensitivity`.
+    * inc, dec : floats
+        The inclination and declination of the regional field (in degrees).
+        Required for ``field='tf'``.
+    * pmag : [mx, my, mz] or None
+        The magnetization vector used for all prisms. Required for the
+        magnetic fields. If None and ``field='tf'``, will use a unit
+        magnetization in the direction of the regional field (induced
+        magnetization).
+
+    Returns:
+
+    * jacobian : :class:`scipy.sparse.linalg.LinearOperator`
+        The operator with shape (len(xp), mesh.size).
+
+    Examples:
+
+    >>> from fatiando import gridder
+    >>> from fatiando.mesher import PrismMesh
+    >>> mesh = PrismMesh((0, 100, 0, 200, 0, 50), (2, 2, 1))
+    >>> xp, yp, zp = gridder.regular((-100, 200, -100, 300), (4, 5), z=-1)
+    >>> jac = fft_operator(xp, yp, zp, (4, 5), mesh, 'gz')
+    >>> jac.shape
+    (20, 4)
+    >>> dens = numpy.array([1000., -500., 200., 0.])
+    >>> matrix = sensitivity(xp, yp, zp, mesh, 'gz')
+    >>> numpy.allclose(jac.dot(dens), matrix.dot(dens))
+    True
+
+    """
+    if xp.shape != yp.shape or xp.shape != zp.shape:
+        raise ValueError("Input arrays xp, yp, and zp must have same length!")
+    nx, ny = shape
+    if xp.size != nx*ny:
+        raise ValueError("Grid shape {} doesn't match {} points.".format(
+            shape, xp.size))
+    if not (isinstance(mesh, PrismMesh) and mesh.celltype is Prism):
+        raise ValueError("The model must be a PrismMesh.")
+    nz, mny, mnx = mesh.shape
+    xs, ys, zs = mesh.get_xs(), mesh.get_ys(), mesh.get_zs()
+    dx, dy = xs[1] - xs[0], ys[1] - ys[0]
+    xgrid = numpy.reshape(xp, shape)
+    ygrid = numpy.reshape(yp, shape)
+    regular = (numpy.allclose(zp, zp[0]) and
+               numpy.allclose(xgrid, xgrid[:, :1]) and
+               numpy.allclose(ygrid, ygrid[:1, :]) and
+               numpy.allclose(numpy.diff(xgrid[:, 0]), dx) and
+               numpy.allclose(numpy.diff(ygrid[0, :]), dy))
+    if not regular:
+        raise ValueError(
+            "The points must be on a regular grid at a constant height with "
+            "the same spacing as the mesh ({}, {}).".format(dx, dy))
+    # Sizes of the grids used in the FFTs. The effect of a prism on all
+    # horizontal offsets between the grid and the mesh fits in them.
+    fftshape = (nx + mnx - 1, ny + mny - 1)
+    x = xgrid[0, 0] + dx*numpy.arange(-(mnx - 1), nx)
+    y = ygrid[0, 0] + dy*numpy.arange(-(mny - 1), ny)
+    x, y = [numpy.ascontiguousarray(i.ravel())
+            for i in numpy.meshgrid(x, y, indexing='ij')]
+    z = zp[0]*numpy.ones_like(x)
+    kernels = []
+    for k in range(nz):
+        cell = Prism(xs[0], xs[1], ys[0], ys[1], zs[k], zs[k + 1])
+        magnetic, model = _unit_model([cell], field, inc, dec, pmag)
+        if magnetic and field != 'tf':
+            # bx, by, bz don't take the direction of the regional field
+            model = model[:9] + model[-1:]
+        effect = numpy.zeros(x.size, dtype=numpy.float)
+        getattr(_prism, field)(x, y, z, *(model[:-1] + (effect,)))
+        effect *= model[-1]
+        kernels.append(numpy.fft.rfft2(effect.reshape(fftshape)))
+    kernels = numpy.array(kernels)
+    valid = numpy.ones(mesh.size, dtype=numpy.float)
+    valid[list(mesh.mask)] = 0
+
+    def matvec(vector):
+        # The mesh layers are (ny, nx) but the grid is (nx, ny)
+        props = (valid*numpy.ravel(vector)).reshape((nz, mny, mnx))
+        props = numpy.fft.rfft2(numpy.transpose(props, (0, 2, 1)), fftshape)
+        res = numpy.fft.irfft2((kernels*props).sum(axis=0), fftshape)
+        return res[mnx - 1:, mny - 1:].ravel()
+
+    def rmatvec(vector):
+        residuals = numpy.zeros(fftshape, dtype=numpy.float)
+        residuals[mnx - 1:, mny - 1:] = numpy.reshape(vector, shape)
+        residuals = numpy.fft.rfft2(residuals)
+        res = numpy.fft.irfft2(numpy.conj(kernels)*residuals, fftshape)
+        res = numpy.transpose(res[:, :mnx, :mny], (0, 2, 1))
+        return valid*res.ravel()
+
+    return scipy.sparse.linalg.LinearOperator(
+        (xp.size, mesh.size), matvec=matvec, rmatvec=rmatvec,
+        dtype=numpy.float)
+
+
+def _unit_model(mesh, field, inc, dec, pmag):
+    """
+    Pack the prisms of *mesh* with unit physical property into 1d-arrays.
+
+    Used to make the columns of the sensitivity matrix. Elements of *mesh*
+    that are None are kept with zero physical property so that the columns
+    match the elements of the mesh.
+
+    Returns:
+
+    * magnetic : True or False
+        Whether *field* is a magnetic field.
+    * model : tuple
+        ``(x1, x2, y1, y2, z1, z2, density, scale)`` for the gravitational
+        fields or ``(x1, x2, y1, y2, z1, z2, mx, my, mz, fx, fy, fz, scale)``
+        for the magnetic fields. *scale* converts the result to the units of
+        the field.
+
+    """
+    bounds, valid = _prism_bounds(mesh)
+    if field in _UNITS:
+        return False, bounds + (valid, _UNITS[field])
+    if field not in ['tf', 'bx', 'by', 'bz']:
+        raise ValueError("Invalid field '{}'".format(field))
+    fx, fy, fz = 0, 0, 0
+    if field == 'tf':
+        fx, fy, fz = utils.dircos(inc, dec)
+        if pmag is None:
+            pmag = [fx, fy, fz]
+    if pmag is None:
+        raise ValueError("Need a magnetization vector for '{}'".format(field))
+    magnetization = tuple(m*valid for m in pmag)
+    return True, bounds + magnetization + (fx, fy, fz, CM*T2NT)
+
+
 def kernelxx(xp, yp, zp, prism):
     r"""
     Calculates the xx derivative of the function
@@ -828,10 +1713,8 @@ def kernelxx(xp, yp, zp, prism):
     if xp.shape != yp.shape or xp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
     res = numpy.zeros(len(xp), dtype=numpy.float)
-    x1, x2 = prism.x1, prism.x2
-    y1, y2 = prism.y1, prism.y2
-    z1, z2 = prism.z1, prism.z2
-    _prism.gxx(xp, yp, zp, x1, x2, y1, y2, z1, z2, 1, res)
+    x1, x2, y1, y2, z1, z2, density = _density_model([prism], 1)
+    _prism.gxx(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
     return res
 
 
@@ -863,10 +1746,8 @@ def kernelyy(xp, yp, zp, prism):
     if xp.shape != yp.shape or xp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
     res = numpy.zeros(len(xp), dtype=numpy.float)
-    x1, x2 = prism.x1, prism.x2
-    y1, y2 = prism.y1, prism.y2
-    z1, z2 = prism.z1, prism.z2
-    _prism.gyy(xp, yp, zp, x1, x2, y1, y2, z1, z2, 1, res)
+    x1, x2, y1, y2, z1, z2, density = _density_model([prism], 1)
+    _prism.gyy(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
     return res
 
 
@@ -898,10 +1779,8 @@ def kernelzz(xp, yp, zp, prism):
     if xp.shape != yp.shape or xp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
     res = numpy.zeros(len(xp), dtype=numpy.float)
-    x1, x2 = prism.x1, prism.x2
-    y1, y2 = prism.y1, prism.y2
-    z1, z2 = prism.z1, prism.z2
-    _prism.gzz(xp, yp, zp, x1, x2, y1, y2, z1, z2, 1, res)
+    x1, x2, y1, y2, z1, z2, density = _density_model([prism], 1)
+    _prism.gzz(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
     return res
 
 
@@ -933,10 +1812,8 @@ def kernelxy(xp, yp, zp, prism):
     if xp.shape != yp.shape or xp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
     res = numpy.zeros(len(xp), dtype=numpy.float)
-    x1, x2 = prism.x1, prism.x2
-    y1, y2 = prism.y1, prism.y2
-    z1, z2 = prism.z1, prism.z2
-    _prism.gxy(xp, yp, zp, x1, x2, y1, y2, z1, z2, 1, res)
+    x1, x2, y1, y2, z1, z2, density = _density_model([prism], 1)
+    _prism.gxy(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
     return res
 
 
@@ -968,10 +1845,8 @@ def kernelxz(xp, yp, zp, prism):
     if xp.shape != yp.shape or xp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
     res = numpy.zeros(len(xp), dtype=numpy.float)
-    x1, x2 = prism.x1, prism.x2
-    y1, y2 = prism.y1, prism.y2
-    z1, z2 = prism.z1, prism.z2
-    _prism.gxz(xp, yp, zp, x1, x2, y1, y2, z1, z2, 1, res)
+    x1, x2, y1, y2, z1, z2, density = _density_model([prism], 1)
+    _prism.gxz(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
     return res
 
 
@@ -1003,8 +1878,6 @@ def kernelyz(xp, yp, zp, prism):
     if xp.shape != yp.shape or xp.shape != zp.shape:
         raise ValueError("Input arrays xp, yp, and zp must have same shape!")
     res = numpy.zeros(len(xp), dtype=numpy.float)
-    x1, x2 = prism.x1, prism.x2
-    y1, y2 = prism.y1, prism.y2
-    z1, z2 = prism.z1, prism.z2
-    _prism.gyz(xp, yp, zp, x1, x2, y1, y2, z1, z2, 1, res)
+    x1, x2, y1, y2, z1, z2, density = _density_model([prism], 1)
+    _prism.gyz(xp, yp, zp, x1, x2, y1, y2, z1, z2, density, res)
     return res
@@ -1,5 +1,23 @@
 r"""
 The potential fields of a homogeneous sphere.
+
+The fields are calculated by a compiled engine (using `numba
+<http://numba.pydata.org>`__) that runs in parallel threads on all cores. Use
+:func:`~fatiando.gravmag.sphere.fields` to calculate several fields at once
+(e.g., the full gravity gradient tensor), which is faster than calling each
+function separately. This makes models with many spheres (e.g., equivalent
+sources) practical.
+
+For very large models, pass an *accuracy* to the functions to use a
+Barnes-Hut tree code instead of summing the effect of every sphere. Groups of
+spheres that are far from a computation point are replaced by the multipole
+expansion (up to the quadrupole) of their masses or magnetic dipoles. The
+cost grows as :math:`N \log M` instead of :math:`N M` (for N computation
+points and M spheres). How far a group has to be depends on the model, so it
+is calibrated against the direct sum on a sample of the computation points.
+The direct sum of the gravity (``gz``) is very cheap and is faster than the
+tree code for up to a few hundred thousand spheres. The gradients and the
+magnetic fields are faster with the tree code from about 10^5 spheres.
 """
 from __future__ import division, absolute_import
 
@@ -7,6 +25,8 @@ import numpy as np
 
 from ..constants import SI2MGAL, G, CM, T2NT, SI2EOTVOS
 from .. import utils
+from ..mesher import PointGrid
+from . import _sphere_numba, _treecode_numba, _threads
 from .._our_duecredit import due, Doi
 
 
@@ -15,34 +35,268 @@ due.cite(Doi("10.1017/CBO9780511549816"),
          path='fatiando.gravmag.sphere')
 
 
-# These are the second derivatives of the V = 1/r function that is used by the
-# magnetic field component, total-field magnetic anomaly, gravity gradients,
-# and the kernel functions.
-def _v_xx(x, y, z, r_sqr, r_5):
-    return (3*x**2 - r_sqr)/r_5
+# The unit conversion of each field
+_UNITS = {'gz': G*SI2MGAL, 'bx': CM*T2NT, 'by': CM*T2NT, 'bz': CM*T2NT,
+          'tf': CM*T2NT}
+_UNITS.update((f, G*SI2EOTVOS) for f in 'gxx gxy gxz gyy gyz gzz'.split())
+# The number of computation points used to calibrate the tree code
+_SAMPLE_SIZE = 256
 
 
-def _v_xy(x, y, z, r_sqr, r_5):
-    return 3*x*y/r_5
+def _sources(spheres, gravity, magnetic, dens=None, pmag=None):
+    """
+    Pack the spheres into the array used by the compiled engine.
 
+    Only the spheres that have the physical properties needed (*gravity* for
+    the density and *magnetic* for the magnetization) are included. *dens*
+    and *pmag* can have one value per sphere.
 
-def _v_xz(x, y, z, r_sqr, r_5):
-    return 3*x*z/r_5
+    Returns:
 
+    * sources : 2d-array
+        One sphere per column with the center, the mass (density times
+        volume), and the 3 components of the magnetic moment (magnetization
+        times volume).
 
-def _v_yy(x, y, z, r_sqr, r_5):
-    return (3*y**2 - r_sqr)/r_5
+    """
+    if isinstance(spheres, PointGrid):
+        return _grid_sources(spheres, gravity, magnetic, dens, pmag)
+    dens_array = np.ndim(dens) > 0
+    pmag_array = np.ndim(pmag) > 1
+    sources = []
+    for i, sphere in enumerate(spheres):
+        if sphere is None:
+            continue
+        mass, moment = 0, (0, 0, 0)
+        valid = False
+        volume = 4*np.pi*(sphere.radius**3)/3
+        if gravity and (dens is not None or 'density' in sphere.props):
+            if dens is None:
+                density = sphere.props['density']
+            else:
+                density = dens[i] if dens_array else dens
+            mass = density*volume
+            valid = True
+        if magnetic and (pmag is not None or
+                         'magnetization' in sphere.props):
+            if pmag is None:
+                moment = volume*np.asarray(sphere.props['magnetization'])
+            else:
+                moment = volume*np.asarray(pmag[i] if pmag_array else pmag)
+            valid = True
+        if valid:
+            sources.append([sphere.x, sphere.y, sphere.z, mass, moment[0],
+                            moment[1], moment[2]])
+    sources = np.array(sources, dtype='float').reshape((len(sources), 7))
+    return np.ascontiguousarray(sources.T)
+
+
+def _grid_sources(grid, gravity, magnetic, dens, pmag):
+    """
+    Same as _sources but for a :class:`~fatiando.mesher.PointGrid` without
+    looping over the points.
+    """
+    volume = 4*np.pi*(grid.radius**3)/3
+    sources = np.zeros((7, grid.size))
+    sources[0], sources[1], sources[2] = grid.x, grid.y, grid.z
+    valid = False
+    if gravity and (dens is not None or 'density' in grid.props):
+        density = grid.props['density'] if dens is None else dens
+        sources[3] = volume*np.asarray(density)
+        valid = True
+    if magnetic and (pmag is not None or 'magnetization' in grid.props):
+        mag = grid.props['magnetization'] if pmag is None else pmag
+        sources[4:] = volume*np.transpose(np.asarray(mag))
+        valid = True
+    if not valid:
+        return np.zeros((7, 0))
+    return sources
+
+
+def _engine(xp, yp, zp, sources, fields, direction=None, accuracy=None):
+    """
+    Calculate the *fields* of the packed *sources* in one pass of the
+    compiled engine (without the unit conversions). If *accuracy* is not
+    None, will use the tree code instead.
 
+    Returns:
 
-def _v_yz(x, y, z, r_sqr, r_5):
-    return 3*y*z/r_5
+    * results : 2d-array
+        One column per field with the shape of the computation points
+        flattened.
 
+    """
+    xp, yp, zp = (np.ascontiguousarray(i, dtype='float').ravel()
+                  for i in np.broadcast_arrays(xp, yp, zp))
+    codes = np.array([_sphere_numba.FIELD_CODES[f] for f in fields])
+    if direction is None:
+        direction = np.zeros(3)
+    direction = np.asarray(direction, dtype='float')
+    result = np.empty((xp.size, len(fields)))
+    if accuracy is not None and accuracy <= 0:
+        raise ValueError("Invalid accuracy {}. Must be > 0.".format(accuracy))
+    if accuracy is None or xp.size <= _SAMPLE_SIZE:
+        _threads.run(
+            lambda part: _sphere_numba.engine(codes, xp[part], yp[part],
+                                              zp[part], sources, direction,
+                                              result[part]),
+            xp.size)
+        return result
+    tree = _treecode_numba.build(sources, _treecode_numba.LEAF_SIZE)
+    order, start, end, child, center, radius, depth = tree
+    sources = np.ascontiguousarray(sources[:, order])
+    moments = np.empty((start.size, _treecode_numba.NMOMENTS))
+    _threads.run(
+        lambda part: _treecode_numba.node_moments(sources, start[part],
+                                                  end[part], center[part],
+                                                  moments[part]),
+        start.size)
+
+    def treecode(theta, x, y, z, out):
+        # The points close to the sources take longer, so use smaller parts
+        # to keep all threads busy
+        _threads.run(
+            lambda part: _treecode_numba.engine(
+                codes, x[part], y[part], z[part], sources, start, end, child,
+                center, radius, moments, theta, depth, direction, out[part]),
+            x.size, parts=4*_threads.NJOBS)
+
+    # The error of the expansion is at most about 2*theta**3 times the field
+    # (for random positive and negative sources) but can be orders of
+    # magnitude smaller depending on the sources and the points. So search
+    # for the largest theta that is accurate enough (with a safety factor of
+    # 2) on a sample of the points, where the direct sum is cheap.
+    sample = np.linspace(0, xp.size - 1, _SAMPLE_SIZE).astype('int')
+    x, y, z = xp[sample], yp[sample], zp[sample]
+    true = np.empty((sample.size, len(fields)))
+    _sphere_numba.engine(codes, x, y, z, sources, direction, true)
+    tolerance = 0.5*accuracy*np.abs(true).max(axis=0)
+    approx = np.empty_like(true)
+
+    def accurate(theta):
+        treecode(theta, x, y, z, approx)
+        return np.all(np.abs(approx - true).max(axis=0) <= tolerance)
+
+    theta, high = min((accuracy/2)**(1/3), 0.9), 0.9
+    if accurate(high):
+        theta = high
+    else:
+        for _ in range(5):
+            middle = np.sqrt(theta*high)
+            if accurate(middle):
+                theta = middle
+            else:
+                high = middle
+    treecode(theta, xp, yp, zp, result)
+    return result
+
+
+def fields(xp, yp, zp, spheres, fields, dens=None, pmag=None, inc=None,
+           dec=None, accuracy=None):
+    """
+    Calculate several gravitational and magnetic fields at once.
+
+    This is faster than calling each function separately because the
+    distances between the computation points and the spheres are calculated
+    only once for all fields. Use it, e.g., to calculate all components of
+    the gravity gradient tensor or of the magnetic induction.
+
+    The coordinate system of the input parameters is x -> North, y -> East and
+    z -> Down.
 
-def _v_zz(x, y, z, r_sqr, r_5):
-    return (3*z**2 - r_sqr)/r_5
+    Input units should be SI. The output is in the same units as the
+    corresponding functions (mGal for gz, Eotvos for the gravity gradients,
+    and nT for the magnetic fields).
 
+    Parameters:
 
-def tf(xp, yp, zp, spheres, inc, dec, pmag=None):
+    * xp, yp, zp : arrays
+        The x, y, and z coordinates where the fields will be calculated
+    * spheres : list of :class:`fatiando.mesher.Sphere`
+        The spheres. Spheres must have the physical property ``'density'``
+        for the gravitational fields and ``'magnetization'`` for the magnetic
+        fields. Spheres that are ``None`` or without the property will be
+        ignored.
+    * fields : list of strings
+        The fields that will be calculated. Can be any of ``'gz'``,
+        ``'gxx'``, ``'gxy'``, ``'gxz'``, ``'gyy'``, ``'gyz'``, ``'gzz'``,
+        ``'bx'``, ``'by'``, ``'bz'``, and ``'tf'``.
+    * dens : float, 1d-array or None
+        If not None, will use this value instead of the ``'density'`` property
+        of the spheres. Can be an array with the density of each sphere.
+    * pmag : [mx, my, mz], 2d-array or None
+        If not None, will use this value instead of the ``'magnetization'``
+        property of the spheres. Can be an array with the magnetization
+        vector of each sphere (one per row).
+    * inc, dec : floats or None
+        The inclination and declination of the regional field (in degrees).
+        Required for ``'tf'``.
+    * accuracy : float or None
+        If not None, will use a tree code to approximate the effect of groups
+        of spheres that are far from the computation points. The error is
+        about *accuracy* times the largest absolute value of the field (e.g.,
+        ``1e-3``). Use it for models with many spheres (> 10^5). If None,
+        will sum the effect of every sphere.
+
+    Returns:
+
+    * results : list of arrays
+        The fields calculated on xp, yp, zp in the same order as *fields*.
+
+    Examples:
+
+    >>> from fatiando.mesher import Sphere
+    >>> model = [Sphere(0, 0, 500, 200, {'density': 1000,
+    ...                                  'magnetization': [1, 0, 1]})]
+    >>> xp, yp, zp = np.array([0., 100.]), np.zeros(2), np.zeros(2)
+    >>> results = fields(xp, yp, zp, model, ['gzz', 'tf'], inc=45, dec=0)
+    >>> bool(np.allclose(results[0], gzz(xp, yp, zp, model)))
+    True
+    >>> bool(np.allclose(results[1], tf(xp, yp, zp, model, 45, 0)))
+    True
+
+    Use *accuracy* to speed up the computations for large models:
+
+    >>> from fatiando.mesher import PointGrid
+    >>> layer = PointGrid([-5000, 5000, -5000, 5000], 500, (100, 100))
+    >>> layer.addprop('density', np.random.uniform(-1, 1, layer.size))
+    >>> xp, yp = np.random.uniform(-5000, 5000, (2, 100))
+    >>> zp = np.zeros(100)
+    >>> true = gz(xp, yp, zp, layer)
+    >>> approx = gz(xp, yp, zp, layer, accuracy=1e-3)
+    >>> bool(np.abs(approx - true).max() < 1e-3*np.abs(true).max())
+    True
+
+    """
+    for field in fields:
+        if field not in _UNITS:
+            raise ValueError("Invalid field '{}'".format(field))
+    direction = None
+    if 'tf' in fields:
+        if inc is None or dec is None:
+            raise ValueError("inc and dec are required for 'tf'")
+        direction = utils.dircos(inc, dec)
+    gravity = any(f.startswith('g') for f in fields)
+    magnetic = any(not f.startswith('g') for f in fields)
+    sources = _sources(spheres, gravity, magnetic, dens=dens, pmag=pmag)
+    shape = np.broadcast(xp, yp, zp).shape
+    result = _engine(xp, yp, zp, sources, fields, direction, accuracy)
+    return [(result[:, i]*_UNITS[field]).reshape(shape)
+            for i, field in enumerate(fields)]
+
+
+def _kernel(xp, yp, zp, sphere, field):
+    """
+    Calculate the second derivative *field* of the kernel of a single sphere.
+    """
+    volume = 4*np.pi*(sphere.radius**3)/3
+    sources = np.array([[sphere.x], [sphere.y], [sphere.z], [volume], [0],
+                        [0], [0]], dtype='float')
+    result = _engine(xp, yp, zp, sources, [field])
+    return result[:, 0].reshape(np.broadcast(xp, yp, zp).shape)
+
+
+def tf(xp, yp, zp, spheres, inc, dec, pmag=None, accuracy=None):
     r"""
     The total-field magnetic anomaly.
 
@@ -84,6 +338,12 @@ def tf(xp, yp, zp, spheres, inc, dec, pmag=None):
         A magnetization vector. If not None, will use this value instead of the
         ``'magnetization'`` property of the spheres. Use this, e.g., for
         sensitivity matrix building.
+    * accuracy : float or None
+        If not None, will use a tree code to approximate the effect of groups
+        of spheres that are far from the computation points. The error is
+        about *accuracy* times the largest absolute value of the field (e.g.,
+        ``1e-3``). Use it for models with many spheres (> 10^5). If None,
+        will sum the effect of every sphere.
 
     Returns:
 
@@ -96,38 +356,11 @@ def tf(xp, yp, zp, spheres, inc, dec, pmag=None):
     Applications, Cambridge University Press.
 
     """
-    fx, fy, fz = utils.dircos(inc, dec)
-    if pmag is not None:
-        pmx, pmy, pmz = pmag
-    res = 0
-    for sphere in spheres:
-        if sphere is None:
-            continue
-        if 'magnetization' not in sphere.props and pmag is None:
-            continue
-        if pmag is None:
-            mx, my, mz = sphere.props['magnetization']
-        else:
-            mx, my, mz = pmx, pmy, pmz
-        x = sphere.x - xp
-        y = sphere.y - yp
-        z = sphere.z - zp
-        r_sqr = x**2 + y**2 + z**2
-        # This is faster than r5 = r_sqrt**2.5
-        r = np.sqrt(r_sqr)
-        r_5 = r*r*r*r*r
-        volume = 4*np.pi*(sphere.radius**3)/3
-        # Calculating v_xx, etc to calculate B is ~2x slower than this
-        dotprod = mx*x + my*y + mz*z
-        bx = (3*dotprod*x - r_sqr*mx)/r_5
-        by = (3*dotprod*y - r_sqr*my)/r_5
-        bz = (3*dotprod*z - r_sqr*mz)/r_5
-        res += volume*(fx*bx + fy*by + fz*bz)
-    res *= CM*T2NT
-    return res
+    return fields(xp, yp, zp, spheres, ['tf'], pmag=pmag, inc=inc,
+                  dec=dec, accuracy=accuracy)[0]
 
 
-def bx(xp, yp, zp, spheres, pmag=None):
+def bx(xp, yp, zp, spheres, pmag=None, accuracy=None):
     """
     The x component of the magnetic induction.
 
@@ -150,6 +383,12 @@ def bx(xp, yp, zp, spheres, pmag=None):
         A magnetization vector. If not None, will use this value instead of the
         ``'magnetization'`` property of the spheres. Use this, e.g., for
         sensitivity matrix building.
+    * accuracy : float or None
+        If not None, will use a tree code to approximate the effect of groups
+        of spheres that are far from the computation points. The error is
+        about *accuracy* times the largest absolute value of the field (e.g.,
+        ``1e-3``). Use it for models with many spheres (> 10^5). If None,
+        will sum the effect of every sphere.
 
     Returns:
 
@@ -162,34 +401,11 @@ def bx(xp, yp, zp, spheres, pmag=None):
     Applications, Cambridge University Press.
 
     """
-    if pmag is not None:
-        pmx, pmy, pmz = pmag
-    res = 0
-    for sphere in spheres:
-        if sphere is None:
-            continue
-        if 'magnetization' not in sphere.props and pmag is None:
-            continue
-        if pmag is None:
-            mx, my, mz = sphere.props['magnetization']
-        else:
-            mx, my, mz = pmx, pmy, pmz
-        x = sphere.x - xp
-        y = sphere.y - yp
-        z = sphere.z - zp
-        r_sqr = x**2 + y**2 + z**2
-        # This is faster than r5 = r_sqrt**2.5
-        r = np.sqrt(r_sqr)
-        r_5 = r*r*r*r*r
-        volume = 4*np.pi*(sphere.radius**3)/3
-        # Calculating v_xx, etc to calculate B is ~1.3x slower than this
-        dotprod = mx*x + my*y + mz*z
-        res += volume*(3*dotprod*x - r_sqr*mx)/r_5
-    res *= CM * T2NT
-    return res
+    return fields(xp, yp, zp, spheres, ['bx'], pmag=pmag,
+                  accuracy=accuracy)[0]
 
 
-def by(xp, yp, zp, spheres, pmag=None):
+def by(xp, yp, zp, spheres, pmag=None, accuracy=None):
     """
     The y component of the magnetic induction.
 
@@ -212,6 +428,12 @@ def by(xp, yp, zp, spheres, pmag=None):
         A magnetization vector. If not None, will use this value instead of the
         ``'magnetization'`` property of the spheres. Use this, e.g., for
         sensitivity matrix building.
+    * accuracy : float or None
+        If not None, will use a tree code to approximate the effect of groups
+        of spheres that are far from the computation points. The error is
+        about *accuracy* times the largest absolute value of the field (e.g.,
+        ``1e-3``). Use it for models with many spheres (> 10^5). If None,
+        will sum the effect of every sphere.
 
     Returns:
 
@@ -224,34 +446,11 @@ def by(xp, yp, zp, spheres, pmag=None):
     Applications, Cambridge University Press.
 
     """
-    if pmag is not None:
-        pmx, pmy, pmz = pmag
-    res = 0
-    for sphere in spheres:
-        if sphere is None:
-            continue
-        if 'magnetization' not in sphere.props and pmag is None:
-            continue
-        if pmag is None:
-            mx, my, mz = sphere.props['magnetization']
-        else:
-            mx, my, mz = pmx, pmy, pmz
-        x = sphere.x - xp
-        y = sphere.y - yp
-        z = sphere.z - zp
-        r_sqr = x**2 + y**2 + z**2
-        # This is faster than r5 = r_sqrt**2.5
-        r = np.sqrt(r_sqr)
-        r_5 = r*r*r*r*r
-        volume = 4*np.pi*(sphere.radius**3)/3
-        # Calculating v_xx, etc to calculate B is ~1.3x slower than this
-        dotprod = mx*x + my*y + mz*z
-        res += volume*(3*dotprod*y - r_sqr*my)/r_5
-    res *= CM * T2NT
-    return res
+    return fields(xp, yp, zp, spheres, ['by'], pmag=pmag,
+                  accuracy=accuracy)[0]
 
 
-def bz(xp, yp, zp, spheres, pmag=None):
+def bz(xp, yp, zp, spheres, pmag=None, accuracy=None):
     """
     The z component of the magnetic induction.
 
@@ -274,6 +473,12 @@ def bz(xp, yp, zp, spheres, pmag=None):
         A magnetization vector. If not None, will use this value instead of the
         ``'magnetization'`` property of the spheres. Use this, e.g., for
         sensitivity matrix building.
+    * accuracy : float or None
+        If not None, will use a tree code to approximate the effect of groups
+        of spheres that are far from the computation points. The error is
+        about *accuracy* times the largest absolute value of the field (e.g.,
+        ``1e-3``). Use it for models with many spheres (> 10^5). If None,
+        will sum the effect of every sphere.
 
     Returns:
 
@@ -286,34 +491,11 @@ def bz(xp, yp, zp, spheres, pmag=None):
     Applications, Cambridge University Press.
 
     """
-    if pmag is not None:
-        pmx, pmy, pmz = pmag
-    res = 0
-    for sphere in spheres:
-        if sphere is None:
-            continue
-        if 'magnetization' not in sphere.props and pmag is None:
-            continue
-        if pmag is None:
-            mx, my, mz = sphere.props['magnetization']
-        else:
-            mx, my, mz = pmx, pmy, pmz
-        x = sphere.x - xp
-        y = sphere.y - yp
-        z = sphere.z - zp
-        r_sqr = x**2 + y**2 + z**2
-        # This is faster than r5 = r_sqrt**2.5
-        r = np.sqrt(r_sqr)
-        r_5 = r*r*r*r*r
-        volume = 4*np.pi*(sphere.radius**3)/3
-        # Calculating v_xx, etc to calculate B is ~1.3x slower than this
-        dotprod = mx*x + my*y + mz*z
-        res += volume*(3*dotprod*z - r_sqr*mz)/r_5
-    res *= CM * T2NT
-    return res
+    return fields(xp, yp, zp, spheres, ['bz'], pmag=pmag,
+                  accuracy=accuracy)[0]
 
 
-def gz(xp, yp, zp, spheres, dens=None):
+def gz(xp, yp, zp, spheres, dens=None, accuracy=None):
     r"""
     The :math:`g_z` gravitational acceleration component.
 
@@ -339,6 +521,12 @@ def gz(xp, yp, zp, spheres, dens=None):
     * dens : float or None
         If not None, will use this value instead of the ``'density'`` property
         of the spheres. Use this, e.g., for sensitivity matrix building.
+    * accuracy : float or None
+        If not None, will use a tree code to approximate the effect of groups
+        of spheres that are far from the computation points. The error is
+        about *accuracy* times the largest absolute value of the field (e.g.,
+        ``1e-3``). Use it for models with many spheres (> 10^5). If None,
+        will sum the effect of every sphere.
 
     Returns:
 
@@ -351,29 +539,11 @@ def gz(xp, yp, zp, spheres, dens=None):
     Applications, Cambridge University Press.
 
     """
-    res = 0
-    for sphere in spheres:
-        if sphere is None:
-            continue
-        if 'density' not in sphere.props and dens is None:
-            continue
-        if dens is None:
-            density = sphere.props['density']
-        else:
-            density = dens
-        x = sphere.x - xp
-        y = sphere.y - yp
-        z = sphere.z - zp
-        r = np.sqrt(x**2 + y**2 + z**2)
-        # This is faster than r3 = r_sqrt**1.5
-        r_cb = r*r*r
-        mass = density*4*np.pi*(sphere.radius**3)/3
-        res += mass*z/r_cb
-    res *= G*SI2MGAL
-    return res
-
-
-def gxx(xp, yp, zp, spheres, dens=None):
+    return fields(xp, yp, zp, spheres, ['gz'], dens=dens,
+                  accuracy=accuracy)[0]
+
+
+def gxx(xp, yp, zp, spheres, dens=None, accuracy=None):
     r"""
     The :math:`g_{xx}` gravity gradient component.
 
@@ -400,6 +570,12 @@ def gxx(xp, yp, zp, spheres, dens=None):
     * dens : float or None
         If not None, will use this value instead of the ``'density'`` property
         of the spheres. Use this, e.g., for sensitivity matrix building.
+    * accuracy : float or None
+        If not None, will use a tree code to approximate the effect of groups
+        of spheres that are far from the computation points. The error is
+        about *accuracy* times the largest absolute value of the field (e.g.,
+        ``1e-3``). Use it for models with many spheres (> 10^5). If None,
+        will sum the effect of every sphere.
 
     Returns:
 
@@ -412,30 +588,11 @@ def gxx(xp, yp, zp, spheres, dens=None):
     Applications, Cambridge University Press.
 
     """
-    res = 0
-    for sphere in spheres:
-        if sphere is None:
-            continue
-        if 'density' not in sphere.props and dens is None:
-            continue
-        if dens is None:
-            density = sphere.props['density']
-        else:
-            density = dens
-        x = sphere.x - xp
-        y = sphere.y - yp
-        z = sphere.z - zp
-        r_sqr = x**2 + y**2 + z**2
-        # This is faster than r5 = r_sqrt**2.5
-        r = np.sqrt(r_sqr)
-        r_5 = r*r*r*r*r
-        volume = 4*np.pi*(sphere.radius**3)/3
-        res += density*volume*_v_xx(x, y, z, r_sqr, r_5)
-    res *= G*SI2EOTVOS
-    return res
+    return fields(xp, yp, zp, spheres, ['gxx'], dens=dens,
+                  accuracy=accuracy)[0]
 
 
-def gxy(xp, yp, zp, spheres, dens=None):
+def gxy(xp, yp, zp, spheres, dens=None, accuracy=None):
     r"""
     The :math:`g_{xy}` gravity gradient component.
 
@@ -462,6 +619,12 @@ def gxy(xp, yp, zp, spheres, dens=None):
     * dens : float or None
         If not None, will use this value instead of the ``'density'`` property
         of the spheres. Use this, e.g., for sensitivity matrix building.
+    * accuracy : float or None
+        If not None, will use a tree code to approximate the effect of groups
+        of spheres that are far from the computation points. The error is
+        about *accuracy* times the largest absolute value of the field (e.g.,
+        ``1e-3``). Use it for models with many spheres (> 10^5). If None,
+        will sum the effect of every sphere.
 
     Returns:
 
@@ -474,30 +637,11 @@ def gxy(xp, yp, zp, spheres, dens=None):
     Applications, Cambridge University Press.
 
     """
-    res = 0
-    for sphere in spheres:
-        if sphere is None:
-            continue
-        if 'density' not in sphere.props and dens is None:
-            continue
-        if dens is None:
-            density = sphere.props['density']
-        else:
-            density = dens
-        x = sphere.x - xp
-        y = sphere.y - yp
-        z = sphere.z - zp
-        r_sqr = x**2 + y**2 + z**2
-        # This is faster than r5 = r_sqrt**2.5
-        r = np.sqrt(r_sqr)
-        r_5 = r*r*r*r*r
-        volume = 4*np.pi*(sphere.radius**3)/3
-        res += density*volume*_v_xy(x, y, z, r_sqr, r_5)
-    res *= G*SI2EOTVOS
-    return res
+    return fields(xp, yp, zp, spheres, ['gxy'], dens=dens,
+                  accuracy=accuracy)[0]
 
 
-def gxz(xp, yp, zp, spheres, dens=None):
+def gxz(xp, yp, zp, spheres, dens=None, accuracy=None):
     r"""
     The :math:`g_{xz}` gravity gradient component.
 
@@ -524,6 +668,12 @@ def gxz(xp, yp, zp, spheres, dens=None):
     * dens : float or None
         If not None, will use this value instead of the ``'density'`` property
         of the spheres. Use this, e.g., for sensitivity matrix building.
+    * accuracy : float or None
+        If not None, will use a tree code to approximate the effect of groups
+        of spheres that are far from the computation points. The error is
+        about *accuracy* times the largest absolute value of the field (e.g.,
+        ``1e-3``). Use it for models with many spheres (> 10^5). If None,
+        will sum the effect of every sphere.
 
     Returns:
 
@@ -536,30 +686,11 @@ def gxz(xp, yp, zp, spheres, dens=None):
     Applications, Cambridge University Press.
 
     """
-    res = 0
-    for sphere in spheres:
-        if sphere is None:
-            continue
-        if 'density' not in sphere.props and dens is None:
-            continue
-        if dens is None:
-            density = sphere.props['density']
-        else:
-            density = dens
-        x = sphere.x - xp
-        y = sphere.y - yp
-        z = sphere.z - zp
-        r_sqr = x**2 + y**2 + z**2
-        # This is faster than r5 = r_sqrt**2.5
-        r = np.sqrt(r_sqr)
-        r_5 = r*r*r*r*r
-        volume = 4*np.pi*(sphere.radius**3)/3
-        res += density*volume*_v_xz(x, y, z, r_sqr, r_5)
-    res *= G*SI2EOTVOS
-    return res
+    return fields(xp, yp, zp, spheres, ['gxz'], dens=dens,
+                  accuracy=accuracy)[0]
 
 
-def gyy(xp, yp, zp, spheres, dens=None):
+def gyy(xp, yp, zp, spheres, dens=None, accuracy=None):
     r"""
     The :math:`g_{yy}` gravity gradient component.
 
@@ -586,6 +717,12 @@ def gyy(xp, yp, zp, spheres, dens=None):
     * dens : float or None
         If not None, will use this value instead of the ``'density'`` property
         of the spheres. Use this, e.g., for sensitivity matrix building.
+    * accuracy : float or None
+        If not None, will use a tree code to approximate the effect of groups
+        of spheres that are far from the computation points. The error is
+        about *accuracy* times the largest absolute value of the field (e.g.,
+        ``1e-3``). Use it for models with many spheres (> 10^5). If None,
+        will sum the effect of every sphere.
 
     Returns:
 
@@ -598,30 +735,11 @@ def gyy(xp, yp, zp, spheres, dens=None):
     Applications, Cambridge University Press.
 
     """
-    res = 0
-    for sphere in spheres:
-        if sphere is None:
-            continue
-        if 'density' not in sphere.props and dens is None:
-            continue
-        if dens is None:
-            density = sphere.props['density']
-        else:
-            density = dens
-        x = sphere.x - xp
-        y = sphere.y - yp
-        z = sphere.z - zp
-        r_sqr = x**2 + y**2 + z**2
-        # This is faster than r5 = r_sqrt**2.5
-        r = np.sqrt(r_sqr)
-        r_5 = r*r*r*r*r
-        volume = 4*np.pi*(sphere.radius**3)/3
-        res += density*volume*_v_yy(x, y, z, r_sqr, r_5)
-    res *= G*SI2EOTVOS
-    return res
+    return fields(xp, yp, zp, spheres, ['gyy'], dens=dens,
+                  accuracy=accuracy)[0]
 
 
-def gyz(xp, yp, zp, spheres, dens=None):
+def gyz(xp, yp, zp, spheres, dens=None, accuracy=None):
     r"""
     The :math:`g_{yz}` gravity gradient component.
 
@@ -648,6 +766,12 @@ def gyz(xp, yp, zp, spheres, dens=None):
     * dens : float or None
         If not None, will use this value instead of the ``'density'`` property
         of the spheres. Use this, e.g., for sensitivity matrix building.
+    * accuracy : float or None
+        If not None, will use a tree code to approximate the effect of groups
+        of spheres that are far from the computation points. The error is
+        about *accuracy* times the largest absolute value of the field (e.g.,
+        ``1e-3``). Use it for models with many spheres (> 10^5). If None,
+        will sum the effect of every sphere.
 
     Returns:
 
@@ -660,30 +784,11 @@ def gyz(xp, yp, zp, spheres, dens=None):
     Applications, Cambridge University Press.
 
     """
-    res = 0
-    for sphere in spheres:
-        if sphere is None:
-            continue
-        if 'density' not in sphere.props and dens is None:
-            continue
-        if dens is None:
-            density = sphere.props['density']
-        else:
-            density = dens
-        x = sphere.x - xp
-        y = sphere.y - yp
-        z = sphere.z - zp
-        r_sqr = x**2 + y**2 + z**2
-        # This is faster than r5 = r_sqrt**2.5
-        r = np.sqrt(r_sqr)
-        r_5 = r*r*r*r*r
-        volume = 4*np.pi*(sphere.radius**3)/3
-        res += density*volume*_v_yz(x, y, z, r_sqr, r_5)
-    res *= G*SI2EOTVOS
-    return res
+    return fields(xp, yp, zp, spheres, ['gyz'], dens=dens,
+                  accuracy=accuracy)[0]
 
 
-def gzz(xp, yp, zp, spheres, dens=None):
+def gzz(xp, yp, zp, spheres, dens=None, accuracy=None):
     r"""
     The :math:`g_{zz}` gravity gradient component.
 
@@ -710,6 +815,12 @@ def gzz(xp, yp, zp, spheres, dens=None):
     * dens : float or None
         If not None, will use this value instead of the ``'density'`` property
         of the spheres. Use this, e.g., for sensitivity matrix building.
+    * accuracy : float or None
+        If not None, will use a tree code to approximate the effect of groups
+        of spheres that are far from the computation points. The error is
+        about *accuracy* times the largest absolute value of the field (e.g.,
+        ``1e-3``). Use it for models with many spheres (> 10^5). If None,
+        will sum the effect of every sphere.
 
     Returns:
 
@@ -722,27 +833,8 @@ def gzz(xp, yp, zp, spheres, dens=None):
     Applications, Cambridge University Press.
 
     """
-    res = 0
-    for sphere in spheres:
-        if sphere is None:
-            continue
-        if 'density' not in sphere.props and dens is None:
-            continue
-        if dens is None:
-            density = sphere.props['density']
-        else:
-            density = dens
-        x = sphere.x - xp
-        y = sphere.y - yp
-        z = sphere.z - zp
-        r_sqr = x**2 + y**2 + z**2
-        # This is faster than r5 = r_sqrt**2.5
-        r = np.sqrt(r_sqr)
-        r_5 = r*r*r*r*r
-        volume = 4*np.pi*(sphere.radius**3)/3
-        res += density*volume*_v_zz(x, y, z, r_sqr, r_5)
-    res *= G*SI2EOTVOS
-    return res
+    return fields(xp, yp, zp, spheres, ['gzz'], dens=dens,
+                  accuracy=accuracy)[0]
 
 
 def kernelxx(xp, yp, zp, sphere):
@@ -774,16 +866,7 @@ def kernelxx(xp, yp, zp, sphere):
         The function calculated on xp, yp, zp
 
     """
-    x = sphere.x - xp
-    y = sphere.y - yp
-    z = sphere.z - zp
-    r_sqr = x**2 + y**2 + z**2
-    # This is faster than r5 = r_sqrt**2.5
-    r = np.sqrt(r_sqr)
-    r_5 = r*r*r*r*r
-    volume = 4*np.pi*(sphere.radius**3)/3
-    res = volume*_v_xx(x, y, z, r_sqr, r_5)
-    return res
+    return _kernel(xp, yp, zp, sphere, 'gxx')
 
 
 def kernelxy(xp, yp, zp, sphere):
@@ -815,16 +898,7 @@ def kernelxy(xp, yp, zp, sphere):
         The function calculated on xp, yp, zp
 
     """
-    x = sphere.x - xp
-    y = sphere.y - yp
-    z = sphere.z - zp
-    r_sqr = x**2 + y**2 + z**2
-    # This is faster than r5 = r_sqrt**2.5
-    r = np.sqrt(r_sqr)
-    r_5 = r*r*r*r*r
-    volume = 4*np.pi*(sphere.radius**3)/3
-    res = volume*_v_xy(x, y, z, r_sqr, r_5)
-    return res
+    return _kernel(xp, yp, zp, sphere, 'gxy')
 
 
 def kernelxz(xp, yp, zp, sphere):
@@ -856,16 +930,7 @@ def kernelxz(xp, yp, zp, sphere):
         The function calculated on xp, yp, zp
 
     """
-    x = sphere.x - xp
-    y = sphere.y - yp
-    z = sphere.z - zp
-    r_sqr = x**2 + y**2 + z**2
-    # This is faster than r5 = r_sqrt**2.5
-    r = np.sqrt(r_sqr)
-    r_5 = r*r*r*r*r
-    volume = 4*np.pi*(sphere.radius**3)/3
-    res = volume*_v_xz(x, y, z, r_sqr, r_5)
-    return res
+    return _kernel(xp, yp, zp, sphere, 'gxz')
 
 
 def kernelyy(xp, yp, zp, sphere):
@@ -897,16 +962,7 @@ def kernelyy(xp, yp, zp, sphere):
         The function calculated on xp, yp, zp
 
     """
-    x = sphere.x - xp
-    y = sphere.y - yp
-    z = sphere.z - zp
-    r_sqr = x**2 + y**2 + z**2
-    # This is faster than r5 = r_sqrt**2.5
-    r = np.sqrt(r_sqr)
-    r_5 = r*r*r*r*r
-    volume = 4*np.pi*(sphere.radius**3)/3
-    res = volume*_v_yy(x, y, z, r_sqr, r_5)
-    return res
+    return _kernel(xp, yp, zp, sphere, 'gyy')
 
 
 def kernelyz(xp, yp, zp, sphere):
@@ -938,16 +994,7 @@ def kernelyz(xp, yp, zp, sphere):
         The function calculated on xp, yp, zp
 
     """
-    x = sphere.x - xp
-    y = sphere.y - yp
-    z = sphere.z - zp
-    r_sqr = x**2 + y**2 + z**2
-    # This is faster than r5 = r_sqrt**2.5
-    r = np.sqrt(r_sqr)
-    r_5 = r*r*r*r*r
-    volume = 4*np.pi*(sphere.radius**3)/3
-    res = volume*_v_yz(x, y, z, r_sqr, r_5)
-    return res
+    return _kernel(xp, yp, zp, sphere, 'gyz')
 
 
 def kernelzz(xp, yp, zp, sphere):
@@ -979,13 +1026,4 @@ def kernelzz(xp, yp, zp, sphere):
         The function calculated on xp, yp, zp
 
     """
-    x = sphere.x - xp
-    y = sphere.y - yp
-    z = sphere.z - zp
-    r_sqr = x**2 + y**2 + z**2
-    # This is faster than r5 = r_sqrt**2.5
-    r = np.sqrt(r_sqr)
-    r_5 = r*r*r*r*r
-    volume = 4*np.pi*(sphere.radius**3)/3
-    res = volume*_v_zz(x, y, z, r_sqr, r_5)
-    return res
+    return _kernel(xp, yp, zp, sphere, 'gzz')
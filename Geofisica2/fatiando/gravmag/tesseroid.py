@@ -64,6 +64,11 @@ Forward modeling of gravitational fields is performed by functions:
 :func:`~fatiando.gravmag.tesseroid.gyz`,
 :func:`~fatiando.gravmag.tesseroid.gzz`
 
+Function :func:`~fatiando.gravmag.tesseroid.fields` calculates any combination
+of the above at once (e.g., the full gravity gradient tensor). This is faster
+than calling each function separately because the tesseroids are divided only
+once.
+
 The fields are calculated using Gauss-Legendre Quadrature integration and the
 adaptive discretization algorithm of Uieda et al. (2016). The accuracy of the
 integration is controlled by the ``ratio`` argument. Larger values cause finer
@@ -71,12 +76,84 @@ discretization and more accuracy but slower computation times. The defaults
 values are the ones suggested in the paper and guarantee an accuracy of
 approximately 0.1%.
 
+The model can be a list of :class:`~fatiando.mesher.Tesseroid` or an array
+with the bounds of one tesseroid per row and an array of densities (the *dens*
+argument). The latter avoids the overhead of handling each tesseroid in Python
+and is much faster for large models (e.g., global models with millions of
+cells).
+
 .. warning::
 
     The integration error may be larger than this if the computation
     points are closer than 1 km of the tesseroids. This effect is more
     significant in the gravity gradient components.
 
+The integration uses 2-point GLQ by default. Use the ``max_order`` argument
+to allow higher orders (up to 8) for tesseroids that are close to the
+computation points. They are integrated with the lowest order that is
+accurate at their distance when that takes fewer kernel evaluations than
+dividing them. The results stay within the accuracy target of ``ratio``
+(about 0.1%) but are not the same as the ones of the 2-point GLQ. This is much
+faster for the gravity gradients of models with large tesseroids. The
+tesseroids can also be divided below 1 km in the radial direction, which
+reduces the error for points close to them (see the warning above).
+
+All functions take a *stats* dictionary that is filled with the maximum depth
+of the discretization stack and the number of kernel evaluations. Use it to
+measure how much a larger ``ratio`` costs.
+
+Global grids
+++++++++++++
+
+Function :func:`~fatiando.gravmag.tesseroid.global_grid` calculates the fields
+of a global :class:`~fatiando.mesher.TesseroidMesh` on a regular grid with the
+same longitude spacing as the mesh. It uses the invariance of the fields to
+rotations in longitude to calculate a single tesseroid per latitude band and
+obtains the rest with FFT convolutions. The result is exact (not an
+approximation) and the computation time depends on the number of latitude
+bands instead of the number of tesseroids.
+
+Sensitivity matrix
+++++++++++++++++++
+
+Function :func:`~fatiando.gravmag.tesseroid.sensitivity` calculates the
+sensitivity (Jacobian) matrix of a field for a tesseroid model in a single
+compiled and parallel pass. The matrix can be single precision, written to a
+``numpy.memmap``, or stored as a sparse matrix without the elements that are
+small compared to the largest of each row. The effect of a tesseroid decays
+quickly with the distance so these matrices are very sparse for global models.
+
+Large numbers of points
++++++++++++++++++++++++
+
+Function :func:`~fatiando.gravmag.tesseroid.stream` calculates the fields in
+chunks of computation points and writes each chunk to a ``.npy`` file as soon
+as it is done. It reports the progress after each chunk and can resume an
+interrupted computation from the last chunk that was finished.
+
+Compilation
++++++++++++
+
+The integration is done by functions compiled with `numba
+<http://numba.pydata.org>`__ the first time they are used. The compiled code
+is cached on disk, so new processes (e.g., the workers of a pool) and later
+runs load it instead of compiling again. Function
+:func:`~fatiando.gravmag.tesseroid.warm_up` compiles (or loads) everything up
+front and reports how long it took.
+
+Parallel computation
+++++++++++++++++++++
+
+All functions take the *njobs* argument to split the computation points
+between several threads. The threads share the model so nothing is copied.
+The computation can also run in a ``multiprocessing.Pool`` passed as the
+*pool* argument. For repeated calculations on large models, create a
+:class:`~fatiando.gravmag.tesseroid.SharedPool` once and pass it as the
+*pool* argument. It keeps the worker processes alive and shares the points and
+the model through shared memory (copying them only when they change). Give the
+model to its ``set_model`` method to also skip converting it into arrays on
+every call.
+
 References
 ++++++++++
 
@@ -90,10 +167,13 @@ doi:10.1190/geo2015-0204.1
 from __future__ import division, absolute_import
 from future.builtins import range
 import multiprocessing
+import os
+import time
 import warnings
 
 import numpy as np
-from . import _tesseroid_numba
+import scipy.sparse
+from . import _tesseroid_numba, _threads
 from ..constants import SI2MGAL, SI2EOTVOS, MEAN_EARTH_RADIUS, G
 from .._our_duecredit import due, Doi, BibTeX
 
@@ -104,25 +184,47 @@ due.cite(Doi("10.1190/geo2015-0204.1"),
 RATIO_V = 1
 RATIO_G = 1.6
 RATIO_GG = 8
+# Initial size of the stack used in the adaptive discretization. The engines
+# make it larger when needed.
 STACK_SIZE = 100
-
-
-def _check_input(lon, lat, height, model, ratio, njobs, pool):
+# Default ratios and the conversion factors from SI of each field. Used by
+# fields to calculate them at once.
+_RATIOS = {'potential': RATIO_V, 'gx': RATIO_G, 'gy': RATIO_G, 'gz': RATIO_G,
+           'gxx': RATIO_GG, 'gxy': RATIO_GG, 'gxz': RATIO_GG, 'gyy': RATIO_GG,
+           'gyz': RATIO_GG, 'gzz': RATIO_GG}
+_UNITS = {'potential': G, 'gx': SI2MGAL*G, 'gy': SI2MGAL*G, 'gz': SI2MGAL*G,
+          'gxx': SI2EOTVOS*G, 'gxy': SI2EOTVOS*G, 'gxz': SI2EOTVOS*G,
+          'gyy': SI2EOTVOS*G, 'gyz': SI2EOTVOS*G, 'gzz': SI2EOTVOS*G}
+_DIVISION_WARNING = (
+    "Stopped dividing a tesseroid because it's dimensions would be " +
+    "below the minimum numerical threshold (1e-6 degrees or 1e-3 m). " +
+    "Will compute without division. Cannot guarantee the accuracy of " +
+    "the solution.")
+
+
+def _check_input(lon, lat, height, model, ratio, njobs, pool, nfields=1,
+                 max_order=2):
     """
     Check if the inputs are as expected and generate the output array.
 
     Returns:
 
-    * results : 1d-array, zero filled
+    * results : 2d-array, zero filled
+        One row per computation point and one column for each of the
+        *nfields* fields.
 
     """
     assert lon.shape == lat.shape == height.shape, \
         "Input coordinate arrays must have same shape"
     assert ratio > 0, "Invalid ratio {}. Must be > 0.".format(ratio)
     assert njobs > 0, "Invalid number of jobs {}. Must be > 0.".format(njobs)
-    if njobs == 1:
+    assert 2 <= max_order <= _tesseroid_numba.MAX_ORDER, \
+        "Invalid max_order {}. Must be between 2 and {}.".format(
+            max_order, _tesseroid_numba.MAX_ORDER)
+    # A SharedPool sets njobs itself (and can have a single worker)
+    if njobs == 1 and not isinstance(pool, SharedPool):
         assert pool is None, "njobs should be number of processes in the pool"
-    result = np.zeros_like(lon)
+    result = np.zeros((np.size(lon), nfields))
     return result
 
 
@@ -143,67 +245,68 @@ def _convert_coords(lon, lat, height):
     return lon, sinlat, coslat, radius
 
 
-def _check_tesseroid(tesseroid, dens):
-    """
-    Check if the tesseroid is valid and get the right density to use.
-
-    Returns None if the tesseroid should be ignored. Else, return the density
-    that should be used.
-    """
-    if tesseroid is None:
-        return None
-    if 'density' not in tesseroid.props and dens is None:
-        return None
-    w, e, s, n, top, bottom = tesseroid.get_bounds()
-    # Check if the dimensions given are valid
-    assert w <= e and s <= n and top >= bottom, \
-        "Invalid tesseroid dimensions {}".format(tesseroid.get_bounds())
-    # Check if the tesseroid has volume > 0
-    if (e - w <= 1e-6) or (n - s <= 1e-6) or (top - bottom <= 1e-3):
-        msg = ("Encountered tesseroid with dimensions smaller than the " +
-               "numerical threshold (1e-6 degrees or 1e-3 m). " +
-               "Ignoring this tesseroid.")
-        warnings.warn(msg, RuntimeWarning)
-        return None
-    if dens is not None:
-        density = dens
-    else:
-        density = tesseroid.props['density']
-    return density
-
-
-def _dispatcher(field, lon, lat, height, model, **kwargs):
+def _dispatcher(fields, lon, lat, height, model, **kwargs):
     """
-    Dispatch the computation of *field* to the appropriate function.
+    Dispatch the computation of *fields* to the appropriate function.
 
     Returns:
 
-    * result : 1d-array
+    * result : 2d-array
+        One column for each of the *fields*.
 
     """
     njobs = kwargs.get('njobs', 1)
     pool = kwargs.get('pool', None)
     dens = kwargs['dens']
     ratio = kwargs['ratio']
-    result = _check_input(lon, lat, height, model, ratio, njobs, pool)
-    if njobs > 1 and pool is None:
-        pool = multiprocessing.Pool(njobs)
-        created_pool = True
-    else:
-        created_pool = False
-    if pool is None:
-        _forward_model([lon, lat, height, result, model, dens, ratio,
-                        field])
+    max_order = kwargs.get('max_order', 2)
+    if isinstance(pool, SharedPool):
+        njobs = pool.njobs
+    result = _check_input(lon, lat, height, model, ratio, njobs, pool,
+                          nfields=len(fields), max_order=max_order)
+    if isinstance(pool, SharedPool):
+        # The pool converts the model only if it changed
+        shared, info = pool.run(fields, lon, lat, height, model, dens, ratio,
+                                max_order=max_order)
+        result[:] = shared
+    elif pool is None:
+        bounds, density = _model_arrays(model, dens)
+        info = _integrate(lon, lat, height, bounds, density, ratio, fields,
+                          result, njobs=njobs, max_order=max_order)
     else:
+        bounds, density = _model_arrays(model, dens)
         chunks = _split_arrays(arrays=[lon, lat, height, result],
-                               extra_args=[model, dens, ratio, field],
+                               extra_args=[bounds, density, ratio, fields,
+                                           max_order],
                                nparts=njobs)
-        result = np.hstack(pool.map(_forward_model, chunks))
-    if created_pool:
-        pool.close()
+        parts = pool.map(_forward_model, chunks)
+        result = np.vstack([part for part, _ in parts])
+        info = _merge_info([part_info for _, part_info in parts])
+    _report(info, kwargs.get('stats', None))
     return result
 
 
+def _merge_info(infos):
+    """
+    Combine the instrumentation arrays returned by _integrate for several
+    parts of the computation.
+    """
+    infos = np.array(infos, dtype='int64').reshape((-1, 3))
+    return np.array([infos[:, 0].sum(), infos[:, 1].max(), infos[:, 2].sum()])
+
+
+def _report(info, stats):
+    """
+    Warn if the discretization hit the size threshold and put the
+    instrumentation in *info* into the *stats* dictionary (if not None).
+    """
+    if info[0] != 0:
+        warnings.warn(_DIVISION_WARNING, RuntimeWarning)
+    if stats is not None:
+        stats['max_stack_depth'] = int(info[1])
+        stats['kernel_evaluations'] = int(info[2])
+
+
 def _forward_model(args):
     """
     Run the computations on the model for a given list of arguments.
@@ -213,33 +316,335 @@ def _forward_model(args):
 
     Arguments should be, in order:
 
-    lon, lat, height, result, model, dens, ratio, field
+    lon, lat, height, result, bounds, density, ratio, fields, max_order
+
+    Returns the result and the instrumentation array of the integration.
+    """
+    lon, lat, height, result, bounds, density, ratio, fields, max_order = args
+    info = _integrate(lon, lat, height, bounds, density, ratio, fields,
+                      result, max_order=max_order)
+    return result, info
+
+
+def _model_arrays(model, dens, index=False):
+    """
+    Get the bounds and densities of the valid tesseroids in *model*.
+
+    *model* can be a list of tesseroids or an array with the bounds of one
+    tesseroid per row (in which case *dens* must be given). Tesseroids that
+    are None or don't have a density are skipped. So are the ones with
+    dimensions below the numerical threshold (with a warning).
+
+    Returns:
+
+    * bounds, density : 2d-array and 1d-array
+        The bounds (one tesseroid per row) and the density of each tesseroid.
+    * index : 1d-array
+        Only if *index* is True. The position of each tesseroid in *model*.
+
+    """
+    if isinstance(model, np.ndarray):
+        assert model.ndim == 2 and model.shape[1] == 6, \
+            "Model array must have shape (N, 6). Got {}".format(model.shape)
+        assert dens is not None, \
+            "Must give the density of the tesseroids when model is an array"
+        bounds = np.asarray(model, dtype='float')
+        positions = np.arange(bounds.shape[0])
+    else:
+        model = list(model)
+        if dens is None:
+            positions = [i for i, t in enumerate(model)
+                         if t is not None and 'density' in t.props]
+            dens = [model[i].props['density'] for i in positions]
+        else:
+            positions = [i for i, t in enumerate(model) if t is not None]
+        bounds = np.array([model[i].get_bounds() for i in positions],
+                          dtype='float').reshape((len(positions), 6))
+        positions = np.array(positions, dtype='int')
+    density = np.array(np.broadcast_to(np.asarray(dens, dtype='float'),
+                                       bounds.shape[:1]))
+    w, e, s, n, top, bottom = bounds.T
+    # Check if the dimensions given are valid
+    invalid = (w > e) | (s > n) | (top < bottom)
+    assert not np.any(invalid), \
+        "Invalid tesseroid dimensions {}".format(bounds[invalid][0])
+    # Check if the tesseroids have volume > 0
+    small = (e - w <= 1e-6) | (n - s <= 1e-6) | (top - bottom <= 1e-3)
+    if np.any(small):
+        msg = ("Encountered tesseroid with dimensions smaller than the " +
+               "numerical threshold (1e-6 degrees or 1e-3 m). " +
+               "Ignoring this tesseroid.")
+        warnings.warn(msg, RuntimeWarning)
+        bounds, density = bounds[~small], density[~small]
+        positions = positions[~small]
+    if index:
+        return np.ascontiguousarray(bounds), density, positions
+    return np.ascontiguousarray(bounds), density
+
+
+def _integrate(lon, lat, height, bounds, density, ratio, fields, result,
+               njobs=1, max_order=2):
+    """
+    Add the effect of the tesseroids in *bounds* to *result*.
+
+    Each column of *result* gets one of the *fields*. If *njobs* > 1, the
+    computation points are split into parts that run in *njobs* parallel
+    threads. Tesseroids can be integrated with GLQ orders up to *max_order*
+    instead of being divided.
+
+    Returns:
+
+    * info : 1d-array
+        The error code (different from zero if a tesseroid stopped being
+        divided because of the minimum size threshold), the maximum depth of
+        the discretization stack, and the number of kernel evaluations.
+
     """
-    lon, lat, height, result, model, dens, ratio, field = args
     lon, sinlat, coslat, radius = _convert_coords(lon, lat, height)
-    func = getattr(_tesseroid_numba, field)
-    warning_msg = (
-        "Stopped dividing a tesseroid because it's dimensions would be " +
-        "below the minimum numerical threshold (1e-6 degrees or 1e-3 m). " +
-        "Will compute without division. Cannot guarantee the accuracy of " +
-        "the solution.")
-    # Arrays needed by the kernel. Can't allocate them inside the kernel
-    # because numba doesn't like that.
-    stack = np.empty((STACK_SIZE, 6), dtype='float')
-    lonc = np.empty(2, dtype='float')
-    sinlatc = np.empty(2, dtype='float')
-    coslatc = np.empty(2, dtype='float')
-    rc = np.empty(2)
-    for tesseroid in model:
-        density = _check_tesseroid(tesseroid, dens)
-        if density is None:
-            continue
-        bounds = np.array(tesseroid.get_bounds())
-        error = func(lon, sinlat, coslat, radius, bounds, density, ratio,
-                     stack, lonc, sinlatc, coslatc, rc, result)
-        if error != 0:
-            warnings.warn(warning_msg, RuntimeWarning)
-    return result
+    codes = np.array([_tesseroid_numba.FIELD_CODES[f] for f in fields])
+    # Always pass a float so that numba compiles a single version
+    ratio = float(ratio)
+    ratios = _tesseroid_numba.order_ratios(ratio, max_order)
+
+    def run(part):
+        info = np.zeros(3, dtype='int64')
+        # Arrays needed by the kernel. Can't allocate them inside the kernel
+        # because numba doesn't like that.
+        stack = np.empty((STACK_SIZE, 6), dtype='float')
+        size = _tesseroid_numba.MAX_ORDER
+        lonc = np.empty(size, dtype='float')
+        sinlatc = np.empty(size, dtype='float')
+        coslatc = np.empty(size, dtype='float')
+        rc = np.empty(size)
+        _tesseroid_numba.engine(codes, lon[part], sinlat[part], coslat[part],
+                                radius[part], bounds, density, ratio, ratios,
+                                stack, lonc, sinlatc, coslatc, rc,
+                                result[part], info)
+        return info
+
+    return _merge_info(_threads.run(run, lon.size, njobs=njobs,
+                                    parts=_parts(njobs)))
+
+
+def _parts(njobs):
+    """
+    The number of parts to split the computation points into when running in
+    *njobs* threads.
+
+    The points close to the tesseroids take much longer, so use several parts
+    per thread to keep all of them busy.
+    """
+    return 1 if njobs == 1 else 4*njobs
+
+
+class SharedPool(object):
+    """
+    A pool of worker processes that keeps its data in shared memory.
+
+    Pass it as the *pool* argument of the functions in this module to run them
+    in parallel. The computation points and the model are copied into shared
+    memory blocks that the workers read directly. Only the names of the blocks
+    are sent to the workers on each call (the model is not pickled) and the
+    workers stay alive until the pool is closed. Use this when calculating
+    several fields (or the same field many times) on large models.
+
+    The data are only copied into the shared memory if they changed since the
+    last call. Use :meth:`~fatiando.gravmag.tesseroid.SharedPool.set_model`
+    to also avoid converting a large model (e.g., a list of tesseroids) into
+    arrays on every call.
+
+    The *njobs* argument of the functions is ignored when using this pool.
+    Requires Python >= 3.8 (``multiprocessing.shared_memory``).
+
+    Parameters:
+
+    * njobs : int
+        The number of worker processes.
+
+    Example::
+
+    >>> from fatiando.mesher import Tesseroid
+    >>> model = [Tesseroid(0, 1, 0, 1, 0, -10000, {'density': 1000})]
+    >>> lon, lat = np.array([0.5, 0.2, 0.8]), np.array([0.5, 0.1, 0.3])
+    >>> height = 1000*np.ones(3)
+    >>> with SharedPool(njobs=2) as pool:
+    ...     shared = gz(lon, lat, height, model, pool=pool)
+    ...     tensor = [gxx(lon, lat, height, model, pool=pool),
+    ...               gzz(lon, lat, height, model, pool=pool)]
+    >>> bool(np.allclose(shared, gz(lon, lat, height, model)))
+    True
+
+    Share the model once to calculate its fields on several sets of points:
+
+    >>> with SharedPool(njobs=2) as pool:
+    ...     pool.set_model(model)
+    ...     shared = [gz(lon, lat, h*np.ones(3), model, pool=pool)
+    ...               for h in [1000, 2000, 5000]]
+
+    """
+
+    def __init__(self, njobs):
+        from multiprocessing import resource_tracker
+        assert njobs > 0, "Invalid number of jobs {}. Must be > 0.".format(
+            njobs)
+        self.njobs = njobs
+        self._blocks = {}
+        # The model (and density) whose arrays are in the shared memory
+        self._model = None
+        # Start the tracker of the shared memory blocks before the workers so
+        # that they all use the same one. Otherwise, each worker would report
+        # the blocks as leaked when it exits.
+        resource_tracker.ensure_running()
+        # Start the workers from a clean process instead of forking this one.
+        # Forking after numba has started its own threads (e.g., in other
+        # code using parallel=True) can make the interpreter hang on exit.
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+        else:
+            context = multiprocessing.get_context('spawn')
+        self._pool = context.Pool(njobs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Stop the worker processes and free the shared memory.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        for name in list(self._blocks):
+            self._free(name)
+        self._model = None
+
+    def _free(self, name):
+        "Release the shared memory block *name*"
+        block, array = self._blocks.pop(name)
+        del array
+        block.close()
+        block.unlink()
+
+    def set_model(self, model, dens=None):
+        """
+        Convert the *model* into arrays and share it with the workers.
+
+        The calls with this pool and the same *model* object (and *dens*) use
+        the shared model directly. Call this again if the model was changed
+        in place (e.g., the densities of the tesseroids).
+
+        Parameters:
+
+        * model : list of Tesseroid or 2d-array
+            The model in any of the formats accepted by the functions of this
+            module.
+        * dens : float, array or None
+            The density of the tesseroids (see the functions of this module).
+
+        """
+        bounds, density = _model_arrays(model, dens)
+        self._share('bounds', bounds)
+        self._share('density', density)
+        self._model = (model, dens)
+
+    def _share(self, name, data):
+        """
+        Copy *data* into the shared memory block *name* (unless it already
+        has the same values). The block is only allocated again if the size
+        of *data* changed.
+
+        Returns:
+
+        * spec : tuple
+            The name of the block and the shape of the array. All that the
+            workers need to find the data.
+
+        """
+        from multiprocessing import shared_memory
+        data = np.asarray(data, dtype='float')
+        if name in self._blocks and self._blocks[name][1].shape != data.shape:
+            self._free(name)
+        if name not in self._blocks:
+            block = shared_memory.SharedMemory(create=True,
+                                               size=max(data.nbytes, 1))
+            array = np.ndarray(data.shape, dtype='float', buffer=block.buf)
+            self._blocks[name] = (block, array)
+        block, array = self._blocks[name]
+        if not np.array_equal(array, data):
+            array[...] = data
+        return block.name, array.shape
+
+    def run(self, fields, lon, lat, height, model, dens, ratio, max_order=2):
+        """
+        Calculate *fields* in the workers (without the unit conversions).
+
+        *model* and *dens* are the same as in the functions of this module.
+        The model is only converted into arrays if it isn't the one given to
+        :meth:`~fatiando.gravmag.tesseroid.SharedPool.set_model`.
+        *max_order* is the maximum GLQ order.
+
+        Returns:
+
+        * result, info : 2d-array and 1d-array
+            The calculated fields (one per column) and the instrumentation of
+            the integration (see ``_integrate``).
+
+        """
+        assert self._pool is not None, "The pool has been closed."
+        if (self._model is None or self._model[0] is not model or
+                self._model[1] is not dens):
+            bounds, density = _model_arrays(model, dens)
+            self._share('bounds', bounds)
+            self._share('density', density)
+            # The shared model is no longer the one given to set_model
+            self._model = None
+        arrays = [('lon', lon), ('lat', lat), ('height', height),
+                  ('result', np.zeros((np.size(lon), len(fields))))]
+        specs = dict((name, self._share(name, data)) for name, data in arrays)
+        for name in ['bounds', 'density']:
+            block, array = self._blocks[name]
+            specs[name] = (block.name, array.shape)
+        strides = np.linspace(0, np.size(lon), self.njobs + 1).astype('int')
+        chunks = [(fields, ratio, max_order, specs, strides[i],
+                   strides[i + 1]) for i in range(self.njobs)]
+        info = _merge_info(self._pool.map(_shared_forward_model, chunks))
+        return self._blocks['result'][1].copy(), info
+
+
+# The shared memory blocks that a worker process of SharedPool is using
+_attached = {}
+
+
+def _shared_forward_model(args):
+    """
+    Run the computations of a SharedPool worker on a part of the points.
+
+    Arguments should be, in order:
+
+    fields, ratio, max_order, specs, low, high
+    """
+    from multiprocessing import shared_memory
+    fields, ratio, max_order, specs, low, high = args
+    names = set(name for name, _ in specs.values())
+    # Let go of the blocks that were replaced since the last call
+    for name in list(_attached):
+        if name not in names:
+            _attached.pop(name).close()
+    arrays = {}
+    for key, (name, shape) in specs.items():
+        if name not in _attached:
+            _attached[name] = shared_memory.SharedMemory(name=name)
+        arrays[key] = np.ndarray(shape, dtype='float',
+                                 buffer=_attached[name].buf)
+    part = slice(low, high)
+    return _integrate(arrays['lon'][part], arrays['lat'][part],
+                      arrays['height'][part], arrays['bounds'],
+                      arrays['density'], ratio, fields,
+                      arrays['result'][part], max_order=max_order)
 
 
 def _split_arrays(arrays, extra_args, nparts):
@@ -267,7 +672,7 @@ def _split_arrays(arrays, extra_args, nparts):
 
 
 def potential(lon, lat, height, model, dens=None, ratio=RATIO_V,
-              njobs=1, pool=None):
+              njobs=1, pool=None, stats=None, max_order=2):
     """
     Calculate the gravitational potential due to a tesseroid model.
 
@@ -281,26 +686,43 @@ def potential(lon, lat, height, model, dens=None, ratio=RATIO_V,
     * lon, lat, height : arrays
         Arrays with the longitude, latitude and height coordinates of the
         computation points.
-    * model : list of :class:`~fatiando.mesher.Tesseroid`
+    * model : list of :class:`~fatiando.mesher.Tesseroid` or 2d-array
         The density model used to calculate the gravitational effect.
         Tesseroids must have the property ``'density'``. Those that don't have
         this property will be ignored in the computations. Elements that are
-        None will also be ignored.
-    * dens : float or None
+        None will also be ignored. Can also be an array with the bounds
+        ``[w, e, s, n, top, bottom]`` of one tesseroid per row (faster for
+        large models). In this case, *dens* is required.
+    * dens : float, 1d-array or None
         If not None, will use this value instead of the ``'density'`` property
         of the tesseroids. Use this, e.g., for sensitivity matrix building.
+        Can be an array with the density of each tesseroid.
     * ratio : float
         Will divide each tesseroid until the distance between it and the
         computation points is < ratio*size of tesseroid. Used to guarantee the
         accuracy of the numerical integration.
     * njobs : int
-        Split the computation into *njobs* parts and run it in parallel using
-        ``multiprocessing``. If ``njobs=1`` will run the computation in serial.
-    * pool : None or multiprocessing.Pool object
+        Split the computation into *njobs* parts and run it in parallel
+        threads (or in the processes of *pool*). If ``njobs=1`` will run the
+        computation in serial.
+    * pool : None, multiprocessing.Pool or SharedPool object
         If not None, will use this pool to run the computation in parallel
         instead of creating a new one. You must still specify *njobs* as the
         number of processes in the pool. Use this to avoid spawning processes
         on each call to this functions, which can have significant overhead.
+        A :class:`~fatiando.gravmag.tesseroid.SharedPool` also avoids copying
+        the model to the processes on each call (*njobs* is ignored).
+    * stats : None or dict
+        If a dict, will be filled with the maximum depth of the discretization
+        stack (``'max_stack_depth'``) and the number of kernel evaluations
+        (``'kernel_evaluations'``) of this call. Use it to tune *ratio*.
+    * max_order : int
+        The maximum order of the Gauss-Legendre Quadrature (2 to 8). Tesseroids
+        that are too close to a computation point for the 2-point quadrature
+        are integrated with a higher order (instead of being divided) if that
+        takes fewer kernel evaluations. The results stay within the accuracy
+        target of *ratio* (about 0.1%). If 2, will only divide the
+        tesseroids.
 
     Returns:
 
@@ -315,14 +737,15 @@ def potential(lon, lat, height, model, dens=None, ratio=RATIO_V,
 
     """
     field = 'potential'
-    result = _dispatcher(field, lon, lat, height, model, dens=dens,
-                         ratio=ratio, njobs=njobs, pool=pool)
+    result = _dispatcher([field], lon, lat, height, model, dens=dens,
+                         ratio=ratio, njobs=njobs, pool=pool,
+                         stats=stats, max_order=max_order)[:, 0]
     result *= G
     return result
 
 
 def gx(lon, lat, height, model, dens=None, ratio=RATIO_G,
-       njobs=1, pool=None):
+       njobs=1, pool=None, stats=None, max_order=2):
     """
     Calculate the North component of the gravitational attraction.
 
@@ -336,26 +759,43 @@ def gx(lon, lat, height, model, dens=None, ratio=RATIO_G,
     * lon, lat, height : arrays
         Arrays with the longitude, latitude and height coordinates of the
         computation points.
-    * model : list of :class:`~fatiando.mesher.Tesseroid`
+    * model : list of :class:`~fatiando.mesher.Tesseroid` or 2d-array
         The density model used to calculate the gravitational effect.
         Tesseroids must have the property ``'density'``. Those that don't have
         this property will be ignored in the computations. Elements that are
-        None will also be ignored.
-    * dens : float or None
+        None will also be ignored. Can also be an array with the bounds
+        ``[w, e, s, n, top, bottom]`` of one tesseroid per row (faster for
+        large models). In this case, *dens* is required.
+    * dens : float, 1d-array or None
         If not None, will use this value instead of the ``'density'`` property
         of the tesseroids. Use this, e.g., for sensitivity matrix building.
+        Can be an array with the density of each tesseroid.
     * ratio : float
         Will divide each tesseroid until the distance between it and the
         computation points is < ratio*size of tesseroid. Used to guarantee the
         accuracy of the numerical integration.
     * njobs : int
-        Split the computation into *njobs* parts and run it in parallel using
-        ``multiprocessing``. If ``njobs=1`` will run the computation in serial.
-    * pool : None or multiprocessing.Pool object
+        Split the computation into *njobs* parts and run it in parallel
+        threads (or in the processes of *pool*). If ``njobs=1`` will run the
+        computation in serial.
+    * pool : None, multiprocessing.Pool or SharedPool object
         If not None, will use this pool to run the computation in parallel
         instead of creating a new one. You must still specify *njobs* as the
         number of processes in the pool. Use this to avoid spawning processes
         on each call to this functions, which can have significant overhead.
+        A :class:`~fatiando.gravmag.tesseroid.SharedPool` also avoids copying
+        the model to the processes on each call (*njobs* is ignored).
+    * stats : None or dict
+        If a dict, will be filled with the maximum depth of the discretization
+        stack (``'max_stack_depth'``) and the number of kernel evaluations
+        (``'kernel_evaluations'``) of this call. Use it to tune *ratio*.
+    * max_order : int
+        The maximum order of the Gauss-Legendre Quadrature (2 to 8). Tesseroids
+        that are too close to a computation point for the 2-point quadrature
+        are integrated with a higher order (instead of being divided) if that
+        takes fewer kernel evaluations. The results stay within the accuracy
+        target of *ratio* (about 0.1%). If 2, will only divide the
+        tesseroids.
 
     Returns:
 
@@ -370,14 +810,15 @@ def gx(lon, lat, height, model, dens=None, ratio=RATIO_G,
 
     """
     field = 'gx'
-    result = _dispatcher(field, lon, lat, height, model, dens=dens,
-                         ratio=ratio, njobs=njobs, pool=pool)
+    result = _dispatcher([field], lon, lat, height, model, dens=dens,
+                         ratio=ratio, njobs=njobs, pool=pool,
+                         stats=stats, max_order=max_order)[:, 0]
     result *= SI2MGAL*G
     return result
 
 
 def gy(lon, lat, height, model, dens=None, ratio=RATIO_G,
-       njobs=1, pool=None):
+       njobs=1, pool=None, stats=None, max_order=2):
     """
     Calculate the East component of the gravitational attraction.
 
@@ -391,26 +832,43 @@ def gy(lon, lat, height, model, dens=None, ratio=RATIO_G,
     * lon, lat, height : arrays
         Arrays with the longitude, latitude and height coordinates of the
         computation points.
-    * model : list of :class:`~fatiando.mesher.Tesseroid`
+    * model : list of :class:`~fatiando.mesher.Tesseroid` or 2d-array
         The density model used to calculate the gravitational effect.
         Tesseroids must have the property ``'density'``. Those that don't have
         this property will be ignored in the computations. Elements that are
-        None will also be ignored.
-    * dens : float or None
+        None will also be ignored. Can also be an array with the bounds
+        ``[w, e, s, n, top, bottom]`` of one tesseroid per row (faster for
+        large models). In this case, *dens* is required.
+    * dens : float, 1d-array or None
         If not None, will use this value instead of the ``'density'`` property
         of the tesseroids. Use this, e.g., for sensitivity matrix building.
+        Can be an array with the density of each tesseroid.
     * ratio : float
         Will divide each tesseroid until the distance between it and the
         computation points is < ratio*size of tesseroid. Used to guarantee the
         accuracy of the numerical integration.
     * njobs : int
-        Split the computation into *njobs* parts and run it in parallel using
-        ``multiprocessing``. If ``njobs=1`` will run the computation in serial.
-    * pool : None or multiprocessing.Pool object
+        Split the computation into *njobs* parts and run it in parallel
+        threads (or in the processes of *pool*). If ``njobs=1`` will run the
+        computation in serial.
+    * pool : None, multiprocessing.Pool or SharedPool object
         If not None, will use this pool to run the computation in parallel
         instead of creating a new one. You must still specify *njobs* as the
         number of processes in the pool. Use this to avoid spawning processes
         on each call to this functions, which can have significant overhead.
+        A :class:`~fatiando.gravmag.tesseroid.SharedPool` also avoids copying
+        the model to the processes on each call (*njobs* is ignored).
+    * stats : None or dict
+        If a dict, will be filled with the maximum depth of the discretization
+        stack (``'max_stack_depth'``) and the number of kernel evaluations
+        (``'kernel_evaluations'``) of this call. Use it to tune *ratio*.
+    * max_order : int
+        The maximum order of the Gauss-Legendre Quadrature (2 to 8). Tesseroids
+        that are too close to a computation point for the 2-point quadrature
+        are integrated with a higher order (instead of being divided) if that
+        takes fewer kernel evaluations. The results stay within the accuracy
+        target of *ratio* (about 0.1%). If 2, will only divide the
+        tesseroids.
 
     Returns:
 
@@ -425,14 +883,15 @@ def gy(lon, lat, height, model, dens=None, ratio=RATIO_G,
 
     """
     field = 'gy'
-    result = _dispatcher(field, lon, lat, height, model, dens=dens,
-                         ratio=ratio, njobs=njobs, pool=pool)
+    result = _dispatcher([field], lon, lat, height, model, dens=dens,
+                         ratio=ratio, njobs=njobs, pool=pool,
+                         stats=stats, max_order=max_order)[:, 0]
     result *= SI2MGAL*G
     return result
 
 
 def gz(lon, lat, height, model, dens=None, ratio=RATIO_G,
-       njobs=1, pool=None):
+       njobs=1, pool=None, stats=None, max_order=2):
     """
     Calculate the radial component of the gravitational attraction.
 
@@ -451,26 +910,43 @@ def gz(lon, lat, height, model, dens=None, ratio=RATIO_G,
     * lon, lat, height : arrays
         Arrays with the longitude, latitude and height coordinates of the
         computation points.
-    * model : list of :class:`~fatiando.mesher.Tesseroid`
+    * model : list of :class:`~fatiando.mesher.Tesseroid` or 2d-array
         The density model used to calculate the gravitational effect.
         Tesseroids must have the property ``'density'``. Those that don't have
         this property will be ignored in the computations. Elements that are
-        None will also be ignored.
-    * dens : float or None
+        None will also be ignored. Can also be an array with the bounds
+        ``[w, e, s, n, top, bottom]`` of one tesseroid per row (faster for
+        large models). In this case, *dens* is required.
+    * dens : float, 1d-array or None
         If not None, will use this value instead of the ``'density'`` property
         of the tesseroids. Use this, e.g., for sensitivity matrix building.
+        Can be an array with the density of each tesseroid.
     * ratio : float
         Will divide each tesseroid until the distance between it and the
         computation points is < ratio*size of tesseroid. Used to guarantee the
         accuracy of the numerical integration.
     * njobs : int
-        Split the computation into *njobs* parts and run it in parallel using
-        ``multiprocessing``. If ``njobs=1`` will run the computation in serial.
-    * pool : None or multiprocessing.Pool object
+        Split the computation into *njobs* parts and run it in parallel
+        threads (or in the processes of *pool*). If ``njobs=1`` will run the
+        computation in serial.
+    * pool : None, multiprocessing.Pool or SharedPool object
         If not None, will use this pool to run the computation in parallel
         instead of creating a new one. You must still specify *njobs* as the
         number of processes in the pool. Use this to avoid spawning processes
         on each call to this functions, which can have significant overhead.
+        A :class:`~fatiando.gravmag.tesseroid.SharedPool` also avoids copying
+        the model to the processes on each call (*njobs* is ignored).
+    * stats : None or dict
+        If a dict, will be filled with the maximum depth of the discretization
+        stack (``'max_stack_depth'``) and the number of kernel evaluations
+        (``'kernel_evaluations'``) of this call. Use it to tune *ratio*.
+    * max_order : int
+        The maximum order of the Gauss-Legendre Quadrature (2 to 8). Tesseroids
+        that are too close to a computation point for the 2-point quadrature
+        are integrated with a higher order (instead of being divided) if that
+        takes fewer kernel evaluations. The results stay within the accuracy
+        target of *ratio* (about 0.1%). If 2, will only divide the
+        tesseroids.
 
     Returns:
 
@@ -485,14 +961,15 @@ def gz(lon, lat, height, model, dens=None, ratio=RATIO_G,
 
     """
     field = 'gz'
-    result = _dispatcher(field, lon, lat, height, model, dens=dens,
-                         ratio=ratio, njobs=njobs, pool=pool)
+    result = _dispatcher([field], lon, lat, height, model, dens=dens,
+                         ratio=ratio, njobs=njobs, pool=pool,
+                         stats=stats, max_order=max_order)[:, 0]
     result *= SI2MGAL*G
     return result
 
 
 def gxx(lon, lat, height, model, dens=None, ratio=RATIO_GG,
-        njobs=1, pool=None):
+        njobs=1, pool=None, stats=None, max_order=2):
     """
     Calculate the xx component of the gravity gradient tensor.
 
@@ -506,26 +983,43 @@ def gxx(lon, lat, height, model, dens=None, ratio=RATIO_GG,
     * lon, lat, height : arrays
         Arrays with the longitude, latitude and height coordinates of the
         computation points.
-    * model : list of :class:`~fatiando.mesher.Tesseroid`
+    * model : list of :class:`~fatiando.mesher.Tesseroid` or 2d-array
         The density model used to calculate the gravitational effect.
         Tesseroids must have the property ``'density'``. Those that don't have
         this property will be ignored in the computations. Elements that are
-        None will also be ignored.
-    * dens : float or None
+        None will also be ignored. Can also be an array with the bounds
+        ``[w, e, s, n, top, bottom]`` of one tesseroid per row (faster for
+        large models). In this case, *dens* is required.
+    * dens : float, 1d-array or None
         If not None, will use this value instead of the ``'density'`` property
         of the tesseroids. Use this, e.g., for sensitivity matrix building.
+        Can be an array with the density of each tesseroid.
     * ratio : float
         Will divide each tesseroid until the distance between it and the
         computation points is < ratio*size of tesseroid. Used to guarantee the
         accuracy of the numerical integration.
     * njobs : int
-        Split the computation into *njobs* parts and run it in parallel using
-        ``multiprocessing``. If ``njobs=1`` will run the computation in serial.
-    * pool : None or multiprocessing.Pool object
+        Split the computation into *njobs* parts and run it in parallel
+        threads (or in the processes of *pool*). If ``njobs=1`` will run the
+        computation in serial.
+    * pool : None, multiprocessing.Pool or SharedPool object
         If not None, will use this pool to run the computation in parallel
         instead of creating a new one. You must still specify *njobs* as the
         number of processes in the pool. Use this to avoid spawning processes
         on each call to this functions, which can have significant overhead.
+        A :class:`~fatiando.gravmag.tesseroid.SharedPool` also avoids copying
+        the model to the processes on each call (*njobs* is ignored).
+    * stats : None or dict
+        If a dict, will be filled with the maximum depth of the discretization
+        stack (``'max_stack_depth'``) and the number of kernel evaluations
+        (``'kernel_evaluations'``) of this call. Use it to tune *ratio*.
+    * max_order : int
+        The maximum order of the Gauss-Legendre Quadrature (2 to 8). Tesseroids
+        that are too close to a computation point for the 2-point quadrature
+        are integrated with a higher order (instead of being divided) if that
+        takes fewer kernel evaluations. The results stay within the accuracy
+        target of *ratio* (about 0.1%). If 2, will only divide the
+        tesseroids.
 
     Returns:
 
@@ -540,14 +1034,15 @@ def gxx(lon, lat, height, model, dens=None, ratio=RATIO_GG,
 
     """
     field = 'gxx'
-    result = _dispatcher(field, lon, lat, height, model, dens=dens,
-                         ratio=ratio, njobs=njobs, pool=pool)
+    result = _dispatcher([field], lon, lat, height, model, dens=dens,
+                         ratio=ratio, njobs=njobs, pool=pool,
+                         stats=stats, max_order=max_order)[:, 0]
     result *= SI2EOTVOS*G
     return result
 
 
 def gxy(lon, lat, height, model, dens=None, ratio=RATIO_GG,
-        njobs=1, pool=None):
+        njobs=1, pool=None, stats=None, max_order=2):
     """
     Calculate the xy component of the gravity gradient tensor.
 
@@ -561,26 +1056,43 @@ def gxy(lon, lat, height, model, dens=None, ratio=RATIO_GG,
     * lon, lat, height : arrays
         Arrays with the longitude, latitude and height coordinates of the
         computation points.
-    * model : list of :class:`~fatiando.mesher.Tesseroid`
+    * model : list of :class:`~fatiando.mesher.Tesseroid` or 2d-array
         The density model used to calculate the gravitational effect.
         Tesseroids must have the property ``'density'``. Those that don't have
         this property will be ignored in the computations. Elements that are
-        None will also be ignored.
-    * dens : float or None
+        None will also be ignored. Can also be an array with the bounds
+        ``[w, e, s, n, top, bottom]`` of one tesseroid per row (faster for
+        large models). In this case, *dens* is required.
+    * dens : float, 1d-array or None
         If not None, will use this value instead of the ``'density'`` property
         of the tesseroids. Use this, e.g., for sensitivity matrix building.
+        Can be an array with the density of each tesseroid.
     * ratio : float
         Will divide each tesseroid until the distance between it and the
         computation points is < ratio*size of tesseroid. Used to guarantee the
         accuracy of the numerical integration.
     * njobs : int
-        Split the computation into *njobs* parts and run it in parallel using
-        ``multiprocessing``. If ``njobs=1`` will run the computation in serial.
-    * pool : None or multiprocessing.Pool object
+        Split the computation into *njobs* parts and run it in parallel
+        threads (or in the processes of *pool*). If ``njobs=1`` will run the
+        computation in serial.
+    * pool : None, multiprocessing.Pool or SharedPool object
         If not None, will use this pool to run the computation in parallel
         instead of creating a new one. You must still specify *njobs* as the
         number of processes in the pool. Use this to avoid spawning processes
         on each call to this functions, which can have significant overhead.
+        A :class:`~fatiando.gravmag.tesseroid.SharedPool` also avoids copying
+        the model to the processes on each call (*njobs* is ignored).
+    * stats : None or dict
+        If a dict, will be filled with the maximum depth of the discretization
+        stack (``'max_stack_depth'``) and the number of kernel evaluations
+        (``'kernel_evaluations'``) of this call. Use it to tune *ratio*.
+    * max_order : int
+        The maximum order of the Gauss-Legendre Quadrature (2 to 8). Tesseroids
+        that are too close to a computation point for the 2-point quadrature
+        are integrated with a higher order (instead of being divided) if that
+        takes fewer kernel evaluations. The results stay within the accuracy
+        target of *ratio* (about 0.1%). If 2, will only divide the
+        tesseroids.
 
     Returns:
 
@@ -595,14 +1107,15 @@ def gxy(lon, lat, height, model, dens=None, ratio=RATIO_GG,
 
     """
     field = 'gxy'
-    result = _dispatcher(field, lon, lat, height, model, dens=dens,
-                         ratio=ratio, njobs=njobs, pool=pool)
+    result = _dispatcher([field], lon, lat, height, model, dens=dens,
+                         ratio=ratio, njobs=njobs, pool=pool,
+                         stats=stats, max_order=max_order)[:, 0]
     result *= SI2EOTVOS*G
     return result
 
 
 def gxz(lon, lat, height, model, dens=None, ratio=RATIO_GG,
-        njobs=1, pool=None):
+        njobs=1, pool=None, stats=None, max_order=2):
     """
     Calculate the xz component of the gravity gradient tensor.
 
@@ -616,26 +1129,43 @@ def gxz(lon, lat, height, model, dens=None, ratio=RATIO_GG,
     * lon, lat, height : arrays
         Arrays with the longitude, latitude and height coordinates of the
         computation points.
-    * model : list of :class:`~fatiando.mesher.Tesseroid`
+    * model : list of :class:`~fatiando.mesher.Tesseroid` or 2d-array
         The density model used to calculate the gravitational effect.
         Tesseroids must have the property ``'density'``. Those that don't have
         this property will be ignored in the computations. Elements that are
-        None will also be ignored.
-    * dens : float or None
+        None will also be ignored. Can also be an array with the bounds
+        ``[w, e, s, n, top, bottom]`` of one tesseroid per row (faster for
+        large models). In this case, *dens* is required.
+    * dens : float, 1d-array or None
         If not None, will use this value instead of the ``'density'`` property
         of the tesseroids. Use this, e.g., for sensitivity matrix building.
+        Can be an array with the density of each tesseroid.
     * ratio : float
         Will divide each tesseroid until the distance between it and the
         computation points is < ratio*size of tesseroid. Used to guarantee the
         accuracy of the numerical integration.
     * njobs : int
-        Split the computation into *njobs* parts and run it in parallel using
-        ``multiprocessing``. If ``njobs=1`` will run the computation in serial.
-    * pool : None or multiprocessing.Pool object
+        Split the computation into *njobs* parts and run it in parallel
+        threads (or in the processes of *pool*). If ``njobs=1`` will run the
+        computation in serial.
+    * pool : None, multiprocessing.Pool or SharedPool object
         If not None, will use this pool to run the computation in parallel
         instead of creating a new one. You must still specify *njobs* as the
         number of processes in the pool. Use this to avoid spawning processes
         on each call to this functions, which can have significant overhead.
+        A :class:`~fatiando.gravmag.tesseroid.SharedPool` also avoids copying
+        the model to the processes on each call (*njobs* is ignored).
+    * stats : None or dict
+        If a dict, will be filled with the maximum depth of the discretization
+        stack (``'max_stack_depth'``) and the number of kernel evaluations
+        (``'kernel_evaluations'``) of this call. Use it to tune *ratio*.
+    * max_order : int
+        The maximum order of the Gauss-Legendre Quadrature (2 to 8). Tesseroids
+        that are too close to a computation point for the 2-point quadrature
+        are integrated with a higher order (instead of being divided) if that
+        takes fewer kernel evaluations. The results stay within the accuracy
+        target of *ratio* (about 0.1%). If 2, will only divide the
+        tesseroids.
 
     Returns:
 
@@ -650,14 +1180,15 @@ def gxz(lon, lat, height, model, dens=None, ratio=RATIO_GG,
 
     """
     field = 'gxz'
-    result = _dispatcher(field, lon, lat, height, model, dens=dens,
-                         ratio=ratio, njobs=njobs, pool=pool)
+    result = _dispatcher([field], lon, lat, height, model, dens=dens,
+                         ratio=ratio, njobs=njobs, pool=pool,
+                         stats=stats, max_order=max_order)[:, 0]
     result *= SI2EOTVOS*G
     return result
 
 
 def gyy(lon, lat, height, model, dens=None, ratio=RATIO_GG,
-        njobs=1, pool=None):
+        njobs=1, pool=None, stats=None, max_order=2):
     """
     Calculate the yy component of the gravity gradient tensor.
 
@@ -671,26 +1202,43 @@ def gyy(lon, lat, height, model, dens=None, ratio=RATIO_GG,
     * lon, lat, height : arrays
         Arrays with the longitude, latitude and height coordinates of the
         computation points.
-    * model : list of :class:`~fatiando.mesher.Tesseroid`
+    * model : list of :class:`~fatiando.mesher.Tesseroid` or 2d-array
         The density model used to calculate the gravitational effect.
         Tesseroids must have the property ``'density'``. Those that don't have
         this property will be ignored in the computations. Elements that are
-        None will also be ignored.
-    * dens : float or None
+        None will also be ignored. Can also be an array with the bounds
+        ``[w, e, s, n, top, bottom]`` of one tesseroid per row (faster for
+        large models). In this case, *dens* is required.
+    * dens : float, 1d-array or None
         If not None, will use this value instead of the ``'density'`` property
         of the tesseroids. Use this, e.g., for sensitivity matrix building.
+        Can be an array with the density of each tesseroid.
     * ratio : float
         Will divide each tesseroid until the distance between it and the
         computation points is < ratio*size of tesseroid. Used to guarantee the
         accuracy of the numerical integration.
     * njobs : int
-        Split the computation into *njobs* parts and run it in parallel using
-        ``multiprocessing``. If ``njobs=1`` will run the computation in serial.
-    * pool : None or multiprocessing.Pool object
+        Split the computation into *njobs* parts and run it in parallel
+        threads (or in the processes of *pool*). If ``njobs=1`` will run the
+        computation in serial.
+    * pool : None, multiprocessing.Pool or SharedPool object
         If not None, will use this pool to run the computation in parallel
         instead of creating a new one. You must still specify *njobs* as the
         number of processes in the pool. Use this to avoid spawning processes
         on each call to this functions, which can have significant overhead.
+        A :class:`~fatiando.gravmag.tesseroid.SharedPool` also avoids copying
+        the model to the processes on each call (*njobs* is ignored).
+    * stats : None or dict
+        If a dict, will be filled with the maximum depth of the discretization
+        stack (``'max_stack_depth'``) and the number of kernel evaluations
+        (``'kernel_evaluations'``) of this call. Use it to tune *ratio*.
+    * max_order : int
+        The maximum order of the Gauss-Legendre Quadrature (2 to 8). Tesseroids
+        that are too close to a computation point for the 2-point quadrature
+        are integrated with a higher order (instead of being divided) if that
+        takes fewer kernel evaluations. The results stay within the accuracy
+        target of *ratio* (about 0.1%). If 2, will only divide the
+        tesseroids.
 
     Returns:
 
@@ -705,14 +1253,15 @@ def gyy(lon, lat, height, model, dens=None, ratio=RATIO_GG,
 
     """
     field = 'gyy'
-    result = _dispatcher(field, lon, lat, height, model, dens=dens,
-                         ratio=ratio, njobs=njobs, pool=pool)
+    result = _dispatcher([field], lon, lat, height, model, dens=dens,
+                         ratio=ratio, njobs=njobs, pool=pool,
+                         stats=stats, max_order=max_order)[:, 0]
     result *= SI2EOTVOS*G
     return result
 
 
 def gyz(lon, lat, height, model, dens=None, ratio=RATIO_GG,
-        njobs=1, pool=None):
+        njobs=1, pool=None, stats=None, max_order=2):
     """
     Calculate the yz component of the gravity gradient tensor.
 
@@ -726,26 +1275,43 @@ def gyz(lon, lat, height, model, dens=None, ratio=RATIO_GG,
     * lon, lat, height : arrays
         Arrays with the longitude, latitude and height coordinates of the
         computation points.
-    * model : list of :class:`~fatiando.mesher.Tesseroid`
+    * model : list of :class:`~fatiando.mesher.Tesseroid` or 2d-array
         The density model used to calculate the gravitational effect.
         Tesseroids must have the property ``'density'``. Those that don't have
         this property will be ignored in the computations. Elements that are
-        None will also be ignored.
-    * dens : float or None
+        None will also be ignored. Can also be an array with the bounds
+        ``[w, e, s, n, top, bottom]`` of one tesseroid per row (faster for
+        large models). In this case, *dens* is required.
+    * dens : float, 1d-array or None
         If not None, will use this value instead of the ``'density'`` property
         of the tesseroids. Use this, e.g., for sensitivity matrix building.
+        Can be an array with the density of each tesseroid.
     * ratio : float
         Will divide each tesseroid until the distance between it and the
         computation points is < ratio*size of tesseroid. Used to guarantee the
         accuracy of the numerical integration.
     * njobs : int
-        Split the computation into *njobs* parts and run it in parallel using
-        ``multiprocessing``. If ``njobs=1`` will run the computation in serial.
-    * pool : None or multiprocessing.Pool object
+        Split the computation into *njobs* parts and run it in parallel
+        threads (or in the processes of *pool*). If ``njobs=1`` will run the
+        computation in serial.
+    * pool : None, multiprocessing.Pool or SharedPool object
         If not None, will use this pool to run the computation in parallel
         instead of creating a new one. You must still specify *njobs* as the
         number of processes in the pool. Use this to avoid spawning processes
         on each call to this functions, which can have significant overhead.
+        A :class:`~fatiando.gravmag.tesseroid.SharedPool` also avoids copying
+        the model to the processes on each call (*njobs* is ignored).
+    * stats : None or dict
+        If a dict, will be filled with the maximum depth of the discretization
+        stack (``'max_stack_depth'``) and the number of kernel evaluations
+        (``'kernel_evaluations'``) of this call. Use it to tune *ratio*.
+    * max_order : int
+        The maximum order of the Gauss-Legendre Quadrature (2 to 8). Tesseroids
+        that are too close to a computation point for the 2-point quadrature
+        are integrated with a higher order (instead of being divided) if that
+        takes fewer kernel evaluations. The results stay within the accuracy
+        target of *ratio* (about 0.1%). If 2, will only divide the
+        tesseroids.
 
     Returns:
 
@@ -760,14 +1326,15 @@ def gyz(lon, lat, height, model, dens=None, ratio=RATIO_GG,
 
     """
     field = 'gyz'
-    result = _dispatcher(field, lon, lat, height, model, dens=dens,
-                         ratio=ratio, njobs=njobs, pool=pool)
+    result = _dispatcher([field], lon, lat, height, model, dens=dens,
+                         ratio=ratio, njobs=njobs, pool=pool,
+                         stats=stats, max_order=max_order)[:, 0]
     result *= SI2EOTVOS*G
     return result
 
 
 def gzz(lon, lat, height, model, dens=None, ratio=RATIO_GG,
-        njobs=1, pool=None):
+        njobs=1, pool=None, stats=None, max_order=2):
     """
     Calculate the zz component of the gravity gradient tensor.
 
@@ -781,26 +1348,43 @@ def gzz(lon, lat, height, model, dens=None, ratio=RATIO_GG,
     * lon, lat, height : arrays
         Arrays with the longitude, latitude and height coordinates of the
         computation points.
-    * model : list of :class:`~fatiando.mesher.Tesseroid`
+    * model : list of :class:`~fatiando.mesher.Tesseroid` or 2d-array
         The density model used to calculate the gravitational effect.
         Tesseroids must have the property ``'density'``. Those that don't have
         this property will be ignored in the computations. Elements that are
-        None will also be ignored.
-    * dens : float or None
+        None will also be ignored. Can also be an array with the bounds
+        ``[w, e, s, n, top, bottom]`` of one tesseroid per row (faster for
+        large models). In this case, *dens* is required.
+    * dens : float, 1d-array or None
         If not None, will use this value instead of the ``'density'`` property
         of the tesseroids. Use this, e.g., for sensitivity matrix building.
+        Can be an array with the density of each tesseroid.
     * ratio : float
         Will divide each tesseroid until the distance between it and the
         computation points is < ratio*size of tesseroid. Used to guarantee the
         accuracy of the numerical integration.
     * njobs : int
-        Split the computation into *njobs* parts and run it in parallel using
-        ``multiprocessing``. If ``njobs=1`` will run the computation in serial.
-    * pool : None or multiprocessing.Pool object
+        Split the computation into *njobs* parts and run it in parallel
+        threads (or in the processes of *pool*). If ``njobs=1`` will run the
+        computation in serial.
+    * pool : None, multiprocessing.Pool or SharedPool object
         If not None, will use this pool to run the computation in parallel
         instead of creating a new one. You must still specify *njobs* as the
         number of processes in the pool. Use this to avoid spawning processes
         on each call to this functions, which can have significant overhead.
+        A :class:`~fatiando.gravmag.tesseroid.SharedPool` also avoids copying
+        the model to the processes on each call (*njobs* is ignored).
+    * stats : None or dict
+        If a dict, will be filled with the maximum depth of the discretization
+        stack (``'max_stack_depth'``) and the number of kernel evaluations
+        (``'kernel_evaluations'``) of this call. Use it to tune *ratio*.
+    * max_order : int
+        The maximum order of the Gauss-Legendre Quadrature (2 to 8). Tesseroids
+        that are too close to a computation point for the 2-point quadrature
+        are integrated with a higher order (instead of being divided) if that
+        takes fewer kernel evaluations. The results stay within the accuracy
+        target of *ratio* (about 0.1%). If 2, will only divide the
+        tesseroids.
 
     Returns:
 
@@ -815,7 +1399,565 @@ def gzz(lon, lat, height, model, dens=None, ratio=RATIO_GG,
 
     """
     field = 'gzz'
-    result = _dispatcher(field, lon, lat, height, model, dens=dens,
-                         ratio=ratio, njobs=njobs, pool=pool)
+    result = _dispatcher([field], lon, lat, height, model, dens=dens,
+                         ratio=ratio, njobs=njobs, pool=pool,
+                         stats=stats, max_order=max_order)[:, 0]
     result *= SI2EOTVOS*G
     return result
+
+
+def fields(lon, lat, height, model, fields, dens=None, ratio=None, njobs=1,
+           pool=None, stats=None, max_order=2):
+    """
+    Calculate several gravitational fields of a tesseroid model at once.
+
+    This is faster than calling each function separately because the adaptive
+    discretization of the tesseroids is done only once for all fields. Use it,
+    e.g., to calculate all components of the gravity gradient tensor.
+
+    .. warning:: Tesseroids with dimensions < 10 cm will be ignored to avoid
+        numerical errors.
+
+    Implements the method of Uieda et al. (2016).
+
+    Parameters:
+
+    * lon, lat, height : arrays
+        Arrays with the longitude, latitude and height coordinates of the
+        computation points.
+    * model : list of :class:`~fatiando.mesher.Tesseroid` or 2d-array
+        The density model used to calculate the gravitational effect.
+        Tesseroids must have the property ``'density'``. Those that don't have
+        this property will be ignored in the computations. Elements that are
+        None will also be ignored. Can also be an array with the bounds
+        ``[w, e, s, n, top, bottom]`` of one tesseroid per row (faster for
+        large models). In this case, *dens* is required.
+    * fields : list of strings
+        The fields that will be calculated. Can be any of ``'potential'``,
+        ``'gx'``, ``'gy'``, ``'gz'``, ``'gxx'``, ``'gxy'``, ``'gxz'``,
+        ``'gyy'``, ``'gyz'``, and ``'gzz'``.
+    * dens : float, 1d-array or None
+        If not None, will use this value instead of the ``'density'`` property
+        of the tesseroids. Use this, e.g., for sensitivity matrix building.
+        Can be an array with the density of each tesseroid.
+    * ratio : float or None
+        Will divide each tesseroid until the distance between it and the
+        computation points is < ratio*size of tesseroid. Used to guarantee the
+        accuracy of the numerical integration. If None, will use the largest
+        of the default values of the requested fields (the most accurate).
+    * njobs : int
+        Split the computation into *njobs* parts and run it in parallel
+        threads (or in the processes of *pool*). If ``njobs=1`` will run the
+        computation in serial.
+    * pool : None, multiprocessing.Pool or SharedPool object
+        If not None, will use this pool to run the computation in parallel
+        instead of creating a new one. You must still specify *njobs* as the
+        number of processes in the pool. A
+        :class:`~fatiando.gravmag.tesseroid.SharedPool` also avoids copying
+        the model to the processes on each call (*njobs* is ignored).
+    * stats : None or dict
+        If a dict, will be filled with the maximum depth of the discretization
+        stack (``'max_stack_depth'``) and the number of kernel evaluations
+        (``'kernel_evaluations'``) of this call. Use it to tune *ratio*.
+    * max_order : int
+        The maximum order of the Gauss-Legendre Quadrature (2 to 8). Tesseroids
+        that are too close to a computation point for the 2-point quadrature
+        are integrated with a higher order (instead of being divided) if that
+        takes fewer kernel evaluations. The results stay within the accuracy
+        target of *ratio* (about 0.1%). If 2, will only divide the
+        tesseroids.
+
+    Returns:
+
+    * results : list of arrays
+        The fields in the same order as *fields*. The units are the same as
+        the corresponding functions (SI for the potential, mGal for gravity
+        and Eotvos for the gravity gradients).
+
+    Examples:
+
+    >>> from fatiando.mesher import Tesseroid
+    >>> model = [Tesseroid(0, 1, 0, 1, 0, -10000, {'density': 1000})]
+    >>> lon, lat = np.array([0.5, 0.2, 0.8]), np.array([0.5, 0.1, 0.3])
+    >>> height = 1000*np.ones(3)
+    >>> gzz_fused, gz_fused = fields(lon, lat, height, model, ['gzz', 'gz'])
+    >>> bool(np.allclose(gzz_fused, gzz(lon, lat, height, model)))
+    True
+    >>> # The strictest ratio (of gzz) was used for both fields
+    >>> gz_strict = gz(lon, lat, height, model, ratio=RATIO_GG)
+    >>> bool(np.allclose(gz_fused, gz_strict))
+    True
+
+    References:
+
+    Uieda, L., V. Barbosa, and C. Braitenberg (2016), Tesseroids:
+    Forward-modeling gravitational fields in spherical coordinates, Geophysics,
+    F41-F48, doi:10.1190/geo2015-0204.1
+
+    """
+    for field in fields:
+        assert field in _UNITS, "Invalid field '{}'".format(field)
+    if ratio is None:
+        ratio = max(_RATIOS[field] for field in fields)
+    result = _dispatcher(list(fields), lon, lat, height, model, dens=dens,
+                         ratio=ratio, njobs=njobs, pool=pool,
+                         stats=stats, max_order=max_order)
+    return [result[:, i]*_UNITS[field] for i, field in enumerate(fields)]
+
+
+def global_grid(lon, lat, height, mesh, fields, dens=None, ratio=None,
+                njobs=1, stats=None, max_order=2):
+    """
+    Calculate gravitational fields of a global mesh on a regular grid.
+
+    Uses the fact that the effect of a tesseroid depends only on the
+    difference in longitude between it and the computation point. The
+    effect of a single tesseroid of each latitude band (and layer) of the mesh
+    is calculated on all points of the grid and the effect of the whole band
+    is obtained by a circular convolution (using FFTs) with the densities
+    along longitude. The computation time is proportional to the number of
+    points times the number of latitude bands (instead of the number of
+    tesseroids), which makes large global models possible.
+
+    .. note:: The grid must have the same longitude spacing as the mesh and
+        the mesh must go around the whole globe (east - west = 360 degrees).
+
+    Parameters:
+
+    * lon, lat : 1d-arrays
+        The longitudes and latitudes of the grid. *lon* must have one point
+        for each tesseroid of the mesh in longitude, equally spaced.
+    * height : float
+        The height of the computation points.
+    * mesh : :class:`~fatiando.mesher.TesseroidMesh`
+        The global density model. Must have the property ``'density'`` (unless
+        *dens* is given).
+    * fields : list of strings
+        The fields that will be calculated. Can be any of ``'potential'``,
+        ``'gx'``, ``'gy'``, ``'gz'``, ``'gxx'``, ``'gxy'``, ``'gxz'``,
+        ``'gyy'``, ``'gyz'``, and ``'gzz'``.
+    * dens : float, 1d-array or None
+        If not None, will use this value instead of the ``'density'`` property
+        of the mesh.
+    * ratio : float or None
+        Will divide each tesseroid until the distance between it and the
+        computation points is < ratio*size of tesseroid. If None, will use the
+        largest of the default values of the requested fields.
+    * njobs : int
+        Number of threads used to calculate the effect of each band.
+    * stats : None or dict
+        If a dict, will be filled with the maximum depth of the discretization
+        stack (``'max_stack_depth'``) and the number of kernel evaluations
+        (``'kernel_evaluations'``) of this call.
+    * max_order : int
+        The maximum order of the Gauss-Legendre Quadrature (2 to 8). See
+        :func:`~fatiando.gravmag.tesseroid.gz`.
+
+    Returns:
+
+    * results : list of 2d-arrays
+        The fields in the same order as *fields*. Each array has shape
+        ``(len(lat), len(lon))``. The units are the same as the corresponding
+        functions (SI for the potential, mGal for gravity and Eotvos for the
+        gravity gradients).
+
+    Examples:
+
+    >>> from fatiando.mesher import TesseroidMesh
+    >>> mesh = TesseroidMesh((0, 360, -90, 90, 0, -20000), (1, 6, 12))
+    >>> mesh.addprop('density', np.linspace(-300, 300, mesh.size))
+    >>> lon = np.arange(0, 360, 30) + 5
+    >>> lat = np.array([-45, 0, 20])
+    >>> gz_grid, = global_grid(lon, lat, 100e3, mesh, ['gz'])
+    >>> gz_grid.shape
+    (3, 12)
+    >>> glon, glat = np.meshgrid(lon, lat)
+    >>> gz_direct = gz(glon.ravel(), glat.ravel(), 100e3*np.ones(glon.size),
+    ...                mesh)
+    >>> bool(np.allclose(gz_grid.ravel(), gz_direct))
+    True
+
+    """
+    for field in fields:
+        assert field in _UNITS, "Invalid field '{}'".format(field)
+    if ratio is None:
+        ratio = max(_RATIOS[field] for field in fields)
+    assert 2 <= max_order <= _tesseroid_numba.MAX_ORDER, \
+        "Invalid max_order {}. Must be between 2 and {}.".format(
+            max_order, _tesseroid_numba.MAX_ORDER)
+    nr, nlat, nlon = mesh.shape
+    lons, lats, heights = mesh.get_xs(), mesh.get_ys(), mesh.get_zs()
+    spacing = (lons[-1] - lons[0])/nlon
+    assert np.allclose(lons[-1] - lons[0], 360), \
+        "The mesh must go around the whole globe"
+    lon = np.asarray(lon, dtype='float')
+    assert lon.size == nlon and np.allclose(np.diff(lon), spacing), \
+        "The grid longitudes must have the same spacing as the mesh"
+    if dens is None:
+        dens = mesh.props['density']
+    density = np.array(np.broadcast_to(np.asarray(dens, dtype='float'),
+                                       (mesh.size,)))
+    density[list(mesh.mask)] = 0
+    density = density.reshape((nr, nlat, nlon))
+    glon, glat = np.meshgrid(lon, lat)
+    glon, glat = glon.ravel(), glat.ravel()
+    gheight = height*np.ones_like(glon)
+    spectra = np.zeros((len(fields), len(lat), nlon//2 + 1), dtype='complex')
+    infos = [np.zeros(3, dtype='int64')]
+    for k in range(nr):
+        for j in range(nlat):
+            # The first tesseroid of the band, with unit density
+            bounds, unit = _model_arrays(
+                np.array([[lons[0], lons[1], lats[j], lats[j + 1],
+                           heights[k], heights[k + 1]]]), 1)
+            if not np.any(density[k, j]) or unit.size == 0:
+                continue
+            effect = np.zeros((glon.size, len(fields)))
+            infos.append(_integrate(glon, glat, gheight, bounds, unit,
+                                    ratio, fields, effect, njobs=njobs,
+                                    max_order=max_order))
+            # The effect of tesseroid i on point l is the effect of the first
+            # tesseroid on point l - i, so the band is a circular convolution.
+            effect = effect.T.reshape((len(fields), len(lat), nlon))
+            spectra += (np.fft.rfft(effect, axis=-1) *
+                        np.fft.rfft(density[k, j]))
+    _report(_merge_info(infos), stats)
+    results = np.fft.irfft(spectra, n=nlon, axis=-1)
+    return [results[i]*_UNITS[field] for i, field in enumerate(fields)]
+
+
+def stream(lon, lat, height, model, fields, fname, chunk_size=100000,
+           dens=None, ratio=None, njobs=1, pool=None, max_order=2):
+    """
+    Calculate gravitational fields in chunks of points and save them to disk.
+
+    Use this for very large numbers of computation points (e.g., global grids
+    with millions of points). The points are split into chunks of
+    *chunk_size* that are calculated one at a time and written to a ``.npy``
+    file as soon as they are done. This is a generator that yields after each
+    chunk with the progress of the computation. Nothing is calculated until
+    you iterate over it.
+
+    If *fname* already exists (e.g., from a run that crashed or was
+    interrupted), the chunks that were finished are skipped and the
+    computation resumes from where it stopped. Unfinished rows of the file are
+    filled with NaN.
+
+    Parameters:
+
+    * lon, lat, height : arrays
+        Arrays with the longitude, latitude and height coordinates of the
+        computation points.
+    * model : list of :class:`~fatiando.mesher.Tesseroid` or 2d-array
+        The density model (see :func:`~fatiando.gravmag.tesseroid.gz`).
+    * fields : list of strings
+        The fields that will be calculated. Can be any of ``'potential'``,
+        ``'gx'``, ``'gy'``, ``'gz'``, ``'gxx'``, ``'gxy'``, ``'gxz'``,
+        ``'gyy'``, ``'gyz'``, and ``'gzz'``.
+    * fname : str
+        The ``.npy`` file that will store the results. It will have one row
+        per computation point and one column per field (in the same units as
+        the corresponding functions).
+    * chunk_size : int
+        The number of computation points in each chunk.
+    * dens, ratio, njobs, pool, max_order
+        Same as in :func:`~fatiando.gravmag.tesseroid.fields`. They are used
+        for each chunk.
+
+    Yields:
+
+    * progress : dict
+        Information about the computation after each chunk is written:
+        ``'chunk'`` (index of the chunk that finished), ``'nchunks'``,
+        ``'done'`` (number of points finished, including the ones from
+        previous runs), ``'size'`` (total number of points), ``'elapsed'``
+        (seconds since the start of this run), ``'rate'`` (points per second
+        in this run), and ``'eta'`` (estimated seconds until the end).
+
+    Examples:
+
+    >>> import os, tempfile
+    >>> from fatiando.mesher import Tesseroid
+    >>> model = [Tesseroid(0, 1, 0, 1, 0, -10000, {'density': 1000})]
+    >>> lon, lat = np.linspace(0, 1, 25), np.linspace(0, 1, 25)
+    >>> height = 1000*np.ones(25)
+    >>> fname = os.path.join(tempfile.mkdtemp(), 'gravity.npy')
+    >>> for progress in stream(lon, lat, height, model, ['gz', 'gzz'], fname,
+    ...                        chunk_size=10):
+    ...     print('{done}/{size} points'.format(**progress))
+    10/25 points
+    20/25 points
+    25/25 points
+    >>> results = np.load(fname, mmap_mode='r')
+    >>> results.shape
+    (25, 2)
+    >>> gz_all, gzz_all = fields(lon, lat, height, model, ['gz', 'gzz'])
+    >>> bool(np.allclose(results[:, 0], gz_all))
+    True
+    >>> # Running it again resumes from the finished chunks (all of them)
+    >>> len(list(stream(lon, lat, height, model, ['gz', 'gzz'], fname,
+    ...                 chunk_size=10)))
+    0
+
+    """
+    for field in fields:
+        assert field in _UNITS, "Invalid field '{}'".format(field)
+    if ratio is None:
+        ratio = max(_RATIOS[field] for field in fields)
+    units = np.array([_UNITS[field] for field in fields])
+    assert chunk_size > 0, \
+        "Invalid chunk_size {}. Must be > 0.".format(chunk_size)
+    assert lon.shape == lat.shape == height.shape, \
+        "Input coordinate arrays must have same shape"
+    lon, lat, height = [np.ravel(i) for i in [lon, lat, height]]
+    shape = (lon.size, len(fields))
+    if os.path.exists(fname):
+        out = np.lib.format.open_memmap(fname, mode='r+')
+        if out.shape != shape:
+            raise ValueError(
+                "Existing file '{}' has shape {} but expected {}.".format(
+                    fname, out.shape, shape))
+    else:
+        out = np.lib.format.open_memmap(fname, mode='w+', dtype='float',
+                                        shape=shape)
+        out[:] = np.nan
+        out.flush()
+    # Pack the model only once instead of on every chunk
+    bounds, density = _model_arrays(model, dens)
+    if isinstance(pool, SharedPool):
+        pool.set_model(bounds, density)
+    strides = list(range(0, lon.size, chunk_size)) + [lon.size]
+    chunks = [(i, low, high)
+              for i, (low, high) in enumerate(zip(strides[:-1], strides[1:]))
+              if np.isnan(out[low:high]).any()]
+    done = lon.size - sum(high - low for _, low, high in chunks)
+    start = time.time()
+    computed = 0
+    for chunk, low, high in chunks:
+        part = slice(low, high)
+        out[part] = units*_dispatcher(
+            list(fields), lon[part], lat[part], height[part], bounds,
+            dens=density, ratio=ratio, njobs=njobs, pool=pool,
+            max_order=max_order)
+        out.flush()
+        computed += high - low
+        done += high - low
+        elapsed = time.time() - start
+        rate = computed/elapsed if elapsed > 0 else float('inf')
+        yield dict(chunk=chunk, nchunks=len(strides) - 1, done=done,
+                   size=lon.size, elapsed=elapsed, rate=rate,
+                   eta=(lon.size - done)/rate)
+
+
+def sensitivity(lon, lat, height, model, field, dtype='float64', out=None,
+                njobs=1, ratio=None, max_order=2, threshold=None,
+                stats=None):
+    """
+    Calculate the sensitivity (Jacobian) matrix of a field for a tesseroid
+    model.
+
+    Column j of the matrix is the *field* of tesseroid j of *model* with unit
+    density (1 kg/m^3). Elements of *model* that are None (or tesseroids that
+    are too small) have a column of zeros. The matrix is filled in a single
+    compiled (and optionally parallel) pass.
+
+    Use *out* to write the matrix into an existing array. This can be a
+    ``numpy.memmap`` to build matrices that don't fit in memory. Alternatively,
+    use *threshold* to get a sparse matrix without the elements that are
+    smaller (in absolute value) than *threshold* times the largest element of
+    their row. The matrix is calculated in blocks of rows so the full dense
+    version is never stored.
+
+    Parameters:
+
+    * lon, lat, height : arrays
+        Arrays with the longitude, latitude and height coordinates of the
+        computation points.
+    * model : list of :class:`~fatiando.mesher.Tesseroid`,
+      :class:`~fatiando.mesher.TesseroidMesh` or 2d-array
+        The tesseroids that make up the model. Their densities are ignored.
+        Can also be an array with the bounds ``[w, e, s, n, top, bottom]`` of
+        one tesseroid per row.
+    * field : str
+        The field that will be calculated. Can be any of ``'potential'``,
+        ``'gx'``, ``'gy'``, ``'gz'``, ``'gxx'``, ``'gxy'``, ``'gxz'``,
+        ``'gyy'``, ``'gyz'``, and ``'gzz'``.
+    * dtype : float32 or float64
+        The data type of the matrix. Ignored if *out* is given.
+    * out : None or 2d-array
+        If given, the matrix will be written to this array. Must have shape
+        (len(lon), len(model)) and dtype float32 or float64. Can be a
+        ``numpy.memmap``. Can't be used with *threshold*.
+    * njobs : int
+        Split the computation points (rows) into *njobs* parts and run them
+        in parallel threads. If ``njobs=1`` will run the computation in
+        serial.
+    * ratio : float or None
+        Will divide each tesseroid until the distance between it and the
+        computation points is < ratio*size of tesseroid. If None, will use the
+        default value for *field*.
+    * max_order : int
+        The maximum order of the Gauss-Legendre Quadrature (2 to 8). See
+        :func:`~fatiando.gravmag.tesseroid.gz`.
+    * threshold : None or float
+        If given, will return a :class:`scipy.sparse.csr_matrix` with only the
+        elements that are larger (in absolute value) than *threshold* times
+        the largest element of their row.
+    * stats : None or dict
+        If a dict, will be filled with the maximum depth of the discretization
+        stack (``'max_stack_depth'``) and the number of kernel evaluations
+        (``'kernel_evaluations'``) of this call.
+
+    Returns:
+
+    * sensitivity : 2d-array or scipy.sparse.csr_matrix
+        The sensitivity matrix (*out* if it was given). The units are the
+        same as the corresponding field function.
+
+    Examples:
+
+    >>> from fatiando.mesher import Tesseroid
+    >>> model = [Tesseroid(0, 1, 0, 1, 0, -10000),
+    ...          Tesseroid(1, 2, 0, 1, 0, -10000)]
+    >>> lon, lat = np.array([0.5, 1.5, 30]), np.array([0.5, 0.5, 0])
+    >>> height = 1000*np.ones(3)
+    >>> jac = sensitivity(lon, lat, height, model, 'gz', dtype=np.float32)
+    >>> jac.shape, jac.dtype
+    ((3, 2), dtype('float32'))
+    >>> bool(np.allclose(jac[:, 1], gz(lon, lat, height, model[1:], dens=1)))
+    True
+    >>> sparse = sensitivity(lon, lat, height, model, 'gz', threshold=0.1)
+    >>> sparse.nnz
+    4
+    >>> bool(np.allclose(sparse.toarray()[2], jac[2]))
+    True
+
+    """
+    assert field in _UNITS, "Invalid field '{}'".format(field)
+    if ratio is None:
+        ratio = _RATIOS[field]
+    _check_input(lon, lat, height, model, ratio, njobs, None,
+                 max_order=max_order)
+    bounds, _, columns = _model_arrays(model, 1, index=True)
+    shape = (np.size(lon), len(model))
+    # The columns of the elements that were skipped
+    missing = np.setdiff1d(np.arange(shape[1]), columns)
+    lon, lat, height = [np.ravel(i) for i in [lon, lat, height]]
+    if threshold is None:
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        if out.shape != shape or out.dtype not in (np.float32, np.float64):
+            raise ValueError(
+                "Invalid output array with shape {} and dtype {}. ".format(
+                    out.shape, out.dtype) +
+                "Must have shape {} and dtype float32 or float64.".format(
+                    shape))
+        out[:, missing] = 0
+        info = _sensitivity(lon, lat, height, bounds, columns, field, ratio,
+                            max_order, njobs, out)
+        if hasattr(out, 'flush'):
+            out.flush()
+    else:
+        if out is not None:
+            raise ValueError("Can't use 'out' with a threshold.")
+        # Number of rows calculated at a time (about 80 MB per block)
+        size = max(1, 10**7//max(shape[1], 1))
+        blocks, infos = [], []
+        for low in range(0, shape[0], size):
+            part = slice(low, low + size)
+            block = np.zeros((len(lon[part]), shape[1]), dtype=dtype)
+            infos.append(_sensitivity(lon[part], lat[part], height[part],
+                                      bounds, columns, field, ratio,
+                                      max_order, njobs, block))
+            largest = np.abs(block).max(axis=1)
+            block[np.abs(block) < threshold*largest[:, None]] = 0
+            blocks.append(scipy.sparse.csr_matrix(block))
+        out = scipy.sparse.vstack(blocks, format='csr') if blocks else \
+            scipy.sparse.csr_matrix(shape, dtype=dtype)
+        info = _merge_info(infos + [np.zeros(3, dtype='int64')])
+    _report(info, stats)
+    return out
+
+
+def _sensitivity(lon, lat, height, bounds, columns, field, ratio, max_order,
+                 njobs, out):
+    """
+    Fill the sensitivity matrix *out* (see sensitivity).
+
+    Returns the instrumentation array of the integration (see _integrate).
+    """
+    lon, sinlat, coslat, radius = _convert_coords(lon, lat, height)
+    codes = np.array([_tesseroid_numba.FIELD_CODES[field]])
+    ratios = _tesseroid_numba.order_ratios(ratio, max_order)
+
+    def run(part):
+        info = np.zeros(3, dtype='int64')
+        _tesseroid_numba.sensitivity_engine(
+            codes, lon[part], sinlat[part], coslat[part], radius[part],
+            bounds, columns, float(ratio), ratios, _UNITS[field], STACK_SIZE,
+            out[part], info)
+        return info
+
+    return _merge_info(_threads.run(run, lon.size, njobs=njobs,
+                                    parts=_parts(njobs)))
+
+
+def warm_up():
+    """
+    Compile the numba engines used by this module and report the timings.
+
+    The engines are compiled the first time they are used, which can take
+    several seconds. The compiled code is cached on disk so this only
+    happens once (unless the code or the numba version change). Call this
+    function to get the compilation out of the way before timing a
+    computation or to check if the cache is working.
+
+    Returns:
+
+    * report : dict
+        For each engine, a tuple with the time (in seconds) of the first call
+        and how the engine was obtained: ``'compiled'`` (just in time),
+        ``'cache'`` (loaded from the on-disk cache), or ``'memory'`` (was
+        already compiled in this process). Also has the location of the
+        cache in ``'cache_path'``.
+
+    Examples:
+
+    >>> report = warm_up()
+    >>> sorted(report)
+    ['cache_path', 'engine', 'sensitivity_engine']
+    >>> seconds, source = report['engine']
+    >>> source in ['compiled', 'cache', 'memory']
+    True
+    >>> warm_up()['engine'][1]
+    'memory'
+
+    """
+    lon, lat, height = np.zeros(1), np.zeros(1), 1000*np.ones(1)
+    bounds = np.array([[0, 1, 0, 1, 0, -1000.]])
+    density = np.ones(1)
+    fields = sorted(_UNITS)
+    calls = [
+        ('engine', lambda: _integrate(
+            lon, lat, height, bounds, density, 1, fields,
+            np.zeros((1, len(fields))))),
+        ('sensitivity_engine', lambda: [
+            sensitivity(lon, lat, height, bounds, 'gz', dtype=dtype)
+            for dtype in [np.float64, np.float32]])]
+    report = {}
+    for name, call in calls:
+        dispatcher = getattr(_tesseroid_numba, name)
+        compiled = len(dispatcher.overloads)
+        hits = sum(dispatcher.stats.cache_hits.values())
+        start = time.time()
+        call()
+        seconds = time.time() - start
+        if len(dispatcher.overloads) == compiled:
+            source = 'memory'
+        elif sum(dispatcher.stats.cache_hits.values()) > hits:
+            source = 'cache'
+        else:
+            source = 'compiled'
+        report[name] = (seconds, source)
+    report['cache_path'] = _tesseroid_numba.engine.stats.cache_path
+    return report
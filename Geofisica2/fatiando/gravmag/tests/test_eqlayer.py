@@ -145,3 +145,25 @@ def test_eqlayer_polereduce():
     calc = sphere.tf(x, y, z, layer, inc=-90, dec=0)
 
     assert_allclose(calc, true, atol=10, rtol=0.05)
+
+
+def test_eql_predicted_treecode():
+    "EQLGravity and EQLTotalField can predict data with the tree code"
+    area = [-2000, 2000, -2000, 2000]
+    x, y, z = gridder.scatter(area, 1000, z=-100, seed=42)
+    layer = PointGrid(area, 200, (30, 30))
+    p = np.random.RandomState(0).uniform(-1, 1, layer.size)
+    data = np.zeros_like(x)
+    inc, dec = -60, -15
+    for accuracy in [1e-2, 1e-4]:
+        gravity = [EQLGravity(x, y, z, data, layer, accuracy=a)
+                   for a in [None, accuracy]]
+        magnetic = [EQLTotalField(x, y, z, data, inc, dec, layer, -70, 30,
+                                  accuracy=a)
+                    for a in [None, accuracy]]
+        for direct, tree in [gravity, magnetic]:
+            true = direct.predicted(p)
+            approx = tree.predicted(p)
+            assert not np.all(approx == true)
+            assert_allclose(approx, true, rtol=0,
+                            atol=accuracy*np.abs(true).max())
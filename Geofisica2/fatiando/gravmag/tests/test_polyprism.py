@@ -11,7 +11,7 @@ import pytest
 from ... import utils, gridder, constants
 from ...mesher import PolygonalPrism
 from ...datasets import check_hash
-from .. import polyprism
+from .. import polyprism, _threads
 
 
 TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
@@ -102,3 +102,76 @@ def test_polyprism_regression(data, model):
         tolerance = 1e-8
         npt.assert_allclose(result, true, rtol=0, atol=tolerance,
                             err_msg='kernel: {}'.format(kernel))
+
+
+def test_polyprism_threads(monkeypatch, data, model):
+    "Polyprism gives the same result when split among several threads"
+    inc, dec = data['inc'], data['dec']
+    x, y, z = data['x'], data['y'], data['z']
+    serial = [polyprism.gzz(x, y, z, model),
+              polyprism.tf(x, y, z, model, inc, dec)]
+    monkeypatch.setattr(_threads, 'NJOBS', 3)
+    npt.assert_allclose(polyprism.gzz(x, y, z, model), serial[0], rtol=1e-12)
+    npt.assert_allclose(polyprism.tf(x, y, z, model, inc, dec), serial[1],
+                        rtol=1e-12)
+
+
+def test_polyprism_mixed_models():
+    "Prisms with different number of vertices and missing properties"
+    x, y, z = gridder.regular([-2000, 2000, -2000, 2000], (20, 15), z=-10)
+    x, y, z = x.reshape((20, 15)), y.reshape((20, 15)), z.reshape((20, 15))
+    inc, dec = -30, 20
+    model = [
+        PolygonalPrism([[-500, -500], [0, -600], [500, -500], [500, 500],
+                        [-500, 500]], 100, 500, {'density': 1000}),
+        None,
+        PolygonalPrism([[700, 0], [1500, 200], [1000, 900]], 50, 300,
+                       {'magnetization': utils.ang2vec(3, 25, -10)}),
+        PolygonalPrism(np.transpose(gridder.circular_scatter(
+                           [-1800, -1000, -300, 1000], 40)), 200, 800,
+                       {'density': -500, 'magnetization': [1, -2, 0.5]})]
+    for field in FIELDS:
+        func = getattr(polyprism, field)
+        if field == 'tf':
+            args = [inc, dec]
+        else:
+            args = []
+        result = func(x, y, z, model, *args)
+        assert result.shape == x.shape
+        separate = sum(func(x, y, z, [p], *args) for p in model
+                       if p is not None)
+        npt.assert_allclose(result, separate, rtol=1e-10, atol=1e-10,
+                            err_msg='field: {}'.format(field))
+        # Passing the magnetization uses it for all prisms
+        if field == 'tf':
+            result = func(x, y, z, model, inc, dec, pmag=[1, 2, 3])
+            separate = sum(
+                func(x, y, z, [p], inc, dec, pmag=[1, 2, 3])
+                for p in model if p is not None)
+            npt.assert_allclose(result, separate, rtol=1e-10, atol=1e-10)
+    # No prisms with the right properties gives zeros
+    empty = [None, PolygonalPrism([[0, 0], [1, 0], [1, 1]], 0, 1, {})]
+    npt.assert_array_equal(polyprism.gz(x, y, z, empty), np.zeros_like(x))
+
+
+def test_polyprism_magnetic_from_kernels(model):
+    "The fused magnetic fields match the ones built from the kernels"
+    prism = model[0]
+    mx, my, mz = prism.props['magnetization']
+    inc, dec = -30, 20
+    fx, fy, fz = utils.dircos(inc, dec)
+    # Include points inside and around the prism
+    for height in [-10, 300, 800]:
+        x, y, z = gridder.regular([-4500, 4500, -5000, 5000], (31, 37),
+                                  z=height)
+        v1, v2, v3, v4, v5, v6 = [getattr(polyprism, kernel)(x, y, z, prism)
+                                  for kernel in KERNELS]
+        bx = (v1*mx + v2*my + v3*mz)*constants.CM*constants.T2NT
+        by = (v2*mx + v4*my + v5*mz)*constants.CM*constants.T2NT
+        bz = (v3*mx + v5*my + v6*mz)*constants.CM*constants.T2NT
+        tf = fx*bx + fy*by + fz*bz
+        npt.assert_allclose(polyprism.bx(x, y, z, model), bx, atol=1e-8)
+        npt.assert_allclose(polyprism.by(x, y, z, model), by, atol=1e-8)
+        npt.assert_allclose(polyprism.bz(x, y, z, model), bz, atol=1e-8)
+        npt.assert_allclose(polyprism.tf(x, y, z, model, inc, dec), tf,
+                            atol=1e-8)
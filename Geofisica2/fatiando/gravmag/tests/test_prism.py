@@ -1,11 +1,14 @@
 from __future__ import absolute_import
+import tempfile
 import numpy as np
+import scipy.sparse.linalg
 from numpy.testing import assert_array_almost_equal as assert_almost
 from pytest import raises
 
-from ...mesher import Prism
+from ...mesher import Prism, PrismMesh
 from .. import _prism_numpy, prism
 from ... import utils, gridder
+from ...constants import G, SI2MGAL, SI2EOTVOS, CM, T2NT, PERM_FREE_SPACE
 
 
 def test_fails_if_shape_mismatch():
@@ -361,3 +364,317 @@ def test_around():
                   'Failed gzz, east and gyy')
     assert_almost(west, prism.gyy(xp, yp, zp, model), 10,
                   'Failed gzz, west and gyy')
+
+
+def test_serial_vs_parallel():
+    "gravmag.prism serial and parallel execution give same result"
+    inc, dec = -30, 50
+    model = [
+        Prism(100, 300, -100, 100, 0, 400,
+              {'density': -1000,
+               'magnetization': utils.ang2vec(-2, inc, dec)}),
+        Prism(-300, -100, -100, 100, 0, 200,
+              {'density': 2000, 'magnetization': utils.ang2vec(5, 25, -10)})]
+    x, y, z = gridder.regular([-500, 500, -500, 500], (21, 31), z=-1)
+    njobs = 3
+    funcs = ['potential', 'gx', 'gy', 'gz',
+             'gxx', 'gxy', 'gxz', 'gyy', 'gyz', 'gzz',
+             'bx', 'by', 'bz', 'tf']
+    for f in funcs:
+        if f == 'tf':
+            serial = prism.tf(x, y, z, model, inc, dec)
+            parallel = prism.tf(x, y, z, model, inc, dec, njobs=njobs)
+        else:
+            serial = getattr(prism, f)(x, y, z, model)
+            parallel = getattr(prism, f)(x, y, z, model, njobs=njobs)
+        assert_almost(serial, parallel, 10, 'Field = %s' % (f))
+    raises(ValueError, prism.gz, x, y, z, model, njobs=0)
+
+
+def test_fields():
+    "gravmag.prism.fields gives the same results as the separate functions"
+    model = [Prism(-300, 300, -300, 300, -300, 300, {'density': 1000}),
+             None,
+             Prism(400, 600, -200, 0, 0, 300, {'density': -500}),
+             Prism(400, 600, -200, 0, 0, 300)]
+    # Include the points where gxy, gxz and gyz are singular
+    shape = (21, 21)
+    area = [-600, 600, -600, 600]
+    grids = [gridder.regular(area, shape, z=-310),
+             gridder.regular(area, shape, z=300),
+             np.array(gridder.regular(area, shape, z=300))[[0, 2, 1]],
+             np.array(gridder.regular(area, shape, z=300))[[2, 1, 0]]]
+    funcs = ['potential', 'gx', 'gy', 'gz',
+             'gxx', 'gxy', 'gxz', 'gyy', 'gyz', 'gzz']
+    requests = [funcs, funcs[::-1], ['gz'], ['gxy', 'gyy', 'gxy']]
+    for xp, yp, zp in grids:
+        for fields in requests:
+            results = prism.fields(xp, yp, zp, model, fields)
+            assert len(results) == len(fields)
+            for f, res in zip(fields, results):
+                assert_almost(res, getattr(prism, f)(xp, yp, zp, model), 10,
+                              'Field = %s' % (f))
+        results = prism.fields(xp, yp, zp, model, ['gz', 'gzz'], dens=-10,
+                               njobs=2)
+        assert_almost(results[1], prism.gzz(xp, yp, zp, model, dens=-10), 10)
+    raises(ValueError, prism.fields, xp, yp, zp, model, ['gz', 'tf'])
+
+
+def test_sensitivity():
+    "gravmag.prism.sensitivity columns match the fields of each prism"
+    inc, dec = -30, 50
+    model = [Prism(-300, 300, -300, 300, 100, 500),
+             None,
+             Prism(400, 600, -200, 0, 0, 300)]
+    xp, yp, zp = gridder.regular([-600, 600, -600, 600], (11, 11), z=-10)
+    pmag = utils.ang2vec(2, 25, -10)
+    for field in ['potential', 'gz', 'gxy', 'gzz', 'tf', 'bx', 'bz']:
+        kwargs = {}
+        if field in ['tf', 'bx', 'bz']:
+            kwargs['pmag'] = pmag
+        if field == 'tf':
+            kwargs.update(inc=inc, dec=dec)
+        jac = prism.sensitivity(xp, yp, zp, model, field, njobs=2, **kwargs)
+        assert jac.shape == (len(xp), len(model))
+        assert np.all(jac[:, 1] == 0)
+        for j in [0, 2]:
+            if field in ['tf', 'bx', 'bz']:
+                args = ([model[j]],) + ((inc, dec) if field == 'tf' else ())
+                true = getattr(prism, field)(xp, yp, zp, *args, pmag=pmag)
+            else:
+                true = getattr(prism, field)(xp, yp, zp, [model[j]], dens=1)
+            assert_almost(jac[:, j], true, 10, 'Field = %s' % (field))
+    single = prism.sensitivity(xp, yp, zp, model, 'gz', dtype=np.float32)
+    assert single.dtype == np.float32
+    assert_almost(single, prism.sensitivity(xp, yp, zp, model, 'gz'), 4)
+    out = np.memmap(tempfile.TemporaryFile(), mode='w+', dtype=np.float32,
+                    shape=(len(xp), len(model)))
+    assert prism.sensitivity(xp, yp, zp, model, 'gz', out=out) is out
+    assert_almost(out, single, 10)
+    raises(ValueError, prism.sensitivity, xp, yp, zp, model, 'gz',
+           out=np.empty((len(xp), 2)))
+    raises(ValueError, prism.sensitivity, xp, yp, zp, model, 'bx')
+    raises(ValueError, prism.sensitivity, xp, yp, zp, model, 'gzx')
+
+
+def test_jacobian_operator():
+    "gravmag.prism.jacobian_operator products match the sensitivity matrix"
+    inc, dec = -30, 50
+    model = [Prism(-300, 300, -300, 300, 100, 500),
+             None,
+             Prism(400, 600, -200, 0, 0, 300),
+             Prism(-600, -400, 0, 200, 50, 150)]
+    xp, yp, zp = gridder.regular([-600, 600, -600, 600], (11, 13), z=-10)
+    pmag = utils.ang2vec(2, 25, -10)
+    vector = np.array([1000, 20, -500, 300])
+    residuals = np.sin(xp/100)
+    for field in ['potential', 'gx', 'gxz', 'gzz', 'tf', 'by', 'bz']:
+        kwargs = {}
+        if field in ['tf', 'by', 'bz']:
+            kwargs['pmag'] = pmag
+        if field == 'tf':
+            kwargs.update(inc=inc, dec=dec)
+        matrix = prism.sensitivity(xp, yp, zp, model, field, **kwargs)
+        for njobs in [1, 3]:
+            jac = prism.jacobian_operator(xp, yp, zp, model, field,
+                                          njobs=njobs, **kwargs)
+            assert jac.shape == matrix.shape
+            true = matrix.dot(vector)
+            assert_almost(jac.dot(vector)/np.abs(true).max(),
+                          true/np.abs(true).max(), 10, 'Field = %s' % (field))
+            true = matrix.T.dot(residuals)
+            assert_almost(jac.T.dot(residuals)/np.abs(true).max(),
+                          true/np.abs(true).max(), 10, 'Field = %s' % (field))
+    raises(ValueError, prism.jacobian_operator, xp, yp, zp, model, 'gz',
+           njobs=0)
+
+
+def test_jacobian_operator_inversion():
+    "gravmag.prism.jacobian_operator works as the Jacobian of a Misfit"
+    from ...inversion import Misfit, Damping
+
+    class Gravity(Misfit):
+        def __init__(self, data, jacobian):
+            super(Gravity, self).__init__(data=data, nparams=jacobian.shape[1],
+                                          islinear=True)
+            self.matrix = jacobian
+
+        def predicted(self, p):
+            return utils.safe_dot(self.jacobian(p), p)
+
+        def jacobian(self, p):
+            return self.matrix
+
+    mesh = [Prism(x, x + 200, y, y + 200, 100, 300)
+            for x in [-400, -200, 0, 200] for y in [-400, -200, 0, 200]]
+    xp, yp, zp = gridder.regular([-500, 500, -500, 500], (10, 10), z=-1)
+    true = np.linspace(-500, 500, len(mesh))
+    matrix = prism.sensitivity(xp, yp, zp, mesh, 'gz')
+    data = matrix.dot(true)
+    operator = prism.jacobian_operator(xp, yp, zp, mesh, 'gz', njobs=2)
+    dense = Gravity(data, matrix) + 1e-8*Damping(len(mesh))
+    free = Gravity(data, operator) + 1e-8*Damping(len(mesh))
+    assert isinstance(free.hessian(None),
+                      scipy.sparse.linalg.LinearOperator)
+    free.config('linear', precondition=True).fit()
+    dense.config('linear', precondition=False).fit()
+    assert_almost(free.p_/1000, dense.p_/1000, 3)
+    free.config('levmarq', initial=np.zeros(len(mesh)), lamb=0.001).fit()
+    assert np.linalg.norm(free[0].residuals()) < 0.01*np.linalg.norm(data)
+
+
+def test_regular_mesh():
+    "gravmag.prism gives the same result for a PrismMesh and a list of prisms"
+    mesh = PrismMesh((-1000, 1000, -800, 1200, 0, 800), (6, 7, 8))
+    np.random.seed(0)
+    mesh.addprop('density', np.random.uniform(-500, 500, mesh.size))
+    mesh.mask.extend([3, 10, 50])
+    # Include points aligned with the nodes of the mesh
+    grids = [gridder.regular((-1000, 1000, -800, 1200), (9, 8), z=-100),
+             gridder.regular((-1500, 1500, -1500, 1500), (15, 15), z=1000)]
+    funcs = ['potential', 'gx', 'gy', 'gz',
+             'gxx', 'gxy', 'gxz', 'gyy', 'gyz', 'gzz']
+    for xp, yp, zp in grids:
+        for f in funcs:
+            true = getattr(prism, f)(xp, yp, zp, list(mesh))
+            scale = np.abs(true).max()
+            res = getattr(prism, f)(xp, yp, zp, mesh)
+            assert_almost(res/scale, true/scale, 10, 'Field = %s' % (f))
+            res = getattr(prism, f)(xp, yp, zp, mesh, dens=10, njobs=2)
+            true = getattr(prism, f)(xp, yp, zp, list(mesh), dens=10)
+            scale = np.abs(true).max()
+            assert_almost(res/scale, true/scale, 10, 'Field = %s' % (f))
+
+
+def test_fft_operator():
+    "gravmag.prism.fft_operator products match the sensitivity matrix"
+    inc, dec = -30, 50
+    mesh = PrismMesh((-1000, 1000, -800, 1200, 0, 800), (3, 5, 4))
+    mesh.mask.extend([2, 7])
+    np.random.seed(0)
+    vector = np.random.uniform(-500, 500, mesh.size)
+    pmag = utils.ang2vec(1, 25, -10)
+    # Grids with the same spacing as the mesh but not aligned with it
+    grids = [((7, 6), gridder.regular((-1730, 1270, -1140, 860), (7, 6),
+                                      z=-10)),
+             ((2, 3), gridder.regular((100, 600, 30, 830), (2, 3), z=-150))]
+    for shape, (xp, yp, zp) in grids:
+        residuals = np.cos(xp/300 + yp/200)
+        for field in ['potential', 'gy', 'gz', 'gxy', 'gzz', 'tf', 'bx']:
+            kwargs = {}
+            if field in ['tf', 'bx']:
+                kwargs['pmag'] = pmag
+            if field == 'tf':
+                kwargs.update(inc=inc, dec=dec)
+            matrix = prism.sensitivity(xp, yp, zp, mesh, field, **kwargs)
+            jac = prism.fft_operator(xp, yp, zp, shape, mesh, field,
+                                     **kwargs)
+            assert jac.shape == matrix.shape
+            true = matrix.dot(vector)
+            assert_almost(jac.dot(vector)/np.abs(true).max(),
+                          true/np.abs(true).max(), 10, 'Field = %s' % (field))
+            true = matrix.T.dot(residuals)
+            assert_almost(jac.T.dot(residuals)/np.abs(true).max(),
+                          true/np.abs(true).max(), 10, 'Field = %s' % (field))
+    xp, yp, zp = gridder.regular((-1000, 1000, -800, 1200), (5, 5), z=-10)
+    raises(ValueError, prism.fft_operator, xp, yp, zp, (5, 5), mesh, 'gz')
+    xp, yp, zp = gridder.regular((-1000, 500, -800, 1200), (3, 6), z=-10)
+    raises(ValueError, prism.fft_operator, xp, yp, zp, (6, 3), mesh, 'gz')
+    zp[0] = 0
+    raises(ValueError, prism.fft_operator, xp, yp, zp, (3, 6), mesh, 'gz')
+    raises(ValueError, prism.fft_operator, xp, yp, zp, (3, 6), list(mesh),
+           'gz')
+
+
+def test_farfield():
+    "gravmag.prism far-field approximation is within the reported error bound"
+    inc, dec = -30, 50
+    magnetization = utils.ang2vec(2, 25, -10)
+    model = [Prism(-100, 100, -50, 150, 100, 250,
+                   {'density': 1000, 'magnetization': magnetization})]
+    volume = 200*200*150
+    center = np.array([0, 50, 175])
+    diagonal = np.sqrt(200**2 + 200**2 + 150**2)
+    np.random.seed(1)
+    xp, yp, zp = np.random.uniform(-5000, 5000, (3, 500))
+    distance = np.sqrt((xp - center[0])**2 + (yp - center[1])**2 +
+                       (zp - center[2])**2)
+    orders = dict(potential=0, gx=1, gy=1, gz=1)
+    for ratio in [2, 5, 20]:
+        far = distance > ratio*diagonal
+        for field in ['potential', 'gx', 'gy', 'gz', 'gxx', 'gxy', 'gxz',
+                      'gyy', 'gyz', 'gzz', 'tf', 'bx', 'by', 'bz']:
+            args = (inc, dec) if field == 'tf' else ()
+            func = getattr(prism, field)
+            true = func(xp, yp, zp, model, *args)
+            approx = func(xp, yp, zp, model, *args, ratio=ratio, njobs=2)
+            assert np.all(approx[~far] == true[~far]), field
+            order = orders.get(field, 2)
+            if field in ['tf', 'bx', 'by', 'bz']:
+                const = CM*T2NT*np.linalg.norm(magnetization)*volume
+            elif field == 'potential':
+                const = G*1000*volume
+            elif order == 1:
+                const = G*SI2MGAL*1000*volume
+            else:
+                const = G*SI2EOTVOS*1000*volume
+            factorial = [1, 1, 2][order]
+            bound = (prism.farfield_error(field, ratio)*factorial*const /
+                     distance[far]**(order + 1))
+            assert np.all(np.abs(approx[far] - true[far]) <= bound), field
+            assert np.any(approx[far] != true[far]), field
+    raises(ValueError, prism.gz, xp, yp, zp, model, ratio=0.5)
+    raises(ValueError, prism.farfield_error, 'gz', 0.2)
+    raises(ValueError, prism.farfield_error, 'gzx', 2)
+
+
+def test_magnetic_fields():
+    "gravmag.prism.magnetic_fields matches tf, bx, by, and bz"
+    inc, dec = -30, 50
+    intensity = 25000
+    model = [Prism(-300, 300, -300, 300, 100, 500),
+             None,
+             Prism(400, 600, -200, 0, 0, 300),
+             Prism(-600, -400, 0, 200, 50, 150)]
+    magnetization = np.array([utils.ang2vec(2, 25, -10), [0, 0, 0],
+                              [0, 0, 0], utils.ang2vec(1, -60, 100)])
+    susceptibility = np.array([0.01, 0, 0.05, 0])
+    induced = susceptibility*intensity/(T2NT*PERM_FREE_SPACE)
+    for p, m, i in zip(model, magnetization, induced):
+        if p is not None:
+            p.props['magnetization'] = m + utils.ang2vec(i, inc, dec)
+    xp, yp, zp = gridder.regular([-600, 600, -600, 600], (11, 13), z=-10)
+    true = [prism.tf(xp, yp, zp, model, inc, dec), prism.bx(xp, yp, zp, model),
+            prism.by(xp, yp, zp, model), prism.bz(xp, yp, zp, model)]
+    results = [
+        prism.magnetic_fields(xp, yp, zp, model, inc, dec,
+                              magnetization=magnetization,
+                              susceptibility=susceptibility,
+                              intensity=intensity),
+        prism.magnetic_fields(xp, yp, zp, model, inc, dec, njobs=3),
+        prism.magnetic_fields(xp, yp, zp, model, inc, dec,
+                              magnetization=[p.props['magnetization']
+                                             if p is not None else [0, 0, 0]
+                                             for p in model])]
+    for res in results:
+        for field, t in zip(['tf', 'bx', 'by', 'bz'], true):
+            assert_almost(res.pop(0), t, 10, 'Field = %s' % (field))
+    # Same for a mesh and a list of prisms
+    mesh = PrismMesh((-1000, 1000, -800, 1200, 0, 800), (3, 5, 4))
+    mesh.mask.extend([2, 7])
+    np.random.seed(0)
+    susceptibility = np.random.uniform(0, 0.1, mesh.size)
+    true = prism.magnetic_fields(xp, yp, zp, list(mesh), inc, dec,
+                                 susceptibility=susceptibility,
+                                 intensity=intensity)
+    res = prism.magnetic_fields(xp, yp, zp, mesh, inc, dec,
+                                susceptibility=susceptibility,
+                                intensity=intensity)
+    for t, r in zip(true, res):
+        assert_almost(r, t, 10)
+    raises(ValueError, prism.magnetic_fields, xp, yp, zp, model, inc, dec,
+           susceptibility=susceptibility)
+    raises(ValueError, prism.magnetic_fields, xp, yp, zp, model, inc, dec,
+           susceptibility=np.ones(4))
+    raises(ValueError, prism.magnetic_fields, xp, yp, zp, model, inc, dec,
+           magnetization=np.ones((4, 2)))
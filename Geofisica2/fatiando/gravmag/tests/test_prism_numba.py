@@ -0,0 +1,118 @@
+from __future__ import absolute_import
+import numpy as np
+from numpy.testing import assert_allclose
+
+from ...mesher import Prism, PrismMesh
+from .. import prism, _prism_numba
+from ... import utils, gridder
+
+
+def _model():
+    "A few prisms with density and magnetization"
+    model = [Prism(-500, 500, -1000, 1000, 200, 1200,
+                   {'density': 1000,
+                    'magnetization': utils.ang2vec(3, 25, -10)}),
+             Prism(-2000, -1500, 500, 1500, 0, 700,
+                   {'density': -500,
+                    'magnetization': utils.ang2vec(2, -30, 40)}),
+             None,
+             Prism(1000, 2000, -3000, -2000, 1000, 1500,
+                   {'density': 200})]
+    x, y, z = gridder.scatter((-5000, 5000, -5000, 5000), 150, z=-50,
+                              seed=0)
+    return x, y, z, model
+
+
+def _compare(func, monkeypatch):
+    "Run func with the Cython and the numba backends and compare"
+    cython = func()
+    monkeypatch.setattr(prism, '_prism', _prism_numba)
+    numba = func()
+    monkeypatch.undo()
+    if not isinstance(cython, list):
+        cython, numba = [cython], [numba]
+    for cy, nb in zip(cython, numba):
+        cy, nb = np.asarray(cy), np.asarray(nb)
+        assert_allclose(nb, cy, rtol=1e-8, atol=1e-10*np.abs(cy).max())
+
+
+def test_numba_fields(monkeypatch):
+    "gravmag.prism numba backend matches Cython for all fields"
+    x, y, z, model = _model()
+    inc, dec = -5, 20
+    for f in ['potential', 'gx', 'gy', 'gz', 'gxx', 'gxy', 'gxz', 'gyy',
+              'gyz', 'gzz']:
+        _compare(lambda: getattr(prism, f)(x, y, z, model), monkeypatch)
+        _compare(lambda: getattr(prism, f)(x, y, z, model, ratio=3),
+                 monkeypatch)
+    _compare(lambda: prism.tf(x, y, z, model, inc, dec), monkeypatch)
+    _compare(lambda: prism.tf(x, y, z, model, inc, dec, ratio=3),
+             monkeypatch)
+    for f in ['bx', 'by', 'bz']:
+        _compare(lambda: getattr(prism, f)(x, y, z, model), monkeypatch)
+    _compare(lambda: prism.fields(x, y, z, model, ['gzz', 'gx', 'potential']),
+             monkeypatch)
+    _compare(lambda: prism.magnetic_fields(x, y, z, model[:2], inc, dec,
+                                           susceptibility=[0.1, 0.01],
+                                           intensity=50000),
+             monkeypatch)
+
+
+def test_numba_fused_fields(monkeypatch):
+    "gravmag.prism.fields with numba matches the numba field functions"
+    x, y, z, model = _model()
+    # Include points aligned with the corners of the prisms to check the
+    # singularity treatment of gxy, gxz, and gyz
+    x = np.append(x, [-500, -500, 1000, 2000])
+    y = np.append(y, [-1000, 3000, -3000, -3000])
+    z = np.append(z, [-50, 1200, 1000, 1500])
+    monkeypatch.setattr(prism, '_prism', _prism_numba)
+    names = ['potential', 'gx', 'gy', 'gz', 'gxx', 'gxy', 'gxz', 'gyy',
+             'gyz', 'gzz']
+    for fields in [names, names[::-1], ['gyz'], ['gxy', 'gz']]:
+        fused = prism.fields(x, y, z, model, fields)
+        for f, result in zip(fields, fused):
+            single = getattr(prism, f)(x, y, z, model)
+            assert_allclose(result, single, rtol=1e-10,
+                            atol=1e-12*np.abs(single).max(), err_msg=f)
+
+
+def test_numba_mesh(monkeypatch):
+    "gravmag.prism numba backend matches Cython for meshes and matrices"
+    x, y, z, _ = _model()
+    mesh = PrismMesh((-3000, 3000, -3000, 3000, 100, 2100), (4, 5, 6))
+    mesh.addprop('density', np.linspace(-500, 500, mesh.size))
+    mesh.addprop('magnetization', [utils.ang2vec(1, 30, 10)]*mesh.size)
+    for f in ['gz', 'gxy', 'potential']:
+        _compare(lambda: getattr(prism, f)(x, y, z, mesh), monkeypatch)
+        _compare(lambda: prism.sensitivity(x, y, z, mesh, f,
+                                           dtype=np.float32),
+                 monkeypatch)
+    _compare(lambda: prism.sensitivity(x, y, z, mesh, 'tf', inc=20, dec=3),
+             monkeypatch)
+    residuals = np.sin(x/1000)
+    for f in ['gzz', 'tf']:
+        _compare(lambda: prism.jacobian_operator(
+            x, y, z, mesh, f, njobs=2, inc=20, dec=3).rmatvec(residuals),
+            monkeypatch)
+
+
+def test_numba_njobs(monkeypatch):
+    "gravmag.prism numba backend splits the points among njobs threads"
+    x, y, z, model = _model()
+    original = _prism_numba.gz
+    sizes = []
+
+    def gz(xp, *args):
+        "Record the number of points in each call"
+        sizes.append(xp.size)
+        return original(xp, *args)
+
+    monkeypatch.setattr(prism, '_prism', _prism_numba)
+    serial = prism.gz(x, y, z, model)
+    monkeypatch.setattr(_prism_numba, 'gz', gz)
+    for njobs in [1, 2, 3]:
+        sizes = []
+        assert_allclose(prism.gz(x, y, z, model, njobs=njobs), serial)
+        assert len(sizes) == njobs
+        assert sum(sizes) == x.size
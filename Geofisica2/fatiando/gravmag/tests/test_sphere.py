@@ -4,14 +4,15 @@ Includes regression tests comparing results against saved output.
 """
 from __future__ import absolute_import, division
 import os
+import time
 import numpy as np
 import numpy.testing as npt
 import pytest
 
 from ... import utils, gridder, constants
-from ...mesher import Sphere
+from ...mesher import Sphere, PointGrid
 from ...datasets import check_hash
-from .. import sphere
+from .. import sphere, _threads
 
 
 TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
@@ -130,3 +131,91 @@ def test_sphere_ignore_missing_prop(data, model):
         else:
             result = getattr(sphere, field)(x, y, z, model2)
         npt.assert_allclose(result, data[field], atol=1e-10, rtol=0)
+
+
+def test_sphere_fields(data, model):
+    "Sphere fields calculates all fields in one pass"
+    x, y, z = data['x'], data['y'], data['z']
+    inc, dec = data['inc'], data['dec']
+    results = sphere.fields(x, y, z, model, FIELDS, inc=inc, dec=dec)
+    for field, result in zip(FIELDS, results):
+        npt.assert_allclose(result, data[field], atol=1e-10, rtol=0)
+    with pytest.raises(ValueError):
+        sphere.fields(x, y, z, model, ['gz', 'bla'])
+    with pytest.raises(ValueError):
+        sphere.fields(x, y, z, model, ['tf'])
+
+
+def test_sphere_many_spheres():
+    "Sphere gives the sum of the spheres for models larger than a block"
+    np.random.seed(0)
+    model = [Sphere(x, y, 1000, 50, {'density': 1,
+                                     'magnetization': [1, -2, 3]})
+             for x, y in np.random.uniform(-5000, 5000, (1100, 2))]
+    x, y, z = gridder.scatter([-5000, 5000, -5000, 5000], 600, z=-10)
+    for field in FIELDS:
+        args = (30, -15) if field == 'tf' else ()
+        result = getattr(sphere, field)(x, y, z, model, *args)
+        true = sum(getattr(sphere, field)(x, y, z, [s], *args)
+                   for s in model)
+        npt.assert_allclose(result, true, rtol=1e-10,
+                            atol=1e-10*np.abs(true).max())
+
+
+def test_sphere_threads(monkeypatch, data, model):
+    "Sphere gives the same result when split among several threads"
+    x, y, z = data['x'], data['y'], data['z']
+    inc, dec = data['inc'], data['dec']
+    for accuracy in [None, 1e-3]:
+        monkeypatch.setattr(_threads, 'NJOBS', 1)
+        serial = sphere.fields(x, y, z, model, FIELDS, inc=inc, dec=dec,
+                               accuracy=accuracy)
+        monkeypatch.setattr(_threads, 'NJOBS', 3)
+        results = sphere.fields(x, y, z, model, FIELDS, inc=inc, dec=dec,
+                                accuracy=accuracy)
+        for result, true in zip(results, serial):
+            npt.assert_allclose(result, true, rtol=1e-12)
+
+
+def test_sphere_treecode():
+    "Sphere tree code is within the requested accuracy of the direct sum"
+    np.random.seed(1)
+    layer = PointGrid([-5000, 5000, -5000, 5000], 500, (60, 60))
+    layer.addprop('density', np.random.uniform(-1, 1, layer.size))
+    layer.addprop('magnetization', np.random.uniform(-1, 1, (layer.size, 3)))
+    # Also use a list of spheres with None elements
+    model = [None] + list(layer)
+    x, y, z = gridder.scatter([-6000, 6000, -6000, 6000], 500, z=-100)
+    true = sphere.fields(x, y, z, layer, FIELDS, inc=30, dec=-15)
+    for accuracy in [1e-2, 1e-4]:
+        for spheres in [layer, model]:
+            results = sphere.fields(x, y, z, spheres, FIELDS, inc=30,
+                                    dec=-15, accuracy=accuracy)
+            for result, field in zip(results, true):
+                npt.assert_allclose(result, field, rtol=0,
+                                    atol=accuracy*np.abs(field).max())
+    approx = sphere.gz(x, y, z, layer, dens=2, accuracy=1e-3)
+    true = sphere.gz(x, y, z, layer, dens=2)
+    npt.assert_allclose(approx, true, rtol=0, atol=1e-3*np.abs(true).max())
+    with pytest.raises(ValueError):
+        sphere.gz(x, y, z, layer, accuracy=0)
+
+
+def test_sphere_treecode_speed():
+    "Sphere tree code is faster than the direct sum for large models"
+    np.random.seed(2)
+    layer = PointGrid([-10000, 10000, -10000, 10000], 500, (300, 300))
+    layer.addprop('magnetization', np.random.uniform(-1, 1, (layer.size, 3)))
+    x, y, z = gridder.scatter([-10000, 10000, -10000, 10000], 5000, z=0)
+    # Compile the engines first
+    sphere.tf(x[:300], y[:300], z[:300], layer, 30, -15, accuracy=1e-3)
+    start = time.time()
+    true = sphere.tf(x, y, z, layer, 30, -15)
+    direct = time.time() - start
+    start = time.time()
+    approx = sphere.tf(x, y, z, layer, 30, -15, accuracy=1e-3)
+    tree = time.time() - start
+    assert tree < direct
+    # The error should be close to the accuracy (not much smaller)
+    error = np.abs(approx - true).max()/np.abs(true).max()
+    assert 1e-4 < error < 1e-3
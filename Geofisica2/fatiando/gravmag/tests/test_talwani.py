@@ -0,0 +1,90 @@
+"""
+Tests for the Talwani 2D polygon forward modeling.
+"""
+from __future__ import absolute_import, division
+import numpy as np
+import numpy.testing as npt
+
+from ...mesher import Polygon
+from ...constants import G, SI2MGAL
+from .. import talwani, _threads
+
+
+def regular_polygon(center, radius, nverts, props):
+    "Make a regular polygon with vertices given clockwise (z is down)"
+    angles = np.linspace(0, 2*np.pi, nverts, endpoint=False)
+    x = center[0] + radius*np.cos(angles)
+    z = center[1] + radius*np.sin(angles)
+    return Polygon(np.transpose([x, z]), props)
+
+
+def test_talwani_vs_cylinder():
+    "Talwani matches a horizontal cylinder outside of the polygon"
+    density, radius, nverts = 1000, 500, 100
+    cx, cz = 300, 1000
+    polygon = regular_polygon([cx, cz], radius, nverts, {'density': density})
+    # The field of the polygon outside of it is the same as that of a line
+    # mass with the same area
+    area = 0.5*nverts*radius**2*np.sin(2*np.pi/nverts)
+    # Keep the points from lining up with the vertices because the
+    # singularities are avoided by moving them by 1 cm
+    xp = np.linspace(-5000, 5000, 101) + 0.3
+    for zp in [np.zeros_like(xp), np.full_like(xp, 2000)]:
+        dx, dz = cx - xp, cz - zp
+        true = 2*G*density*area*dz/(dx**2 + dz**2)*SI2MGAL
+        npt.assert_allclose(talwani.gz(xp, zp, [polygon]), true, rtol=1e-10)
+        # The density can be overwritten
+        npt.assert_allclose(talwani.gz(xp, zp, [None, polygon], dens=-200),
+                            -0.2*true, rtol=1e-10)
+
+
+def test_talwani_edge_cache():
+    "The edge cache gives the same as gz while vertices change"
+    xp = np.linspace(-3000, 3000, 61)
+    zp = np.linspace(0, -100, 61)
+    cache = talwani.EdgeCache(xp, zp)
+    model = [regular_polygon([0, 1000], 500, 20, {'density': 500}),
+             Polygon([[-2000, 200], [-1000, 200], [-1500, 800]], {}),
+             regular_polygon([1500, 300], 200, 10, {'density': -300})]
+    npt.assert_allclose(cache.gz(model), talwani.gz(xp, zp, model),
+                        rtol=1e-12)
+    assert cache.updated == 30
+    # Move a vertex of the first polygon
+    model[0].x[3] += 100
+    model[0].y[3] -= 50
+    npt.assert_allclose(cache.gz(model), talwani.gz(xp, zp, model),
+                        rtol=1e-12)
+    assert cache.updated == 2
+    # Move the first vertex of the last polygon (wraps around)
+    model[2].x[0] += 30
+    npt.assert_allclose(cache.gz(model), talwani.gz(xp, zp, model),
+                        rtol=1e-12)
+    assert cache.updated == 2
+    # Use keys so that deleting a polygon doesn't recalculate the others
+    keys = ['a', 'b', 'c']
+    cache.gz(model, keys=keys)
+    npt.assert_allclose(cache.gz(model[1:], keys=keys[1:]),
+                        talwani.gz(xp, zp, model[1:]), rtol=1e-12)
+    assert cache.updated == 0
+    # Removing a vertex recalculates the whole polygon
+    smaller = Polygon(np.transpose([model[2].x[1:], model[2].y[1:]]),
+                      model[2].props)
+    npt.assert_allclose(cache.gz([smaller], keys=['c']),
+                        talwani.gz(xp, zp, [smaller]), rtol=1e-12)
+    assert cache.updated == 9
+
+
+def test_talwani_threads(monkeypatch):
+    "Talwani gives the same result when split among several threads"
+    xp = np.linspace(-3000, 3000, 61)
+    zp = np.linspace(0, -100, 61)
+    model = [regular_polygon([0, 1000], 500, 20, {'density': 500}),
+             regular_polygon([1500, 300], 200, 10, {'density': -300})]
+    serial = talwani.gz(xp, zp, model)
+    monkeypatch.setattr(_threads, 'NJOBS', 3)
+    npt.assert_allclose(talwani.gz(xp, zp, model), serial, rtol=1e-12)
+    cache = talwani.EdgeCache(xp, zp)
+    npt.assert_allclose(cache.gz(model), serial, rtol=1e-12)
+    model[0].x[3] += 100
+    npt.assert_allclose(cache.gz(model), talwani.gz(xp, zp, model),
+                        rtol=1e-12)
@@ -1,11 +1,16 @@
 from __future__ import division, absolute_import
 import numpy as np
+import scipy.sparse
 from numpy.testing import assert_array_almost_equal, assert_allclose
 from pytest import raises
 import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
 import warnings
 
-from .. import tesseroid
+from .. import tesseroid, _tesseroid_numba
 from ...mesher import Tesseroid, TesseroidMesh
 from ... import gridder
 from ...constants import SI2MGAL, SI2EOTVOS, G, MEAN_EARTH_RADIUS
@@ -93,6 +98,34 @@ def test_pool_as_argument():
             func(lon, lat, height, model, njobs=1, pool=pool)
 
 
+def test_fork_after_threads():
+    "gravmag.tesseroid threads don't stop a forked pool from exiting"
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return
+    script = '\n'.join([
+        "import multiprocessing",
+        "import numpy as np",
+        "from fatiando.gravmag import tesseroid",
+        "from fatiando.mesher import Tesseroid",
+        "model = [Tesseroid(0, 1, 0, 1, 2000, 0, {'density': 600})]",
+        "lon, lat = np.zeros(10), np.linspace(-1, 1, 10)",
+        "height = 1000*np.ones(10)",
+        "serial = tesseroid.gz(lon, lat, height, model, njobs=2)",
+        "pool = multiprocessing.get_context('fork').Pool(2)",
+        "pooled = tesseroid.gz(lon, lat, height, model, njobs=2, pool=pool)",
+        "pool.close()",
+        "pool.join()",
+        "assert np.allclose(serial, pooled)"])
+    # Run in a new interpreter because the hang happened on exit
+    root = os.path.abspath(os.path.join(os.path.dirname(tesseroid.__file__),
+                                        os.path.pardir, os.path.pardir))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [p for p in [env.get('PYTHONPATH')] if p])
+    subprocess.check_call([sys.executable, '-c', script], env=env,
+                          timeout=300)
+
+
 def test_ignore_zero_volume():
     "gravmag.tesseroid ignores tesseroids with 0 volume"
     props = dict(density=2000)
@@ -136,6 +169,147 @@ def test_serial_vs_parallel():
         assert_allclose(serial, parallel, err_msg="Mismatch for {}".format(f))
 
 
+def test_shared_pool():
+    "gravmag.tesseroid SharedPool gives same result as serial execution"
+    model = TesseroidMesh((-1, 1.5, -2, 2, 0, -10e3), (3, 2, 1))
+    model.addprop('density', 500*np.ones(model.size))
+    lon, lat, height = gridder.regular((-1, 1.5, -2, 2), (15, 21), z=150e3)
+    with tesseroid.SharedPool(njobs=3) as pool:
+        for f in 'potential gx gy gz gxx gxy gxz gyy gyz gzz'.split():
+            func = getattr(tesseroid, f)
+            serial = func(lon, lat, height, model)
+            shared = func(lon, lat, height, model, pool=pool)
+            assert_allclose(serial, shared,
+                            err_msg="Mismatch for {}".format(f))
+        # Changing the size of the points and the model, and the density
+        serial = tesseroid.gz(lon[:100], lat[:100], height[:100],
+                              list(model)[:4], dens=-200)
+        shared = tesseroid.gz(lon[:100], lat[:100], height[:100],
+                              list(model)[:4], dens=-200, pool=pool)
+        assert_allclose(serial, shared)
+    # A pool with a single worker
+    with tesseroid.SharedPool(njobs=1) as pool:
+        serial = tesseroid.fields(lon, lat, height, model, ['gz', 'gzz'])
+        shared = tesseroid.fields(lon, lat, height, model, ['gz', 'gzz'],
+                                  pool=pool)
+        assert_allclose(serial, shared)
+        assert_allclose(tesseroid.gx(lon, lat, height, model),
+                        tesseroid.gx(lon, lat, height, model, pool=pool))
+
+
+def test_shared_pool_set_model(monkeypatch):
+    "gravmag.tesseroid SharedPool only converts the model given once"
+    model = TesseroidMesh((-1, 1.5, -2, 2, 0, -10e3), (3, 2, 1))
+    model.addprop('density', 500*np.ones(model.size))
+    lon, lat, height = gridder.regular((-1, 1.5, -2, 2), (15, 21), z=150e3)
+    model_arrays = tesseroid._model_arrays
+    calls = []
+
+    def counted(*args, **kwargs):
+        calls.append(args)
+        return model_arrays(*args, **kwargs)
+
+    monkeypatch.setattr(tesseroid, '_model_arrays', counted)
+    with tesseroid.SharedPool(njobs=2) as pool:
+        pool.set_model(model)
+        for z in [150e3, 300e3]:
+            height = z*np.ones_like(lon)
+            assert_allclose(tesseroid.gz(lon, lat, height, model),
+                            tesseroid.gz(lon, lat, height, model, pool=pool))
+        # Only set_model and the serial calls converted the model
+        assert len(calls) == 3
+        # Change the model and the points in place
+        model.props['density'] = -200*np.ones(model.size)
+        lon += 0.5
+        pool.set_model(model)
+        assert_allclose(tesseroid.gz(lon, lat, height, model),
+                        tesseroid.gz(lon, lat, height, model, pool=pool))
+        # Other models are converted on every call
+        assert_allclose(tesseroid.gz(lon, lat, height, model, dens=10),
+                        tesseroid.gz(lon, lat, height, model, dens=10,
+                                     pool=pool))
+        assert_allclose(tesseroid.gz(lon, lat, height, model),
+                        tesseroid.gz(lon, lat, height, model, pool=pool))
+        assert len(calls) == 9
+
+
+def test_array_model():
+    "gravmag.tesseroid gives same result for list and array models"
+    model = TesseroidMesh((-1, 1.5, -2, 2, 0, -10e3), (3, 2, 1))
+    density = np.linspace(-500, 500, model.size)
+    model.addprop('density', density)
+    bounds = np.array([t.get_bounds() for t in model])
+    # Add a tesseroid that is too small and should be ignored
+    bounds = np.vstack([bounds, [0, 1e-7, 0, 1, 0, -1000]])
+    density = np.hstack([density, 1000])
+    lon, lat, height = gridder.regular((-1, 1.5, -2, 2), (15, 21), z=150e3)
+    for f in 'potential gx gy gz gxx gxy gxz gyy gyz gzz'.split():
+        func = getattr(tesseroid, f)
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            array = func(lon, lat, height, bounds, dens=density)
+        assert len(w) == 1
+        assert_allclose(func(lon, lat, height, model), array,
+                        err_msg="Mismatch for {}".format(f))
+    assert_allclose(tesseroid.gz(lon, lat, height, model, dens=100),
+                    tesseroid.gz(lon, lat, height, bounds[:-1], dens=100))
+    raises(AssertionError, tesseroid.gz, lon, lat, height, bounds)
+    raises(AssertionError, tesseroid.gz, lon, lat, height, bounds[:, :4],
+           dens=density)
+
+
+def test_fields():
+    "gravmag.tesseroid.fields gives same results as separate functions"
+    model = TesseroidMesh((-1, 1.5, -2, 2, 0, -10e3), (3, 2, 1))
+    model.addprop('density', np.linspace(-500, 500, model.size))
+    lon, lat, height = gridder.regular((-1, 1.5, -2, 2), (15, 21), z=150e3)
+    names = 'potential gx gy gz gxx gxy gxz gyy gyz gzz'.split()
+    for njobs in [1, 2]:
+        results = tesseroid.fields(lon, lat, height, model, names,
+                                   njobs=njobs)
+        for f, result in zip(names, results):
+            separate = getattr(tesseroid, f)(lon, lat, height, model,
+                                             ratio=tesseroid.RATIO_GG)
+            assert_allclose(separate, result,
+                            err_msg="Mismatch for {}".format(f))
+    gx, gz = tesseroid.fields(lon, lat, height, model, ['gx', 'gz'],
+                              dens=100, ratio=2)
+    assert_allclose(gx, tesseroid.gx(lon, lat, height, model, dens=100,
+                                     ratio=2))
+    assert_allclose(gz, tesseroid.gz(lon, lat, height, model, dens=100,
+                                     ratio=2))
+    raises(AssertionError, tesseroid.fields, lon, lat, height, model,
+           ['gz', 'bla'])
+
+
+def test_global_grid():
+    "gravmag.tesseroid.global_grid gives same results as fields"
+    model = TesseroidMesh((0, 360, -90, 90, 0, -50e3), (2, 6, 12))
+    model.addprop('density', np.linspace(-500, 500, model.size))
+    model.mask.extend([3, 20, 50])
+    lon = np.arange(0, 360, 30) + 10
+    lat = np.array([-60, -10, 0, 35, 80])
+    height = 250e3
+    glon, glat = np.meshgrid(lon, lat)
+    gheight = height*np.ones(glon.size)
+    names = ['potential', 'gx', 'gz', 'gyz', 'gzz']
+    for dens in [None, 200]:
+        grids = tesseroid.global_grid(lon, lat, height, model, names,
+                                      dens=dens)
+        results = tesseroid.fields(glon.ravel(), glat.ravel(), gheight, model,
+                                   names, dens=dens)
+        for f, grid, result in zip(names, grids, results):
+            assert grid.shape == (lat.size, lon.size)
+            assert_allclose(grid.ravel(), result, atol=1e-10,
+                            err_msg="Mismatch for {}".format(f))
+    raises(AssertionError, tesseroid.global_grid, lon[:-1], lat, height,
+           model, ['gz'])
+    regional = TesseroidMesh((0, 180, -90, 90, 0, -50e3), (2, 6, 12))
+    regional.addprop('density', np.ones(regional.size))
+    raises(AssertionError, tesseroid.global_grid, lon, lat, height,
+           regional, ['gz'])
+
+
 def test_fails_if_shape_mismatch():
     'gravmag.tesseroid fails if given computation points with different shapes'
     model = [Tesseroid(0, 1, 0, 1, 1000, -20000, {'density': 2670})]
@@ -269,22 +443,226 @@ def test_laplace_equation():
                                   % (str(tess), np.abs(trace).max()))
 
 
-def test_stack_overflow():
-    "gravmag.tesseroid raises exceptions on stack overflow"
+def test_stack_grows():
+    "gravmag.tesseroid grows the discretization stack instead of overflowing"
     model = [Tesseroid(0, 1, 0, 1, 0, -20e4, {'density': 2600})]
     area = [0, 1, 0, 1]
-    shape = [20, 20]
+    shape = [4, 4]
     lon, lat, h = gridder.regular(area, shape, z=1000)
     fields = 'potential gx gy gz gxx gxy gxz gyy gyz gzz'.split()
     backup = tesseroid.STACK_SIZE
-    tesseroid.STACK_SIZE = 5
-    for f in fields:
-        raises(OverflowError, getattr(tesseroid, f), lon, lat, h, model)
-    # Check if overflows on normal queue size when trying to calculated on top
-    # of the tesseroid
-    tesseroid.STACK_SIZE = 20
-    lon, lat, h = np.array([0.5]), np.array([0.5]), np.array([0])
-    for f in fields:
-        raises(OverflowError, getattr(tesseroid, f), lon, lat, h, model)
-    # Restore the module default queue size
-    tesseroid.STACK_SIZE = backup
+    try:
+        # One field of each kernel family is enough to test the small stack
+        for f in ['potential', 'gz', 'gzz']:
+            stats = {}
+            default = getattr(tesseroid, f)(lon, lat, h, model, stats=stats)
+            assert stats['max_stack_depth'] > 5
+            tesseroid.STACK_SIZE = 5
+            for njobs in [1, 2]:
+                small = {}
+                result = getattr(tesseroid, f)(lon, lat, h, model,
+                                               njobs=njobs, stats=small)
+                assert_allclose(default, result,
+                                err_msg="Mismatch for {}".format(f))
+                assert small == stats
+            tesseroid.STACK_SIZE = backup
+        # Calculating on top of the tesseroid needs a deep stack
+        tesseroid.STACK_SIZE = 20
+        lon, lat, h = np.array([0.5]), np.array([0.5]), np.array([0])
+        for f in fields:
+            stats = {}
+            with warnings.catch_warnings(record=True):
+                result = getattr(tesseroid, f)(lon, lat, h, model,
+                                               stats=stats)
+            assert np.all(np.isfinite(result))
+            assert stats['max_stack_depth'] > 20
+    finally:
+        tesseroid.STACK_SIZE = backup
+
+
+def test_stats():
+    "gravmag.tesseroid reports the kernel evaluations in stats"
+    model = [Tesseroid(0, 1, 0, 1, 0, -20e3, {'density': 2600}),
+             Tesseroid(1, 2, 0, 1, 0, -20e3, {'density': 2600})]
+    lon, lat, h = gridder.regular([0, 2, 0, 1], [5, 5], z=1e6)
+    stats = {}
+    tesseroid.gz(lon, lat, h, model, stats=stats)
+    # Far from the model the tesseroids aren't divided
+    assert stats == {'max_stack_depth': 0, 'kernel_evaluations': 400}
+    tesseroid.fields(lon, lat, h, model, ['gx', 'gz'], stats=stats)
+    assert stats['kernel_evaluations'] == 800
+    lon, lat, h = gridder.regular([0, 2, 0, 1], [5, 5], z=1e3)
+    evaluations = []
+    for ratio in [1, 2, 4]:
+        tesseroid.gz(lon, lat, h, model, ratio=ratio, stats=stats)
+        evaluations.append(stats['kernel_evaluations'])
+        pool = multiprocessing.Pool(2)
+        pooled = {}
+        tesseroid.gz(lon, lat, h, model, ratio=ratio, njobs=2, pool=pool,
+                     stats=pooled)
+        pool.close()
+        pool.join()
+        assert pooled == stats
+    assert evaluations[0] < evaluations[1] < evaluations[2]
+
+
+def test_max_order():
+    "gravmag.tesseroid higher GLQ orders keep the accuracy with less work"
+    model = TesseroidMesh((0, 360, -90, 90, 0, -10e3), (1, 6, 12))
+    model.addprop('density', 1000*np.ones(model.size))
+    lon, lat, height = gridder.regular((0, model.dims[0], 0, model.dims[1]),
+                                       (10, 10), z=2000)
+    shell = calc_shell_effect(2000, 0, -10e3, 1000)
+    for f in ['potential', 'gz', 'gzz']:
+        default, adaptive = {}, {}
+        tess = getattr(tesseroid, f)(lon, lat, height, model, stats=default)
+        for max_order in [3, 5, 8]:
+            tess = getattr(tesseroid, f)(lon, lat, height, model,
+                                         max_order=max_order, stats=adaptive)
+            diff = 100*np.abs(shell[f] - tess)/np.abs(shell[f])
+            assert diff.max() < 0.1, "diff > 0.1% for {} order {}: {}".format(
+                f, max_order, diff.max())
+            assert (adaptive['kernel_evaluations'] <=
+                    default['kernel_evaluations'])
+        if f == 'gzz':
+            assert (adaptive['kernel_evaluations'] <
+                    default['kernel_evaluations']/2)
+    # Close to a large tesseroid, compare with a much finer discretization
+    model = [Tesseroid(0, 1, 0, 1, 0, -20e3, {'density': 2600})]
+    lon, lat, h = gridder.regular([-0.5, 1.5, -0.5, 1.5], [6, 6], z=500)
+    ratios = dict(gz=tesseroid.RATIO_G, gxz=tesseroid.RATIO_GG,
+                  gzz=tesseroid.RATIO_GG)
+    for f, ratio in ratios.items():
+        func = getattr(tesseroid, f)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            reference = func(lon, lat, h, model, ratio=6*ratio)
+            default = func(lon, lat, h, model)
+        scale = np.abs(reference).max()
+        default = np.abs(default - reference).max()/scale
+        for max_order in [4, 8]:
+            tess = func(lon, lat, h, model, max_order=max_order)
+            diff = np.abs(tess - reference).max()/scale
+            assert diff < 1e-3 and diff < 2*default, \
+                "error {} (2-point {}) for {} order {}".format(
+                    diff, default, f, max_order)
+    lon, lat, h = gridder.regular([-1, 2, -1, 2], [10, 10], z=10e3)
+    serial = tesseroid.gzz(lon, lat, h, model, max_order=6)
+    pool = multiprocessing.Pool(2)
+    pooled = tesseroid.gzz(lon, lat, h, model, max_order=6, njobs=2,
+                           pool=pool)
+    pool.close()
+    pool.join()
+    assert_allclose(serial, pooled)
+    with tesseroid.SharedPool(2) as pool:
+        shared = tesseroid.gzz(lon, lat, h, model, max_order=6, pool=pool)
+    assert_allclose(serial, shared)
+    threads = tesseroid.gzz(lon, lat, h, model, max_order=6, njobs=2)
+    assert_allclose(serial, threads)
+    for max_order in [1, 9]:
+        raises(AssertionError, tesseroid.gzz, lon, lat, h, model,
+               max_order=max_order)
+
+
+def test_stream():
+    "gravmag.tesseroid.stream writes the fields to disk and resumes"
+    model = TesseroidMesh((-1, 1.5, -2, 2, 0, -10e3), (3, 2, 1))
+    model.addprop('density', np.linspace(-500, 500, model.size))
+    lon, lat, height = gridder.regular((-1, 1.5, -2, 2), (15, 21), z=150e3)
+    names = ['gz', 'gxy', 'potential']
+    expected = np.transpose(tesseroid.fields(lon, lat, height, model, names))
+    fname = os.path.join(tempfile.mkdtemp(), 'fields.npy')
+    progress = tesseroid.stream(lon, lat, height, model, names, fname,
+                                chunk_size=50)
+    # Simulate a crash after the first 3 chunks
+    for i, info in zip(range(3), progress):
+        assert info['chunk'] == i
+        assert info['done'] == 50*(i + 1)
+    progress.close()
+    partial = np.load(fname)
+    assert_allclose(partial[:150], expected[:150])
+    assert np.all(np.isnan(partial[150:]))
+    # Also lose a row of one of the finished chunks
+    out = np.lib.format.open_memmap(fname, mode='r+')
+    out[60] = np.nan
+    del out
+    resumed = list(tesseroid.stream(lon, lat, height, model, names, fname,
+                                    chunk_size=50))
+    assert [info['chunk'] for info in resumed] == [1, 3, 4, 5, 6]
+    assert resumed[-1]['done'] == resumed[-1]['size'] == lon.size
+    assert resumed[-1]['nchunks'] == 7
+    assert_allclose(np.load(fname), expected)
+    raises(ValueError, list, tesseroid.stream(lon, lat, height, model,
+                                              ['gz'], fname))
+
+
+def test_sensitivity():
+    "gravmag.tesseroid.sensitivity columns are the fields of each tesseroid"
+    model = TesseroidMesh((-1, 1.5, -2, 2, 0, -10e3), (2, 2, 2))
+    model.mask.append(3)
+    lon, lat, height = gridder.regular((-1, 1.5, -2, 2), (7, 9), z=50e3)
+    for f in ['potential', 'gx', 'gz', 'gyz', 'gzz']:
+        func = getattr(tesseroid, f)
+        jac = tesseroid.sensitivity(lon, lat, height, model, f)
+        assert jac.shape == (lon.size, model.size)
+        for j, tess in enumerate(model):
+            if j == 3:
+                assert np.all(jac[:, j] == 0)
+                continue
+            assert_allclose(jac[:, j], func(lon, lat, height, [tess], dens=1),
+                            err_msg="Mismatch for {} column {}".format(f, j))
+        parallel = tesseroid.sensitivity(lon, lat, height, model, f, njobs=3)
+        assert_allclose(jac, parallel)
+        single = tesseroid.sensitivity(lon, lat, height, model, f,
+                                       dtype=np.float32)
+        assert single.dtype == np.float32
+        assert_allclose(jac, single, rtol=1e-5, atol=1e-5*np.abs(jac).max())
+    # Write to a memory mapped array
+    out = np.memmap(tempfile.TemporaryFile(), mode='w+', dtype=np.float32,
+                    shape=(lon.size, model.size))
+    result = tesseroid.sensitivity(lon, lat, height, model, 'gz', out=out)
+    assert result is out
+    jac = tesseroid.sensitivity(lon, lat, height, model, 'gz')
+    assert_allclose(out, jac, rtol=1e-5, atol=1e-5*np.abs(jac).max())
+    raises(ValueError, tesseroid.sensitivity, lon, lat, height, model, 'gz',
+           out=np.empty((3, 3)))
+    raises(AssertionError, tesseroid.sensitivity, lon, lat, height, model,
+           'bla')
+
+
+def test_sensitivity_sparse():
+    "gravmag.tesseroid.sensitivity drops small elements with threshold"
+    model = TesseroidMesh((0, 360, -90, 90, 0, -10e3), (1, 6, 12))
+    lon, lat, height = gridder.regular((0, 360, -80, 80), (10, 13), z=10e3)
+    dense = tesseroid.sensitivity(lon, lat, height, model, 'gzz')
+    sparse = tesseroid.sensitivity(lon, lat, height, model, 'gzz',
+                                   threshold=0.01)
+    assert scipy.sparse.isspmatrix_csr(sparse)
+    assert sparse.shape == dense.shape
+    largest = np.abs(dense).max(axis=1)
+    keep = np.abs(dense) >= 0.01*largest[:, None]
+    assert sparse.nnz == keep.sum() < dense.size/2
+    assert_allclose(sparse.toarray(), np.where(keep, dense, 0))
+    single = tesseroid.sensitivity(lon, lat, height, model, 'gzz',
+                                   threshold=0.01, dtype=np.float32, njobs=2)
+    assert single.dtype == np.float32
+    assert_allclose(single.toarray(), sparse.toarray(), rtol=1e-5,
+                    atol=1e-5*largest.max())
+    raises(ValueError, tesseroid.sensitivity, lon, lat, height, model, 'gz',
+           threshold=0.1, out=dense)
+
+
+def test_warm_up():
+    "gravmag.tesseroid.warm_up compiles or loads the cached engines"
+    for name in ['engine', 'sensitivity_engine']:
+        assert getattr(_tesseroid_numba, name)._cache is not None
+    report = tesseroid.warm_up()
+    assert sorted(report) == ['cache_path', 'engine', 'sensitivity_engine']
+    for name in ['engine', 'sensitivity_engine']:
+        seconds, source = report[name]
+        assert seconds >= 0
+        assert source in ['compiled', 'cache', 'memory']
+    # Everything is in memory on the second call
+    report = tesseroid.warm_up()
+    for name in ['engine', 'sensitivity_engine']:
+        assert report[name][1] == 'memory'
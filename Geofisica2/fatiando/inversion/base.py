@@ -35,10 +35,12 @@ from future.utils import with_metaclass
 from future.builtins import super, object, range, isinstance, zip, map
 import hashlib
 import copy
+from functools import reduce
 from abc import ABCMeta, abstractmethod
 import numpy as np
 
 from . import optimization
+from ..utils import safe_add
 
 
 class OperatorMixin(object):
@@ -509,7 +511,8 @@ class MultiObjective(OptimizerMixin, OperatorMixin):
             The sum of the hessians of the components.
 
         """
-        return self.regul_param*sum(obj.hessian(p) for obj in self)
+        return self.regul_param*reduce(safe_add,
+                                       (obj.hessian(p) for obj in self))
 
 
 class CachedMethod(object):
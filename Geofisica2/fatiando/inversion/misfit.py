@@ -59,6 +59,13 @@ class Misfit(OptimizerMixin, OperatorMixin):
     solving the same problem with different methods or using an iterative
     method doesn't have the penalty of recalculating the Jacobian.
 
+    The Jacobian can also be a :class:`scipy.sparse.linalg.LinearOperator`
+    (e.g., from :func:`fatiando.gravmag.prism.jacobian_operator`) for problems
+    where the matrix doesn't fit in memory. In this case, the Hessian will
+    also be a ``LinearOperator`` and :math:`\bar{\bar{J}}^T\bar{\bar{J}}` is
+    never formed. The gradient solvers will skip the Jacobi preconditioning
+    because the diagonal of the Hessian is not available.
+
     .. warning::
 
         When subclassing, be careful not to set the following attributes:
@@ -243,15 +250,15 @@ class Misfit(OptimizerMixin, OperatorMixin):
 
         Returns:
 
-        * hessian : 2d-array
-            The Hessian matrix
+        * hessian : 2d-array or LinearOperator
+            The Hessian matrix. A LinearOperator if the Jacobian is one.
 
         """
         jacobian = self.jacobian(p)
         if self.weights is None:
             hessian = safe_dot(jacobian.T, jacobian)
         else:
-            hessian = safe_dot(jacobian.T, self.weights*jacobian)
+            hessian = safe_dot(jacobian.T, safe_dot(self.weights, jacobian))
         hessian *= 2*self.regul_param
         return hessian
 
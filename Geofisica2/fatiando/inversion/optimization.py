@@ -44,8 +44,9 @@ import copy
 import warnings
 import numpy
 import scipy.sparse
+import scipy.sparse.linalg
 
-from ..utils import safe_solve, safe_diagonal, safe_dot
+from ..utils import safe_solve, safe_diagonal, safe_dot, safe_add
 
 
 def linear(hessian, gradient, precondition=True):
@@ -64,12 +65,15 @@ def linear(hessian, gradient, precondition=True):
 
     Parameters:
 
-    * hessian : 2d-array
-        The Hessian matrix of the objective function.
+    * hessian : 2d-array or LinearOperator
+        The Hessian matrix of the objective function. Can be a
+        :class:`scipy.sparse.linalg.LinearOperator` for matrix-free problems,
+        in which case the system is solved iteratively.
     * gradient : 1d-array
         The gradient vector of the objective function.
     * precondition : True or False
-        If True, will use Jacobi preconditioning.
+        If True, will use Jacobi preconditioning. Ignored if the Hessian is a
+        LinearOperator that doesn't provide its diagonal.
 
     Yields:
 
@@ -85,7 +89,7 @@ def linear(hessian, gradient, precondition=True):
     will only have the method name.
 
     """
-    if precondition:
+    if precondition and _has_diagonal(hessian):
         diag = numpy.abs(safe_diagonal(hessian))
         diag[diag < 10 ** -10] = 10 ** -10
         precond = scipy.sparse.diags(1. / diag, 0).tocsr()
@@ -164,7 +168,7 @@ def newton(hessian, gradient, value, initial, maxit=30, tol=10 ** -5,
     for iteration in range(maxit):
         hess = hessian(p)
         grad = gradient(p)
-        if precondition:
+        if precondition and _has_diagonal(hess):
             diag = numpy.abs(safe_diagonal(hess))
             diag[diag < 10 ** -10] = 10 ** -10
             precond = scipy.sparse.diags(1. / diag, 0).tocsr()
@@ -254,16 +258,26 @@ def levmarq(hessian, gradient, value, initial, maxit=30, maxsteps=20, lamb=10,
     for iteration in range(maxit):
         hess = hessian(p)
         minus_gradient = -gradient(p)
-        if precondition:
+        if precondition and _has_diagonal(hess):
             diag = numpy.abs(safe_diagonal(hess))
             diag[diag < 10 ** -10] = 10 ** -10
             precond = scipy.sparse.diags(1. / diag, 0).tocsr()
             hess = safe_dot(precond, hess)
             minus_gradient = safe_dot(precond, minus_gradient)
         stagnation = True
-        diag = scipy.sparse.diags(safe_diagonal(hess), 0).tocsr()
+        if _has_diagonal(hess):
+            diag = scipy.sparse.diags(safe_diagonal(hess), 0).tocsr()
+        else:
+            # Matrix-free Hessian. Damp the step with the identity instead,
+            # scaled by the curvature of the Hessian along the gradient.
+            norm = numpy.linalg.norm(minus_gradient)**2
+            scale = 1
+            if norm > 0:
+                scale = abs(numpy.dot(minus_gradient,
+                                      safe_dot(hess, minus_gradient)))/norm
+            diag = scale*scipy.sparse.identity(p.size).tocsr()
         for step in range(maxsteps):
-            newp = p + safe_solve(hess + lamb * diag, minus_gradient)
+            newp = p + safe_solve(safe_add(hess, lamb * diag), minus_gradient)
             newmisfit = value(newp)
             if newmisfit >= misfit:
                 if lamb < 10 ** 15:
@@ -570,3 +584,15 @@ def acor(value, bounds, nparams, nants=None, archive_size=None, maxit=1000,
         stats['objective'].append(trail[0])
         stats['iterations'] += 1
         yield iteration, archive[0], copy.deepcopy(stats)
+
+
+def _has_diagonal(hessian):
+    """
+    Check if the diagonal of the Hessian is available for preconditioning.
+
+    Matrix-free Hessians (:class:`scipy.sparse.linalg.LinearOperator`) only
+    have it if they implement a ``diagonal`` method.
+    """
+    if isinstance(hessian, scipy.sparse.linalg.LinearOperator):
+        return hasattr(hessian, 'diagonal')
+    return True
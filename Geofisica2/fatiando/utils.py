@@ -45,7 +45,8 @@ def safe_solve(matrix, vector):
     Uses the standard :func:`numpy.linalg.solve` if both *matrix* and *vector*
     are dense.
 
-    If any of the two is sparse (from :mod:`scipy.sparse`) then will use the
+    If any of the two is sparse (from :mod:`scipy.sparse`) or *matrix* is a
+    :class:`scipy.sparse.linalg.LinearOperator` then will use the
     Conjugate Gradient Method (:func:`scipy.sparse.cgs`).
 
     Parameters:
@@ -62,7 +63,8 @@ def safe_solve(matrix, vector):
 
 
     """
-    if scipy.sparse.issparse(matrix) or scipy.sparse.issparse(vector):
+    if (scipy.sparse.issparse(matrix) or scipy.sparse.issparse(vector) or
+            _is_operator(matrix)):
         estimate, status = scipy.sparse.linalg.cgs(matrix, vector)
         if status >= 0:
             return estimate
@@ -78,6 +80,9 @@ def safe_dot(a, b):
 
     If *a* and *b* are dense, will use :func:`numpy.dot`. If either is sparse
     (from :mod:`scipy.sparse`) will use the multiplication operator (i.e., \*).
+    If either is a :class:`scipy.sparse.linalg.LinearOperator`, the product
+    is a matrix-vector product or, for two matrices, a new operator (the
+    matrices are never formed).
 
     Parameters:
 
@@ -90,6 +95,10 @@ def safe_dot(a, b):
         The dot product of *a* and *b*
 
     """
+    if _is_operator(a) or _is_operator(b):
+        if _is_operator(b):
+            return scipy.sparse.linalg.aslinearoperator(a) * b
+        return scipy.sparse.linalg.aslinearoperator(a).dot(b)
     if scipy.sparse.issparse(a) or scipy.sparse.issparse(b):
         return a * b
     else:
@@ -105,18 +114,60 @@ def safe_diagonal(matrix):
     * matrix : 2d-array, matrix, sparse matrix
         The matrix...
 
+    .. note:: The diagonal of a :class:`scipy.sparse.linalg.LinearOperator`
+        is only available if it has a ``diagonal`` method. Otherwise, will
+        raise a ``ValueError``.
+
     Returns:
 
     * diag : 1d-array
         A numpy array with the diagonal of the matrix
 
     """
+    if _is_operator(matrix):
+        if not hasattr(matrix, 'diagonal'):
+            raise ValueError(
+                "Can't get the diagonal of a LinearOperator without forming "
+                "the matrix.")
+        return numpy.array(matrix.diagonal())
     if scipy.sparse.issparse(matrix):
         return numpy.array(matrix.diagonal())
     else:
         return numpy.diagonal(matrix).copy()
 
 
+def safe_add(a, b):
+    """
+    Add two matrices using the appropriate method.
+
+    If either is a :class:`scipy.sparse.linalg.LinearOperator`, the sum is a
+    new operator (the matrices are never formed). Otherwise, uses the ``+``
+    operator.
+
+    Parameters:
+
+    * a, b : array, matrix, sparse matrix, or LinearOperator
+        The matrices to add.
+
+    Returns:
+
+    * sum : array, matrix, or LinearOperator
+        The sum of *a* and *b*
+
+    """
+    if _is_operator(a) or _is_operator(b):
+        return (scipy.sparse.linalg.aslinearoperator(a) +
+                scipy.sparse.linalg.aslinearoperator(b))
+    return a + b
+
+
+def _is_operator(matrix):
+    """
+    Check if *matrix* is a :class:`scipy.sparse.linalg.LinearOperator`.
+    """
+    return isinstance(matrix, scipy.sparse.linalg.LinearOperator)
+
+
 def sph2cart(lon, lat, height):
     """
     Convert spherical coordinates to Cartesian geocentric coordinates.